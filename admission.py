@@ -0,0 +1,290 @@
+"""
+Admission control and fair scheduling of upstream calls.
+At most ADMISSION_MAX_INFLIGHT requests talk to the gateway at once; the rest wait
+in a bounded queue for up to ADMISSION_QUEUE_TIMEOUT seconds. When the queue is
+full, or the wait times out, the request is shed with a 503 and Retry-After
+instead of piling up connections and coroutines.
+
+Each client key is a tenant with its own `max_concurrency`, `priority` and `weight`.
+A free slot goes to the highest-priority tenant with a request waiting; tenants of the
+same priority share slots in proportion to their weight (weighted fair queuing on
+virtual finish times), so one busy key cannot starve the others. Requests held back only
+by their own key's max_concurrency wait in that key's queue and do not take places in the
+shared one, so a capped key cannot crowd other tenants out of the queue.
+"""
+
+import os
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from database import APIKey
+from metrics import ADMISSION_WAIT, ADMISSION_REJECTED
+
+# === Configuration ===
+# Upstream requests in flight at once (streams count until their last chunk); 0 = unlimited
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "256"))
+# Requests allowed to wait for a slot; beyond this they are rejected immediately
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "512"))
+# Requests one client key may have waiting for its own max_concurrency (outside the shared queue)
+ADMISSION_KEY_QUEUE_SIZE = int(os.getenv("ADMISSION_KEY_QUEUE_SIZE", "64"))
+# Seconds a request may wait for a slot
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Retry-After (seconds) sent with shed requests
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+
+
+class AdmissionRejected(Exception):
+    """
+    The request was shed. `reason` is "queue_full" or "timeout" when the proxy is at
+    capacity, or "concurrency" when the client key's own max_concurrency kept it waiting.
+    """
+
+    def __init__(self, reason: str, retry_after: int = ADMISSION_RETRY_AFTER, limit: int = 0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.limit = limit
+
+
+class Tenant:
+    """Scheduling state of one client key."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.max_concurrency = 0
+        self.priority = 0
+        self.weight = 1
+        self.inflight = 0
+        # Virtual finish time of this tenant's latest request
+        self.finish = 0.0
+        # (virtual start, virtual finish, future) per waiting request, oldest first
+        self.waiters: deque[tuple[float, float, asyncio.Future]] = deque()
+
+    def has_room(self) -> bool:
+        return self.max_concurrency <= 0 or self.inflight < self.max_concurrency
+
+    def room(self) -> Optional[int]:
+        """Requests the key's own limit still lets through, or None without a limit."""
+        if self.max_concurrency <= 0:
+            return None
+        return max(0, self.max_concurrency - self.inflight)
+
+    def waiting_for_slot(self) -> int:
+        """Waiters that only need a free upstream slot; the rest wait for the key's own concurrency."""
+        room = self.room()
+        return len(self.waiters) if room is None else min(len(self.waiters), room)
+
+
+class AdmissionController:
+    """A counting semaphore with a bounded, time-limited wait queue shared fairly between tenants."""
+
+    def __init__(
+        self,
+        max_inflight: int = ADMISSION_MAX_INFLIGHT,
+        queue_size: int = ADMISSION_QUEUE_SIZE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+        key_queue_size: int = ADMISSION_KEY_QUEUE_SIZE
+    ):
+        self.max_inflight = max_inflight
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.key_queue_size = key_queue_size
+        self.inflight = 0
+        # All waiting requests, including those held back by their own key's limit
+        self.queue_depth = 0
+        # Tenants with requests in flight or waiting
+        self._tenants: dict[str, Tenant] = {}
+        # Virtual time: start of the last request granted a slot
+        self._vclock = 0.0
+        self.admitted = 0
+        self.rejected = 0
+
+    def _has_slot(self) -> bool:
+        return self.max_inflight <= 0 or self.inflight < self.max_inflight
+
+    def _tenant(self, api_key: Optional[APIKey]) -> Tenant:
+        key = api_key.id if api_key else ""
+        tenant = self._tenants.get(key)
+        if tenant is None:
+            tenant = self._tenants[key] = Tenant(key)
+            # A tenant that was idle starts at the current virtual time instead of banking credit
+            tenant.finish = self._vclock
+        if api_key:
+            tenant.max_concurrency = api_key.max_concurrency
+            tenant.priority = api_key.priority
+            tenant.weight = max(1, api_key.weight)
+        return tenant
+
+    def _tag(self, tenant: Tenant) -> tuple[float, float]:
+        """Virtual start and finish times for a new request, fixed when it arrives."""
+        start = max(self._vclock, tenant.finish)
+        tenant.finish = start + 1 / tenant.weight
+        return start, tenant.finish
+
+    def _grant(self, tenant: Tenant, start: float):
+        self._vclock = max(self._vclock, start)
+        tenant.inflight += 1
+        self.inflight += 1
+
+    def _dispatch(self):
+        """Hand free slots to waiting tenants: highest priority first, then smallest virtual finish."""
+        while self.queue_depth and self._has_slot():
+            best = None
+            for tenant in self._tenants.values():
+                if tenant.waiters and tenant.has_room():
+                    rank = (-tenant.priority, tenant.waiters[0][1])
+                    if best is None or rank < best[0]:
+                        best = (rank, tenant)
+            if best is None:
+                return
+            tenant = best[1]
+            start, _, waiter = tenant.waiters.popleft()
+            self.queue_depth -= 1
+            self._grant(tenant, start)
+            waiter.set_result(None)
+
+    def _forget_if_idle(self, tenant: Tenant):
+        if not tenant.inflight and not tenant.waiters and self._tenants.get(tenant.key) is tenant:
+            del self._tenants[tenant.key]
+
+    async def acquire(self, api_key: Optional[APIKey] = None) -> Tenant:
+        """
+        Take an upstream slot for `api_key`, waiting in the queue if none is free.
+        Returns the ticket to pass to release()/hold(). Raises AdmissionRejected.
+        """
+        tenant = self._tenant(api_key)
+        if self._has_slot() and tenant.has_room() and not tenant.waiters:
+            self._grant(tenant, self._tag(tenant)[0])
+            self.admitted += 1
+            return tenant
+
+        # A request the key's own limit would hold back anyway waits in the key's queue
+        room = tenant.room()
+        if room is not None and len(tenant.waiters) >= room:
+            if len(tenant.waiters) - room >= self.key_queue_size:
+                self._forget_if_idle(tenant)
+                self._reject("concurrency", tenant.max_concurrency)
+        elif self.shared_queue_depth() >= self.queue_size:
+            self._forget_if_idle(tenant)
+            self._reject("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        tenant.waiters.append((*self._tag(tenant), waiter))
+        self.queue_depth += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait({waiter}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            # The client went away while queued; pass on a slot that was already handed over
+            if waiter.done():
+                self.release(tenant)
+            else:
+                self._abandon(tenant, waiter)
+            raise
+
+        if not waiter.done():
+            self._abandon(tenant, waiter)
+            ADMISSION_WAIT.observe(time.perf_counter() - started, "timeout")
+            if not tenant.has_room():
+                self._reject("concurrency", tenant.max_concurrency)
+            self._reject("timeout")
+
+        ADMISSION_WAIT.observe(time.perf_counter() - started, "admitted")
+        self.admitted += 1
+        return tenant
+
+    def shared_queue_depth(self) -> int:
+        """Waiting requests that count against queue_size: those only waiting for an upstream slot."""
+        return sum(tenant.waiting_for_slot() for tenant in self._tenants.values())
+
+    def release(self, tenant: Tenant):
+        """Return a slot and hand free slots to the next waiters."""
+        tenant.inflight -= 1
+        self.inflight -= 1
+        self._dispatch()
+        self._forget_if_idle(tenant)
+
+    def _abandon(self, tenant: Tenant, waiter: asyncio.Future):
+        waiter.cancel()
+        for entry in tenant.waiters:
+            if entry[2] is waiter:
+                tenant.waiters.remove(entry)
+                self.queue_depth -= 1
+                break
+        self._forget_if_idle(tenant)
+
+    def _reject(self, reason: str, limit: int = 0):
+        self.rejected += 1
+        ADMISSION_REJECTED.inc(1, reason)
+        raise AdmissionRejected(reason, limit=limit)
+
+    @asynccontextmanager
+    async def slot(self, api_key: Optional[APIKey] = None):
+        """Hold a slot for the duration of the block."""
+        tenant = await self.acquire(api_key)
+        try:
+            yield
+        finally:
+            self.release(tenant)
+
+    def hold(self, response: Response, tenant: Tenant) -> Response:
+        """Release the slot acquired for `response` once it is done: after the last chunk of a stream."""
+        if isinstance(response, StreamingResponse):
+            response.body_iterator = self._release_after(response.body_iterator, tenant)
+        else:
+            self.release(tenant)
+        return response
+
+    async def _release_after(self, chunks: AsyncIterator[bytes], tenant: Tenant) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            self.release(tenant)
+
+    def get_stats(self) -> dict:
+        return {
+            "max_inflight": self.max_inflight,
+            "inflight": self.inflight,
+            "queue_depth": self.queue_depth,
+            "shared_queue_depth": self.shared_queue_depth(),
+            "active_keys": len(self._tenants),
+            "admitted": self.admitted,
+            "rejected": self.rejected
+        }
+
+
+def rejected_response(e: AdmissionRejected) -> JSONResponse:
+    """OpenAI-style 503 (proxy at capacity) or 429 (key at its concurrency limit) with Retry-After."""
+    if e.reason == "concurrency":
+        status_code = 429
+        error_type = "rate_limit_error"
+        message = f"Concurrency limit exceeded. Limit: {e.limit} requests in flight"
+    else:
+        status_code = 503
+        error_type = "server_error"
+        message = (
+            "Server is at capacity, too many requests are waiting" if e.reason == "queue_full"
+            else "Server is at capacity, timed out waiting for an upstream slot"
+        )
+    return JSONResponse(
+        status_code=status_code,
+        headers={"Retry-After": str(e.retry_after)},
+        content={
+            "error": {
+                "message": message,
+                "type": error_type,
+                "param": None,
+                "code": None
+            }
+        }
+    )
+
+
+# Global instance
+admission = AdmissionController()
@@ -3,12 +3,16 @@ Authentication and rate limiting middleware for the Load Balancer.
 """
 
 import os
+import time
 from typing import Optional, Callable
 from fastapi import Request, HTTPException
 from fastapi.responses import JSONResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 
-from database import validate_key, log_usage, get_request_count_in_window, APIKey
+from database import validate_key, log_usage, hash_key, APIKey
+from metrics import AUTH_DURATION
+from tracing import span, start_trace, finish_trace, finish_after_body
+from state_backend import state_backend
 
 
 def get_admin_secret() -> str:
@@ -36,7 +40,12 @@ def is_admin_path(path: str) -> bool:
 
 def is_health_path(path: str) -> bool:
     """Check if the path is a health/utility endpoint."""
-    return path in ["/lb/health", "/lb/refresh", "/health", "/docs", "/openapi.json", "/redoc"]
+    return path in ["/lb/health", "/lb/refresh", "/health", "/metrics", "/docs", "/openapi.json", "/redoc"]
+
+
+def is_usage_exempt_path(path: str) -> bool:
+    """Check if requests to the path are served locally and not written to the usage log."""
+    return path == "/v1/models"
 
 
 async def verify_admin_auth(request: Request) -> bool:
@@ -62,16 +71,23 @@ async def verify_client_auth(request: Request) -> tuple[bool, Optional[APIKey],
     if not raw_key:
         return False, None, "Missing API key. Use Authorization: Bearer <your-api-key>"
 
-    # Validate the key
-    api_key = await validate_key(raw_key)
+    # Validate the key (recently validated keys come from the auth cache)
+    key_hash = hash_key(raw_key)
+    api_key = state_backend.get_cached_key(key_hash)
+    if api_key is None:
+        with span("validate_key"):
+            api_key = await validate_key(raw_key)
+        if api_key:
+            state_backend.cache_key(key_hash, api_key)
 
     if not api_key:
         return False, None, "Invalid or expired API key"
 
     # Check rate limit
     if api_key.rate_limit > 0:
-        request_count = await get_request_count_in_window(api_key.id, window_seconds=60)
-        if request_count >= api_key.rate_limit:
+        with span("rate_limit"):
+            allowed, _ = await state_backend.check_rate_limit(api_key.id, api_key.rate_limit, window_seconds=60)
+        if not allowed:
             return False, api_key, f"Rate limit exceeded. Limit: {api_key.rate_limit} requests/minute"
 
     return True, api_key, None
@@ -92,6 +108,25 @@ class AuthMiddleware(BaseHTTPMiddleware):
         if is_health_path(path):
             return await call_next(request)
 
+        trace = start_trace(request.method, path)
+        if trace is None:
+            return await self._handle(request, call_next, path)
+
+        try:
+            response = await self._handle(request, call_next, path)
+        except BaseException:
+            finish_trace(trace, 500)
+            raise
+
+        # Spans recorded so far; streamed bodies finish the trace when they end
+        response.headers["Server-Timing"] = trace.server_timing()
+        if hasattr(response, "body_iterator"):
+            response.body_iterator = finish_after_body(trace, response.body_iterator, response.status_code)
+        else:
+            finish_trace(trace, response.status_code)
+        return response
+
+    async def _handle(self, request: Request, call_next: Callable, path: str):
         # Admin endpoints require admin secret
         if is_admin_path(path):
             if not await verify_admin_auth(request):
@@ -103,10 +138,16 @@ class AuthMiddleware(BaseHTTPMiddleware):
             return await call_next(request)
 
         # All other endpoints require client API key
-        is_valid, api_key, error_message = await verify_client_auth(request)
+        auth_started = time.perf_counter()
+        with span("auth"):
+            is_valid, api_key, error_message = await verify_client_auth(request)
 
         if not is_valid:
             status_code = 429 if error_message and "Rate limit" in error_message else 401
+            AUTH_DURATION.observe(
+                time.perf_counter() - auth_started,
+                "rate_limited" if status_code == 429 else "invalid"
+            )
             error_type = "rate_limit_error" if status_code == 429 else "authentication_error"
             return create_openai_error_response(
                 message=error_message,
@@ -114,6 +155,8 @@ class AuthMiddleware(BaseHTTPMiddleware):
                 status_code=status_code
             )
 
+        AUTH_DURATION.observe(time.perf_counter() - auth_started, "ok")
+
         # Store API key info in request state for later use
         request.state.api_key = api_key
 
@@ -121,7 +164,7 @@ class AuthMiddleware(BaseHTTPMiddleware):
         response = await call_next(request)
 
         # Log usage after successful request (async, non-blocking)
-        if api_key and response.status_code < 400:
+        if api_key and response.status_code < 400 and not is_usage_exempt_path(path):
             # Extract model from request body if available
             model = None
             try:
@@ -131,11 +174,12 @@ class AuthMiddleware(BaseHTTPMiddleware):
             except:
                 pass
 
-            await log_usage(
-                key_id=api_key.id,
-                endpoint=path,
-                model=model
-            )
+            with span("log_usage"):
+                await log_usage(
+                    key_id=api_key.id,
+                    endpoint=path,
+                    model=model
+                )
 
         return response
 
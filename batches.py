@@ -0,0 +1,746 @@
+"""
+Batch jobs in the style of the OpenAI Batch API.
+A client uploads a JSONL file of requests (POST /v1/files, purpose "batch") and creates a
+batch for it (POST /v1/batches). The batch runs in the background: its requests fan out
+over the Vercel keys with at most BATCH_CONCURRENCY in flight per process, failures are
+retried with backoff, and every result is appended to the batch's output or error file as
+soon as it arrives, so the output can be downloaded while the job is still running.
+
+Files live under BATCH_DIR and batches with their progress in SQLite. The result files are
+the record of which requests are done, so a batch interrupted by a restart resumes without
+repeating finished requests. With several workers each batch is claimed by one of them and
+taken over by another if that worker stops heartbeating.
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+import aiosqlite
+from fastapi.responses import JSONResponse
+
+from database import DATABASE_PATH, APIKey, get_key_by_id
+from quotas import QuotaExceeded
+from logger import get_logger
+
+# === Configuration ===
+# Uploaded input files and result files
+BATCH_DIR = os.getenv("BATCH_DIR", "data/batches")
+# SQLite file holding files and batches (the main database by default)
+BATCH_DB_PATH = os.getenv("BATCH_DB_PATH", DATABASE_PATH)
+# Batch requests in flight at once in this process, shared by all running batches
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))
+# Retries per request after a 429/5xx or a connection error, with exponential backoff
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "3"))
+BATCH_RETRY_BACKOFF = float(os.getenv("BATCH_RETRY_BACKOFF", "1"))
+BATCH_MAX_FILE_BYTES = int(os.getenv("BATCH_MAX_FILE_BYTES", str(200 * 1024 * 1024)))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "50000"))
+# Seconds without a heartbeat before another worker takes over a running batch
+BATCH_CLAIM_TIMEOUT = float(os.getenv("BATCH_CLAIM_TIMEOUT", "30"))
+# Seconds a request may spend waiting for the key's token rate limit before it fails
+BATCH_QUOTA_MAX_WAIT = float(os.getenv("BATCH_QUOTA_MAX_WAIT", "600"))
+
+BATCH_ENDPOINTS = ("/v1/chat/completions", "/v1/completions", "/v1/embeddings")
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+# Statuses of batches that still have work to do
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+# Seconds between progress writes (and cancellation checks) of a running batch
+PROGRESS_INTERVAL = 1.0
+# Shortest wait after a token rate rejection, whatever Retry-After it came with
+QUOTA_MIN_WAIT = 0.1
+MAX_REPORTED_ERRORS = 100
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+logger = get_logger("batches")
+
+# (owner key, endpoint, body) -> (status code, response body); may raise QuotaExceeded
+SendFunc = Callable[[Optional[APIKey], str, dict], Awaitable[tuple[int, bytes]]]
+LoadKeyFunc = Callable[[str], Awaitable[Optional[APIKey]]]
+
+
+class BatchError(Exception):
+    """A client error, answered as an OpenAI-style invalid_request_error."""
+
+    def __init__(self, status_code: int, message: str, param: Optional[str] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.param = param
+
+
+def error_response(e: BatchError) -> JSONResponse:
+    return JSONResponse(
+        status_code=e.status_code,
+        content={
+            "error": {
+                "message": e.message,
+                "type": "invalid_request_error",
+                "param": e.param,
+                "code": None
+            }
+        }
+    )
+
+
+def _line_error(code: str, message: str, line: Optional[int] = None) -> dict:
+    return {"code": code, "message": message, "param": None, "line": line}
+
+
+def validate_input(path: str, endpoint: str, max_requests: int = BATCH_MAX_REQUESTS) -> tuple[int, list[dict]]:
+    """Check every line of an input file. Returns (number of requests, errors)."""
+    errors = []
+    seen = set()
+    total = 0
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            total += 1
+            try:
+                request = json.loads(line)
+            except ValueError:
+                errors.append(_line_error("invalid_json", "Line is not valid JSON", number))
+            else:
+                error = _check_request(request, endpoint, seen)
+                if error:
+                    errors.append(_line_error(error[0], error[1], number))
+            if len(errors) >= MAX_REPORTED_ERRORS:
+                break
+
+    if total == 0:
+        errors.append(_line_error("empty_file", "The input file has no requests"))
+    elif total > max_requests:
+        errors.append(_line_error("too_many_requests", f"A batch can have at most {max_requests} requests"))
+    return total, errors
+
+
+def _check_request(request, endpoint: str, seen: set) -> Optional[tuple[str, str]]:
+    if not isinstance(request, dict):
+        return "invalid_request", "Line is not a JSON object"
+    custom_id = request.get("custom_id")
+    if not isinstance(custom_id, str) or not custom_id:
+        return "missing_custom_id", "custom_id must be a non-empty string"
+    if custom_id in seen:
+        return "duplicate_custom_id", f"custom_id '{custom_id}' is used more than once"
+    seen.add(custom_id)
+    if request.get("method", "POST").upper() != "POST":
+        return "invalid_method", "Only POST requests are supported"
+    if request.get("url") != endpoint:
+        return "mismatched_url", f"url must be the batch endpoint {endpoint}"
+    if not isinstance(request.get("body"), dict):
+        return "invalid_body", "body must be a JSON object"
+    return None
+
+
+def iter_requests(path: str) -> Iterator[dict]:
+    """The requests of a validated input file, in order."""
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+async def run_in_thread(func, *args):
+    """
+    Run a blocking file operation in a thread. A cancelled caller still waits for it to
+    return, so the file is never closed while the thread is using it.
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await future
+        raise
+
+
+def scan_results(path: str) -> tuple[set[str], int]:
+    """
+    custom_ids already written to a result file, and how many lines it has.
+    A line cut off by a crash is removed so the file stays valid JSONL.
+    """
+    if not os.path.exists(path):
+        return set(), 0
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    done = set()
+    lines = 0
+    for line in data[:end].splitlines():
+        if line.strip():
+            done.add(json.loads(line)["custom_id"])
+            lines += 1
+    return done, lines
+
+
+class BatchStore:
+    """Files on disk and batch rows in SQLite."""
+
+    def __init__(self, db_path: str = BATCH_DB_PATH, directory: str = BATCH_DIR):
+        self.db_path = db_path
+        self.directory = directory
+
+    async def init(self):
+        os.makedirs(self.directory, exist_ok=True)
+        db_directory = os.path.dirname(self.db_path)
+        if db_directory:
+            os.makedirs(db_directory, exist_ok=True)
+
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS batch_files (
+                    id TEXT PRIMARY KEY,
+                    key_id TEXT NOT NULL,
+                    purpose TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    created_at INTEGER NOT NULL
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS batches (
+                    id TEXT PRIMARY KEY,
+                    key_id TEXT NOT NULL,
+                    endpoint TEXT NOT NULL,
+                    input_file_id TEXT NOT NULL,
+                    output_file_id TEXT NOT NULL,
+                    error_file_id TEXT NOT NULL,
+                    completion_window TEXT NOT NULL,
+                    metadata TEXT,
+                    status TEXT NOT NULL,
+                    errors TEXT,
+                    total INTEGER DEFAULT 0,
+                    completed INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    created_at INTEGER NOT NULL,
+                    in_progress_at INTEGER,
+                    finalizing_at INTEGER,
+                    completed_at INTEGER,
+                    failed_at INTEGER,
+                    cancelling_at INTEGER,
+                    cancelled_at INTEGER,
+                    runner TEXT,
+                    heartbeat_at REAL
+                )
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_batches_key_id ON batches(key_id)")
+            await db.commit()
+
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.directory, f"{file_id}.jsonl")
+
+    async def save_file(
+        self,
+        key_id: str,
+        purpose: str,
+        filename: str,
+        chunks: AsyncIterator[bytes],
+        max_bytes: int = BATCH_MAX_FILE_BYTES
+    ) -> dict:
+        """Write an upload to disk chunk by chunk and register it."""
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        path = self.file_path(file_id)
+        size = 0
+        try:
+            with open(path, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise BatchError(400, f"File is larger than {max_bytes} bytes", "file")
+                    await run_in_thread(f.write, chunk)
+        except BaseException:
+            await asyncio.to_thread(os.remove, path)
+            raise
+
+        await self._add_file(file_id, key_id, purpose, filename)
+        return await self.get_file(file_id, key_id)
+
+    async def _add_file(self, file_id: str, key_id: str, purpose: str, filename: str):
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(
+                "INSERT INTO batch_files (id, key_id, purpose, filename, created_at) VALUES (?, ?, ?, ?, ?)",
+                (file_id, key_id, purpose, filename, int(time.time()))
+            )
+            await db.commit()
+
+    async def get_file(self, file_id: str, key_id: str) -> Optional[dict]:
+        """The file object, if it exists and belongs to `key_id`."""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                "SELECT * FROM batch_files WHERE id = ? AND key_id = ?", (file_id, key_id)
+            ) as cursor:
+                row = await cursor.fetchone()
+        if not row:
+            return None
+        path = self.file_path(file_id)
+        return {
+            "id": row["id"],
+            "object": "file",
+            "bytes": os.path.getsize(path) if os.path.exists(path) else 0,
+            "created_at": row["created_at"],
+            "filename": row["filename"],
+            "purpose": row["purpose"]
+        }
+
+    async def create_batch(
+        self,
+        key_id: str,
+        input_file_id: str,
+        endpoint: str,
+        completion_window: str = "24h",
+        metadata: Optional[dict] = None
+    ) -> dict:
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        output_file_id = f"file-{uuid.uuid4().hex[:24]}"
+        error_file_id = f"file-{uuid.uuid4().hex[:24]}"
+        await self._add_file(output_file_id, key_id, "batch_output", f"{batch_id}_output.jsonl")
+        await self._add_file(error_file_id, key_id, "batch_output", f"{batch_id}_error.jsonl")
+
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(
+                """
+                INSERT INTO batches (
+                    id, key_id, endpoint, input_file_id, output_file_id, error_file_id,
+                    completion_window, metadata, status, created_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'validating', ?)
+                """,
+                (
+                    batch_id, key_id, endpoint, input_file_id, output_file_id, error_file_id,
+                    completion_window, json.dumps(metadata) if metadata else None, int(time.time())
+                )
+            )
+            await db.commit()
+        return await self.get_batch(batch_id, key_id)
+
+    async def get_batch(self, batch_id: str, key_id: Optional[str] = None) -> Optional[dict]:
+        """The batch row, optionally only if it belongs to `key_id`."""
+        query = "SELECT * FROM batches WHERE id = ?"
+        params = [batch_id]
+        if key_id is not None:
+            query += " AND key_id = ?"
+            params.append(key_id)
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(query, params) as cursor:
+                row = await cursor.fetchone()
+        return dict(row) if row else None
+
+    async def list_batches(self, key_id: str, limit: int = 20, after: Optional[str] = None) -> tuple[list[dict], bool]:
+        """Newest first, starting after the batch `after`. Returns (batches, has_more)."""
+        query = "SELECT * FROM batches WHERE key_id = ?"
+        params: list = [key_id]
+        if after:
+            query += " AND rowid < (SELECT rowid FROM batches WHERE id = ?)"
+            params.append(after)
+        query += " ORDER BY rowid DESC LIMIT ?"
+        params.append(limit + 1)
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+        return [dict(row) for row in rows[:limit]], len(rows) > limit
+
+    async def update_batch(self, batch_id: str, holder: Optional[str] = None, **fields) -> bool:
+        """Set columns of a batch; with `holder`, only while that runner still holds it."""
+        query = f"UPDATE batches SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?"
+        params = [*fields.values(), batch_id]
+        if holder is not None:
+            query += " AND runner = ?"
+            params.append(holder)
+        async with aiosqlite.connect(self.db_path) as db:
+            cursor = await db.execute(query, params)
+            await db.commit()
+            return cursor.rowcount > 0
+
+    async def mark_in_progress(self, batch_id: str, holder: str, total: int):
+        """Record a validated batch as started; a cancel that arrived while validating stays in place."""
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(
+                """
+                UPDATE batches SET total = ?, in_progress_at = ?,
+                status = CASE WHEN status = 'validating' THEN 'in_progress' ELSE status END
+                WHERE id = ? AND runner = ?
+                """,
+                (total, int(time.time()), batch_id, holder)
+            )
+            await db.commit()
+
+    async def request_cancel(self, batch_id: str, key_id: str) -> bool:
+        async with aiosqlite.connect(self.db_path) as db:
+            cursor = await db.execute(
+                """
+                UPDATE batches SET status = 'cancelling', cancelling_at = ?
+                WHERE id = ? AND key_id = ? AND status IN ('validating', 'in_progress')
+                """,
+                (int(time.time()), batch_id, key_id)
+            )
+            await db.commit()
+            return cursor.rowcount > 0
+
+    async def claim(self, batch_id: str, holder: str, timeout: float, now: Optional[float] = None) -> bool:
+        """Take a batch that nobody runs, or whose runner stopped heartbeating."""
+        now = now if now is not None else time.time()
+        async with aiosqlite.connect(self.db_path) as db:
+            cursor = await db.execute(
+                f"""
+                UPDATE batches SET runner = ?, heartbeat_at = ?
+                WHERE id = ? AND status IN ({", ".join("?" for _ in ACTIVE_STATUSES)})
+                AND (runner IS NULL OR runner = ? OR heartbeat_at < ?)
+                """,
+                (holder, now, batch_id, *ACTIVE_STATUSES, holder, now - timeout)
+            )
+            await db.commit()
+            return cursor.rowcount > 0
+
+    async def claimable(self, timeout: float, now: Optional[float] = None) -> list[str]:
+        """Batches with work left that nobody is running."""
+        now = now if now is not None else time.time()
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute(
+                f"""
+                SELECT id FROM batches
+                WHERE status IN ({", ".join("?" for _ in ACTIVE_STATUSES)})
+                AND (runner IS NULL OR heartbeat_at < ?)
+                ORDER BY rowid
+                """,
+                (*ACTIVE_STATUSES, now - timeout)
+            ) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+
+def batch_object(batch: dict) -> dict:
+    """The OpenAI batch object for a batch row."""
+    created_at = batch["created_at"]
+    return {
+        "id": batch["id"],
+        "object": "batch",
+        "endpoint": batch["endpoint"],
+        "errors": json.loads(batch["errors"]) if batch["errors"] else None,
+        "input_file_id": batch["input_file_id"],
+        "completion_window": batch["completion_window"],
+        "status": batch["status"],
+        "output_file_id": batch["output_file_id"] if batch["in_progress_at"] else None,
+        "error_file_id": batch["error_file_id"] if batch["failed"] else None,
+        "created_at": created_at,
+        "in_progress_at": batch["in_progress_at"],
+        "expires_at": created_at + 24 * 3600,
+        "finalizing_at": batch["finalizing_at"],
+        "completed_at": batch["completed_at"],
+        "failed_at": batch["failed_at"],
+        "expired_at": None,
+        "cancelling_at": batch["cancelling_at"],
+        "cancelled_at": batch["cancelled_at"],
+        "request_counts": {
+            "total": batch["total"],
+            "completed": batch["completed"],
+            "failed": batch["failed"]
+        },
+        "metadata": json.loads(batch["metadata"]) if batch["metadata"] else None
+    }
+
+
+class _Job:
+    """Progress of one running batch."""
+
+    def __init__(self, batch: dict, completed: int, failed: int):
+        self.batch = batch
+        self.completed = completed
+        self.failed = failed
+        self.cancelled = False
+        # Set when another worker took the batch over
+        self.lost = False
+        # Set when the batch stops sending, to end its heartbeat
+        self.stopped = asyncio.Event()
+
+
+class BatchRunner:
+    """Runs claimed batches in the background, sharing one concurrency budget."""
+
+    def __init__(
+        self,
+        store: BatchStore,
+        send: SendFunc,
+        load_key: LoadKeyFunc = get_key_by_id,
+        concurrency: int = BATCH_CONCURRENCY,
+        max_retries: int = BATCH_MAX_RETRIES,
+        retry_backoff: float = BATCH_RETRY_BACKOFF,
+        claim_timeout: float = BATCH_CLAIM_TIMEOUT,
+        quota_max_wait: float = BATCH_QUOTA_MAX_WAIT
+    ):
+        self.store = store
+        self.send = send
+        self.load_key = load_key
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.claim_timeout = claim_timeout
+        self.quota_max_wait = quota_max_wait
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._jobs: dict[str, asyncio.Task] = {}
+        # Progress of batches sending requests in this process
+        self._progress: dict[str, _Job] = {}
+        self._watcher: Optional[asyncio.Task] = None
+        self.requests_sent = 0
+        self.retries = 0
+        self.batches_finished = 0
+
+    async def start(self):
+        """Create the tables, resume unfinished batches and keep looking for orphaned ones."""
+        await self.store.init()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        await self.adopt()
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        """Stop running batches and hand them back so the next process resumes them right away."""
+        if self._watcher:
+            self._watcher.cancel()
+            self._watcher = None
+        jobs = list(self._jobs.values())
+        for task in jobs:
+            task.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.claim_timeout / 3)
+            try:
+                await self.adopt()
+            except Exception as e:
+                logger.warning(f"⚠️  Failed to check for batches to run: {e}")
+
+    async def adopt(self):
+        """Claim and start every batch with work left that no live worker is running."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        for batch_id in await self.store.claimable(self.claim_timeout):
+            if batch_id not in self._jobs and await self.store.claim(batch_id, self.holder, self.claim_timeout):
+                self._jobs[batch_id] = asyncio.create_task(self._run(batch_id))
+
+    def cancel(self, batch_id: str):
+        """Stop sending a batch right away if it runs here; other workers notice on their next heartbeat."""
+        job = self._progress.get(batch_id)
+        if job:
+            job.cancelled = True
+
+    async def wait(self, batch_id: str):
+        """Wait for a batch running in this process to stop."""
+        task = self._jobs.get(batch_id)
+        if task:
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _run(self, batch_id: str):
+        try:
+            batch = await self.store.get_batch(batch_id)
+            if batch["status"] == "validating":
+                batch = await self._validate(batch)
+            if batch["status"] in ACTIVE_STATUSES:
+                # Also recounts the results of batches interrupted while cancelling or finalizing
+                await self._execute(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Batch {batch_id} stopped: {e}")
+        finally:
+            self._jobs.pop(batch_id, None)
+            try:
+                await asyncio.shield(self.store.update_batch(batch_id, holder=self.holder, runner=None))
+            except Exception as e:
+                logger.warning(f"⚠️  Failed to release batch {batch_id}: {e}")
+
+    async def _validate(self, batch: dict) -> dict:
+        path = self.store.file_path(batch["input_file_id"])
+        total, errors = await asyncio.to_thread(validate_input, path, batch["endpoint"])
+        now = int(time.time())
+        if errors:
+            await self.store.update_batch(
+                batch["id"], holder=self.holder, status="failed", failed_at=now, total=total,
+                errors=json.dumps({"object": "list", "data": errors})
+            )
+            logger.info(f"Batch {batch['id']} failed validation with {len(errors)} error(s)")
+        else:
+            await self.store.mark_in_progress(batch["id"], self.holder, total)
+            logger.info(f"Batch {batch['id']} started: {total} request(s) to {batch['endpoint']}")
+        return await self.store.get_batch(batch["id"])
+
+    async def _execute(self, batch: dict):
+        output_path = self.store.file_path(batch["output_file_id"])
+        error_path = self.store.file_path(batch["error_file_id"])
+        done, completed = await asyncio.to_thread(scan_results, output_path)
+        failed_ids, failed = await asyncio.to_thread(scan_results, error_path)
+        done |= failed_ids
+        if done:
+            logger.info(f"Resuming batch {batch['id']}: {len(done)} of {batch['total']} request(s) already done")
+
+        job = _Job(batch, completed, failed)
+        job.cancelled = batch["status"] == "cancelling"
+        # Requests are sent as the key that created the batch, with its quotas and scheduling
+        api_key = await self.load_key(batch["key_id"])
+        if not job.cancelled and (api_key is None or not api_key.is_active):
+            await self.store.update_batch(
+                batch["id"], holder=self.holder, status="failed", failed_at=int(time.time()),
+                completed=completed, failed=failed, errors=json.dumps({"object": "list", "data": [
+                    _line_error("key_inactive", "The API key that created this batch was deleted or deactivated")
+                ]})
+            )
+            logger.info(f"Batch {batch['id']} failed: its API key is no longer active")
+            return
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        tasks: set[asyncio.Task] = set()
+        self._progress[batch["id"]] = job
+
+        # Unbuffered, so every result line reaches the file in one write
+        requests = iter_requests(self.store.file_path(batch["input_file_id"]))
+        with open(output_path, "ab", buffering=0) as output, open(error_path, "ab", buffering=0) as errors:
+            try:
+                while (request := await run_in_thread(next, requests, None)) is not None:
+                    if request["custom_id"] in done:
+                        continue
+                    await self._semaphore.acquire()
+                    if job.cancelled or job.lost:
+                        self._semaphore.release()
+                        break
+                    task = asyncio.create_task(self._process(job, api_key, request, output, errors))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    # Let the request start before reading the next line
+                    await asyncio.sleep(0)
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                requests.close()
+                job.stopped.set()
+                await asyncio.gather(heartbeat, return_exceptions=True)
+                self._progress.pop(batch["id"], None)
+                if not job.lost:
+                    await asyncio.shield(self._save_progress(job))
+
+        if not job.lost:
+            await self._finish(batch, job.cancelled, job)
+
+    async def _heartbeat(self, job: _Job):
+        """
+        Save progress, renew the claim and pick up cancellations until `job.stopped` is set.
+        Stopping is cooperative so a write in progress is never abandoned with its connection open.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(job.stopped.wait(), timeout=PROGRESS_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if not await self._save_progress(job):
+                    job.lost = True
+                    logger.warning(f"Batch {job.batch['id']} was taken over by another worker")
+                    return
+                batch = await self.store.get_batch(job.batch["id"])
+                if batch and batch["status"] == "cancelling":
+                    job.cancelled = True
+            except Exception as e:
+                logger.warning(f"⚠️  Failed to save progress of batch {job.batch['id']}: {e}")
+
+    async def _save_progress(self, job: _Job) -> bool:
+        return await self.store.update_batch(
+            job.batch["id"], holder=self.holder,
+            completed=job.completed, failed=job.failed, heartbeat_at=time.time()
+        )
+
+    async def _finish(self, batch: dict, cancelled: bool, job: _Job):
+        now = int(time.time())
+        fields = {"cancelled_at": now, "status": "cancelled"} if cancelled else {
+            "finalizing_at": now, "completed_at": now, "status": "completed"
+        }
+        await self.store.update_batch(batch["id"], holder=self.holder, **fields)
+        self.batches_finished += 1
+        logger.info(f"Batch {batch['id']} {fields['status']}")
+
+    async def _process(self, job: _Job, api_key: Optional[APIKey], request: dict, output, errors):
+        try:
+            outcome = await self._send_with_retries(job, api_key, request["body"])
+        finally:
+            self._semaphore.release()
+        if outcome is None:
+            # Cancelled before it could be sent; like the rest of the batch it has no result
+            return
+        status, content, error = outcome
+
+        result = {
+            "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+            "custom_id": request["custom_id"],
+            "response": None,
+            "error": error
+        }
+        if status is not None:
+            try:
+                body = json.loads(content)
+            except ValueError:
+                body = content.decode("utf-8", errors="replace")
+            result["response"] = {"status_code": status, "request_id": uuid.uuid4().hex, "body": body}
+
+        line = json.dumps(result, ensure_ascii=False).encode("utf-8") + b"\n"
+        if status is not None and 200 <= status < 300:
+            await run_in_thread(output.write, line)
+            job.completed += 1
+        else:
+            await run_in_thread(errors.write, line)
+            job.failed += 1
+
+    async def _send_with_retries(
+        self, job: _Job, api_key: Optional[APIKey], body: dict
+    ) -> Optional[tuple[Optional[int], bytes, Optional[dict]]]:
+        """(status code, response body, error) of the last attempt, or None if the batch was cancelled first."""
+        attempt = 0
+        quota_waited = 0.0
+        while True:
+            try:
+                status, content = await self.send(api_key, job.batch["endpoint"], dict(body))
+                error = None
+            except QuotaExceeded as e:
+                # Rejected before it was sent
+                # Wait for the token window instead of spending a retry, but not forever
+                wait = min(max(e.retry_after, QUOTA_MIN_WAIT), self.quota_max_wait - quota_waited)
+                if e.quota != "tpm" or wait <= 0:
+                    return None, b"", {"code": "quota_exceeded", "message": e.message}
+                if not await self._sleep_unless_cancelled(job, wait):
+                    return None
+                quota_waited += wait
+                continue
+            except Exception as e:
+                status, content = None, b""
+                error = {"code": "request_failed", "message": str(e) or type(e).__name__}
+            self.requests_sent += 1
+
+            if (status is not None and status not in RETRY_STATUSES) or attempt >= self.max_retries:
+                return status, content, error
+            self.retries += 1
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+            attempt += 1
+
+    async def _sleep_unless_cancelled(self, job: _Job, seconds: float) -> bool:
+        """Sleep, waking up early if the batch is cancelled or taken over. Returns False if it was."""
+        deadline = time.monotonic() + seconds
+        while not (job.cancelled or job.lost):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            await asyncio.sleep(min(remaining, PROGRESS_INTERVAL))
+        return False
+
+    def get_stats(self) -> dict:
+        return {
+            "running": len(self._jobs),
+            "concurrency": self.concurrency,
+            "requests_sent": self.requests_sent,
+            "retries": self.retries,
+            "batches_finished": self.batches_finished
+        }
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the proxy's per-request hot paths, with regression thresholds.
+
+Times each component in isolation against a SQLite database seeded with a
+realistic usage_logs table (1M rows by default): API key hashing and
+validation, the rate-limit window count, usage logging, Vercel key selection,
+and the -thinking request rewrite and SSE transform. The median time per call
+is compared with benchmarks/thresholds.json; the script exits with status 1
+when a benchmark is slower than its threshold.
+
+Usage:
+    python benchmarks/bench_hot_paths.py
+    python benchmarks/bench_hot_paths.py --only validate_key,log_usage --rounds 2000
+    python benchmarks/bench_hot_paths.py --db /tmp/bench.db          # reuse the seeded database
+    python benchmarks/bench_hot_paths.py --update-thresholds         # re-baseline after a deliberate change
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("USE_POCKETBASE", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+THRESHOLDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thresholds.json")
+
+
+def seed_database(path: str, client_keys: int, usage_rows: int) -> list[tuple[str, str]]:
+    """Create client keys and `usage_rows` usage logs over the last 30 days; returns (raw key, id) pairs."""
+    import database
+
+    database.DATABASE_PATH = path
+    asyncio.run(database.init_database())
+
+    keys = []
+    for i in range(client_keys):
+        raw_key, api_key = asyncio.run(database.create_key(name=f"bench-{i}", rate_limit=60))
+        keys.append((raw_key, api_key.id))
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    ids = [key_id for _, key_id in keys]
+    conn = sqlite3.connect(path)
+    batch = 100_000
+    for start in range(0, usage_rows, batch):
+        conn.executemany(
+            "INSERT INTO usage_logs (key_id, timestamp, endpoint, tokens_used, model, cached) VALUES (?, ?, ?, ?, ?, 0)",
+            (
+                (
+                    random.choice(ids),
+                    (now - timedelta(seconds=random.uniform(0, 30 * 86400))).isoformat(),
+                    "/v1/chat/completions",
+                    random.randint(100, 4000),
+                    "anthropic/claude-sonnet-4.5",
+                )
+                for _ in range(min(batch, usage_rows - start))
+            )
+        )
+    conn.commit()
+    conn.close()
+    return keys
+
+
+def load_keys(path: str) -> list[tuple[str, str]]:
+    """Client keys of an already seeded database. Raw keys are not stored, so re-issue them."""
+    import database
+
+    database.DATABASE_PATH = path
+    conn = sqlite3.connect(path)
+    ids = [row[0] for row in conn.execute("SELECT id FROM api_keys WHERE name LIKE 'bench-%'")]
+    keys = []
+    for key_id in ids:
+        raw_key = database.generate_api_key()
+        conn.execute("UPDATE api_keys SET key_hash = ? WHERE id = ?", (database.hash_key(raw_key), key_id))
+        keys.append((raw_key, key_id))
+    conn.commit()
+    conn.close()
+    return keys
+
+
+def sse_lines(count: int) -> list[str]:
+    """A thinking-model stream: reasoning deltas, then content deltas, then [DONE]."""
+    lines = []
+    for i in range(count):
+        field = "reasoning" if i < count // 3 else "content"
+        chunk = {
+            "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 0,
+            "model": "anthropic/claude-sonnet-4.5",
+            "choices": [{"index": 0, "delta": {field: f"token{i} "}, "finish_reason": None}]
+        }
+        lines.extend([f"data: {json.dumps(chunk)}", ""])
+    lines.append("data: [DONE]")
+    return lines
+
+
+def build_benchmarks(keys: list[tuple[str, str]], vercel_keys: int) -> dict:
+    """Name -> (callable, is_async) for every benchmark."""
+    import database
+    import server
+    from thinking import ThinkTagRewriter, rewrite_thinking_request
+
+    manager = server.vercel_key_manager
+    now = time.time()
+    manager.keys = [
+        {"name": f"vck-{i}", "api_key": f"vck_bench_{i}", "balance": random.uniform(0, 50),
+         "total_used": 0.0, "updated_at": now + 86400}
+        for i in range(vercel_keys)
+    ]
+
+    request_body = json.dumps({
+        "model": "anthropic/claude-sonnet-4.5-thinking",
+        "messages": [{"role": "user", "content": "x" * 4000}],
+        "stream": True
+    }).encode("utf-8")
+
+    lines = sse_lines(300)
+
+    def thinking_sse_stream():
+        rewriter = ThinkTagRewriter()
+        for line in lines:
+            rewriter.feed(line)
+
+    def thinking_request_rewrite():
+        data = json.loads(request_body)
+        rewrite_thinking_request(data)
+        json.dumps(data).encode("utf-8")
+
+    def hash_key():
+        database.hash_key(random.choice(keys)[0])
+
+    async def validate_key():
+        await database.validate_key(random.choice(keys)[0])
+
+    async def get_request_count_in_window():
+        await database.get_request_count_in_window(random.choice(keys)[1], 60)
+
+    async def log_usage():
+        await database.log_usage(random.choice(keys)[1], "/v1/chat/completions", 1000, "anthropic/claude-sonnet-4.5")
+
+    async def get_key():
+        await manager.get_key()
+
+    return {
+        "hash_key": (hash_key, False),
+        "validate_key": (validate_key, True),
+        "get_request_count_in_window": (get_request_count_in_window, True),
+        "log_usage": (log_usage, True),
+        "get_key": (get_key, True),
+        "thinking_request_rewrite": (thinking_request_rewrite, False),
+        "thinking_sse_stream_300_events": (thinking_sse_stream, False),
+    }
+
+
+async def measure(fn, is_async: bool, rounds: int, warmup: int) -> list[float]:
+    """Per-call durations in microseconds."""
+    timings = []
+    for i in range(warmup + rounds):
+        start = time.perf_counter()
+        if is_async:
+            await fn()
+        else:
+            fn()
+        if i >= warmup:
+            timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def stats(timings: list[float]) -> dict:
+    ordered = sorted(timings)
+    return {
+        "median_us": round(ordered[len(ordered) // 2], 2),
+        "mean_us": round(sum(ordered) / len(ordered), 2),
+        "p99_us": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 2),
+        "ops_per_s": round(len(ordered) / (sum(ordered) / 1e6), 1),
+    }
+
+
+async def main_async(args, benchmarks: dict) -> dict:
+    results = {}
+    for name, (fn, is_async) in benchmarks.items():
+        rounds = args.rounds if is_async else args.rounds * 10
+        results[name] = stats(await measure(fn, is_async, rounds, warmup=max(10, rounds // 20)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot path micro-benchmarks")
+    parser.add_argument("--db", help="SQLite database to use (seeded on first use, reused afterwards)")
+    parser.add_argument("--usage-rows", type=int, default=1_000_000, help="Rows in usage_logs")
+    parser.add_argument("--client-keys", type=int, default=100, help="Client API keys")
+    parser.add_argument("--vercel-keys", type=int, default=20, help="Vercel keys in the key manager")
+    parser.add_argument("--rounds", type=int, default=500, help="Timed calls per async benchmark (10x for sync)")
+    parser.add_argument("--only", help="Comma-separated benchmark names")
+    parser.add_argument("--thresholds", default=THRESHOLDS_PATH, help="Thresholds file")
+    parser.add_argument("--update-thresholds", action="store_true",
+                        help="Write median x --headroom as the new thresholds")
+    parser.add_argument("--headroom", type=float, default=3.0, help="Threshold / median when updating")
+    parser.add_argument("--output", "-o", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="lb-bench-"), "bench.db")
+    if os.path.exists(path):
+        print(f"Reusing {path}")
+        keys = load_keys(path)
+    else:
+        print(f"Seeding {path} with {args.usage_rows:,} usage rows...")
+        started = time.perf_counter()
+        keys = seed_database(path, args.client_keys, args.usage_rows)
+        print(f"Seeded in {time.perf_counter() - started:.1f}s")
+
+    benchmarks = build_benchmarks(keys, args.vercel_keys)
+    if args.only:
+        wanted = set(args.only.split(","))
+        unknown = wanted - set(benchmarks)
+        if unknown:
+            parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+        benchmarks = {k: v for k, v in benchmarks.items() if k in wanted}
+
+    thresholds = {}
+    if os.path.exists(args.thresholds):
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+
+    results = asyncio.run(main_async(args, benchmarks))
+
+    failed = []
+    print(f"\n{'benchmark':>32} {'median(us)':>12} {'p99(us)':>12} {'ops/s':>12} {'limit(us)':>12}")
+    for name, r in results.items():
+        limit = thresholds.get(name, {}).get("max_median_us")
+        status = ""
+        if limit is not None and r["median_us"] > limit:
+            failed.append(name)
+            status = "  REGRESSION"
+        print(f"{name:>32} {r['median_us']:>12} {r['p99_us']:>12} {r['ops_per_s']:>12} "
+              f"{limit if limit is not None else '-':>12}{status}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"params": vars(args), "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.update_thresholds:
+        for name, r in results.items():
+            thresholds[name] = {"max_median_us": round(r["median_us"] * args.headroom, 1)}
+        with open(args.thresholds, "w") as f:
+            json.dump(thresholds, f, indent=2)
+            f.write("\n")
+        print(f"Thresholds written to {args.thresholds}")
+    elif failed:
+        print(f"\n{len(failed)} benchmark(s) slower than their threshold: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
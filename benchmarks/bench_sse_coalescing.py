@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Benchmark: CPU cost per streamed token with SSE write coalescing on and off.
+
+Boots a small streaming server (in a subprocess) whose responses go through
+sse.coalesce_sse, drives concurrent streams against it and compares the server's
+CPU time per token and the number of writes per response.
+
+Usage:
+    python benchmarks/bench_sse_coalescing.py
+    python benchmarks/bench_sse_coalescing.py --streams 200 --tokens 500 --window-ms 10
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+def create_app(window_ms: float, max_bytes: int, tokens: int, interval_ms: float, burst: int):
+    """Streaming app emitting OpenAI-style token chunks, `burst` events every `interval_ms`."""
+    from fastapi import FastAPI
+    from fastapi.responses import StreamingResponse
+    from sse import coalesce_sse
+
+    app = FastAPI()
+
+    async def token_source():
+        sent = 0
+        while sent < tokens:
+            for _ in range(min(burst, tokens - sent)):
+                event = {"choices": [{"index": 0, "delta": {"content": f"tok{sent} "}}]}
+                yield f"data: {json.dumps(event)}\n\n".encode("utf-8")
+                sent += 1
+            await asyncio.sleep(interval_ms / 1000)
+        yield b"data: [DONE]\n\n"
+
+    @app.get("/stream")
+    async def stream():
+        return StreamingResponse(
+            coalesce_sse(token_source(), window_ms=window_ms, max_bytes=max_bytes),
+            media_type="text/event-stream"
+        )
+
+    @app.get("/cpu")
+    async def cpu():
+        return {"cpu": time.process_time()}
+
+    return app
+
+
+def serve(args):
+    import uvicorn
+    app = create_app(args.window_ms, args.max_bytes, args.tokens, args.interval_ms, args.burst)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+
+
+async def run_case(args, window_ms: float) -> dict:
+    """Start a server with the given window and measure one round of streams."""
+    cmd = [
+        sys.executable, __file__, "--serve",
+        "--port", str(args.port),
+        "--window-ms", str(window_ms),
+        "--max-bytes", str(args.max_bytes),
+        "--tokens", str(args.tokens),
+        "--interval-ms", str(args.interval_ms),
+        "--burst", str(args.burst),
+    ]
+    proc = subprocess.Popen(cmd)
+    base = f"http://127.0.0.1:{args.port}"
+
+    try:
+        limits = httpx.Limits(max_connections=args.streams, max_keepalive_connections=args.streams)
+        async with httpx.AsyncClient(base_url=base, timeout=120, limits=limits) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/cpu")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+
+            async def one_stream() -> tuple[int, int]:
+                reads = 0
+                size = 0
+                async with client.stream("GET", "/stream") as resp:
+                    async for chunk in resp.aiter_raw():
+                        reads += 1
+                        size += len(chunk)
+                return reads, size
+
+            cpu_before = (await client.get("/cpu")).json()["cpu"]
+            wall_start = time.perf_counter()
+            results = await asyncio.gather(*[one_stream() for _ in range(args.streams)])
+            wall = time.perf_counter() - wall_start
+            cpu_after = (await client.get("/cpu")).json()["cpu"]
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    total_tokens = args.streams * args.tokens
+    cpu = cpu_after - cpu_before
+    return {
+        "window_ms": window_ms,
+        "server_cpu_s": round(cpu, 4),
+        "cpu_us_per_token": round(cpu / total_tokens * 1e6, 2),
+        "reads_per_stream": round(sum(r for r, _ in results) / len(results), 1),
+        "bytes_per_stream": sum(s for _, s in results) // len(results),
+        "wall_s": round(wall, 3),
+    }
+
+
+async def main_async(args):
+    results = [await run_case(args, 0), await run_case(args, args.window_ms)]
+
+    print(f"\n{args.streams} streams x {args.tokens} tokens "
+          f"({args.burst} token(s) every {args.interval_ms}ms)\n")
+    print(f"{'window':>10} {'cpu(s)':>10} {'us/token':>10} {'reads/stream':>14} {'wall(s)':>10}")
+    for r in results:
+        label = "off" if r["window_ms"] == 0 else f"{r['window_ms']:g}ms"
+        print(f"{label:>10} {r['server_cpu_s']:>10} {r['cpu_us_per_token']:>10} "
+              f"{r['reads_per_stream']:>14} {r['wall_s']:>10}")
+
+    off, on = results
+    if on["cpu_us_per_token"]:
+        print(f"\nCPU per token: {off['cpu_us_per_token'] / on['cpu_us_per_token']:.2f}x lower with coalescing")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"params": vars(args), "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE write coalescing benchmark")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--streams", type=int, default=100, help="Concurrent streams")
+    parser.add_argument("--tokens", type=int, default=300, help="Tokens per stream")
+    parser.add_argument("--interval-ms", type=float, default=2.0, help="Delay between token bursts")
+    parser.add_argument("--burst", type=int, default=2, help="Tokens emitted per burst")
+    parser.add_argument("--window-ms", type=float, default=10.0, help="Coalescing window to compare against")
+    parser.add_argument("--max-bytes", type=int, default=8192, help="Coalescing size limit")
+    parser.add_argument("--output", "-o", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+    else:
+        asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
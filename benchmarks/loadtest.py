@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test: the proxy (server.py) against the mock Vercel AI Gateway.
+
+Boots benchmarks/mock_gateway.py and server.py in subprocesses (in a temporary
+working directory with its own key list and SQLite database), creates client
+keys through the admin API and drives a mix of streaming, non-streaming and
+thinking-model requests. Reports requests per second, latency and TTFB
+percentiles, and the proxy's CPU and RSS. Results can be written as JSON and
+compared against an earlier run.
+
+Usage:
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --concurrency 200 --duration 30 --mix stream=6,nonstream=3,thinking=1
+    python benchmarks/loadtest.py --rate 500 --token-rate 100 -o after.json --compare before.json
+    python benchmarks/loadtest.py --proxy-env SSE_COALESCE_MS=10 --proxy-env LOG_LEVEL=WARNING
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import secrets
+import argparse
+import tempfile
+import subprocess
+from dataclasses import dataclass
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from profiler import percentile
+
+MODEL = "anthropic/claude-sonnet-4.5"
+THINKING_MODEL = MODEL + "-thinking"
+EMBEDDING_MODEL = "openai/text-embedding-3-small"
+KINDS = ("stream", "nonstream", "thinking", "embeddings")
+
+
+@dataclass
+class Sample:
+    kind: str
+    status: int
+    latency: float  # seconds, request sent -> body fully read
+    ttfb: float     # seconds, request sent -> first body byte
+    size: int       # response bytes
+    error: str = ""
+
+
+def parse_mix(raw: str) -> dict[str, float]:
+    """Parse "stream=6,nonstream=3,thinking=1" into normalized weights."""
+    mix = {}
+    for item in raw.split(","):
+        if not item.strip():
+            continue
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError(f"Unknown request kind {kind!r}, expected one of {', '.join(KINDS)}")
+        mix[kind] = float(weight or 1)
+    total = sum(mix.values())
+    if total <= 0:
+        raise ValueError("Traffic mix is empty")
+    return {kind: weight / total for kind, weight in mix.items()}
+
+
+def request_for(kind: str, prompt_chars: int) -> tuple[str, dict]:
+    """Path and JSON body for one request of the given kind."""
+    # A random prefix keeps bodies distinct so caches never answer for the upstream
+    prompt = f"{secrets.token_hex(4)} " + "x" * max(0, prompt_chars - 9)
+    if kind == "embeddings":
+        return "/v1/embeddings", {"model": EMBEDDING_MODEL, "input": prompt}
+    body = {
+        "model": THINKING_MODEL if kind == "thinking" else MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": kind != "nonstream",
+    }
+    return "/v1/chat/completions", body
+
+
+def read_proc(pid: int) -> tuple[float, int]:
+    """CPU seconds (user + system) and RSS bytes of a process, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        return cpu, rss
+    except (OSError, IndexError, ValueError):
+        return 0.0, 0
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+async def wait_ready(url: str, proc: subprocess.Popen, name: str):
+    async with httpx.AsyncClient(timeout=2) as client:
+        for _ in range(300):
+            if proc.poll() is not None:
+                raise RuntimeError(f"{name} exited with code {proc.returncode}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{name} did not start on {url}")
+
+
+def start_mock(args) -> subprocess.Popen:
+    cmd = [
+        sys.executable, os.path.join(ROOT, "benchmarks", "mock_gateway.py"),
+        "--port", str(args.mock_port),
+        "--latency-ms", str(args.latency_ms),
+        "--token-rate", str(args.token_rate),
+        "--completion-tokens", str(args.completion_tokens),
+        "--error-rate", str(args.error_rate),
+    ]
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+
+
+def start_proxy(args, workdir: str) -> subprocess.Popen:
+    os.makedirs(os.path.join(workdir, "config"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    keys = [{"name": f"load-{i}", "api_key": f"vck_load_{i}"} for i in range(args.vercel_keys)]
+    with open(os.path.join(workdir, "config", "key-list.json"), "w") as f:
+        json.dump({"keys": keys}, f)
+
+    env = {
+        **os.environ,
+        "USE_POCKETBASE": "false",
+        "VERCEL_GATEWAY_URL": f"http://127.0.0.1:{args.mock_port}",
+        "ADMIN_SECRET": args.admin_secret,
+        "DATABASE_PATH": os.path.join(workdir, "data", "lb_database.db"),
+        "HOST": "127.0.0.1",
+        "PORT": str(args.port),
+        "LOG_LEVEL": "WARNING",
+        "WATCHDOG_ENABLED": "false",
+    }
+    for item in args.proxy_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    log = open(os.path.join(workdir, "proxy.log"), "w")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py")], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+async def create_client_keys(base: str, admin_secret: str, count: int) -> list[str]:
+    headers = {"Authorization": f"Bearer {admin_secret}"}
+    async with httpx.AsyncClient(base_url=base, headers=headers, timeout=30) as client:
+        keys = []
+        for i in range(count):
+            resp = await client.post("/admin/keys", json={"name": f"loadtest-{i}", "rate_limit": 0})
+            resp.raise_for_status()
+            keys.append(resp.json()["key"])
+        return keys
+
+
+async def one_request(client: httpx.AsyncClient, kind: str, key: str, prompt_chars: int) -> Sample:
+    path, body = request_for(kind, prompt_chars)
+    start = time.perf_counter()
+    ttfb = 0.0
+    size = 0
+    try:
+        async with client.stream("POST", path, json=body, headers={"Authorization": f"Bearer {key}"}) as resp:
+            async for chunk in resp.aiter_raw():
+                if not size:
+                    ttfb = time.perf_counter() - start
+                size += len(chunk)
+        return Sample(kind, resp.status_code, time.perf_counter() - start, ttfb, size)
+    except httpx.HTTPError as e:
+        return Sample(kind, 0, time.perf_counter() - start, ttfb, size, error=type(e).__name__)
+
+
+async def drive(args, base: str, client_keys: list[str]) -> tuple[list[Sample], float]:
+    """Run the load for args.duration seconds; returns the samples and the wall time."""
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+    samples: list[Sample] = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base, timeout=args.timeout, limits=limits) as client:
+        deadline = time.perf_counter() + args.duration
+        started = time.perf_counter()
+
+        def next_request():
+            kind = random.choices(kinds, weights)[0]
+            return one_request(client, kind, random.choice(client_keys), args.prompt_chars)
+
+        if args.rate:
+            # Open loop: Poisson arrivals at args.rate/s, at most args.concurrency in flight
+            slots = asyncio.Semaphore(args.concurrency)
+            tasks = []
+
+            async def limited():
+                async with slots:
+                    samples.append(await next_request())
+
+            while time.perf_counter() < deadline:
+                tasks.append(asyncio.create_task(limited()))
+                await asyncio.sleep(random.expovariate(args.rate))
+            await asyncio.gather(*tasks)
+        else:
+            # Closed loop: args.concurrency clients sending back to back
+            async def worker():
+                while time.perf_counter() < deadline:
+                    samples.append(await next_request())
+
+            await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+
+        return samples, time.perf_counter() - started
+
+
+def summarize(samples: list[Sample], wall: float) -> dict:
+    ok = [s for s in samples if 200 <= s.status < 300]
+    latencies = [s.latency * 1000 for s in ok]
+    ttfbs = [s.ttfb * 1000 for s in ok]
+    statuses: dict[str, int] = {}
+    for s in samples:
+        label = str(s.status) if s.status else s.error
+        statuses[label] = statuses.get(label, 0) + 1
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "rps": round(len(ok) / wall, 1) if wall else 0.0,
+        "latency_ms": {f"p{p}": round(percentile(latencies, p), 1) for p in (50, 95, 99)},
+        "ttfb_ms": {f"p{p}": round(percentile(ttfbs, p), 1) for p in (50, 95, 99)},
+        "bytes_per_request": sum(s.size for s in ok) // len(ok) if ok else 0,
+        "statuses": statuses,
+    }
+
+
+def print_results(result: dict, baseline: dict = None):
+    print(f"\n{result['summary']['requests']} requests in {result['wall_s']}s "
+          f"({result['params']['concurrency']} concurrent, mix {result['params']['mix']})\n")
+    print(f"{'kind':>11} {'reqs':>7} {'errors':>7} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} "
+          f"{'ttfb50':>8} {'ttfb99':>8}")
+    rows = [("all", result["summary"])] + list(result["by_kind"].items())
+    for name, s in rows:
+        lat, ttfb = s["latency_ms"], s["ttfb_ms"]
+        print(f"{name:>11} {s['requests']:>7} {s['errors']:>7} {s['rps']:>8} {lat['p50']:>8} "
+              f"{lat['p95']:>8} {lat['p99']:>8} {ttfb['p50']:>8} {ttfb['p99']:>8}")
+
+    proxy = result["proxy"]
+    print(f"\nproxy cpu: {proxy['cpu_percent']}% ({proxy['cpu_ms_per_request']} ms/request), "
+          f"rss: {proxy['rss_mb_max']} MB max")
+    print(f"statuses: {result['summary']['statuses']}")
+
+    if baseline:
+        print(f"\nvs {baseline.get('commit') or 'baseline'}:")
+        pairs = [
+            ("rps", lambda r: r["summary"]["rps"]),
+            ("p50 ms", lambda r: r["summary"]["latency_ms"]["p50"]),
+            ("p99 ms", lambda r: r["summary"]["latency_ms"]["p99"]),
+            ("ttfb p99 ms", lambda r: r["summary"]["ttfb_ms"]["p99"]),
+            ("cpu ms/request", lambda r: r["proxy"]["cpu_ms_per_request"]),
+            ("rss MB", lambda r: r["proxy"]["rss_mb_max"]),
+        ]
+        for label, get in pairs:
+            before, after = get(baseline), get(result)
+            change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+            print(f"{label:>16} {before:>10} -> {after:<10} {change}")
+
+
+async def main_async(args):
+    workdir = tempfile.mkdtemp(prefix="lb-loadtest-")
+    base = f"http://127.0.0.1:{args.port}"
+    mock = start_mock(args)
+    proxy = start_proxy(args, workdir)
+
+    try:
+        await wait_ready(f"http://127.0.0.1:{args.mock_port}/v1/models", mock, "mock gateway")
+        await wait_ready(f"{base}/health", proxy, "proxy")
+        client_keys = await create_client_keys(base, args.admin_secret, args.client_keys)
+
+        if args.warmup:
+            warmup = argparse.Namespace(**{**vars(args), "duration": args.warmup, "rate": 0})
+            await drive(warmup, base, client_keys)
+
+        rss_samples = []
+
+        async def sample_rss():
+            while True:
+                rss_samples.append(read_proc(proxy.pid)[1])
+                await asyncio.sleep(0.5)
+
+        sampler = asyncio.create_task(sample_rss())
+        cpu_before = read_proc(proxy.pid)[0]
+        client_cpu_before = time.process_time()
+        samples, wall = await drive(args, base, client_keys)
+        cpu = read_proc(proxy.pid)[0] - cpu_before
+        client_cpu = time.process_time() - client_cpu_before
+        sampler.cancel()
+    finally:
+        proxy.terminate()
+        mock.terminate()
+        proxy.wait()
+        mock.wait()
+
+    result = {
+        "commit": git_commit(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("admin_secret", "compare", "output")},
+        "wall_s": round(wall, 2),
+        "summary": summarize(samples, wall),
+        "by_kind": {
+            kind: summarize([s for s in samples if s.kind == kind], wall)
+            for kind in parse_mix(args.mix)
+        },
+        "proxy": {
+            "cpu_s": round(cpu, 3),
+            "cpu_percent": round(cpu / wall * 100, 1) if wall else 0.0,
+            "cpu_ms_per_request": round(cpu / len(samples) * 1000, 3) if samples else 0.0,
+            "rss_mb_max": round(max(rss_samples, default=0) / 2**20, 1),
+            "rss_mb_end": round((rss_samples[-1] if rss_samples else 0) / 2**20, 1),
+        },
+        "client_cpu_percent": round(client_cpu / wall * 100, 1) if wall else 0.0,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(result, baseline)
+    if result["client_cpu_percent"] > 90:
+        print("\nWarning: the load generator was CPU bound; numbers may reflect the client, not the proxy")
+    print(f"Proxy log: {os.path.join(workdir, 'proxy.log')}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end proxy load test against the mock gateway")
+    parser.add_argument("--port", type=int, default=8790, help="Proxy port")
+    parser.add_argument("--mock-port", type=int, default=8791, help="Mock gateway port")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds of unmeasured load first")
+    parser.add_argument("--concurrency", type=int, default=50, help="Concurrent clients (max in flight)")
+    parser.add_argument("--rate", type=float, default=0.0, help="Open loop arrivals per second (0 = closed loop)")
+    parser.add_argument("--mix", default="stream=6,nonstream=3,thinking=1",
+                        help=f"Traffic mix weights, kinds: {', '.join(KINDS)}")
+    parser.add_argument("--client-keys", type=int, default=20, help="Client keys to spread requests over")
+    parser.add_argument("--vercel-keys", type=int, default=5, help="Vercel keys in the mock's key list")
+    parser.add_argument("--prompt-chars", type=int, default=2000, help="Prompt size per request")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Mock latency before the first token")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="Mock tokens per second (0 = instant)")
+    parser.add_argument("--completion-tokens", type=int, default=64, help="Mock tokens per completion")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Mock injected error rate")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Client timeout per request")
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for the proxy (repeatable)")
+    parser.add_argument("--admin-secret", default=secrets.token_urlsafe(16), help=argparse.SUPPRESS)
+    parser.add_argument("--output", "-o", help="Write JSON results to this file")
+    parser.add_argument("--compare", help="Earlier JSON results to compare against")
+    args = parser.parse_args()
+    parse_mix(args.mix)
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
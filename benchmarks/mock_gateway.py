@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Mock Vercel AI Gateway for offline testing and load tests.
+
+Implements /v1/credits, /v1/chat/completions (streaming and non-streaming, with
+reasoning deltas), /v1/embeddings and /v1/models with configurable latency,
+token rate, per-key balances and error injection. Point the proxy at it with
+VERCEL_GATEWAY_URL=http://127.0.0.1:9000.
+
+Usage:
+    python benchmarks/mock_gateway.py --port 9000
+    python benchmarks/mock_gateway.py --latency-ms 200 --token-rate 50 --error-rate 0.01
+    python benchmarks/mock_gateway.py --keys vck_a=5,vck_b=0.5 --cost-per-1k-tokens 0.01
+
+Per-request overrides (clients' headers are forwarded by the proxy):
+    X-Mock-Status: 429              respond with this status instead
+    X-Mock-Latency-Ms: 500          latency before the response starts
+    X-Mock-Completion-Tokens: 200   tokens in this completion
+    X-Mock-Token-Rate: 40           tokens per second for this completion
+    X-Mock-Disconnect: true         drop the connection half way through a stream
+"""
+
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from dataclasses import dataclass, field
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DEFAULT_MODELS = [
+    "openai/gpt-4o",
+    "openai/gpt-4o-mini",
+    "anthropic/claude-sonnet-4.5",
+    "google/gemini-2.5-pro",
+    "openai/text-embedding-3-small",
+]
+
+ERROR_MESSAGES = {
+    402: "Insufficient funds",
+    429: "Rate limit exceeded",
+    500: "Internal server error",
+    502: "Bad gateway",
+    503: "Service unavailable",
+}
+
+
+@dataclass
+class MockConfig:
+    latency_ms: float = 0.0          # before the response (or first token) starts
+    jitter_ms: float = 0.0           # uniform random extra latency
+    token_rate: float = 0.0          # generated tokens per second (0 = instant)
+    completion_tokens: int = 32      # tokens per completion (capped by max_tokens)
+    reasoning_tokens: int = 8        # reasoning deltas sent first when "reasoning" is requested
+    embedding_dim: int = 8
+    error_rate: float = 0.0          # fraction of requests answered with an injected error
+    error_codes: tuple = (429, 500, 502, 503)
+    disconnect_rate: float = 0.0     # fraction of streams dropped half way through
+    default_balance: float = 100.0   # balance for keys not listed in `balances`
+    balances: dict = field(default_factory=dict)
+    cost_per_1k_tokens: float = 0.0  # charged against the key's balance
+    models: list = field(default_factory=lambda: list(DEFAULT_MODELS))
+
+
+class MockDisconnect(Exception):
+    """Raised inside a stream to abort the connection mid-response."""
+
+
+def create_app(config: MockConfig) -> FastAPI:
+    app = FastAPI(title="Mock Vercel AI Gateway")
+    balances: dict[str, float] = dict(config.balances)
+    used: dict[str, float] = {}
+    stats = {"requests": 0, "errors": 0, "disconnects": 0, "tokens": 0, "by_route": {}}
+
+    def api_key(request: Request) -> str:
+        """Count the request and return the caller's gateway key."""
+        stats["requests"] += 1
+        route = request.url.path
+        stats["by_route"][route] = stats["by_route"].get(route, 0) + 1
+        auth = request.headers.get("authorization", "")
+        return auth[7:] if auth.startswith("Bearer ") else ""
+
+    def balance(key: str) -> float:
+        return balances.setdefault(key, config.default_balance)
+
+    def charge(key: str, tokens: int):
+        stats["tokens"] += tokens
+        cost = tokens * config.cost_per_1k_tokens / 1000
+        balances[key] = balance(key) - cost
+        used[key] = used.get(key, 0.0) + cost
+
+    def error(status_code: int) -> JSONResponse:
+        stats["errors"] += 1
+        return JSONResponse(
+            status_code=status_code,
+            content={"error": {"message": ERROR_MESSAGES.get(status_code, "Mock error"), "type": "mock_error"}}
+        )
+
+    def injected_error(request: Request, key: str):
+        """Error response for this request, if any (header override, empty balance, random)."""
+        forced = request.headers.get("x-mock-status")
+        if forced:
+            return error(int(forced))
+        if balance(key) <= 0:
+            return error(402)
+        if config.error_rate and random.random() < config.error_rate:
+            return error(random.choice(config.error_codes))
+        return None
+
+    async def wait_latency(request: Request):
+        latency = float(request.headers.get("x-mock-latency-ms", config.latency_ms))
+        if config.jitter_ms:
+            latency += random.uniform(0, config.jitter_ms)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+    async def generate(count: int, token_rate: float):
+        """Pace token generation at `token_rate` tokens per second."""
+        started = time.monotonic()
+        for i in range(count):
+            if token_rate > 0:
+                delay = started + (i + 1) / token_rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield i
+
+    @app.get("/v1/credits")
+    async def credits(request: Request):
+        key = api_key(request)
+        return {"balance": f"{balance(key):.6f}", "total_used": f"{used.get(key, 0.0):.6f}"}
+
+    @app.get("/v1/models")
+    async def models(request: Request):
+        api_key(request)
+        return {
+            "object": "list",
+            "data": [{"id": m, "object": "model", "created": 0, "owned_by": m.split("/")[0]} for m in config.models]
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        data = await request.json()
+        key = api_key(request)
+        err = injected_error(request, key)
+        if err:
+            return err
+
+        model = data.get("model", "mock-model")
+        prompt_tokens = max(1, len(json.dumps(data.get("messages", []))) // 4)
+        completion_tokens = int(request.headers.get("x-mock-completion-tokens", config.completion_tokens))
+        completion_tokens = min(completion_tokens, data.get("max_tokens") or completion_tokens)
+        token_rate = float(request.headers.get("x-mock-token-rate", config.token_rate))
+        reasoning_tokens = config.reasoning_tokens if data.get("reasoning") else 0
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens + reasoning_tokens,
+            "total_tokens": prompt_tokens + completion_tokens + reasoning_tokens
+        }
+        completion_id = f"chatcmpl-mock-{random.getrandbits(48):012x}"
+        created = int(time.time())
+
+        await wait_latency(request)
+
+        if not data.get("stream"):
+            async for _ in generate(completion_tokens + reasoning_tokens, token_rate):
+                pass
+            charge(key, usage["total_tokens"])
+            message = {"role": "assistant", "content": " ".join(f"tok{i}" for i in range(completion_tokens))}
+            if reasoning_tokens:
+                message["reasoning"] = " ".join(f"think{i}" for i in range(reasoning_tokens))
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": usage
+            }
+
+        disconnect = request.headers.get("x-mock-disconnect", "").lower() == "true" or (
+            config.disconnect_rate and random.random() < config.disconnect_rate
+        )
+        include_usage = bool((data.get("stream_options") or {}).get("include_usage"))
+
+        def event(delta: dict, finish_reason=None) -> bytes:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+        async def stream():
+            total = reasoning_tokens + completion_tokens
+            yield event({"role": "assistant", "content": ""})
+            async for i in generate(total, token_rate):
+                if disconnect and i >= total // 2:
+                    stats["disconnects"] += 1
+                    raise MockDisconnect("mock mid-stream disconnect")
+                if i < reasoning_tokens:
+                    yield event({"reasoning": f"think{i} "})
+                else:
+                    yield event({"content": f"tok{i - reasoning_tokens} "})
+            charge(key, usage["total_tokens"])
+            yield event({}, finish_reason="stop")
+            if include_usage:
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                         "model": model, "choices": [], "usage": usage}
+                yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        data = await request.json()
+        key = api_key(request)
+        err = injected_error(request, key)
+        if err:
+            return err
+
+        inputs = data.get("input", [])
+        if not isinstance(inputs, list) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+
+        await wait_latency(request)
+
+        vectors = []
+        tokens = 0
+        for text in inputs:
+            raw = json.dumps(text).encode("utf-8")
+            digest = hashlib.sha256(raw).digest()
+            vectors.append([round(b / 255 - 0.5, 6) for b in digest[:config.embedding_dim]])
+            tokens += max(1, len(raw) // 4)
+        charge(key, tokens)
+
+        return {
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": v} for i, v in enumerate(vectors)],
+            "model": data.get("model", "mock-embedding"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        }
+
+    @app.get("/mock/stats")
+    async def mock_stats():
+        return {**stats, "balances": balances, "used": used}
+
+    return app
+
+
+def parse_balances(raw: str) -> dict:
+    """Parse "key1=5,key2=0.5" into {"key1": 5.0, "key2": 0.5}."""
+    balances = {}
+    for item in raw.split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            balances[key.strip()] = float(value)
+    return balances
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Vercel AI Gateway")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay before the response starts")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="uniform random extra latency")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="tokens per second (0 = instant)")
+    parser.add_argument("--completion-tokens", type=int, default=32)
+    parser.add_argument("--reasoning-tokens", type=int, default=8)
+    parser.add_argument("--embedding-dim", type=int, default=8)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing")
+    parser.add_argument("--error-codes", default="429,500,502,503", help="status codes for injected errors")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="fraction of streams dropped mid-way")
+    parser.add_argument("--default-balance", type=float, default=100.0)
+    parser.add_argument("--keys", default="", help="per-key balances, e.g. vck_a=5,vck_b=0.5")
+    parser.add_argument("--cost-per-1k-tokens", type=float, default=0.0)
+    return parser.parse_args(argv)
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        token_rate=args.token_rate,
+        completion_tokens=args.completion_tokens,
+        reasoning_tokens=args.reasoning_tokens,
+        embedding_dim=args.embedding_dim,
+        error_rate=args.error_rate,
+        error_codes=tuple(int(c) for c in args.error_codes.split(",") if c.strip()),
+        disconnect_rate=args.disconnect_rate,
+        default_balance=args.default_balance,
+        balances=parse_balances(args.keys),
+        cost_per_1k_tokens=args.cost_per_1k_tokens
+    )
+
+
+def main(argv=None):
+    import uvicorn
+
+    args = parse_args(argv)
+    print(f"Mock Vercel AI Gateway on http://{args.host}:{args.port}")
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Replay a recorded traffic trace against the proxy and the mock gateway.
+
+Record traffic by running the proxy with TRAFFIC_RECORD_FILE=data/traffic.jsonl;
+each line holds the shape of one request (model, body size, stream and thinking
+flags, arrival time, response size, status and timing) but no prompt or key.
+This script boots the mock gateway and server.py like loadtest.py, then sends
+requests of the same shape at the recorded arrival times (--speed 2 sends them
+twice as fast). The mock is told, per request, how many tokens to generate and
+how fast, so the upstream timing matches the recording. The report compares the
+replayed latency and throughput with the recorded ones.
+
+Usage:
+    python benchmarks/replay.py data/traffic.jsonl
+    python benchmarks/replay.py data/traffic.jsonl --speed 5 --limit 10000 -o replay.json
+    python benchmarks/replay.py data/traffic.jsonl --no-timing --replay-errors
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import secrets
+import tempfile
+from dataclasses import dataclass
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from loadtest import start_mock, start_proxy, wait_ready, create_client_keys, read_proc, git_commit
+from profiler import percentile
+
+
+@dataclass
+class Replayed:
+    record: dict
+    status: int
+    latency: float   # seconds
+    ttfb: float      # seconds
+    size: int
+    lag: float       # seconds the request was sent after its scheduled time
+    error: str = ""
+
+
+def load_trace(path: str, limit: int = 0) -> list[dict]:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r["ts"])
+    return records[:limit] if limit else records
+
+
+def kind_of(record: dict) -> str:
+    if record["path"].endswith("/embeddings"):
+        return "embeddings"
+    if record.get("think"):
+        return "thinking"
+    return "stream" if record.get("stream") else "nonstream"
+
+
+def padded_body(record: dict) -> dict:
+    """A request body of the recorded shape, padded to the recorded size."""
+    model = record.get("model") or "openai/gpt-4o"
+    if kind_of(record) == "embeddings":
+        body = {"model": model, "input": ""}
+        padded, field = body, "input"
+    else:
+        msgs = max(1, record.get("msgs", 1))
+        body = {"model": model, "messages": [{"role": "user", "content": ""} for _ in range(msgs)]}
+        if record.get("stream"):
+            body["stream"] = True
+        if "max_tokens" in record:
+            body["max_tokens"] = record["max_tokens"]
+        padded, field = body["messages"][0], "content"
+
+    missing = record.get("in", 0) - len(json.dumps(body))
+    if missing > 0:
+        padded[field] = "x" * missing
+    return body
+
+
+async def calibrate(mock_url: str) -> dict[str, tuple[float, float]]:
+    """Response bytes as (fixed, per token) for each kind, measured on the mock directly."""
+    sizes = {}
+    async with httpx.AsyncClient(base_url=mock_url, timeout=30) as client:
+        for kind, body in (
+            ("stream", {"model": "m", "messages": [], "stream": True}),
+            ("thinking", {"model": "m", "messages": [], "stream": True, "reasoning": {"enabled": True}}),
+            ("nonstream", {"model": "m", "messages": []}),
+        ):
+            measured = []
+            for tokens in (10, 110):
+                resp = await client.post("/v1/chat/completions", json=body,
+                                         headers={"X-Mock-Completion-Tokens": str(tokens)})
+                measured.append(len(resp.content))
+            per_token = (measured[1] - measured[0]) / 100
+            sizes[kind] = (measured[0] - 10 * per_token, per_token)
+    return sizes
+
+
+def mock_headers(record: dict, sizes: dict, args) -> dict:
+    """X-Mock-* headers that make the mock answer like the recorded upstream did."""
+    headers = {}
+    kind = kind_of(record)
+    if args.replay_errors and record.get("status", 200) >= 400:
+        headers["X-Mock-Status"] = str(record["status"])
+        return headers
+    if kind in sizes:
+        fixed, per_token = sizes[kind]
+        tokens = max(1, int((record.get("out", 0) - fixed) / per_token)) if per_token > 0 else 1
+        headers["X-Mock-Completion-Tokens"] = str(tokens)
+    if not args.no_timing:
+        ttfb_ms = record.get("ttfb_ms", 0)
+        headers["X-Mock-Latency-Ms"] = str(ttfb_ms)
+        generation_s = (record.get("ms", 0) - ttfb_ms) / 1000
+        if record.get("stream") and generation_s > 0 and "X-Mock-Completion-Tokens" in headers:
+            headers["X-Mock-Token-Rate"] = str(int(headers["X-Mock-Completion-Tokens"]) / generation_s)
+    return headers
+
+
+async def send(client: httpx.AsyncClient, record: dict, key: str, headers: dict, lag: float) -> Replayed:
+    start = time.perf_counter()
+    ttfb = 0.0
+    size = 0
+    body = padded_body(record) if record.get("method", "POST") != "GET" else None
+    try:
+        async with client.stream(record.get("method", "POST"), record["path"], json=body,
+                                 headers={**headers, "Authorization": f"Bearer {key}"}) as resp:
+            async for chunk in resp.aiter_raw():
+                if not size:
+                    ttfb = time.perf_counter() - start
+                size += len(chunk)
+        return Replayed(record, resp.status_code, time.perf_counter() - start, ttfb, size, lag)
+    except httpx.HTTPError as e:
+        return Replayed(record, 0, time.perf_counter() - start, ttfb, size, lag, error=type(e).__name__)
+
+
+async def replay(args, records: list[dict], base: str, client_keys: list[str], sizes: dict) -> tuple[list[Replayed], float]:
+    key_ids = sorted({r.get("key") or "" for r in records})
+    key_for = {key_id: client_keys[i % len(client_keys)] for i, key_id in enumerate(key_ids)}
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    t0 = records[0]["ts"]
+
+    async with httpx.AsyncClient(base_url=base, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        tasks = []
+        for record in records:
+            due = started + (record["ts"] - t0) / args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(
+                client, record, key_for[record.get("key") or ""],
+                mock_headers(record, sizes, args), max(0.0, time.perf_counter() - due)
+            )))
+        results = await asyncio.gather(*tasks)
+        return results, time.perf_counter() - started
+
+
+def percentiles(values: list[float]) -> dict:
+    return {f"p{p}": round(percentile(values, p), 1) for p in (50, 95, 99)}
+
+
+def compare(records: list[dict], results: list[Replayed], wall: float, speed: float) -> dict:
+    """Recorded vs replayed latency, TTFB and throughput, overall and per request kind."""
+    def section(recs: list[dict], reps: list[Replayed]) -> dict:
+        ok = [r for r in reps if 200 <= r.status < 300]
+        span = (recs[-1]["ts"] - recs[0]["ts"]) if len(recs) > 1 else 0
+        return {
+            "requests": len(reps),
+            "recorded": {
+                # The rate the replay aims for: the recorded rate times --speed
+                "rps": round(len(recs) / span * speed, 1) if span else 0.0,
+                "latency_ms": percentiles([r.get("ms", 0) for r in recs]),
+                "ttfb_ms": percentiles([r.get("ttfb_ms", 0) for r in recs]),
+                "errors": sum(1 for r in recs if r.get("status", 200) >= 400),
+            },
+            "replayed": {
+                "rps": round(len(ok) / wall, 1) if wall else 0.0,
+                "latency_ms": percentiles([r.latency * 1000 for r in ok]),
+                "ttfb_ms": percentiles([r.ttfb * 1000 for r in ok]),
+                "errors": len(reps) - len(ok),
+            },
+        }
+
+    by_kind = {}
+    for kind in sorted({kind_of(r) for r in records}):
+        reps = [r for r in results if kind_of(r.record) == kind]
+        by_kind[kind] = section([r.record for r in reps], reps)
+
+    statuses: dict[str, int] = {}
+    for r in results:
+        label = str(r.status) if r.status else r.error
+        statuses[label] = statuses.get(label, 0) + 1
+
+    return {
+        "all": section(records, results),
+        "by_kind": by_kind,
+        "statuses": statuses,
+        "send_lag_ms": percentiles([r.lag * 1000 for r in results]),
+    }
+
+
+def print_report(result: dict):
+    report = result["report"]
+    print(f"\nReplayed {report['all']['requests']} requests at {result['params']['speed']}x "
+          f"in {result['wall_s']}s\n")
+    print(f"{'kind':>11} {'':>9} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'ttfb50':>9} {'ttfb99':>9} {'errors':>7}")
+    for name, section in [("all", report["all"])] + list(report["by_kind"].items()):
+        for label in ("recorded", "replayed"):
+            s = section[label]
+            lat, ttfb = s["latency_ms"], s["ttfb_ms"]
+            print(f"{name if label == 'recorded' else '':>11} {label:>9} {s['rps']:>8} {lat['p50']:>9} "
+                  f"{lat['p95']:>9} {lat['p99']:>9} {ttfb['p50']:>9} {ttfb['p99']:>9} {s['errors']:>7}")
+
+    proxy = result["proxy"]
+    print(f"\nproxy cpu: {proxy['cpu_percent']}% ({proxy['cpu_ms_per_request']} ms/request), "
+          f"rss: {proxy['rss_mb_max']} MB max")
+    print(f"statuses: {report['statuses']}")
+    lag = report["send_lag_ms"]
+    print(f"send lag p99: {lag['p99']} ms")
+    if lag["p99"] > 50:
+        print("Warning: requests went out late; the replayer could not keep up with the schedule")
+
+
+async def main_async(args):
+    records = load_trace(args.trace, args.limit)
+    if not records:
+        raise SystemExit(f"No records in {args.trace}")
+
+    workdir = tempfile.mkdtemp(prefix="lb-replay-")
+    base = f"http://127.0.0.1:{args.port}"
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock = start_mock(args)
+    proxy = start_proxy(args, workdir)
+
+    try:
+        await wait_ready(f"{mock_url}/v1/models", mock, "mock gateway")
+        await wait_ready(f"{base}/health", proxy, "proxy")
+        sizes = await calibrate(mock_url)
+        distinct_keys = len({r.get("key") for r in records})
+        client_keys = await create_client_keys(base, args.admin_secret, min(distinct_keys, args.client_keys))
+
+        rss_samples = []
+
+        async def sample_rss():
+            while True:
+                rss_samples.append(read_proc(proxy.pid)[1])
+                await asyncio.sleep(0.5)
+
+        sampler = asyncio.create_task(sample_rss())
+        cpu_before = read_proc(proxy.pid)[0]
+        results, wall = await replay(args, records, base, client_keys, sizes)
+        cpu = read_proc(proxy.pid)[0] - cpu_before
+        sampler.cancel()
+    finally:
+        proxy.terminate()
+        mock.terminate()
+        proxy.wait()
+        mock.wait()
+
+    result = {
+        "commit": git_commit(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("admin_secret", "output")},
+        "wall_s": round(wall, 2),
+        "report": compare(records, results, wall, args.speed),
+        "proxy": {
+            "cpu_s": round(cpu, 3),
+            "cpu_percent": round(cpu / wall * 100, 1) if wall else 0.0,
+            "cpu_ms_per_request": round(cpu / len(results) * 1000, 3) if results else 0.0,
+            "rss_mb_max": round(max(rss_samples, default=0) / 2**20, 1),
+        },
+    }
+    print_report(result)
+    print(f"Proxy log: {os.path.join(workdir, 'proxy.log')}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded traffic trace against the mock gateway")
+    parser.add_argument("trace", help="JSONL trace written by the proxy's traffic recorder")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed (2 = twice as fast)")
+    parser.add_argument("--limit", type=int, default=0, help="Replay only the first N requests")
+    parser.add_argument("--no-timing", action="store_true",
+                        help="Ignore recorded upstream timing and use the mock's defaults")
+    parser.add_argument("--replay-errors", action="store_true",
+                        help="Have the mock return the recorded error statuses")
+    parser.add_argument("--port", type=int, default=8792, help="Proxy port")
+    parser.add_argument("--mock-port", type=int, default=8793, help="Mock gateway port")
+    parser.add_argument("--client-keys", type=int, default=100, help="Most client keys to create")
+    parser.add_argument("--vercel-keys", type=int, default=5, help="Vercel keys in the mock's key list")
+    parser.add_argument("--max-connections", type=int, default=1000, help="Client connection pool size")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Client timeout per request")
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for the proxy (repeatable)")
+    parser.add_argument("--admin-secret", default=secrets.token_urlsafe(16), help=argparse.SUPPRESS)
+    parser.add_argument("--output", "-o", help="Write JSON results to this file")
+    # Mock settings for anything the per-request X-Mock-* headers don't override
+    parser.set_defaults(latency_ms=0.0, token_rate=0.0, completion_tokens=32, error_rate=0.0)
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Offline key-routing simulator: compare Vercel key selection strategies before rollout.
+
+Replays a request/cost trace against a simulated pool of Vercel keys with
+balances, in simulated time (no network, runs in seconds). Like the real
+VercelKeyManager, strategies only see balances as of the last credit refresh
+(every --refresh-interval seconds); the simulated gateway answers 402 when a
+key's actual balance is used up and charges each request's cost when it
+completes. --zero-on-402 models a proxy that stops using a key after a 402.
+
+Strategies:
+    weighted_random        the current production selection (routing.select_weighted_random)
+    least_loaded           fewest in-flight requests, then highest balance
+    drain_smallest_first   smallest balance that still covers a typical request
+    latency_aware          lowest observed latency x (in-flight + 1), power of two choices
+
+Reported per strategy: 402 and no-key (503) rates, latency percentiles, credit left
+stranded on keys too small to serve a request (fragmentation / wasted credit) and
+CPU time per selection.
+
+Usage:
+    python benchmarks/simulate_routing.py
+    python benchmarks/simulate_routing.py --requests 200000 --rps 100 --key-count 50 --balance-mean 2
+    python benchmarks/simulate_routing.py --balances 5,5,0.5,0.2,20 --cost-mean 0.01
+    python benchmarks/simulate_routing.py --trace data/traffic.jsonl --usd-per-kb 0.002 -o routing.json
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import argparse
+from dataclasses import dataclass
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from routing import select_weighted_random
+from profiler import percentile
+
+MIN_CREDIT = 0.01
+
+
+@dataclass
+class SimRequest:
+    arrival: float   # seconds since the start of the trace
+    duration: float  # seconds on a key with latency factor 1.0
+    cost: float      # USD charged when the request completes
+
+
+@dataclass
+class SimKey:
+    api_key: str
+    name: str
+    actual: float           # real balance at the gateway
+    latency_factor: float   # how much slower than nominal this key's requests run
+    balance: float = 0.0    # balance as last seen by the proxy (what strategies read)
+    inflight: int = 0
+    latency_ewma: float = 0.0
+
+    def as_dict(self) -> dict:
+        return {"api_key": self.api_key, "name": self.name, "balance": self.balance}
+
+
+# === Strategies ===
+# Each takes the key pool and the request context and returns a SimKey or None.
+
+def weighted_random(keys: list[SimKey], ctx: dict):
+    # Run the production code on the same dicts the key manager keeps
+    chosen = select_weighted_random(ctx["views"], min_credit=MIN_CREDIT)
+    return ctx["by_api_key"][chosen["api_key"]] if chosen else None
+
+
+def least_loaded(keys: list[SimKey], ctx: dict):
+    available = [k for k in keys if k.balance > MIN_CREDIT]
+    if not available:
+        return None
+    return min(available, key=lambda k: (k.inflight, -k.balance))
+
+
+def drain_smallest_first(keys: list[SimKey], ctx: dict):
+    # Empty small keys completely before touching big ones, but skip keys that
+    # likely cannot cover a typical request (they would only produce 402s)
+    floor = max(MIN_CREDIT, ctx["typical_cost"])
+    available = [k for k in keys if k.balance - k.inflight * ctx["typical_cost"] > floor]
+    if not available:
+        available = [k for k in keys if k.balance > MIN_CREDIT]
+    if not available:
+        return None
+    return min(available, key=lambda k: k.balance)
+
+
+def latency_aware(keys: list[SimKey], ctx: dict):
+    available = [k for k in keys if k.balance > MIN_CREDIT]
+    if not available:
+        return None
+    if len(available) == 1:
+        return available[0]
+    # Power of two choices keeps a fast key from receiving every request at once
+    def score(k: SimKey) -> float:
+        return (k.latency_ewma or ctx["nominal_latency"]) * (k.inflight + 1)
+
+    a, b = ctx["rng"].sample(available, 2)
+    return a if score(a) <= score(b) else b
+
+
+STRATEGIES = {
+    "weighted_random": weighted_random,
+    "least_loaded": least_loaded,
+    "drain_smallest_first": drain_smallest_first,
+    "latency_aware": latency_aware,
+}
+
+
+# === Inputs ===
+
+def synthetic_trace(args, rng: random.Random) -> list[SimRequest]:
+    """Poisson arrivals with log-normal durations and costs."""
+    requests = []
+    t = 0.0
+    for _ in range(args.requests):
+        t += rng.expovariate(args.rps)
+        requests.append(SimRequest(
+            arrival=t,
+            duration=rng.lognormvariate(0, 0.8) * args.duration_mean / 1.377,  # mean of lognorm(0, 0.8) is ~1.377
+            cost=rng.lognormvariate(0, 1.0) * args.cost_mean / 1.649            # mean of lognorm(0, 1) is ~1.649
+        ))
+    return requests
+
+
+def recorded_trace(path: str, usd_per_kb: float) -> list[SimRequest]:
+    """Requests from a TRAFFIC_RECORD_FILE trace; cost is estimated from request and response size."""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r["ts"])
+    if not records:
+        return []
+    t0 = records[0]["ts"]
+    return [
+        SimRequest(
+            arrival=r["ts"] - t0,
+            duration=r.get("ms", 0) / 1000,
+            cost=(r.get("in", 0) + r.get("out", 0)) / 1024 * usd_per_kb
+        )
+        for r in records if r.get("status", 200) < 400
+    ]
+
+
+def make_keys(args, rng: random.Random) -> list[SimKey]:
+    if args.balances:
+        balances = [float(b) for b in args.balances.split(",") if b.strip()]
+    else:
+        balances = [rng.lognormvariate(0, 1.0) * args.balance_mean / 1.649 for _ in range(args.key_count)]
+    return [
+        SimKey(
+            api_key=f"vck_sim_{i}",
+            name=f"sim-{i}",
+            actual=balance,
+            latency_factor=rng.uniform(1 - args.latency_spread, 1 + args.latency_spread)
+        )
+        for i, balance in enumerate(balances)
+    ]
+
+
+# === Simulation ===
+
+def simulate(strategy, requests: list[SimRequest], keys: list[SimKey], args, seed: int) -> dict:
+    rng = random.Random(seed)
+    random.seed(seed)  # select_weighted_random uses the module-level generator
+    for k in keys:
+        k.balance = k.actual
+
+    views = [k.as_dict() for k in keys]
+    ctx = {
+        "rng": rng,
+        "views": views,
+        "by_api_key": {k.api_key: k for k in keys},
+        "typical_cost": percentile([r.cost for r in requests], 90),
+        "nominal_latency": percentile([r.duration for r in requests], 50),
+    }
+    initial_credit = sum(k.actual for k in keys)
+
+    # Event queue: (time, order, kind, payload)
+    events = [(r.arrival, i, "arrival", r) for i, r in enumerate(requests)]
+    heapq.heapify(events)
+    order = len(events)
+    next_refresh = args.refresh_interval
+
+    served = payment_required = no_key = 0
+    first_402_at = None
+    latencies = []
+    selection_ns = 0
+    selections = 0
+
+    while events:
+        now, _, kind, payload = heapq.heappop(events)
+
+        # Credit refresh: the proxy's view catches up with the gateway
+        while now >= next_refresh:
+            for k, view in zip(keys, views):
+                k.balance = k.actual
+                view["balance"] = k.actual
+            next_refresh += args.refresh_interval
+
+        if kind == "arrival":
+            started = time.perf_counter_ns()
+            key = strategy(keys, ctx)
+            selection_ns += time.perf_counter_ns() - started
+            selections += 1
+
+            if key is None:
+                no_key += 1
+                continue
+            if key.actual <= 0:
+                # The gateway refuses requests on an exhausted key
+                payment_required += 1
+                if first_402_at is None:
+                    first_402_at = now
+                if args.zero_on_402:
+                    key.balance = 0.0
+                    ctx["views"][keys.index(key)]["balance"] = 0.0
+                continue
+
+            key.inflight += 1
+            duration = payload.duration * key.latency_factor
+            order += 1
+            heapq.heappush(events, (now + duration, order, "done", (key, payload, duration)))
+        else:
+            key, request, duration = payload
+            key.inflight -= 1
+            key.actual -= request.cost
+            key.latency_ewma = duration if not key.latency_ewma else 0.8 * key.latency_ewma + 0.2 * duration
+            latencies.append(duration)
+            served += 1
+
+    total = len(requests)
+    typical = ctx["typical_cost"]
+    stranded = [k.actual for k in keys if 0 < k.actual < typical]
+    remaining = sum(max(0.0, k.actual) for k in keys)
+    overdraft = sum(-k.actual for k in keys if k.actual < 0)
+    return {
+        "served": served,
+        "payment_required_rate": round(payment_required / total, 4) if total else 0.0,
+        "no_key_rate": round(no_key / total, 4) if total else 0.0,
+        "first_402_at_s": round(first_402_at, 1) if first_402_at is not None else None,
+        "latency_s": {f"p{p}": round(percentile(latencies, p), 3) for p in (50, 95, 99)},
+        "credit_used": round(initial_credit - remaining, 4),
+        "credit_remaining": round(remaining, 4),
+        # Balances too small to cover a typical request: fragmented, effectively wasted credit
+        "stranded_keys": len(stranded),
+        "stranded_credit": round(sum(stranded), 4),
+        "wasted_pct": round(sum(stranded) / initial_credit * 100, 2) if initial_credit else 0.0,
+        "overdraft": round(overdraft, 4),
+        "selection_us": round(selection_ns / selections / 1000, 2) if selections else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline key-routing simulator")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES),
+                        help=f"Comma-separated strategies: {', '.join(STRATEGIES)}")
+    parser.add_argument("--trace", help="TRAFFIC_RECORD_FILE trace to replay instead of synthetic traffic")
+    parser.add_argument("--usd-per-kb", type=float, default=0.001, help="Cost estimate for recorded traces")
+    parser.add_argument("--requests", type=int, default=50000, help="Synthetic requests")
+    parser.add_argument("--rps", type=float, default=20.0, help="Synthetic arrival rate")
+    parser.add_argument("--duration-mean", type=float, default=4.0, help="Mean request duration (s)")
+    parser.add_argument("--cost-mean", type=float, default=0.003, help="Mean request cost (USD)")
+    parser.add_argument("--balances", help="Explicit key balances, e.g. 5,5,0.5,20")
+    parser.add_argument("--key-count", type=int, default=20, help="Keys when --balances is not given")
+    parser.add_argument("--balance-mean", type=float, default=5.0, help="Mean key balance (USD)")
+    parser.add_argument("--latency-spread", type=float, default=0.3,
+                        help="Per-key latency factor is uniform in 1 +- this")
+    parser.add_argument("--refresh-interval", type=float, default=300.0, help="Seconds between credit refreshes")
+    parser.add_argument("--zero-on-402", action="store_true",
+                        help="Treat a key as empty as soon as it returns 402 (the proxy does not do this today)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", "-o", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    names = [n for n in args.strategies.split(",") if n]
+    unknown = set(names) - set(STRATEGIES)
+    if unknown:
+        parser.error(f"unknown strategy: {', '.join(sorted(unknown))}")
+
+    rng = random.Random(args.seed)
+    requests = recorded_trace(args.trace, args.usd_per_kb) if args.trace else synthetic_trace(args, rng)
+    if not requests:
+        parser.error("no requests to simulate")
+    key_seed = rng.random()
+
+    results = {}
+    for name in names:
+        # Every strategy gets an identical pool and trace
+        keys = make_keys(args, random.Random(key_seed))
+        results[name] = simulate(STRATEGIES[name], requests, keys, args, args.seed)
+
+    pool = make_keys(args, random.Random(key_seed))
+    demand = sum(r.cost for r in requests)
+    print(f"\n{len(requests)} requests over {requests[-1].arrival:.0f}s, demand ${demand:.2f}; "
+          f"{len(pool)} keys, credit ${sum(k.actual for k in pool):.2f}\n")
+    print(f"{'strategy':>22} {'402 rate':>9} {'503 rate':>9} {'first 402':>10} {'p99 (s)':>8} "
+          f"{'stranded':>9} {'wasted':>8} {'overdraft':>10} {'select us':>10}")
+    for name, r in results.items():
+        first = f"{r['first_402_at_s']}s" if r["first_402_at_s"] is not None else "-"
+        print(f"{name:>22} {r['payment_required_rate']:>9.2%} {r['no_key_rate']:>9.2%} {first:>10} "
+              f"{r['latency_s']['p99']:>8} {r['stranded_keys']:>4} keys {r['wasted_pct']:>7}% "
+              f"{r['overdraft']:>10} {r['selection_us']:>10}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"params": vars(args), "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ Usage:
     python cli.py get-key <key-id>
     python cli.py delete-key <key-id>
     python cli.py update-key <key-id> --name "New Name" --rate-limit 100
+    python cli.py update-key <key-id> --max-concurrency 4 --priority -1 --weight 1
+    python cli.py update-key <key-id> --tpm-limit 100000 --daily-budget 5 --monthly-budget 100
     python cli.py key-stats <key-id>
 """
 
@@ -20,6 +22,7 @@ from database import (
     init_database, create_key, list_keys, get_key_by_id,
     update_key, delete_key, get_key_stats
 )
+from state_backend import state_backend
 
 
 def format_datetime(dt: datetime) -> str:
@@ -29,14 +32,52 @@ def format_datetime(dt: datetime) -> str:
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
 
+def format_scheduling(key) -> str:
+    """Concurrency limit, priority and weight for display."""
+    concurrency = str(key.max_concurrency) if key.max_concurrency > 0 else "unlimited"
+    return f"concurrency {concurrency}, priority {key.priority}, weight {key.weight}"
+
+
+def format_quotas(key) -> str:
+    """Token rate and spend quotas for display."""
+    quotas = []
+    if key.tpm_limit > 0:
+        quotas.append(f"{key.tpm_limit} tokens/min")
+    if key.daily_budget_usd > 0:
+        quotas.append(f"${key.daily_budget_usd:g}/day")
+    if key.monthly_budget_usd > 0:
+        quotas.append(f"${key.monthly_budget_usd:g}/month")
+    return ", ".join(quotas) if quotas else "Unlimited"
+
+
+def check_quota_args(args):
+    """Exit if a quota argument is negative."""
+    for name in ("tpm_limit", "daily_budget", "monthly_budget"):
+        value = getattr(args, name)
+        if value is not None and value < 0:
+            print(f"\n✗ --{name.replace('_', '-')} must not be negative\n")
+            sys.exit(1)
+
+
 async def cmd_create_key(args):
     """Create a new API key."""
+    if args.weight < 1:
+        print("\n✗ --weight must be at least 1\n")
+        sys.exit(1)
+    check_quota_args(args)
+
     await init_database()
 
     raw_key, api_key = await create_key(
         name=args.name,
         rate_limit=args.rate_limit,
-        expires_in_days=args.expires
+        expires_in_days=args.expires,
+        max_concurrency=args.max_concurrency,
+        priority=args.priority,
+        weight=args.weight,
+        tpm_limit=args.tpm_limit,
+        daily_budget_usd=args.daily_budget,
+        monthly_budget_usd=args.monthly_budget
     )
 
     print("\n" + "=" * 60)
@@ -48,6 +89,8 @@ async def cmd_create_key(args):
     print(f"  ID:         {api_key.id}")
     print(f"  Name:       {api_key.name}")
     print(f"  Rate Limit: {api_key.rate_limit} req/min" if api_key.rate_limit > 0 else "  Rate Limit: Unlimited")
+    print(f"  Scheduling: {format_scheduling(api_key)}")
+    print(f"  Quotas:     {format_quotas(api_key)}")
     print(f"  Expires:    {format_datetime(api_key.expires_at)}")
     print(f"  Created:    {format_datetime(api_key.created_at)}")
     print("=" * 60 + "\n")
@@ -78,11 +121,13 @@ async def cmd_list_keys(args):
             key.name,
             status,
             rate,
+            format_scheduling(key),
+            format_quotas(key),
             format_datetime(key.expires_at),
             format_datetime(key.created_at)
         ])
 
-    headers = ["ID", "Name", "Status", "Rate Limit", "Expires", "Created"]
+    headers = ["ID", "Name", "Status", "Rate Limit", "Scheduling", "Quotas", "Expires", "Created"]
     print("\n" + tabulate(table_data, headers=headers, tablefmt="grid") + "\n")
     print(f"Total: {len(keys)} key(s)\n")
 
@@ -108,6 +153,8 @@ async def cmd_get_key(args):
     print(f"  Name:       {api_key.name}")
     print(f"  Status:     {status}")
     print(f"  Rate Limit: {api_key.rate_limit} req/min" if api_key.rate_limit > 0 else "  Rate Limit: Unlimited")
+    print(f"  Scheduling: {format_scheduling(api_key)}")
+    print(f"  Quotas:     {format_quotas(api_key)}")
     print(f"  Expires:    {format_datetime(api_key.expires_at)}")
     print(f"  Created:    {format_datetime(api_key.created_at)}")
     print("=" * 50 + "\n")
@@ -132,6 +179,10 @@ async def cmd_delete_key(args):
     success = await delete_key(args.key_id)
 
     if success:
+        # Running servers drop the key from their auth cache (redis backend only;
+        # with the memory backend it expires after AUTH_CACHE_TTL)
+        await state_backend.invalidate_key(args.key_id)
+        await state_backend.stop()
         print(f"\n✓ Key deleted: {args.key_id}\n")
     else:
         print(f"\n✗ Key not found: {args.key_id}\n")
@@ -148,6 +199,11 @@ async def cmd_update_key(args):
         print(f"\n✗ Key not found: {args.key_id}\n")
         sys.exit(1)
 
+    if args.weight is not None and args.weight < 1:
+        print("\n✗ --weight must be at least 1\n")
+        sys.exit(1)
+    check_quota_args(args)
+
     # Build update params
     expires_at = None
     if args.expires is not None:
@@ -166,11 +222,21 @@ async def cmd_update_key(args):
         name=args.name,
         rate_limit=args.rate_limit,
         is_active=is_active,
-        expires_at=expires_at
+        expires_at=expires_at,
+        max_concurrency=args.max_concurrency,
+        priority=args.priority,
+        weight=args.weight,
+        tpm_limit=args.tpm_limit,
+        daily_budget_usd=args.daily_budget,
+        monthly_budget_usd=args.monthly_budget
     )
+    await state_backend.invalidate_key(args.key_id)
+    await state_backend.stop()
 
     print(f"\n✓ Key updated: {updated.name}")
     print(f"  Rate Limit: {updated.rate_limit} req/min" if updated.rate_limit > 0 else "  Rate Limit: Unlimited")
+    print(f"  Scheduling: {format_scheduling(updated)}")
+    print(f"  Quotas: {format_quotas(updated)}")
     print(f"  Active: {updated.is_active}")
     print(f"  Expires: {format_datetime(updated.expires_at)}\n")
 
@@ -191,6 +257,7 @@ async def cmd_key_stats(args):
     print("=" * 50)
     print(f"  Total Requests: {stats['total_requests']}")
     print(f"  Total Tokens:   {stats['total_tokens']}")
+    print(f"  Cache Hits:     {stats['cache_hits']}")
 
     if stats['by_endpoint']:
         print("\n  By Endpoint:")
@@ -236,6 +303,18 @@ def main():
                                help="Rate limit in requests per minute (0 = unlimited)")
     create_parser.add_argument("--expires", "-e", type=int, default=None,
                                help="Expiration in days (default: never)")
+    create_parser.add_argument("--max-concurrency", type=int, default=0,
+                               help="Upstream requests in flight at once (0 = unlimited)")
+    create_parser.add_argument("--priority", type=int, default=0,
+                               help="Higher priorities get free upstream slots first (default: 0)")
+    create_parser.add_argument("--weight", type=int, default=1,
+                               help="Share of upstream slots among keys with the same priority (default: 1)")
+    create_parser.add_argument("--tpm-limit", type=int, default=0,
+                               help="Tokens per minute (0 = unlimited)")
+    create_parser.add_argument("--daily-budget", type=float, default=0,
+                               help="Spend per UTC day in USD (0 = unlimited)")
+    create_parser.add_argument("--monthly-budget", type=float, default=0,
+                               help="Spend per UTC month in USD (0 = unlimited)")
     create_parser.set_defaults(func=cmd_create_key)
 
     # list-keys command
@@ -259,6 +338,12 @@ def main():
     update_parser.add_argument("--name", "-n", help="New name")
     update_parser.add_argument("--rate-limit", "-r", type=int, help="New rate limit")
     update_parser.add_argument("--expires", "-e", type=int, help="New expiration in days")
+    update_parser.add_argument("--max-concurrency", type=int, help="New concurrency limit (0 = unlimited)")
+    update_parser.add_argument("--priority", type=int, help="New priority")
+    update_parser.add_argument("--weight", type=int, help="New weight")
+    update_parser.add_argument("--tpm-limit", type=int, help="New tokens per minute (0 = unlimited)")
+    update_parser.add_argument("--daily-budget", type=float, help="New daily spend in USD (0 = unlimited)")
+    update_parser.add_argument("--monthly-budget", type=float, help="New monthly spend in USD (0 = unlimited)")
     update_parser.add_argument("--activate", action="store_true", help="Activate the key")
     update_parser.add_argument("--deactivate", action="store_true", help="Deactivate the key")
     update_parser.set_defaults(func=cmd_update_key)
@@ -24,6 +24,12 @@ class APIKey:
     expires_at: Optional[datetime]
     rate_limit: int  # requests per minute, 0 = unlimited
     is_active: bool
+    max_concurrency: int = 0  # upstream requests in flight at once, 0 = unlimited
+    priority: int = 0  # higher priorities get free upstream slots first
+    weight: int = 1  # share of upstream slots among keys with the same priority
+    tpm_limit: int = 0  # tokens per minute, 0 = unlimited
+    daily_budget_usd: float = 0  # spend per UTC day, 0 = unlimited
+    monthly_budget_usd: float = 0  # spend per UTC month, 0 = unlimited
 
 @dataclass
 class UsageLog:
@@ -33,6 +39,7 @@ class UsageLog:
     endpoint: str
     tokens_used: Optional[int]
     model: Optional[str]
+    cached: bool = False
 
 
 def hash_key(key: str) -> str:
@@ -46,9 +53,22 @@ def generate_api_key() -> str:
     return f"sk-lb-{random_part}"
 
 
+async def _add_missing_columns(db: aiosqlite.Connection, table: str, columns: dict[str, str]):
+    """Add columns to an existing table if they are not there yet."""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        existing = {row[1] for row in await cursor.fetchall()}
+
+    for name, definition in columns.items():
+        if name not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
 async def init_database():
     """Initialize the database with required tables."""
     async with aiosqlite.connect(DATABASE_PATH) as db:
+        # WAL lets several workers read while one writes (persists in the database file)
+        await db.execute("PRAGMA journal_mode=WAL")
+
         # Create api_keys table
         await db.execute("""
             CREATE TABLE IF NOT EXISTS api_keys (
@@ -58,7 +78,13 @@ async def init_database():
                 created_at TEXT NOT NULL,
                 expires_at TEXT,
                 rate_limit INTEGER DEFAULT 0,
-                is_active INTEGER DEFAULT 1
+                is_active INTEGER DEFAULT 1,
+                max_concurrency INTEGER DEFAULT 0,
+                priority INTEGER DEFAULT 0,
+                weight INTEGER DEFAULT 1,
+                tpm_limit INTEGER DEFAULT 0,
+                daily_budget_usd REAL DEFAULT 0,
+                monthly_budget_usd REAL DEFAULT 0
             )
         """)
 
@@ -71,10 +97,34 @@ async def init_database():
                 endpoint TEXT NOT NULL,
                 tokens_used INTEGER,
                 model TEXT,
+                cached INTEGER DEFAULT 0,
                 FOREIGN KEY (key_id) REFERENCES api_keys(id)
             )
         """)
 
+        # Add columns introduced after the initial schema
+        await _add_missing_columns(db, "usage_logs", {
+            "cached": "INTEGER DEFAULT 0"
+        })
+        await _add_missing_columns(db, "api_keys", {
+            "max_concurrency": "INTEGER DEFAULT 0",
+            "priority": "INTEGER DEFAULT 0",
+            "weight": "INTEGER DEFAULT 1",
+            "tpm_limit": "INTEGER DEFAULT 0",
+            "daily_budget_usd": "REAL DEFAULT 0",
+            "monthly_budget_usd": "REAL DEFAULT 0"
+        })
+
+        # Spend per key and quota period ("2024-05-31" or "2024-05"), written by the quota tracker
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS quota_spend (
+                key_id TEXT NOT NULL,
+                period TEXT NOT NULL,
+                spent_usd REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (key_id, period)
+            )
+        """)
+
         # Create indexes for better performance
         await db.execute("CREATE INDEX IF NOT EXISTS idx_usage_key_id ON usage_logs(key_id)")
         await db.execute("CREATE INDEX IF NOT EXISTS idx_usage_timestamp ON usage_logs(timestamp)")
@@ -86,7 +136,13 @@ async def init_database():
 async def create_key(
     name: str,
     rate_limit: int = 0,
-    expires_in_days: Optional[int] = None
+    expires_in_days: Optional[int] = None,
+    max_concurrency: int = 0,
+    priority: int = 0,
+    weight: int = 1,
+    tpm_limit: int = 0,
+    daily_budget_usd: float = 0,
+    monthly_budget_usd: float = 0
 ) -> tuple[str, APIKey]:
     """
     Create a new API key.
@@ -105,8 +161,11 @@ async def create_key(
     async with aiosqlite.connect(DATABASE_PATH) as db:
         await db.execute(
             """
-            INSERT INTO api_keys (id, key_hash, name, created_at, expires_at, rate_limit, is_active)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO api_keys (
+                id, key_hash, name, created_at, expires_at, rate_limit, is_active,
+                max_concurrency, priority, weight, tpm_limit, daily_budget_usd, monthly_budget_usd
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
             (
                 key_id,
@@ -115,7 +174,13 @@ async def create_key(
                 created_at.isoformat(),
                 expires_at.isoformat() if expires_at else None,
                 rate_limit,
-                1
+                1,
+                max_concurrency,
+                priority,
+                weight,
+                tpm_limit,
+                daily_budget_usd,
+                monthly_budget_usd
             )
         )
         await db.commit()
@@ -127,7 +192,13 @@ async def create_key(
         created_at=created_at,
         expires_at=expires_at,
         rate_limit=rate_limit,
-        is_active=True
+        is_active=True,
+        max_concurrency=max_concurrency,
+        priority=priority,
+        weight=weight,
+        tpm_limit=tpm_limit,
+        daily_budget_usd=daily_budget_usd,
+        monthly_budget_usd=monthly_budget_usd
     )
 
     return raw_key, api_key
@@ -169,7 +240,13 @@ async def validate_key(raw_key: str) -> Optional[APIKey]:
                 created_at=datetime.fromisoformat(row["created_at"]),
                 expires_at=expires_at,
                 rate_limit=row["rate_limit"],
-                is_active=bool(row["is_active"])
+                is_active=bool(row["is_active"]),
+                max_concurrency=row["max_concurrency"],
+                priority=row["priority"],
+                weight=row["weight"],
+                tpm_limit=row["tpm_limit"],
+                daily_budget_usd=row["daily_budget_usd"],
+                monthly_budget_usd=row["monthly_budget_usd"]
             )
 
 
@@ -197,7 +274,13 @@ async def get_key_by_id(key_id: str) -> Optional[APIKey]:
                 created_at=datetime.fromisoformat(row["created_at"]),
                 expires_at=expires_at,
                 rate_limit=row["rate_limit"],
-                is_active=bool(row["is_active"])
+                is_active=bool(row["is_active"]),
+                max_concurrency=row["max_concurrency"],
+                priority=row["priority"],
+                weight=row["weight"],
+                tpm_limit=row["tpm_limit"],
+                daily_budget_usd=row["daily_budget_usd"],
+                monthly_budget_usd=row["monthly_budget_usd"]
             )
 
 
@@ -221,7 +304,13 @@ async def list_keys() -> list[APIKey]:
                     created_at=datetime.fromisoformat(row["created_at"]),
                     expires_at=expires_at,
                     rate_limit=row["rate_limit"],
-                    is_active=bool(row["is_active"])
+                    is_active=bool(row["is_active"]),
+                    max_concurrency=row["max_concurrency"],
+                    priority=row["priority"],
+                    weight=row["weight"],
+                    tpm_limit=row["tpm_limit"],
+                    daily_budget_usd=row["daily_budget_usd"],
+                    monthly_budget_usd=row["monthly_budget_usd"]
                 ))
 
             return keys
@@ -232,7 +321,13 @@ async def update_key(
     name: Optional[str] = None,
     rate_limit: Optional[int] = None,
     is_active: Optional[bool] = None,
-    expires_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None,
+    max_concurrency: Optional[int] = None,
+    priority: Optional[int] = None,
+    weight: Optional[int] = None,
+    tpm_limit: Optional[int] = None,
+    daily_budget_usd: Optional[float] = None,
+    monthly_budget_usd: Optional[float] = None
 ) -> Optional[APIKey]:
     """Update an API key's properties."""
     # Build update query dynamically
@@ -255,6 +350,30 @@ async def update_key(
         updates.append("expires_at = ?")
         params.append(expires_at.isoformat())
 
+    if max_concurrency is not None:
+        updates.append("max_concurrency = ?")
+        params.append(max_concurrency)
+
+    if priority is not None:
+        updates.append("priority = ?")
+        params.append(priority)
+
+    if weight is not None:
+        updates.append("weight = ?")
+        params.append(weight)
+
+    if tpm_limit is not None:
+        updates.append("tpm_limit = ?")
+        params.append(tpm_limit)
+
+    if daily_budget_usd is not None:
+        updates.append("daily_budget_usd = ?")
+        params.append(daily_budget_usd)
+
+    if monthly_budget_usd is not None:
+        updates.append("monthly_budget_usd = ?")
+        params.append(monthly_budget_usd)
+
     if not updates:
         return await get_key_by_id(key_id)
 
@@ -271,10 +390,11 @@ async def update_key(
 
 
 async def delete_key(key_id: str) -> bool:
-    """Delete an API key and its usage logs."""
+    """Delete an API key, its usage logs and its quota spend."""
     async with aiosqlite.connect(DATABASE_PATH) as db:
         # Delete usage logs first
         await db.execute("DELETE FROM usage_logs WHERE key_id = ?", (key_id,))
+        await db.execute("DELETE FROM quota_spend WHERE key_id = ?", (key_id,))
 
         # Delete the key
         cursor = await db.execute("DELETE FROM api_keys WHERE id = ?", (key_id,))
@@ -283,22 +403,44 @@ async def delete_key(key_id: str) -> bool:
         return cursor.rowcount > 0
 
 
+# Usage-log writes started but not yet committed
+_pending_usage_writes = 0
+
+
 async def log_usage(
     key_id: str,
     endpoint: str,
     tokens_used: Optional[int] = None,
-    model: Optional[str] = None
+    model: Optional[str] = None,
+    cached: bool = False
 ):
-    """Log an API request."""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute(
-            """
-            INSERT INTO usage_logs (key_id, timestamp, endpoint, tokens_used, model)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (key_id, datetime.now(timezone.utc).replace(tzinfo=None).isoformat(), endpoint, tokens_used, model)
-        )
-        await db.commit()
+    """Log an API request. Cached responses are logged with zero tokens used."""
+    global _pending_usage_writes
+    _pending_usage_writes += 1
+    try:
+        async with aiosqlite.connect(DATABASE_PATH) as db:
+            await db.execute(
+                """
+                INSERT INTO usage_logs (key_id, timestamp, endpoint, tokens_used, model, cached)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    key_id,
+                    datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),
+                    endpoint,
+                    0 if cached else tokens_used,
+                    model,
+                    1 if cached else 0
+                )
+            )
+            await db.commit()
+    finally:
+        _pending_usage_writes -= 1
+
+
+def get_pending_usage_writes() -> int:
+    """Number of usage-log writes currently waiting on SQLite."""
+    return _pending_usage_writes
 
 
 async def get_request_count_in_window(key_id: str, window_seconds: int = 60) -> int:
@@ -317,6 +459,31 @@ async def get_request_count_in_window(key_id: str, window_seconds: int = 60) ->
             return row[0] if row else 0
 
 
+async def add_quota_spend(spend: dict[tuple[str, str], float]):
+    """Add USD amounts to the stored spend, keyed by (key_id, period)."""
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await db.executemany(
+            """
+            INSERT INTO quota_spend (key_id, period, spent_usd) VALUES (?, ?, ?)
+            ON CONFLICT(key_id, period) DO UPDATE SET spent_usd = spent_usd + excluded.spent_usd
+            """,
+            [(key_id, period, amount) for (key_id, period), amount in spend.items()]
+        )
+        await db.commit()
+
+
+async def load_quota_spend(periods: list[str]) -> dict[tuple[str, str], float]:
+    """Stored spend of every key for the given periods, keyed by (key_id, period)."""
+    placeholders = ", ".join("?" for _ in periods)
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        async with db.execute(
+            f"SELECT key_id, period, spent_usd FROM quota_spend WHERE period IN ({placeholders})",
+            periods
+        ) as cursor:
+            rows = await cursor.fetchall()
+            return {(row[0], row[1]): row[2] for row in rows}
+
+
 async def get_key_stats(key_id: str) -> dict:
     """Get usage statistics for a key."""
     async with aiosqlite.connect(DATABASE_PATH) as db:
@@ -338,6 +505,14 @@ async def get_key_stats(key_id: str) -> dict:
             row = await cursor.fetchone()
             total_tokens = row["total"] or 0
 
+        # Requests served from the response cache
+        async with db.execute(
+            "SELECT COUNT(*) as count FROM usage_logs WHERE key_id = ? AND cached = 1",
+            (key_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            cache_hits = row["count"]
+
         # Requests by endpoint
         async with db.execute(
             """
@@ -376,7 +551,8 @@ async def get_key_stats(key_id: str) -> dict:
                     "timestamp": row["timestamp"],
                     "endpoint": row["endpoint"],
                     "tokens_used": row["tokens_used"],
-                    "model": row["model"]
+                    "model": row["model"],
+                    "cached": bool(row["cached"])
                 }
                 for row in rows
             ]
@@ -384,6 +560,7 @@ async def get_key_stats(key_id: str) -> dict:
         return {
             "total_requests": total_requests,
             "total_tokens": total_tokens,
+            "cache_hits": cache_hits,
             "by_endpoint": by_endpoint,
             "by_model": by_model,
             "recent_requests": recent
@@ -0,0 +1,283 @@
+"""
+Embeddings cache and micro-batcher for the Load Balancer.
+Per-input vectors are cached by content hash; cache misses from concurrent
+callers for the same model are merged into a single upstream request.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+# === Configuration ===
+EMBEDDINGS_BATCHING_ENABLED = os.getenv("EMBEDDINGS_BATCHING_ENABLED", "false").lower() == "true"
+EMBEDDINGS_BATCH_WINDOW_MS = float(os.getenv("EMBEDDINGS_BATCH_WINDOW_MS", "10"))
+EMBEDDINGS_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDINGS_BATCH_MAX_INPUTS", "256"))
+EMBEDDINGS_CACHE_TTL = int(os.getenv("EMBEDDINGS_CACHE_TTL", "86400"))  # 1 day
+EMBEDDINGS_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDINGS_CACHE_MAX_ENTRIES", "50000"))
+
+# Request fields that do not affect the vectors
+IGNORED_FIELDS = ("model", "input", "user")
+
+# send_batch(model, options, inputs) -> (embeddings in input order, prompt tokens)
+SendBatch = Callable[[str, dict, list], Awaitable[tuple[list, int]]]
+
+
+class EmbeddingsUpstreamError(Exception):
+    """The upstream rejected an embeddings batch."""
+
+    def __init__(self, status_code: int, content: bytes, content_type: str = "application/json"):
+        super().__init__(f"Upstream returned {status_code}")
+        self.status_code = status_code
+        self.content = content
+        self.content_type = content_type
+
+
+def normalize_inputs(value: Any) -> Optional[list]:
+    """
+    Turn the `input` field into a list of individual inputs.
+    Returns None for shapes the batcher does not handle.
+    """
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and value:
+        # A flat list of ints is a single tokenized input
+        if all(isinstance(v, int) for v in value):
+            return [value]
+        if all(isinstance(v, (str, list)) for v in value):
+            return value
+    return None
+
+
+def split_request(data: Any) -> Optional[tuple[str, dict, list]]:
+    """Split an embeddings request body into (model, options, inputs)."""
+    if not isinstance(data, dict):
+        return None
+    model = data.get("model")
+    inputs = normalize_inputs(data.get("input"))
+    if not isinstance(model, str) or inputs is None:
+        return None
+    options = {k: v for k, v in data.items() if k not in IGNORED_FIELDS}
+    return model, options, inputs
+
+
+def _options_key(options: dict) -> str:
+    return json.dumps(options, sort_keys=True, separators=(",", ":"))
+
+
+def _input_key(item: Any) -> str:
+    return item if isinstance(item, str) else json.dumps(item, separators=(",", ":"))
+
+
+def make_input_key(model: str, options: dict, item: Any) -> str:
+    """Content hash identifying one input's vector."""
+    raw = f"{model}\0{_options_key(options)}\0{_input_key(item)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """In-memory LRU of per-input vectors with TTL."""
+
+    def __init__(self, ttl: int = EMBEDDINGS_CACHE_TTL, max_entries: int = EMBEDDINGS_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, vector = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return vector
+
+    def set(self, key: str, vector: Any):
+        self._entries[key] = (time.time() + self.ttl, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+@dataclass
+class _Waiter:
+    inputs: list
+    future: asyncio.Future
+
+
+@dataclass
+class _Group:
+    waiters: list = field(default_factory=list)
+    size: int = 0
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+class EmbeddingBatcher:
+    """Collects inputs for the same model/options within a short window into one upstream call."""
+
+    def __init__(
+        self,
+        send_batch: SendBatch,
+        window_ms: float = EMBEDDINGS_BATCH_WINDOW_MS,
+        max_inputs: int = EMBEDDINGS_BATCH_MAX_INPUTS
+    ):
+        self.send_batch = send_batch
+        self.window = window_ms / 1000
+        self.max_inputs = max_inputs
+        self._groups: dict[tuple[str, str], _Group] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.upstream_calls = 0
+        self.batched_requests = 0
+
+    async def embed(self, model: str, options: dict, inputs: list) -> tuple[list, int]:
+        """Embed inputs, possibly together with other callers. Returns (vectors, prompt tokens)."""
+        loop = asyncio.get_running_loop()
+        group_key = (model, _options_key(options))
+        group = self._groups.setdefault(group_key, _Group())
+
+        waiter = _Waiter(inputs=inputs, future=loop.create_future())
+        group.waiters.append(waiter)
+        group.size += len(inputs)
+
+        if group.size >= self.max_inputs:
+            self._flush(group_key)
+        elif group.timer is None:
+            group.timer = loop.call_later(self.window, self._flush, group_key)
+
+        return await waiter.future
+
+    def _flush(self, group_key: tuple[str, str]):
+        group = self._groups.pop(group_key, None)
+        if group is None:
+            return
+        if group.timer is not None:
+            group.timer.cancel()
+
+        model = group_key[0]
+        options = json.loads(group_key[1])
+        task = asyncio.create_task(self._run(model, options, group.waiters))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, model: str, options: dict, waiters: list[_Waiter]):
+        # Identical inputs from different callers are sent once
+        unique: dict[str, int] = {}
+        batch = []
+        for waiter in waiters:
+            for item in waiter.inputs:
+                key = _input_key(item)
+                if key not in unique:
+                    unique[key] = len(batch)
+                    batch.append(item)
+
+        self.batched_requests += len(waiters)
+
+        try:
+            vectors, tokens = await self._send(model, options, batch)
+        except EmbeddingsUpstreamError as e:
+            # A client error may come from a single caller's input; isolate callers
+            if 400 <= e.status_code < 500 and e.status_code not in (402, 429) and len(waiters) > 1:
+                await asyncio.gather(*[self._run(model, options, [w]) for w in waiters])
+                return
+            self._fail(waiters, e)
+            return
+        except Exception as e:
+            self._fail(waiters, e)
+            return
+
+        # Split prompt tokens by each caller's share of the input size;
+        # an input requested by several callers is split between them
+        positions = [[unique[_input_key(item)] for item in waiter.inputs] for waiter in waiters]
+        refs = [0] * len(batch)
+        for waiter_positions in positions:
+            for p in waiter_positions:
+                refs[p] += 1
+        weights = [len(_input_key(item)) / refs[i] for i, item in enumerate(batch)]
+        total_weight = sum(len(_input_key(item)) for item in batch) or 1
+
+        for waiter, waiter_positions in zip(waiters, positions):
+            share = sum(weights[p] for p in waiter_positions) / total_weight
+            if not waiter.future.done():
+                waiter.future.set_result(([vectors[p] for p in waiter_positions], round(tokens * share)))
+
+    async def _send(self, model: str, options: dict, batch: list) -> tuple[list, int]:
+        """Send `batch` as upstream requests of at most `max_inputs` inputs each."""
+        slices = [batch[i:i + self.max_inputs] for i in range(0, len(batch), self.max_inputs)]
+        self.upstream_calls += len(slices)
+        results = await asyncio.gather(
+            *[self.send_batch(model, options, inputs) for inputs in slices],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        vectors = [vector for slice_vectors, _ in results for vector in slice_vectors]
+        return vectors, sum(tokens for _, tokens in results)
+
+    @staticmethod
+    def _fail(waiters: list[_Waiter], error: Exception):
+        for waiter in waiters:
+            if not waiter.future.done():
+                waiter.future.set_exception(error)
+
+
+class EmbeddingsService:
+    """Cache lookup in front of the micro-batcher."""
+
+    def __init__(self, batcher: EmbeddingBatcher, cache: Optional[EmbeddingCache] = None):
+        self.batcher = batcher
+        self.cache = cache if cache is not None else EmbeddingCache()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    async def embed(self, model: str, options: dict, inputs: list) -> tuple[list, int, int]:
+        """Returns (vectors in input order, prompt tokens billed, number of cache hits)."""
+        keys = [make_input_key(model, options, item) for item in inputs]
+        vectors = [self.cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        hits = len(inputs) - len(missing)
+        self.cache_hits += hits
+        self.cache_misses += len(missing)
+
+        tokens = 0
+        if missing:
+            fetched, tokens = await self.batcher.embed(model, options, [inputs[i] for i in missing])
+            for i, vector in zip(missing, fetched):
+                vectors[i] = vector
+                self.cache.set(keys[i], vector)
+
+        return vectors, tokens, hits
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": EMBEDDINGS_BATCHING_ENABLED,
+            "cache_entries": len(self.cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "upstream_calls": self.batcher.upstream_calls,
+            "batched_requests": self.batcher.batched_requests
+        }
+
+
+def build_response(model: str, vectors: list, tokens: int) -> dict:
+    """OpenAI-compatible embeddings response body."""
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": vector}
+            for i, vector in enumerate(vectors)
+        ],
+        "model": model,
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+    }
@@ -0,0 +1,195 @@
+"""
+Idempotency-Key support for the Load Balancer.
+Completed responses are kept in a bounded TTL store so client retries are
+answered without another upstream call; retries that arrive while the original
+request is still running attach to it.
+"""
+
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from fastapi.responses import Response, JSONResponse, StreamingResponse
+
+from singleflight import SingleFlight
+
+# === Configuration ===
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "false").lower() == "true"
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "3600"))  # 1 hour
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+# Responses larger than this are not stored
+IDEMPOTENCY_MAX_BODY_BYTES = int(os.getenv("IDEMPOTENCY_MAX_BODY_BYTES", "1048576"))  # 1 MB
+
+IDEMPOTENCY_HEADER = "idempotency-key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+# Outcomes a retry is expected to re-execute
+RETRYABLE_STATUS_CODES = (408, 409, 425, 429)
+
+
+@dataclass
+class StoredResponse:
+    fingerprint: str
+    status_code: int
+    headers: dict
+    body: bytes
+    expires_at: float
+
+
+def make_fingerprint(method: str, path: str, body: bytes) -> str:
+    """Hash of the request a key was first used with."""
+    digest = hashlib.sha256()
+    digest.update(f"{method} {path}\0".encode("utf-8"))
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def is_storable(status_code: int) -> bool:
+    """Server errors and rate limits are retried upstream instead of replayed."""
+    return status_code < 500 and status_code not in RETRYABLE_STATUS_CODES
+
+
+def _error_response(message: str, status_code: int) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={
+            "error": {
+                "message": message,
+                "type": "invalid_request_error",
+                "param": None,
+                "code": "idempotency_error"
+            }
+        }
+    )
+
+
+class IdempotencyStore:
+    """Bounded TTL store of completed responses plus in-flight attachment."""
+
+    def __init__(
+        self,
+        ttl: int = IDEMPOTENCY_TTL,
+        max_entries: int = IDEMPOTENCY_MAX_ENTRIES,
+        max_body_bytes: int = IDEMPOTENCY_MAX_BODY_BYTES
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self._completed: OrderedDict[str, StoredResponse] = OrderedDict()
+        self._fingerprints: dict[str, str] = {}
+        self._flights = SingleFlight(replay_bytes=max_body_bytes)
+        self.replayed = 0
+
+    def _lookup(self, key: str) -> Optional[StoredResponse]:
+        stored = self._completed.get(key)
+        if stored is None:
+            return None
+        if stored.expires_at <= time.time():
+            del self._completed[key]
+            return None
+        return stored
+
+    def _store(self, key: str, fingerprint: str, status_code: int, headers: dict, body: bytes):
+        if len(body) > self.max_body_bytes:
+            return
+        # Content length is recomputed when the response is replayed
+        headers = {k: v for k, v in headers.items() if k.lower() != "content-length"}
+        self._completed[key] = StoredResponse(
+            fingerprint=fingerprint,
+            status_code=status_code,
+            headers=headers,
+            body=body,
+            expires_at=time.time() + self.ttl
+        )
+        self._completed.move_to_end(key)
+        while len(self._completed) > self.max_entries:
+            self._completed.popitem(last=False)
+
+    async def run(
+        self,
+        key: str,
+        fingerprint: str,
+        fn: Callable[[], Awaitable[Response]]
+    ) -> Response:
+        """Return the stored result for `key`, attach to its in-flight call, or run fn."""
+        stored = self._lookup(key)
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                return _error_response(
+                    "Idempotency-Key was already used with a different request", 422
+                )
+            self.replayed += 1
+            return Response(
+                content=stored.body,
+                status_code=stored.status_code,
+                headers={**stored.headers, REPLAYED_HEADER: "true"}
+            )
+
+        in_flight = self._fingerprints.get(key)
+        if in_flight is None:
+            self._fingerprints[key] = fingerprint
+        elif in_flight != fingerprint:
+            return _error_response(
+                "Idempotency-Key is in use by a different request", 422
+            )
+
+        async def execute() -> Response:
+            try:
+                response = await fn()
+            except BaseException:
+                self._fingerprints.pop(key, None)
+                raise
+
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = self._record_stream(
+                    key, fingerprint, response, response.body_iterator
+                )
+                return response
+
+            self._fingerprints.pop(key, None)
+            if is_storable(response.status_code):
+                self._store(key, fingerprint, response.status_code, dict(response.headers), response.body)
+            return response
+
+        async def still_running() -> Response:
+            return _error_response(
+                "A request with this Idempotency-Key is still in progress", 409
+            )
+
+        return await self._flights.run(key, execute, fallback=still_running)
+
+    async def _record_stream(
+        self,
+        key: str,
+        fingerprint: str,
+        response: StreamingResponse,
+        chunks: AsyncIterator[bytes]
+    ) -> AsyncIterator[bytes]:
+        """Pass a stream through and store it once it has completed."""
+        body = bytearray()
+        complete = False
+        try:
+            async for chunk in chunks:
+                if len(body) <= self.max_body_bytes:
+                    body.extend(chunk)
+                yield chunk
+            complete = True
+        finally:
+            self._fingerprints.pop(key, None)
+            if complete and is_storable(response.status_code):
+                self._store(key, fingerprint, response.status_code, dict(response.headers), bytes(body))
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": IDEMPOTENCY_ENABLED,
+            "stored": len(self._completed),
+            "in_flight": len(self._fingerprints),
+            "replayed": self.replayed,
+            "attached": self._flights.collapsed
+        }
+
+
+# Global instance
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,148 @@
+"""
+Shared Vercel key state for multi-worker deployments.
+Credit balances are kept in a SQLite (WAL) table so every worker sees the same numbers,
+and each key's /v1/credits poll is claimed by one worker at a time instead of all of them.
+The Vercel key list loaded by the leader (see leader.py) is published here too.
+"""
+
+import os
+import json
+import time
+from typing import Optional
+
+import aiosqlite
+
+# === Configuration ===
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Share key balances between processes; on by default when running several workers.
+# Also useful for several containers that mount the same data volume.
+KEY_STATE_SHARED = os.getenv("KEY_STATE_SHARED", "true" if WORKERS > 1 else "false").lower() == "true"
+KEY_STATE_PATH = os.getenv("KEY_STATE_PATH", "data/key_state.db")
+# How often a worker re-reads balances published by the others, in seconds
+KEY_STATE_SYNC_INTERVAL = float(os.getenv("KEY_STATE_SYNC_INTERVAL", "2"))
+# A claimed credit poll that has not been published within this time can be taken over
+KEY_STATE_CLAIM_TIMEOUT = float(os.getenv("KEY_STATE_CLAIM_TIMEOUT", "30"))
+
+
+class KeyStateStore:
+    """Balances and credit-poll claims per Vercel key, shared through SQLite."""
+
+    def __init__(self, db_path: str = KEY_STATE_PATH, claim_timeout: float = KEY_STATE_CLAIM_TIMEOUT):
+        self.db_path = db_path
+        self.claim_timeout = claim_timeout
+        self.claims_won = 0
+        self.claims_lost = 0
+
+    async def init(self):
+        """Create the state table and switch the file to WAL so readers never block writers."""
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS key_state (
+                    api_key TEXT PRIMARY KEY,
+                    balance REAL NOT NULL DEFAULT 0,
+                    total_used REAL NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL DEFAULT 0,
+                    claimed_at REAL NOT NULL DEFAULT 0
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS shared_meta (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            await db.commit()
+
+    async def claim(self, api_key: str, max_age: float, now: Optional[float] = None) -> bool:
+        """
+        Claim the credit poll for `api_key` if its shared balance is older than `max_age`
+        seconds and no other worker is already polling it. Returns True if this worker won.
+        """
+        now = now if now is not None else time.time()
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute("INSERT OR IGNORE INTO key_state (api_key) VALUES (?)", (api_key,))
+            cursor = await db.execute(
+                """
+                UPDATE key_state SET claimed_at = ?
+                WHERE api_key = ? AND updated_at <= ? AND claimed_at <= ?
+                """,
+                (now, api_key, now - max_age, now - self.claim_timeout)
+            )
+            await db.commit()
+            won = cursor.rowcount == 1
+
+        if won:
+            self.claims_won += 1
+        else:
+            self.claims_lost += 1
+        return won
+
+    async def release(self, api_key: str):
+        """Give up a claim without publishing (the poll failed), so another worker can retry."""
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute("UPDATE key_state SET claimed_at = 0 WHERE api_key = ?", (api_key,))
+            await db.commit()
+
+    async def publish(self, key: dict):
+        """Store a freshly polled balance and release the claim."""
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(
+                """
+                INSERT INTO key_state (api_key, balance, total_used, updated_at, claimed_at)
+                VALUES (?, ?, ?, ?, 0)
+                ON CONFLICT(api_key) DO UPDATE SET
+                    balance = excluded.balance,
+                    total_used = excluded.total_used,
+                    updated_at = excluded.updated_at,
+                    claimed_at = 0
+                """,
+                (key["api_key"], key["balance"], key["total_used"], key["updated_at"])
+            )
+            await db.commit()
+
+    async def load(self) -> dict[str, tuple[float, float, float]]:
+        """api_key -> (balance, total_used, updated_at) for every published key."""
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute(
+                "SELECT api_key, balance, total_used, updated_at FROM key_state WHERE updated_at > 0"
+            ) as cursor:
+                return {row[0]: (row[1], row[2], row[3]) for row in await cursor.fetchall()}
+
+    async def publish_key_list(self, keys: list[dict], now: Optional[float] = None):
+        """Store the Vercel key list (name and api_key) loaded by the leader for the other workers."""
+        value = json.dumps([{"name": k["name"], "api_key": k["api_key"]} for k in keys])
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(
+                """
+                INSERT INTO shared_meta (name, value, updated_at) VALUES ('key_list', ?, ?)
+                ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+                """,
+                (value, now if now is not None else time.time())
+            )
+            await db.commit()
+
+    async def load_key_list(self) -> Optional[tuple[list[dict], float]]:
+        """(keys, published_at) for the last published key list, or None if there is none yet."""
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute("SELECT value, updated_at FROM shared_meta WHERE name = 'key_list'") as cursor:
+                row = await cursor.fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def get_stats(self) -> dict:
+        return {
+            "path": self.db_path,
+            "claims_won": self.claims_won,
+            "claims_lost": self.claims_lost
+        }
+
+
+# Global instance
+key_state = KeyStateStore()
@@ -0,0 +1,135 @@
+"""
+Leader election for background tasks in multi-worker deployments.
+Workers compete for a lease row in the shared key-state SQLite file; the holder
+renews it periodically and runs the credit polling and PocketBase key sync, the
+others only read the results. If the leader dies its lease expires and another
+worker takes over.
+"""
+
+import os
+import time
+import uuid
+import socket
+import asyncio
+from typing import Optional
+
+import aiosqlite
+
+from logger import get_logger
+from key_state import KEY_STATE_SHARED, KEY_STATE_PATH
+
+# === Configuration ===
+# Elect one worker for background tasks; on by default whenever key state is shared
+LEADER_ELECTION = os.getenv("LEADER_ELECTION", "true" if KEY_STATE_SHARED else "false").lower() == "true"
+# Seconds a lease lasts without renewal (failover time after a leader dies)
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "15"))
+
+logger = get_logger("leader")
+
+
+class LeaderLease:
+    """A renewable, expiring lease on a named row of the shared SQLite file."""
+
+    def __init__(self, db_path: str = KEY_STATE_PATH, name: str = "background", ttl: float = LEADER_LEASE_TTL):
+        self.db_path = db_path
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._leader_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.elections_won = 0
+        self.current_holder: Optional[str] = None
+
+    @property
+    def is_leader(self) -> bool:
+        # A lease that could not be renewed stops counting before other workers can take it
+        return time.time() < self._leader_until
+
+    async def init(self):
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            await db.commit()
+
+    async def try_acquire(self, now: Optional[float] = None) -> bool:
+        """Take the lease if it is free or expired, or renew it if this worker holds it."""
+        now = now if now is not None else time.time()
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(
+                """
+                INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+                """,
+                (self.name, self.holder, now + self.ttl, now)
+            )
+            await db.commit()
+            async with db.execute("SELECT holder FROM leases WHERE name = ?", (self.name,)) as cursor:
+                row = await cursor.fetchone()
+
+        was_leader = self.is_leader
+        self.current_holder = row[0] if row else None
+        if self.current_holder == self.holder:
+            # Stop acting as leader a little before the lease can be taken over
+            self._leader_until = now + self.ttl * 0.8
+            if not was_leader:
+                self.elections_won += 1
+                logger.info(f"👑 Became leader for background tasks ({self.holder})")
+            return True
+
+        if was_leader:
+            logger.warning(f"Lost leadership to {self.current_holder}")
+        self._leader_until = 0.0
+        return False
+
+    async def release(self):
+        """Give up the lease so another worker can take over immediately."""
+        self._leader_until = 0.0
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+            await db.commit()
+
+    async def _renew_loop(self):
+        while True:
+            try:
+                await self.try_acquire()
+            except Exception as e:
+                self._leader_until = 0.0
+                logger.warning(f"⚠️  Leader lease check failed: {e}")
+            await asyncio.sleep(self.ttl / 3)
+
+    async def start(self):
+        """Create the lease table, run the first election and keep competing in the background."""
+        await self.init()
+        await self.try_acquire()
+        self._task = asyncio.create_task(self._renew_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.release()
+        except Exception as e:
+            logger.warning(f"⚠️  Failed to release leader lease: {e}")
+
+    def get_stats(self) -> dict:
+        return {
+            "holder": self.holder,
+            "is_leader": self.is_leader,
+            "current_leader": self.current_holder,
+            "elections_won": self.elections_won
+        }
+
+
+# Global instance
+leader_lease = LeaderLease()
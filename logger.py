@@ -0,0 +1,131 @@
+"""
+Structured logging for the Load Balancer.
+Records are put on a bounded in-memory queue and written to stdout by a
+background thread, so a slow or blocked stdout never stalls the event loop.
+When the queue is full new records are dropped and counted instead of waiting.
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Optional
+
+# === Configuration ===
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # "text" or "json"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+ROOT_LOGGER = "lb"
+
+# Attributes every LogRecord has; anything else came from `extra=` and is emitted as a field
+_RESERVED_ATTRS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {
+        key: value for key, value in record.__dict__.items()
+        if key not in _RESERVED_ATTRS and not key.startswith("_")
+    }
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line with the `extra=` fields at the top level."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **_extra_fields(record)
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable line with the `extra=` fields appended as JSON."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(message)s", "%Y-%m-%d %H:%M:%S")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += " " + json.dumps(fields, ensure_ascii=False, default=str)
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the writer thread; only resolve the message here
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler: Optional[DroppingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream=None):
+    """Attach the queue handler and start the writer thread (safe to call more than once)."""
+    global _handler, _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JSONFormatter() if fmt == "json" else TextFormatter())
+
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=False)
+    _listener.start()
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level)
+    root.addHandler(_handler)
+    root.propagate = False
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flush queued records and stop the writer thread."""
+    global _handler, _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger(ROOT_LOGGER).removeHandler(_handler)
+    _handler = None
+    _listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger under the Load Balancer root, e.g. get_logger("server")."""
+    setup_logging()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def get_stats() -> dict:
+    return {
+        "queued": _handler.queue.qsize() if _handler else 0,
+        "dropped": _handler.dropped if _handler else 0
+    }
@@ -0,0 +1,176 @@
+"""
+Event loop watchdog for the Load Balancer.
+A probe coroutine measures loop lag continuously and a monitor thread captures
+the event loop's stack whenever a callback blocks it for longer than
+WATCHDOG_BLOCK_THRESHOLD_MS. In strict mode (tests) any block over
+WATCHDOG_FAIL_ON_BLOCK_MS makes the watchdog raise when it is stopped.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+from logger import get_logger
+from profiler import capture_stack, percentile
+
+# === Configuration ===
+WATCHDOG_ENABLED = os.getenv("WATCHDOG_ENABLED", "true").lower() == "true"
+WATCHDOG_INTERVAL_MS = float(os.getenv("WATCHDOG_INTERVAL_MS", "50"))
+WATCHDOG_BLOCK_THRESHOLD_MS = float(os.getenv("WATCHDOG_BLOCK_THRESHOLD_MS", "200"))
+# Strict/test mode: fail when a block over this many ms happens (0 = disabled)
+WATCHDOG_FAIL_ON_BLOCK_MS = float(os.getenv("WATCHDOG_FAIL_ON_BLOCK_MS", "0"))
+# Lag samples kept for the percentiles (1200 x 50ms = last minute)
+WATCHDOG_WINDOW = int(os.getenv("WATCHDOG_WINDOW", "1200"))
+
+RECENT_BLOCKS = 20
+
+logger = get_logger("loop_watchdog")
+
+
+class BlockingCallError(AssertionError):
+    """Raised in strict mode when the event loop was blocked for too long."""
+
+
+class Watchdog:
+    """Loop-lag probe plus a monitor thread that records blocking callbacks."""
+
+    def __init__(
+        self,
+        interval_ms: float = WATCHDOG_INTERVAL_MS,
+        block_threshold_ms: float = WATCHDOG_BLOCK_THRESHOLD_MS,
+        fail_on_block_ms: float = WATCHDOG_FAIL_ON_BLOCK_MS,
+        window: int = WATCHDOG_WINDOW
+    ):
+        self.interval_ms = interval_ms
+        self.block_threshold_ms = block_threshold_ms
+        self.fail_on_block_ms = fail_on_block_ms
+        self.lags_ms: deque[float] = deque(maxlen=window)
+        self.blocks: deque[dict] = deque(maxlen=RECENT_BLOCKS)
+        self.blocked_calls = 0
+        self.violations: list[dict] = []
+        self._heartbeat = time.monotonic()
+        self._stopped_at = 0.0
+        self._labels: dict = {}
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        """Start watching the running event loop."""
+        if self._task is not None:
+            return
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._probe())
+        self._thread = threading.Thread(
+            target=self._monitor,
+            args=(threading.get_ident(),),
+            name="watchdog",
+            daemon=True
+        )
+        self._thread.start()
+
+    async def stop(self):
+        """Stop watching. In strict mode raises BlockingCallError if the loop was blocked."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        self._stopped_at = time.monotonic()
+        self._stop.set()
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+        self.check()
+
+    async def __aenter__(self) -> "Watchdog":
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def check(self):
+        """Raise BlockingCallError if a block over fail_on_block_ms was recorded."""
+        if not self.violations:
+            return
+        worst = max(self.violations, key=lambda b: b["duration_ms"])
+        raise BlockingCallError(
+            f"Event loop blocked {len(self.violations)} time(s), longest {worst['duration_ms']:.0f}ms in:\n  "
+            + "\n  ".join(worst["stack"][-10:])
+        )
+
+    async def _probe(self):
+        interval = self.interval_ms / 1000
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self.lags_ms.append(max(0.0, (now - before - interval) * 1000))
+            self._heartbeat = now
+
+    def _monitor(self, thread_id: int):
+        """Runs in its own thread: captures the loop's stack while the heartbeat is overdue."""
+        overdue = (self.interval_ms + self.block_threshold_ms) / 1000
+        check_every = min(self.interval_ms, self.block_threshold_ms) / 1000
+        stall_beat: Optional[float] = None
+        stall_stack: tuple[str, ...] = ()
+
+        while not self._stop.wait(check_every):
+            beat = self._heartbeat
+            if stall_beat is None:
+                if time.monotonic() - beat > overdue:
+                    frame = sys._current_frames().get(thread_id)
+                    stall_beat = beat
+                    stall_stack = capture_stack(frame, self._labels) if frame is not None else ()
+            elif beat != stall_beat:
+                self._record_block((beat - stall_beat) * 1000 - self.interval_ms, stall_stack)
+                stall_beat = None
+
+        # A block that ended right before stop() never saw another heartbeat
+        if stall_beat is not None:
+            end = self._heartbeat if self._heartbeat != stall_beat else self._stopped_at
+            duration_ms = (end - stall_beat) * 1000 - self.interval_ms
+            if duration_ms > self.block_threshold_ms:
+                self._record_block(duration_ms, stall_stack)
+
+    def _record_block(self, duration_ms: float, stack: tuple[str, ...]):
+        block = {
+            "duration_ms": round(duration_ms, 3),
+            "at": datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),
+            "stack": list(stack)
+        }
+        self.blocked_calls += 1
+        self.blocks.append(block)
+
+        log = logger.warning
+        if self.fail_on_block_ms and duration_ms > self.fail_on_block_ms:
+            self.violations.append(block)
+            log = logger.error
+        culprit = stack[-1] if stack else "unknown"
+        log(f"🐢 Event loop blocked for {duration_ms:.0f}ms in {culprit}", extra={"stack": block["stack"]})
+
+    def get_stats(self) -> dict:
+        lags = list(self.lags_ms)
+        return {
+            "enabled": self.running,
+            "lag_p50_ms": round(percentile(lags, 50), 3),
+            "lag_p99_ms": round(percentile(lags, 99), 3),
+            "lag_max_ms": round(max(lags, default=0.0), 3),
+            "blocked_calls": self.blocked_calls,
+            "recent_blocks": [
+                {**b, "stack": b["stack"][-10:]} for b in self.blocks
+            ]
+        }
+
+
+# Global instance
+watchdog = Watchdog()
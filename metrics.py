@@ -0,0 +1,279 @@
+"""
+Prometheus metrics for the Load Balancer.
+Counters, gauges and histograms rendered in the Prometheus text format.
+
+All updates happen on the event loop thread, so the metrics are plain dict
+updates without locks; rendering only runs when /metrics is scraped.
+"""
+
+import os
+import math
+import time
+from bisect import bisect_left
+from typing import AsyncIterator, Callable, Iterable, Optional
+
+from fastapi.responses import Response, StreamingResponse
+
+# === Configuration ===
+# Label sets per metric before new ones are folded into "other" (guards against unbounded model names)
+METRICS_MAX_SERIES = int(os.getenv("METRICS_MAX_SERIES", "500"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+_registry: list = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _key(self, labels: tuple, series: dict) -> tuple:
+        if labels in series or len(series) < METRICS_MAX_SERIES:
+            return labels
+        return tuple("other" for _ in labels)
+
+    def header(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}"
+        ]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, *labels):
+        key = self._key(labels, self._values)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, *labels):
+        self._values[self._key(labels, self._values)] = value
+
+    def inc(self, amount: float = 1.0, *labels):
+        key = self._key(labels, self._values)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, *labels):
+        self.inc(-amount, *labels)
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class CallbackGauge(_Metric):
+    """Gauge whose samples are read from a callback at scrape time."""
+    type_name = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        callback: Optional[Callable[[], Iterable[tuple[tuple, float]]]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        if self.callback is None:
+            return lines
+        try:
+            samples = list(self.callback())
+        except Exception:
+            return lines
+        for labels, value in samples:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [bucket counts..., +Inf count, sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels, self._series)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series[:-1]):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+def render_metrics() -> str:
+    """Render every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# === Load Balancer metrics ===
+AUTH_DURATION = Histogram(
+    "lb_auth_duration_seconds", "Time spent authenticating client API keys", ("result",), FAST_BUCKETS
+)
+KEY_SELECTION_DURATION = Histogram(
+    "lb_key_selection_duration_seconds", "Time spent selecting a Vercel key", (), FAST_BUCKETS
+)
+UPSTREAM_CONNECT_DURATION = Histogram(
+    "lb_upstream_connect_duration_seconds", "Time to open the upstream connection (TCP + TLS)", ("model",)
+)
+UPSTREAM_TTFB = Histogram(
+    "lb_upstream_ttfb_seconds", "Time from sending the upstream request to its first byte", ("model", "status")
+)
+REQUEST_DURATION = Histogram(
+    "lb_request_duration_seconds", "Total proxy request duration, until the last byte of a stream", ("model", "status")
+)
+BYTES_IN = Counter("lb_request_bytes_total", "Request body bytes received from clients", ("model",))
+BYTES_OUT = Counter("lb_response_bytes_total", "Response body bytes sent to clients", ("model",))
+INFLIGHT_STREAMS = Gauge("lb_inflight_streams", "Streaming responses currently in progress")
+VERCEL_KEY_BALANCE = CallbackGauge("lb_vercel_key_balance_dollars", "Credit balance per Vercel key", ("key",))
+USAGE_WRITER_QUEUE_DEPTH = CallbackGauge(
+    "lb_usage_writer_queue_depth", "Usage-log writes waiting on SQLite"
+)
+ADMISSION_INFLIGHT = CallbackGauge("lb_admission_inflight", "Upstream requests holding an admission slot")
+ADMISSION_QUEUE_DEPTH = CallbackGauge("lb_admission_queue_depth", "Requests waiting for an upstream slot")
+ADMISSION_WAIT = Histogram(
+    "lb_admission_wait_seconds", "Time spent queued for an upstream slot", ("result",)
+)
+ADMISSION_REJECTED = Counter(
+    "lb_admission_rejected_total", "Requests shed by admission control", ("reason",)
+)
+QUOTA_REJECTED = Counter(
+    "lb_quota_rejected_total", "Requests rejected by a client key's token or spend quota", ("quota",)
+)
+QUOTA_TOKENS = Counter("lb_quota_tokens_total", "Tokens charged to client keys with quotas", ("model",))
+QUOTA_SPEND = Counter("lb_quota_spend_dollars_total", "Spend charged to client keys with quotas", ("model",))
+
+
+class UpstreamTrace:
+    """
+    httpx "trace" extension recording connection setup and response header timings.
+    Pass as extensions={"trace": trace} when building the upstream request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.connect_duration: Optional[float] = None
+        self.headers_at: Optional[float] = None
+        self._connect_started: Optional[float] = None
+
+    async def __call__(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.started":
+            self._connect_started = time.perf_counter()
+        elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            if self._connect_started is not None:
+                self.connect_duration = time.perf_counter() - self._connect_started
+        elif event_name.endswith(".receive_response_headers.complete"):
+            self.headers_at = time.perf_counter()
+
+
+def track_response(response: Response, model: str, started: float) -> Response:
+    """Record duration and bytes sent; streams are recorded when they finish."""
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = _track_stream(
+            response.body_iterator, model, str(response.status_code), started
+        )
+        return response
+
+    BYTES_OUT.inc(len(response.body), model)
+    REQUEST_DURATION.observe(time.perf_counter() - started, model, str(response.status_code))
+    return response
+
+
+async def _track_stream(
+    chunks: AsyncIterator[bytes],
+    model: str,
+    status: str,
+    started: float
+) -> AsyncIterator[bytes]:
+    sent = 0
+    INFLIGHT_STREAMS.inc()
+    try:
+        async for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        INFLIGHT_STREAMS.dec()
+        BYTES_OUT.inc(sent, model)
+        REQUEST_DURATION.observe(time.perf_counter() - started, model, status)
@@ -0,0 +1,127 @@
+"""
+Cached /v1/models for the Load Balancer.
+The model list is fetched in the background and served from memory with an ETag.
+"""
+
+import os
+import json
+import time
+import asyncio
+import fnmatch
+import hashlib
+from typing import Awaitable, Callable, Optional
+
+from logger import get_logger
+
+# === Configuration ===
+MODELS_CACHE_ENABLED = os.getenv("MODELS_CACHE_ENABLED", "true").lower() == "true"
+MODELS_CACHE_REFRESH_INTERVAL = int(os.getenv("MODELS_CACHE_REFRESH_INTERVAL", "3600"))  # 1 hour
+# Comma-separated glob patterns, e.g. "openai/*,anthropic/claude-*" (empty = all models)
+MODELS_FILTER = os.getenv("MODELS_FILTER", "")
+
+logger = get_logger("models_cache")
+
+# fetch() -> (status_code, body)
+FetchModels = Callable[[], Awaitable[tuple[int, bytes]]]
+
+
+def parse_patterns(raw: str) -> list[str]:
+    return [p.strip() for p in raw.split(",") if p.strip()]
+
+
+def filter_models(body: bytes, patterns: list[str]) -> bytes:
+    """Keep only models whose id matches one of the patterns."""
+    if not patterns:
+        return body
+    data = json.loads(body)
+    data["data"] = [
+        model for model in data.get("data", [])
+        if any(fnmatch.fnmatchcase(str(model.get("id", "")), p) for p in patterns)
+    ]
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def make_etag(body: bytes) -> str:
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header (which may list several, possibly weak, tags)."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class ModelsCache:
+    """In-memory copy of the upstream model list."""
+
+    def __init__(
+        self,
+        fetch: FetchModels,
+        refresh_interval: int = MODELS_CACHE_REFRESH_INTERVAL,
+        patterns: Optional[list[str]] = None
+    ):
+        self.fetch = fetch
+        self.refresh_interval = refresh_interval
+        self.patterns = parse_patterns(MODELS_FILTER) if patterns is None else patterns
+        self.body: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self.updated_at = 0.0
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.not_modified = 0
+
+    async def refresh(self) -> bool:
+        """Fetch the list from upstream. Keeps the previous copy on failure."""
+        async with self._lock:
+            try:
+                status_code, body = await self.fetch()
+                if status_code != 200:
+                    logger.warning(f"⚠️  Failed to refresh model list: {status_code}")
+                    return False
+                body = filter_models(body, self.patterns)
+            except Exception as e:
+                logger.warning(f"⚠️  Failed to refresh model list: {e}")
+                return False
+
+            self.body = body
+            self.etag = make_etag(body)
+            self.updated_at = time.time()
+            return True
+
+    async def get(self) -> Optional[tuple[bytes, str]]:
+        """Return (body, etag), fetching on first use."""
+        if self.body is None:
+            if self._lock.locked():
+                # Another request is already fetching - wait for it
+                async with self._lock:
+                    pass
+            if self.body is None:
+                await self.refresh()
+        if self.body is None:
+            return None
+        self.hits += 1
+        return self.body, self.etag
+
+    async def run_periodic_refresh(self):
+        """Background task refreshing the list every refresh_interval seconds."""
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": MODELS_CACHE_ENABLED,
+            "etag": self.etag,
+            "updated_at": self.updated_at or None,
+            "hits": self.hits,
+            "not_modified": self.not_modified
+        }
@@ -9,6 +9,8 @@ from typing import Optional, List, Dict, Any
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
+from logger import get_logger
+
 # Load environment variables
 load_dotenv()
 
@@ -22,6 +24,8 @@ POCKETBASE_PASSWORD = os.getenv("POCKETBASE_PASSWORD")
 TOKEN_CACHE_TTL = 3600  # 1 hour
 KEYS_CACHE_TTL = 300  # 5 minutes
 
+logger = get_logger("pocketbase")
+
 
 class PocketBaseClient:
     """Client for interacting with PocketBase API (sync version)."""
@@ -38,7 +42,7 @@ class PocketBaseClient:
     def _login(self) -> Optional[str]:
         """Login to PocketBase and get auth token."""
         if not POCKETBASE_EMAIL or not POCKETBASE_PASSWORD:
-            print("❌ PocketBase credentials not configured")
+            logger.error("❌ PocketBase credentials not configured")
             return None
 
         try:
@@ -55,13 +59,13 @@ class PocketBaseClient:
                     result = response.json()
                     self._token = result.get("token")
                     self._token_expires_at = datetime.now() + timedelta(seconds=TOKEN_CACHE_TTL)
-                    print(f"✅ PocketBase authentication successful")
+                    logger.info(f"✅ PocketBase authentication successful")
                     return self._token
                 else:
-                    print(f"❌ PocketBase login failed: {response.status_code}")
+                    logger.error(f"❌ PocketBase login failed: {response.status_code}")
                     return None
         except Exception as e:
-            print(f"❌ PocketBase authentication error: {e}")
+            logger.error(f"❌ PocketBase authentication error: {e}")
             return None
 
     def _get_token(self) -> Optional[str]:
@@ -95,7 +99,7 @@ class PocketBaseClient:
         token = self._get_token()
         if not token:
             if self._keys_cache:
-                print("⚠️  Using stale cache due to auth failure")
+                logger.warning("⚠️  Using stale cache due to auth failure")
                 return self._keys_cache
             return []
 
@@ -121,14 +125,14 @@ class PocketBaseClient:
                         page += 1
                     elif response.status_code == 401:
                         # Token expired, refresh
-                        print("⚠️  Token expired, refreshing...")
+                        logger.warning("⚠️  Token expired, refreshing...")
                         self._token = None
                         token = self._get_token()
                         if not token:
                             break
                         continue
                     else:
-                        print(f"❌ Failed to fetch keys: {response.status_code}")
+                        logger.error(f"❌ Failed to fetch keys: {response.status_code}")
                         break
 
             # Transform to expected format
@@ -146,14 +150,14 @@ class PocketBaseClient:
             if formatted_keys:
                 self._keys_cache = formatted_keys
                 self._keys_cache_expires_at = datetime.now() + timedelta(seconds=KEYS_CACHE_TTL)
-                print(f"✅ Fetched {len(formatted_keys)} Vercel keys from PocketBase")
+                logger.info(f"✅ Fetched {len(formatted_keys)} Vercel keys from PocketBase")
 
             return formatted_keys
 
         except Exception as e:
-            print(f"❌ Error fetching keys from PocketBase: {e}")
+            logger.error(f"❌ Error fetching keys from PocketBase: {e}")
             if self._keys_cache:
-                print("⚠️  Using stale cache due to error")
+                logger.warning("⚠️  Using stale cache due to error")
                 return self._keys_cache
             return []
 
@@ -189,21 +193,21 @@ class PocketBaseClient:
                         page += 1
                     elif response.status_code == 401:
                         # Token expired, refresh
-                        print("⚠️  Token expired, refreshing...")
+                        logger.warning("⚠️  Token expired, refreshing...")
                         self._token = None
                         token = self._get_token()
                         if not token:
                             break
                         continue
                     else:
-                        print(f"❌ Failed to fetch records: {response.status_code}")
+                        logger.error(f"❌ Failed to fetch records: {response.status_code}")
                         break
 
-            print(f"✅ Fetched {len(all_records)} full records from PocketBase")
+            logger.info(f"✅ Fetched {len(all_records)} full records from PocketBase")
             return all_records
 
         except Exception as e:
-            print(f"❌ Error fetching full records from PocketBase: {e}")
+            logger.error(f"❌ Error fetching full records from PocketBase: {e}")
             return []
 
     def update_key_sync(self, record_id: str, data: Dict[str, Any]) -> bool:
@@ -213,7 +217,7 @@ class PocketBaseClient:
         # Get auth token
         token = self._get_token()
         if not token:
-            print("❌ Cannot update: authentication failed")
+            logger.error("❌ Cannot update: authentication failed")
             return False
 
         try:
@@ -222,13 +226,13 @@ class PocketBaseClient:
                 response = client.patch(url, headers=self._get_headers(), json=data)
 
                 if response.status_code == 200:
-                    print(f"✅ Updated key {record_id}")
+                    logger.info(f"✅ Updated key {record_id}")
                     return True
                 else:
-                    print(f"❌ Failed to update key {record_id}: {response.status_code} - {response.text}")
+                    logger.error(f"❌ Failed to update key {record_id}: {response.status_code} - {response.text}")
                     return False
         except Exception as e:
-            print(f"❌ Error updating key {record_id}: {e}")
+            logger.error(f"❌ Error updating key {record_id}: {e}")
             return False
 
     def test_connection(self) -> bool:
@@ -237,7 +241,7 @@ class PocketBaseClient:
             keys = self.fetch_keys_sync(force_refresh=True)
             return len(keys) > 0
         except Exception as e:
-            print(f"❌ PocketBase connection test failed: {e}")
+            logger.error(f"❌ PocketBase connection test failed: {e}")
             return False
 
 
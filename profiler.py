@@ -0,0 +1,222 @@
+"""
+On-demand sampling profiler for the Load Balancer.
+A background thread samples the event loop thread's Python stack at a fixed
+interval while a probe coroutine measures event-loop lag. Stalls longer than
+SLOW_CALLBACK_MS are reported with the stack that was running at the time.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Optional
+
+# === Configuration ===
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "10"))
+# Event loop stalls longer than this are reported as slow callbacks
+SLOW_CALLBACK_MS = float(os.getenv("SLOW_CALLBACK_MS", "100"))
+
+PROFILE_FORMATS = ("collapsed", "speedscope", "summary")
+MAX_SLOW_CALLBACKS = 50
+
+# Leaf frames of an event loop waiting for I/O (asyncio selector loop, or uvloop's C loop)
+_IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("base_events.py", "run_forever"),
+    ("base_events.py", "run_until_complete"),
+    ("runners.py", "run"),
+}
+
+
+def _label(code) -> str:
+    """Frame label: function (last two path components:first line)."""
+    path = code.co_filename.replace("\\", "/")
+    short = "/".join(path.rsplit("/", 2)[-2:])
+    return f"{code.co_qualname} ({short}:{code.co_firstlineno})"
+
+
+def capture_stack(frame, labels: dict) -> tuple[str, ...]:
+    """Labels of `frame` and its callers, root first. `labels` caches labels per code object."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        label = labels.get(code)
+        if label is None:
+            label = labels[code] = _label(code)
+        stack.append(label)
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+@dataclass
+class ProfileResult:
+    seconds: float
+    interval_ms: float
+    samples: Counter = field(default_factory=Counter)  # stack (root -> leaf) -> count
+    idle_samples: int = 0
+    lags_ms: list[float] = field(default_factory=list)
+    slow_callbacks: list[dict] = field(default_factory=list)
+
+    def collapsed(self) -> str:
+        """Brendan Gregg's collapsed stack format (input for flamegraph.pl / speedscope)."""
+        return "".join(
+            f"{';'.join(stack)} {count}\n"
+            for stack, count in self.samples.most_common()
+        )
+
+    def speedscope(self) -> dict:
+        """Speedscope "sampled" profile with identical stacks merged."""
+        frames: list[dict] = []
+        index: dict[str, int] = {}
+        samples, weights = [], []
+        for stack, count in self.samples.most_common():
+            ids = []
+            for name in stack:
+                if name not in index:
+                    index[name] = len(frames)
+                    frames.append({"name": name})
+                ids.append(index[name])
+            samples.append(ids)
+            weights.append(count * self.interval_ms)
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": "event loop",
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights
+            }],
+            "name": f"Load Balancer event loop ({self.seconds:g}s)",
+            "activeProfileIndex": 0,
+            "exporter": "vercel-api-key-lb"
+        }
+
+    def loop_lag(self) -> dict:
+        return {
+            "probes": len(self.lags_ms),
+            "p50_ms": round(percentile(self.lags_ms, 50), 3),
+            "p99_ms": round(percentile(self.lags_ms, 99), 3),
+            "max_ms": round(max(self.lags_ms, default=0.0), 3)
+        }
+
+    def summary(self, top: int = 20) -> dict:
+        busy = sum(self.samples.values())
+        total = busy + self.idle_samples
+        return {
+            "seconds": self.seconds,
+            "interval_ms": self.interval_ms,
+            "samples": total,
+            "busy_ratio": round(busy / total, 4) if total else 0.0,
+            "loop_lag": self.loop_lag(),
+            "slow_callbacks": self.slow_callbacks,
+            "top_stacks": [
+                {"count": count, "stack": list(stack)}
+                for stack, count in self.samples.most_common(top)
+            ]
+        }
+
+
+class SamplingProfiler:
+    """Samples the event loop thread from a helper thread; one profile at a time."""
+
+    def __init__(self, interval_ms: float = PROFILER_INTERVAL_MS, slow_callback_ms: float = SLOW_CALLBACK_MS):
+        self.interval_ms = interval_ms
+        self.slow_callback_ms = slow_callback_ms
+        self.running = False
+        self._labels: dict = {}
+
+    @staticmethod
+    def _is_idle(frame) -> bool:
+        code = frame.f_code
+        return (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES
+
+    def _sample(
+        self,
+        thread_id: int,
+        stop: threading.Event,
+        heartbeat: list[float],
+        result: ProfileResult
+    ):
+        interval = result.interval_ms / 1000
+        overdue = (result.interval_ms + self.slow_callback_ms) / 1000
+        stall_beat: Optional[float] = None
+        stall_stack: tuple[str, ...] = ()
+
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            if self._is_idle(frame):
+                result.idle_samples += 1
+                stack = ()
+            else:
+                stack = capture_stack(frame, self._labels)
+                result.samples[stack] += 1
+
+            # The probe coroutine updates the heartbeat every interval; if it is
+            # overdue the loop is stuck in whatever is running now
+            beat = heartbeat[0]
+            if stall_beat is None:
+                if time.monotonic() - beat > overdue:
+                    stall_beat, stall_stack = beat, stack
+            elif beat != stall_beat:
+                if len(result.slow_callbacks) < MAX_SLOW_CALLBACKS:
+                    result.slow_callbacks.append({
+                        "duration_ms": round((beat - stall_beat) * 1000 - result.interval_ms, 3),
+                        "stack": list(stall_stack)
+                    })
+                stall_beat = None
+
+    async def profile(self, seconds: float, interval_ms: Optional[float] = None) -> ProfileResult:
+        """Profile the calling event loop for `seconds`."""
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.running = True
+
+        result = ProfileResult(seconds=seconds, interval_ms=interval_ms or self.interval_ms)
+        interval = result.interval_ms / 1000
+        heartbeat = [time.monotonic()]
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample,
+            args=(threading.get_ident(), stop, heartbeat, result),
+            name="profiler",
+            daemon=True
+        )
+        sampler.start()
+
+        try:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                before = time.monotonic()
+                await asyncio.sleep(interval)
+                now = time.monotonic()
+                result.lags_ms.append(max(0.0, (now - before - interval) * 1000))
+                heartbeat[0] = now
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            self.running = False
+
+        return result
+
+
+# Global instance
+profiler = SamplingProfiler()
@@ -0,0 +1,432 @@
+"""
+Token-rate and spend quotas per client key.
+A key may set `tpm_limit` (tokens per minute), `daily_budget_usd` and `monthly_budget_usd`
+(UTC days and months). Every check is answered from counters in this process, so a key
+over its quota gets a 429 without touching SQLite. Before a request is sent, its prompt
+size is estimated and reserved in the key's one-minute token window; once the response is
+done, the reservation is replaced by the `usage` the gateway reported and its cost is
+added to the key's spend.
+
+Spend is written to SQLite every QUOTA_SYNC_INTERVAL seconds and read back, so it survives
+restarts and workers see each other's spend within one interval. The token window is per
+process.
+"""
+
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatchcase
+from typing import AsyncIterator, Optional
+
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from database import APIKey, add_quota_spend, load_quota_spend
+from metrics import QUOTA_REJECTED, QUOTA_TOKENS, QUOTA_SPEND
+from logger import get_logger
+
+# === Configuration ===
+# Model prices in USD per 1M tokens: {"openai/gpt-4o": {"input": 2.5, "output": 10}, "anthropic/*": {...}}
+QUOTA_PRICES_PATH = os.getenv("QUOTA_PRICES_PATH", "config/model-prices.json")
+# Price for models missing from the price list (errs on the expensive side)
+QUOTA_DEFAULT_INPUT_PRICE = float(os.getenv("QUOTA_DEFAULT_INPUT_PRICE", "3"))
+QUOTA_DEFAULT_OUTPUT_PRICE = float(os.getenv("QUOTA_DEFAULT_OUTPUT_PRICE", "15"))
+# Seconds between writing spend to SQLite and reading other workers' spend back
+QUOTA_SYNC_INTERVAL = float(os.getenv("QUOTA_SYNC_INTERVAL", "5"))
+
+# Rough prompt size before the gateway reports the real one
+BYTES_PER_TOKEN = 4
+TPM_WINDOW = 60
+# Endpoints whose streams report usage in a final chunk when `stream_options.include_usage` is set
+STREAM_USAGE_PATHS = ("v1/chat/completions", "v1/completions")
+
+logger = get_logger("quotas")
+
+
+def load_prices(path: str = QUOTA_PRICES_PATH) -> dict[str, tuple[float, float]]:
+    """Model (or glob pattern) -> (input, output) USD per 1M tokens. Missing file = no prices."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            raw = json.load(f)
+        return {
+            model: (float(price.get("input", 0)), float(price.get("output", 0)))
+            for model, price in raw.items()
+        }
+    except Exception as e:
+        logger.warning(f"⚠️  Ignoring model price list {path}: {e}")
+        return {}
+
+
+def estimate_tokens(body: bytes) -> int:
+    """Prompt tokens estimated from the request body size."""
+    return max(1, len(body) // BYTES_PER_TOKEN)
+
+
+def quota_periods(now: float) -> tuple[str, str]:
+    """The UTC day and month `now` falls in, e.g. ("2024-05-31", "2024-05")."""
+    day = datetime.fromtimestamp(now, timezone.utc)
+    return day.strftime("%Y-%m-%d"), day.strftime("%Y-%m")
+
+
+def _seconds_until_next_day(now: float) -> int:
+    day = datetime.fromtimestamp(now, timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(1, int((day + timedelta(days=1)).timestamp() - now))
+
+
+def _seconds_until_next_month(now: float) -> int:
+    month = datetime.fromtimestamp(now, timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    next_month = (month + timedelta(days=32)).replace(day=1)
+    return max(1, int(next_month.timestamp() - now))
+
+
+class QuotaExceeded(Exception):
+    """
+    The key is over one of its quotas: `quota` is "tpm", "daily" or "monthly", or
+    "tpm_request" for a request larger than the whole token rate limit, which never fits
+    and so has no `retry_after`.
+    """
+
+    def __init__(self, quota: str, message: str, retry_after: int):
+        super().__init__(message)
+        self.quota = quota
+        self.message = message
+        self.retry_after = retry_after
+
+
+@dataclass
+class QuotaTicket:
+    """Tokens reserved for one request, settled once its usage is known."""
+    key_id: str
+    model: Optional[str]
+    reserved: int
+    settled: bool = False
+
+
+class QuotaTracker:
+    """In-memory token windows and spend counters for client keys with quotas."""
+
+    def __init__(
+        self,
+        prices: Optional[dict[str, tuple[float, float]]] = None,
+        default_price: tuple[float, float] = (QUOTA_DEFAULT_INPUT_PRICE, QUOTA_DEFAULT_OUTPUT_PRICE),
+        sync_interval: float = QUOTA_SYNC_INTERVAL
+    ):
+        self.prices = load_prices() if prices is None else prices
+        self.default_price = default_price
+        self.sync_interval = sync_interval
+        # key_id -> (timestamp, tokens) charged in the last minute, oldest first; corrections can be negative
+        self._windows: dict[str, deque[tuple[float, int]]] = {}
+        self._window_totals: dict[str, int] = {}
+        # (key_id, period) -> USD, including amounts not yet written to SQLite
+        self._spent: dict[tuple[str, str], float] = {}
+        self._unsynced: dict[tuple[str, str], float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.rejected = 0
+        self.settled = 0
+        self.sync_errors = 0
+
+    @staticmethod
+    def applies(api_key: Optional[APIKey]) -> bool:
+        return bool(api_key) and (
+            api_key.tpm_limit > 0 or api_key.daily_budget_usd > 0 or api_key.monthly_budget_usd > 0
+        )
+
+    def price(self, model: Optional[str]) -> tuple[float, float]:
+        """(input, output) USD per 1M tokens: exact match, then the first matching pattern, then the default."""
+        if model in self.prices:
+            return self.prices[model]
+        if model:
+            for pattern, price in self.prices.items():
+                if fnmatchcase(model, pattern):
+                    return price
+        return self.default_price
+
+    def cost(self, model: Optional[str], prompt_tokens: int, completion_tokens: int) -> float:
+        input_price, output_price = self.price(model)
+        return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+    def tokens_used(self, key_id: str, now: Optional[float] = None) -> int:
+        """Tokens charged to the key in the last minute."""
+        now = now if now is not None else time.time()
+        window = self._windows.get(key_id)
+        if not window:
+            return 0
+        total = self._window_totals[key_id]
+        while window and window[0][0] <= now - TPM_WINDOW:
+            total -= window.popleft()[1]
+        if not window:
+            del self._windows[key_id]
+            del self._window_totals[key_id]
+            return 0
+        self._window_totals[key_id] = total
+        return total
+
+    def spent(self, key_id: str, now: Optional[float] = None) -> tuple[float, float]:
+        """(today, this month) spend of the key in USD."""
+        day, month = quota_periods(now if now is not None else time.time())
+        return self._spent.get((key_id, day), 0.0), self._spent.get((key_id, month), 0.0)
+
+    def _charge_tokens(self, key_id: str, tokens: int, now: float):
+        self._windows.setdefault(key_id, deque()).append((now, tokens))
+        self._window_totals[key_id] = self._window_totals.get(key_id, 0) + tokens
+
+    def _tpm_retry_after(self, key_id: str, needed: int, limit: int, now: float) -> int:
+        """Seconds until enough of the window expires for `needed` more tokens."""
+        total = self._window_totals.get(key_id, 0)
+        for at, tokens in self._windows.get(key_id, ()):
+            total -= tokens
+            if total + needed <= limit:
+                return max(1, int(at + TPM_WINDOW - now) + 1)
+        return TPM_WINDOW
+
+    def check(self, api_key: APIKey, model: Optional[str], estimate: int, now: Optional[float] = None):
+        """Raise QuotaExceeded if a request of `estimate` prompt tokens would go over a quota."""
+        now = now if now is not None else time.time()
+
+        if api_key.tpm_limit > 0:
+            if estimate > api_key.tpm_limit:
+                self._reject(
+                    "tpm_request",
+                    f"Request too large: about {estimate} tokens, limit {api_key.tpm_limit} tokens/minute",
+                    0
+                )
+            used = self.tokens_used(api_key.id, now)
+            if used + estimate > api_key.tpm_limit:
+                self._reject(
+                    "tpm",
+                    f"Token rate limit exceeded. Limit: {api_key.tpm_limit} tokens/minute",
+                    self._tpm_retry_after(api_key.id, estimate, api_key.tpm_limit, now)
+                )
+
+        if api_key.daily_budget_usd > 0 or api_key.monthly_budget_usd > 0:
+            prompt_cost = self.cost(model, estimate, 0)
+            spent_today, spent_month = self.spent(api_key.id, now)
+            if api_key.daily_budget_usd > 0 and spent_today + prompt_cost > api_key.daily_budget_usd:
+                self._reject(
+                    "daily",
+                    f"Daily spend quota exceeded. Limit: ${api_key.daily_budget_usd:g}/day",
+                    _seconds_until_next_day(now)
+                )
+            if api_key.monthly_budget_usd > 0 and spent_month + prompt_cost > api_key.monthly_budget_usd:
+                self._reject(
+                    "monthly",
+                    f"Monthly spend quota exceeded. Limit: ${api_key.monthly_budget_usd:g}/month",
+                    _seconds_until_next_month(now)
+                )
+
+    def _reject(self, quota: str, message: str, retry_after: int):
+        self.rejected += 1
+        QUOTA_REJECTED.inc(1, quota)
+        raise QuotaExceeded(quota, message, retry_after)
+
+    def acquire(self, api_key: Optional[APIKey], model: Optional[str], body: bytes) -> Optional[QuotaTicket]:
+        """
+        Check the key's quotas and reserve the estimated prompt tokens.
+        Returns None for keys without quotas. Raises QuotaExceeded.
+        """
+        if not self.applies(api_key):
+            return None
+        now = time.time()
+        estimate = estimate_tokens(body)
+        self.check(api_key, model, estimate, now)
+        self._charge_tokens(api_key.id, estimate, now)
+        return QuotaTicket(key_id=api_key.id, model=model, reserved=estimate)
+
+    def settle(self, ticket: QuotaTicket, usage: Optional[dict], failed: bool = False, now: Optional[float] = None):
+        """
+        Replace the reservation with the reported usage and charge its cost.
+        Without usage the estimate stands and is charged as prompt tokens; failed requests cost nothing.
+        """
+        if ticket.settled:
+            return
+        ticket.settled = True
+        self.settled += 1
+        now = now if now is not None else time.time()
+
+        cost = None
+        if failed:
+            prompt_tokens = completion_tokens = 0
+        elif isinstance(usage, dict):
+            prompt_tokens = int(usage.get("prompt_tokens") or usage.get("input_tokens") or 0)
+            completion_tokens = int(usage.get("completion_tokens") or usage.get("output_tokens") or 0)
+            if not prompt_tokens and not completion_tokens:
+                prompt_tokens = int(usage.get("total_tokens") or 0)
+            # Use the gateway's own figure when it reports one
+            if isinstance(usage.get("cost"), (int, float)):
+                cost = float(usage["cost"])
+        else:
+            prompt_tokens, completion_tokens = ticket.reserved, 0
+
+        tokens = prompt_tokens + completion_tokens
+        if tokens != ticket.reserved:
+            self._charge_tokens(ticket.key_id, tokens - ticket.reserved, now)
+
+        if cost is None:
+            cost = self.cost(ticket.model, prompt_tokens, completion_tokens)
+        model_label = ticket.model if isinstance(ticket.model, str) and ticket.model else "none"
+        if tokens:
+            QUOTA_TOKENS.inc(tokens, model_label)
+        if cost > 0:
+            QUOTA_SPEND.inc(cost, model_label)
+            for period in quota_periods(now):
+                self._spent[(ticket.key_id, period)] = self._spent.get((ticket.key_id, period), 0.0) + cost
+                self._unsynced[(ticket.key_id, period)] = self._unsynced.get((ticket.key_id, period), 0.0) + cost
+
+    def track(self, response: Response, ticket: QuotaTicket, strip_usage: bool = False) -> Response:
+        """
+        Settle `ticket` from the response's usage: right away for regular responses, after the
+        last chunk of a stream. With `strip_usage` the usage-only stream chunk, requested by the
+        proxy rather than the client, is not passed on.
+        """
+        if isinstance(response, StreamingResponse):
+            if not 200 <= response.status_code < 300:
+                # An upstream error sent as a stream costs nothing, like any other failed request
+                self.settle(ticket, None, failed=True)
+                return response
+            response.body_iterator = self._settle_after(response.body_iterator, ticket, strip_usage)
+            return response
+
+        failed = not 200 <= response.status_code < 300
+        usage = None
+        if not failed:
+            try:
+                usage = json.loads(response.body).get("usage")
+            except Exception:
+                pass
+        self.settle(ticket, usage, failed=failed)
+        return response
+
+    async def _settle_after(self, chunks: AsyncIterator[bytes], ticket: QuotaTicket, strip_usage: bool) -> AsyncIterator[bytes]:
+        usage = None
+        buffer = b""
+        try:
+            async for chunk in chunks:
+                # Pass on complete events only, so the usage event can be found (and dropped) whole
+                buffer += chunk
+                end = buffer.rfind(b"\n\n")
+                if end < 0:
+                    continue
+                events, buffer = buffer[:end + 2], buffer[end + 2:]
+                if b'"usage"' in events:
+                    events, found = _take_usage(events, strip_usage)
+                    usage = found or usage
+                if events:
+                    yield events
+            if buffer:
+                yield buffer
+        finally:
+            self.settle(ticket, usage)
+
+    async def sync(self):
+        """Write spend charged here to SQLite and read back the totals of every worker."""
+        deltas, self._unsynced = self._unsynced, {}
+        try:
+            if deltas:
+                await add_quota_spend(deltas)
+        except Exception as e:
+            for key, amount in deltas.items():
+                self._unsynced[key] = self._unsynced.get(key, 0.0) + amount
+            self.sync_errors += 1
+            logger.warning(f"⚠️  Failed to save quota spend: {e}")
+            return
+
+        try:
+            totals = await load_quota_spend(list(quota_periods(time.time())))
+        except Exception as e:
+            self.sync_errors += 1
+            logger.warning(f"⚠️  Failed to load quota spend: {e}")
+            return
+
+        # Spend charged while the totals were being read is not in them yet
+        for key, amount in self._unsynced.items():
+            totals[key] = totals.get(key, 0.0) + amount
+        self._spent = totals
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            await self.sync()
+
+    async def start(self):
+        """Load the current spend and keep it in sync in the background."""
+        await self.sync()
+        self._task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.sync()
+
+    def usage(self, api_key: APIKey) -> dict:
+        """Current standing of a key against its quotas."""
+        spent_today, spent_month = self.spent(api_key.id)
+        return {
+            "tokens_last_minute": self.tokens_used(api_key.id),
+            "spent_today_usd": round(spent_today, 6),
+            "spent_this_month_usd": round(spent_month, 6)
+        }
+
+    def get_stats(self) -> dict:
+        return {
+            "keys_tracked": len({key_id for key_id, _ in self._spent} | set(self._windows)),
+            "rejected": self.rejected,
+            "settled": self.settled,
+            "unsynced_usd": round(sum(self._unsynced.values()), 6),
+            "sync_errors": self.sync_errors
+        }
+
+
+def _take_usage(events: bytes, strip_usage: bool) -> tuple[bytes, Optional[dict]]:
+    """Find the usage reported in complete SSE events; drop the usage-only event if asked to."""
+    usage = None
+    kept = []
+    for event in events.split(b"\n\n")[:-1]:
+        if event.startswith(b"data: {") and b'"usage"' in event:
+            try:
+                data = json.loads(event[6:])
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and isinstance(data.get("usage"), dict):
+                usage = data["usage"]
+                if strip_usage and not data.get("choices"):
+                    continue
+        kept.append(event + b"\n\n")
+    return b"".join(kept), usage
+
+
+def quota_exceeded_response(e: QuotaExceeded) -> JSONResponse:
+    """OpenAI-style 429 with Retry-After, or 413 for a request that can never fit the token rate limit."""
+    if e.quota == "tpm_request":
+        return JSONResponse(
+            status_code=413,
+            content={
+                "error": {
+                    "message": e.message,
+                    "type": "invalid_request_error",
+                    "param": None,
+                    "code": None
+                }
+            }
+        )
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(e.retry_after)},
+        content={
+            "error": {
+                "message": e.message,
+                "type": "rate_limit_error",
+                "param": None,
+                "code": None
+            }
+        }
+    )
+
+
+# Global instance
+quota_tracker = QuotaTracker()
@@ -0,0 +1,203 @@
+"""
+Deterministic response cache for the Load Balancer.
+Caches non-streaming `temperature: 0` chat completions in an in-memory LRU
+backed by a SQLite disk tier.
+"""
+
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import aiosqlite
+
+# === Configuration ===
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # 1 hour
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+# Empty path disables the disk tier
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "data/response_cache.db")
+# Share entries between client keys. Raises the hit rate, but X-Cache and response
+# timing then tell one tenant whether another already sent the same prompt
+RESPONSE_CACHE_SHARED = os.getenv("RESPONSE_CACHE_SHARED", "false").lower() == "true"
+
+CACHEABLE_PATHS = ("v1/chat/completions", "v1/completions")
+# Fields that do not change the generated output
+IGNORED_FIELDS = ("user", "stream", "stream_options", "metadata")
+PURGE_EVERY_N_SETS = 100
+
+
+@dataclass
+class CachedResponse:
+    status_code: int
+    content_type: str
+    body: bytes
+    expires_at: float
+
+
+def is_cacheable(method: str, path: str, data: Optional[dict], is_stream: bool) -> bool:
+    """Only deterministic, non-streaming completions are cached."""
+    if method != "POST" or path not in CACHEABLE_PATHS or is_stream:
+        return False
+    if not isinstance(data, dict):
+        return False
+    return data.get("temperature") == 0 and data.get("n", 1) == 1
+
+
+def make_cache_key(
+    path: str,
+    data: dict,
+    client_key_id: Optional[str],
+    shared: bool = RESPONSE_CACHE_SHARED
+) -> str:
+    """
+    Canonical hash of the endpoint, model and normalized request body, scoped to the
+    client key unless entries are shared between keys.
+    """
+    normalized = {k: v for k, v in data.items() if k not in IGNORED_FIELDS}
+    canonical = json.dumps(
+        {
+            "path": path,
+            "model": data.get("model"),
+            "body": normalized,
+            "client": None if shared else client_key_id
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def cache_control_flags(header: Optional[str]) -> tuple[bool, bool]:
+    """Parse a Cache-Control request header into (no_cache, no_store)."""
+    if not header:
+        return False, False
+    directives = {d.strip().lower() for d in header.split(",")}
+    return "no-cache" in directives, "no-store" in directives
+
+
+class ResponseCache:
+    """In-memory LRU with TTL in front of an optional SQLite tier."""
+
+    def __init__(
+        self,
+        ttl: int = RESPONSE_CACHE_TTL,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        db_path: Optional[str] = RESPONSE_CACHE_PATH
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db_path = db_path or None
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._sets_since_purge = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def init(self):
+        """Create the disk tier table and drop expired rows."""
+        if not self.db_path:
+            return
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    status_code INTEGER NOT NULL,
+                    content_type TEXT NOT NULL,
+                    body BLOB NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache(expires_at)")
+            await db.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+            await db.commit()
+
+    def _remember(self, key: str, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        """Look up a cached response, memory first, then disk."""
+        now = time.time()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            del self._entries[key]
+
+        if self.db_path:
+            async with aiosqlite.connect(self.db_path) as db:
+                async with db.execute(
+                    "SELECT status_code, content_type, body, expires_at FROM response_cache "
+                    "WHERE cache_key = ? AND expires_at > ?",
+                    (key, now)
+                ) as cursor:
+                    row = await cursor.fetchone()
+            if row:
+                entry = CachedResponse(
+                    status_code=row[0],
+                    content_type=row[1],
+                    body=bytes(row[2]),
+                    expires_at=row[3]
+                )
+                self._remember(key, entry)
+                self.hits += 1
+                return entry
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, status_code: int, content_type: str, body: bytes):
+        """Store a response in both tiers."""
+        entry = CachedResponse(
+            status_code=status_code,
+            content_type=content_type,
+            body=body,
+            expires_at=time.time() + self.ttl
+        )
+        self._remember(key, entry)
+
+        if not self.db_path:
+            return
+
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(
+                """
+                INSERT OR REPLACE INTO response_cache (cache_key, status_code, content_type, body, expires_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (key, entry.status_code, entry.content_type, entry.body, entry.expires_at)
+            )
+
+            self._sets_since_purge += 1
+            if self._sets_since_purge >= PURGE_EVERY_N_SETS:
+                self._sets_since_purge = 0
+                await db.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+
+            await db.commit()
+
+    def get_stats(self) -> dict:
+        """Get hit/miss counters and the memory tier size."""
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "shared": RESPONSE_CACHE_SHARED,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+# Global instance
+response_cache = ResponseCache()
@@ -0,0 +1,34 @@
+"""
+Vercel key selection for the Load Balancer.
+Pure selection functions over the key manager's key dicts, shared with the routing simulator.
+"""
+
+import random
+from typing import Optional
+
+
+def select_weighted_random(keys: list[dict], exclude: Optional[set[str]] = None, min_credit: float = 0.01) -> Optional[dict]:
+    """
+    Pick a key with probability proportional to its balance.
+    Keys at or below `min_credit` and keys whose api_key is in `exclude` are skipped.
+    """
+    available = [
+        k for k in keys
+        if k["balance"] > min_credit and not (exclude and k["api_key"] in exclude)
+    ]
+
+    if not available:
+        return None
+
+    total = sum(k["balance"] for k in available)
+    if total == 0:
+        return random.choice(available)
+
+    r = random.uniform(0, total)
+    cumulative = 0
+    for key in available:
+        cumulative += key["balance"]
+        if r <= cumulative:
+            return key
+
+    return available[-1]
@@ -10,53 +10,111 @@ load_dotenv()
 import json
 import asyncio
 import time
-import random
 import os
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import Callable, Optional
 from datetime import datetime, timedelta, timezone
 
 import httpx
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import StreamingResponse, Response, JSONResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 
 from database import (
     init_database, create_key, list_keys, get_key_by_id,
-    update_key, delete_key, get_key_stats, log_usage
+    update_key, delete_key, get_key_stats, log_usage, get_pending_usage_writes
 )
 from auth import AuthMiddleware
 from pocketbase_client import get_keys_from_pocketbase
+from upstream import (
+    UPSTREAM_TTFB_RETRIES, TTFBTimeout, IdleTimeout, resolve_timeouts, send_with_ttfb,
+    iter_lines, prepend_chunk
+)
+from sse import coalesce_sse
+from thinking import rewrite_thinking_request, rewrite_thinking_stream
+from traffic_recorder import traffic_recorder, request_shape
+from routing import select_weighted_random
+from key_state import WORKERS, KEY_STATE_SHARED, KEY_STATE_SYNC_INTERVAL, KeyStateStore, key_state
+from leader import LEADER_ELECTION, leader_lease
+from state_backend import state_backend
+from shutdown import SHUTDOWN_STREAM_DEADLINE, drain, listen_socket
+from admission import AdmissionRejected, admission, rejected_response
+from quotas import STREAM_USAGE_PATHS, QuotaExceeded, quota_tracker, quota_exceeded_response
+from batches import (
+    BATCH_ENDPOINTS, UPLOAD_CHUNK_SIZE, BatchError, BatchRunner, BatchStore, batch_object, error_response
+)
+from embeddings import (
+    EMBEDDINGS_BATCHING_ENABLED, EmbeddingBatcher, EmbeddingsService, EmbeddingsUpstreamError,
+    split_request, build_response
+)
+from singleflight import SINGLEFLIGHT_ENABLED, singleflight, make_flight_key
+from idempotency import IDEMPOTENCY_ENABLED, IDEMPOTENCY_HEADER, idempotency_store, make_fingerprint
+from models_cache import MODELS_CACHE_ENABLED, ModelsCache, etag_matches
+from metrics import (
+    KEY_SELECTION_DURATION, UPSTREAM_CONNECT_DURATION, UPSTREAM_TTFB, BYTES_IN,
+    VERCEL_KEY_BALANCE, USAGE_WRITER_QUEUE_DEPTH, ADMISSION_INFLIGHT, ADMISSION_QUEUE_DEPTH,
+    UpstreamTrace, track_response, render_metrics
+)
+from tracing import span, otlp_exporter
+from profiler import PROFILER_MAX_SECONDS, PROFILE_FORMATS, profiler
+from loop_watchdog import WATCHDOG_ENABLED, watchdog
+from logger import get_logger, get_stats as get_logging_stats
+from response_cache import (
+    RESPONSE_CACHE_ENABLED, response_cache, is_cacheable, make_cache_key, cache_control_flags
+)
 
 # === Configuration ===
 KEY_LIST_PATH = "config/key-list.json"
 USE_POCKETBASE = os.getenv("USE_POCKETBASE", "true").lower() == "true"
-VERCEL_GATEWAY_URL = "https://ai-gateway.vercel.sh"
+# Point at benchmarks/mock_gateway.py for offline testing
+VERCEL_GATEWAY_URL = os.getenv("VERCEL_GATEWAY_URL", "https://ai-gateway.vercel.sh").rstrip("/")
 CREDIT_CACHE_TTL = 300  # 5 minutes
 MIN_CREDIT = 0.01
 KEYS_REFRESH_INTERVAL = 300  # Refresh keys from PocketBase every 5 minutes
 
+logger = get_logger("server")
+
 # === Pydantic Models for Admin API ===
 class CreateKeyRequest(BaseModel):
     name: str
     rate_limit: int = 0  # 0 = unlimited
     expires_in_days: Optional[int] = None
+    max_concurrency: int = 0  # 0 = unlimited
+    priority: int = 0
+    weight: int = 1
+    tpm_limit: int = 0  # tokens per minute, 0 = unlimited
+    daily_budget_usd: float = 0  # 0 = unlimited
+    monthly_budget_usd: float = 0  # 0 = unlimited
 
 class UpdateKeyRequest(BaseModel):
     name: Optional[str] = None
     rate_limit: Optional[int] = None
     is_active: Optional[bool] = None
     expires_in_days: Optional[int] = None
+    max_concurrency: Optional[int] = None
+    priority: Optional[int] = None
+    weight: Optional[int] = None
+    tpm_limit: Optional[int] = None
+    daily_budget_usd: Optional[float] = None
+    monthly_budget_usd: Optional[float] = None
 
 # === Vercel Key Manager ===
 class VercelKeyManager:
     """Manages Vercel API keys and their credit balances."""
 
-    def __init__(self):
+    def __init__(self, state: Optional[KeyStateStore] = None):
         self.keys: list[dict] = []
         self._lock = asyncio.Lock()
         self._keys_last_refresh = 0
-        self._load_keys()
+        # Balances shared with other workers (None = this process only)
+        self.state = state if state is not None else (key_state if KEY_STATE_SHARED else None)
+        self._last_sync = 0.0
+        # api_key -> time before which this worker does not try to claim the poll again
+        self._next_claim: dict[str, float] = {}
+        # When this worker last published its key list to / adopted one from the shared state
+        self._keys_shared_at = 0.0
+        # Keys are loaded by the first refresh_all(), by the leader only when it is shared
 
     def _load_keys_from_json(self) -> list[dict]:
         """Load Vercel keys from JSON file (fallback)."""
@@ -65,10 +123,10 @@ class VercelKeyManager:
                 data = json.load(f)
             return data.get("keys", [])
         except FileNotFoundError:
-            print(f"⚠️  {KEY_LIST_PATH} not found")
+            logger.warning(f"⚠️  {KEY_LIST_PATH} not found")
             return []
         except Exception as e:
-            print(f"⚠️  Error loading keys from JSON: {e}")
+            logger.error(f"⚠️  Error loading keys from JSON: {e}")
             return []
 
     def _load_keys_from_pocketbase(self) -> list[dict]:
@@ -76,29 +134,37 @@ class VercelKeyManager:
         try:
             return get_keys_from_pocketbase()
         except Exception as e:
-            print(f"⚠️  Error loading keys from PocketBase: {e}")
+            logger.error(f"⚠️  Error loading keys from PocketBase: {e}")
             return []
 
-    def _load_keys(self):
-        """Load Vercel keys from PocketBase or JSON file."""
+    def _fetch_raw_keys(self) -> list[dict]:
+        """Read the key list from PocketBase or the JSON file."""
         raw_keys = []
 
         if USE_POCKETBASE:
-            print("📡 Loading keys from PocketBase...")
+            logger.info("📡 Loading keys from PocketBase...")
             raw_keys = self._load_keys_from_pocketbase()
 
             # Fallback to JSON if PocketBase fails
             if not raw_keys:
-                print("⚠️  PocketBase failed, falling back to JSON file...")
+                logger.warning("⚠️  PocketBase failed, falling back to JSON file...")
                 raw_keys = self._load_keys_from_json()
         else:
-            print("📁 Loading keys from JSON file...")
+            logger.info("📁 Loading keys from JSON file...")
             raw_keys = self._load_keys_from_json()
+        return raw_keys
 
+    def _load_keys(self):
+        """Load Vercel keys from PocketBase or JSON file."""
+        self._set_keys(self._fetch_raw_keys())
+
+    def _set_keys(self, raw_keys: list[dict]):
+        """Swap in a new key list, keeping the balances of keys that are still present."""
         # Preserve existing credit balances
         existing_keys_map = {k["api_key"]: k for k in self.keys}
 
-        self.keys = []
+        # Build the new list before swapping it in; this may run in a worker thread
+        keys = []
         for k in raw_keys:
             api_key = k.get("api_key", "")
             if not api_key:
@@ -107,7 +173,7 @@ class VercelKeyManager:
             # Preserve credit balance if key already exists
             if api_key in existing_keys_map:
                 existing = existing_keys_map[api_key]
-                self.keys.append({
+                keys.append({
                     "name": k.get("name", "Unknown"),
                     "api_key": api_key,
                     "balance": existing.get("balance", 0.0),
@@ -115,7 +181,7 @@ class VercelKeyManager:
                     "updated_at": existing.get("updated_at", 0)
                 })
             else:
-                self.keys.append({
+                keys.append({
                     "name": k.get("name", "Unknown"),
                     "api_key": api_key,
                     "balance": 0.0,
@@ -123,8 +189,9 @@ class VercelKeyManager:
                     "updated_at": 0
                 })
 
+        self.keys = keys
         self._keys_last_refresh = time.time()
-        print(f"✅ Loaded {len(self.keys)} Vercel keys")
+        logger.info(f"✅ Loaded {len(self.keys)} Vercel keys")
 
     def reload_keys(self):
         """Reload keys from source (PocketBase or JSON)."""
@@ -145,53 +212,169 @@ class VercelKeyManager:
                     key["total_used"] = float(data.get("total_used", 0))
                     key["updated_at"] = time.time()
         except Exception as e:
-            print(f"Error fetching credit for {key['name']}: {e}")
+            logger.warning("Error fetching credit for %s: %s", key["name"], e, extra={"key": key["name"]})
+
+    async def _refresh_credit(self, key: dict, max_age: float) -> None:
+        """Poll a key's credit; with shared state, only if this worker wins the claim for it."""
+        if self.state is None:
+            # Balances restored from the shutdown snapshot may still be fresh enough
+            if max_age <= 0 or time.time() - key["updated_at"] >= max_age:
+                await self._fetch_credit(key)
+            return
+
+        # Another worker is polling this key; its result arrives with the next sync
+        if max_age > 0 and time.time() < self._next_claim.get(key["api_key"], 0):
+            return
+
+        try:
+            if not await self.state.claim(key["api_key"], max_age):
+                self._next_claim[key["api_key"]] = time.time() + KEY_STATE_SYNC_INTERVAL
+                return
+        except Exception as e:
+            logger.warning("Shared key state unavailable, polling directly: %s", e)
+            await self._fetch_credit(key)
+            return
+
+        updated_at = key["updated_at"]
+        await self._fetch_credit(key)
+        try:
+            if key["updated_at"] != updated_at:
+                await self.state.publish(key)
+            else:
+                await self.state.release(key["api_key"])
+        except Exception as e:
+            logger.warning("Failed to publish credit for %s: %s", key["name"], e, extra={"key": key["name"]})
 
-    async def refresh_all(self):
-        """Refresh credit balance for all keys and optionally reload keys list."""
-        # Reload keys from PocketBase if needed
+    async def _sync_state(self, force: bool = False) -> None:
+        """Adopt balances that other workers have published since the last sync."""
         now = time.time()
-        if USE_POCKETBASE and (now - self._keys_last_refresh > KEYS_REFRESH_INTERVAL):
-            print("🔄 Refreshing keys from PocketBase...")
-            self._load_keys()
+        if self.state is None or (not force and now - self._last_sync < KEY_STATE_SYNC_INTERVAL):
+            return
+        self._last_sync = now
 
-        # Refresh credit balances
-        await asyncio.gather(*[self._fetch_credit(k) for k in self.keys])
-        print(f"✅ Refreshed credits for {len(self.keys)} Vercel keys")
+        try:
+            shared = await self.state.load()
+        except Exception as e:
+            logger.warning("Failed to read shared key state: %s", e)
+            return
 
-    async def get_key(self) -> Optional[str]:
+        for key in self.keys:
+            entry = shared.get(key["api_key"])
+            if entry and entry[2] > key["updated_at"]:
+                key["balance"], key["total_used"], key["updated_at"] = entry
+
+    async def _share_key_list(self, leader: bool) -> None:
+        """The leader publishes its key list; followers adopt a newer one instead of loading their own."""
+        try:
+            if leader:
+                if self._keys_last_refresh > self._keys_shared_at:
+                    await self.state.publish_key_list(self.keys)
+                    self._keys_shared_at = self._keys_last_refresh
+                return
+
+            published = await self.state.load_key_list()
+            if published and published[1] > self._keys_shared_at:
+                self._set_keys(published[0])
+                self._keys_shared_at = published[1]
+        except Exception as e:
+            logger.warning("Failed to share the Vercel key list: %s", e)
+
+    async def refresh_all(self, max_age: float = CREDIT_CACHE_TTL / 2, leader: bool = True):
+        """
+        Refresh credit balance for all keys and optionally reload keys list.
+        With shared state, keys another worker polled less than `max_age` seconds ago are skipped,
+        and a follower (`leader=False`) only reads the key list and balances the leader published.
+        """
+        if leader or self.state is None:
+            # Load keys on the first refresh, then reload them from PocketBase if needed
+            now = time.time()
+            if not self._keys_last_refresh or (USE_POCKETBASE and now - self._keys_last_refresh > KEYS_REFRESH_INTERVAL):
+                if self._keys_last_refresh:
+                    logger.info("🔄 Refreshing keys from PocketBase...")
+                # PocketBase and the JSON fallback use blocking I/O - keep it off the event loop
+                await asyncio.to_thread(self._load_keys)
+
+        if self.state is not None:
+            await self._share_key_list(leader)
+
+        if leader:
+            # Refresh credit balances
+            await asyncio.gather(*[self._refresh_credit(k, max_age) for k in self.keys])
+
+        if self.state is not None:
+            # Keys this worker has never seen a balance for are being polled by another
+            # worker (e.g. all workers starting at once) - wait briefly for its results
+            # A follower that has no key list yet waits for the leader to publish one
+            deadline = time.time() + 10
+            while True:
+                if not self._keys_last_refresh:
+                    await self._share_key_list(leader)
+                await self._sync_state(force=True)
+                loaded = bool(self._keys_last_refresh)
+                if (loaded and all(k["updated_at"] for k in self.keys)) or time.time() > deadline:
+                    break
+                await asyncio.sleep(0.2)
+
+            if not self._keys_last_refresh:
+                logger.warning("⚠️  No key list published by the leader, loading keys directly")
+                await asyncio.to_thread(self._load_keys)
+        logger.info(f"✅ Refreshed credits for {len(self.keys)} Vercel keys")
+
+    async def save_snapshot(self) -> None:
+        """Persist balances on shutdown so the next process does not have to poll every key again."""
+        if self.state is not None:
+            # Shared state is already persisted on every poll
+            return
+        await key_state.init()
+        for key in self.keys:
+            if key["updated_at"]:
+                await key_state.publish(key)
+        logger.info(f"Saved credit snapshot for {len(self.keys)} Vercel keys")
+
+    async def restore_snapshot(self) -> None:
+        """Adopt balances saved by the previous process."""
+        if self.state is not None or not os.path.exists(key_state.db_path):
+            return
+        try:
+            saved = await key_state.load()
+        except Exception as e:
+            logger.warning("Failed to read credit snapshot: %s", e)
+            return
+        for key in self.keys:
+            entry = saved.get(key["api_key"])
+            if entry and entry[2] > key["updated_at"]:
+                key["balance"], key["total_used"], key["updated_at"] = entry
+
+    async def get_key(self, exclude: Optional[set[str]] = None) -> Optional[str]:
         """
         Select a Vercel key using weighted random based on balance.
         Keys with higher balance have higher probability of being selected.
+        Keys in `exclude` (e.g. ones that already timed out for this request) are skipped.
         """
+        with span("get_key"):
+            return await self._select_key(exclude)
+
+    async def _select_key(self, exclude: Optional[set[str]]) -> Optional[str]:
         async with self._lock:
+            await self._sync_state()
             now = time.time()
 
             # Refresh stale keys
             for key in self.keys:
                 if now - key["updated_at"] > CREDIT_CACHE_TTL:
-                    await self._fetch_credit(key)
-
-            # Filter keys with sufficient balance
-            available = [k for k in self.keys if k["balance"] > MIN_CREDIT]
+                    with span("fetch_credit", key=key["name"]):
+                        await self._refresh_credit(key, CREDIT_CACHE_TTL)
 
-            if not available:
+            # Weighted random selection by balance
+            key = select_weighted_random(self.keys, exclude, MIN_CREDIT)
+            if not key:
                 return None
 
-            # Weighted random selection
-            total = sum(k["balance"] for k in available)
-            if total == 0:
-                return random.choice(available)["api_key"]
-
-            r = random.uniform(0, total)
-            cumulative = 0
-            for key in available:
-                cumulative += key["balance"]
-                if r <= cumulative:
-                    print(f"Selected Vercel key: {key['name']} (${key['balance']:.4f})")
-                    return key["api_key"]
-
-            return available[-1]["api_key"]
+            logger.debug(
+                "Selected Vercel key: %s ($%.4f)", key["name"], key["balance"],
+                extra={"key": key["name"], "balance": key["balance"]}
+            )
+            return key["api_key"]
 
     def get_status(self) -> list[dict]:
         """Get status of all Vercel keys."""
@@ -208,29 +391,99 @@ class VercelKeyManager:
 # === Global instances ===
 vercel_key_manager = VercelKeyManager()
 
+
+async def fetch_models() -> tuple[int, bytes]:
+    """Fetch the model list from the Vercel AI Gateway."""
+    headers = {}
+    vercel_api_key = await vercel_key_manager.get_key()
+    if vercel_api_key:
+        headers["Authorization"] = f"Bearer {vercel_api_key}"
+
+    async with httpx.AsyncClient() as client:
+        resp = await client.get(f"{VERCEL_GATEWAY_URL}/v1/models", headers=headers, timeout=30)
+        return resp.status_code, resp.content
+
+
+models_cache = ModelsCache(fetch_models)
+
+# Gauges read at scrape time
+VERCEL_KEY_BALANCE.callback = lambda: [((k["name"],), k["balance"]) for k in vercel_key_manager.keys]
+USAGE_WRITER_QUEUE_DEPTH.callback = lambda: [((), get_pending_usage_writes())]
+ADMISSION_INFLIGHT.callback = lambda: [((), admission.inflight)]
+ADMISSION_QUEUE_DEPTH.callback = lambda: [((), admission.queue_depth)]
+
 # === Lifespan ===
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Initialize on startup, cleanup on shutdown."""
+    drain.install_signal_handlers()
+    if WATCHDOG_ENABLED:
+        watchdog.start()
+    traffic_recorder.start()
+
     # Initialize database
     await init_database()
-    print("Database initialized")
+    logger.info("Database initialized")
+
+    await state_backend.start()
+    await quota_tracker.start()
+    # Resumes batches left unfinished by the previous process
+    await batch_runner.start()
+
+    if RESPONSE_CACHE_ENABLED:
+        await response_cache.init()
+        logger.info("Response cache enabled")
+
+    if vercel_key_manager.state:
+        await vercel_key_manager.state.init()
+        logger.info(f"Sharing Vercel key state through {vercel_key_manager.state.db_path}")
+
+    # Only the elected worker polls credits and PocketBase; the others read what it publishes
+    use_leader = LEADER_ELECTION and vercel_key_manager.state is not None
+    if use_leader:
+        await leader_lease.start()
 
-    # Refresh Vercel key credits
-    await vercel_key_manager.refresh_all()
+    def is_leader() -> bool:
+        return leader_lease.is_leader if use_leader else True
+
+    # Refresh Vercel key credits (keys in the previous process's snapshot that are still fresh are skipped)
+    await vercel_key_manager.restore_snapshot()
+    await vercel_key_manager.refresh_all(leader=is_leader())
 
     # Start background refresh task
     async def periodic_refresh():
         while True:
             await asyncio.sleep(CREDIT_CACHE_TTL)
-            await vercel_key_manager.refresh_all()
+            await vercel_key_manager.refresh_all(leader=is_leader())
 
     task = asyncio.create_task(periodic_refresh())
 
+    models_task = None
+    if MODELS_CACHE_ENABLED:
+        await models_cache.refresh()
+        models_task = asyncio.create_task(models_cache.run_periodic_refresh())
+
     yield
 
-    # Cleanup
+    # Cleanup - runs once in-flight requests have finished or hit the stream deadline
     task.cancel()
+    if models_task:
+        models_task.cancel()
+    await batch_runner.stop()
+    left = await drain.wait_for(get_pending_usage_writes)
+    if left:
+        logger.warning(f"⚠️  Exiting with {left} usage-log write(s) still pending")
+    try:
+        await vercel_key_manager.save_snapshot()
+    except Exception as e:
+        logger.warning(f"⚠️  Failed to save credit snapshot: {e}")
+    if use_leader:
+        await leader_lease.stop()
+    await quota_tracker.stop()
+    await state_backend.stop()
+    traffic_recorder.stop()
+    otlp_exporter.stop()
+    await watchdog.stop()
 
 # === FastAPI App ===
 app = FastAPI(
@@ -246,33 +499,70 @@ app.add_middleware(AuthMiddleware)
 # === Health & Utility Endpoints ===
 @app.get("/health")
 async def health():
-    """Basic health check."""
-    return {"status": "ok", "timestamp": datetime.now(timezone.utc).replace(tzinfo=None).isoformat()}
+    """Basic health check. Returns 503 while draining so load balancers stop sending traffic."""
+    timestamp = datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
+    if drain.draining:
+        return JSONResponse(status_code=503, content={"status": "draining", "timestamp": timestamp})
+    return {"status": "ok", "timestamp": timestamp}
 
 @app.get("/lb/health")
 async def lb_health():
     """Detailed health check with Vercel key status."""
     return {
-        "status": "ok",
+        "status": "draining" if drain.draining else "ok",
         "vercel_keys": vercel_key_manager.get_status(),
         "total_balance": sum(k["balance"] for k in vercel_key_manager.keys),
+        "response_cache": response_cache.get_stats(),
+        "embeddings": embeddings_service.get_stats(),
+        "singleflight": singleflight.get_stats(),
+        "idempotency": idempotency_store.get_stats(),
+        "models_cache": models_cache.get_stats(),
+        "logging": get_logging_stats(),
+        "state_backend": state_backend.get_stats(),
+        "event_loop": watchdog.get_stats(),
+        "admission": admission.get_stats(),
+        "quotas": quota_tracker.get_stats(),
+        "batches": batch_runner.get_stats(),
+        "shutdown": drain.get_stats(),
+        "process": {
+            "pid": os.getpid(),
+            "workers": WORKERS,
+            "key_state": vercel_key_manager.state.get_stats() if vercel_key_manager.state else None,
+            "leader": leader_lease.get_stats() if LEADER_ELECTION and vercel_key_manager.state else None
+        },
         "timestamp": datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
     }
 
 @app.post("/lb/refresh")
 async def lb_refresh():
     """Force refresh Vercel key credits."""
-    await vercel_key_manager.refresh_all()
+    await vercel_key_manager.refresh_all(max_age=0)
     return {"message": "Credits refreshed", "keys_count": len(vercel_key_manager.keys)}
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus metrics."""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # === Admin API Endpoints ===
 @app.post("/admin/keys")
 async def admin_create_key(req: CreateKeyRequest):
     """Create a new client API key."""
+    if req.weight < 1:
+        raise HTTPException(status_code=400, detail="weight must be at least 1")
+    if min(req.tpm_limit, req.daily_budget_usd, req.monthly_budget_usd) < 0:
+        raise HTTPException(status_code=400, detail="tpm_limit and budgets must not be negative")
+
     raw_key, api_key = await create_key(
         name=req.name,
         rate_limit=req.rate_limit,
-        expires_in_days=req.expires_in_days
+        expires_in_days=req.expires_in_days,
+        max_concurrency=req.max_concurrency,
+        priority=req.priority,
+        weight=req.weight,
+        tpm_limit=req.tpm_limit,
+        daily_budget_usd=req.daily_budget_usd,
+        monthly_budget_usd=req.monthly_budget_usd
     )
 
     return {
@@ -282,6 +572,12 @@ async def admin_create_key(req: CreateKeyRequest):
             "id": api_key.id,
             "name": api_key.name,
             "rate_limit": api_key.rate_limit,
+            "max_concurrency": api_key.max_concurrency,
+            "priority": api_key.priority,
+            "weight": api_key.weight,
+            "tpm_limit": api_key.tpm_limit,
+            "daily_budget_usd": api_key.daily_budget_usd,
+            "monthly_budget_usd": api_key.monthly_budget_usd,
             "expires_at": api_key.expires_at.isoformat() if api_key.expires_at else None,
             "created_at": api_key.created_at.isoformat()
         },
@@ -298,6 +594,12 @@ async def admin_list_keys():
                 "id": k.id,
                 "name": k.name,
                 "rate_limit": k.rate_limit,
+                "max_concurrency": k.max_concurrency,
+                "priority": k.priority,
+                "weight": k.weight,
+                "tpm_limit": k.tpm_limit,
+                "daily_budget_usd": k.daily_budget_usd,
+                "monthly_budget_usd": k.monthly_budget_usd,
                 "is_active": k.is_active,
                 "expires_at": k.expires_at.isoformat() if k.expires_at else None,
                 "created_at": k.created_at.isoformat()
@@ -307,6 +609,42 @@ async def admin_list_keys():
         "total": len(keys)
     }
 
+@app.get("/admin/debug/profile")
+async def admin_debug_profile(seconds: float = 10, format: str = "collapsed", interval_ms: Optional[float] = None):
+    """
+    Sample the event loop for `seconds` and return collapsed stacks, a speedscope
+    profile or a JSON summary. Loop lag and slow callbacks are always included in
+    the response headers and the log.
+    """
+    if format not in PROFILE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(PROFILE_FORMATS)}")
+    if not 0 < seconds <= PROFILER_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILER_MAX_SECONDS:g}")
+    if interval_ms is not None and not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be between 1 and 1000")
+    if profiler.running:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+    result = await profiler.profile(seconds, interval_ms)
+    lag = result.loop_lag()
+    logger.info(
+        f"Profiled event loop for {seconds:g}s: lag p99 {lag['p99_ms']}ms, "
+        f"{len(result.slow_callbacks)} slow callbacks",
+        extra={"loop_lag": lag, "slow_callbacks": result.slow_callbacks}
+    )
+
+    headers = {
+        "X-Loop-Lag-P99-Ms": str(lag["p99_ms"]),
+        "X-Loop-Lag-Max-Ms": str(lag["max_ms"]),
+        "X-Slow-Callbacks": str(len(result.slow_callbacks))
+    }
+    if format == "collapsed":
+        return Response(content=result.collapsed(), media_type="text/plain", headers=headers)
+    if format == "speedscope":
+        headers["Content-Disposition"] = 'attachment; filename="profile.speedscope.json"'
+        return JSONResponse(content=result.speedscope(), headers=headers)
+    return JSONResponse(content=result.summary(), headers=headers)
+
 @app.get("/admin/keys/{key_id}")
 async def admin_get_key(key_id: str):
     """Get details and usage stats for a specific key."""
@@ -321,10 +659,17 @@ async def admin_get_key(key_id: str):
             "id": api_key.id,
             "name": api_key.name,
             "rate_limit": api_key.rate_limit,
+            "max_concurrency": api_key.max_concurrency,
+            "priority": api_key.priority,
+            "weight": api_key.weight,
+            "tpm_limit": api_key.tpm_limit,
+            "daily_budget_usd": api_key.daily_budget_usd,
+            "monthly_budget_usd": api_key.monthly_budget_usd,
             "is_active": api_key.is_active,
             "expires_at": api_key.expires_at.isoformat() if api_key.expires_at else None,
             "created_at": api_key.created_at.isoformat()
         },
+        "quota_usage": quota_tracker.usage(api_key),
         "stats": stats
     }
 
@@ -335,6 +680,11 @@ async def admin_update_key(key_id: str, req: UpdateKeyRequest):
     existing = await get_key_by_id(key_id)
     if not existing:
         raise HTTPException(status_code=404, detail="Key not found")
+    if req.weight is not None and req.weight < 1:
+        raise HTTPException(status_code=400, detail="weight must be at least 1")
+    limits = [req.tpm_limit, req.daily_budget_usd, req.monthly_budget_usd]
+    if any(limit is not None and limit < 0 for limit in limits):
+        raise HTTPException(status_code=400, detail="tpm_limit and budgets must not be negative")
 
     # Calculate expires_at if expires_in_days provided
     expires_at = None
@@ -347,8 +697,15 @@ async def admin_update_key(key_id: str, req: UpdateKeyRequest):
         name=req.name,
         rate_limit=req.rate_limit,
         is_active=req.is_active,
-        expires_at=expires_at
+        expires_at=expires_at,
+        max_concurrency=req.max_concurrency,
+        priority=req.priority,
+        weight=req.weight,
+        tpm_limit=req.tpm_limit,
+        daily_budget_usd=req.daily_budget_usd,
+        monthly_budget_usd=req.monthly_budget_usd
     )
+    await state_backend.invalidate_key(key_id)
 
     return {
         "message": "Key updated successfully",
@@ -356,6 +713,12 @@ async def admin_update_key(key_id: str, req: UpdateKeyRequest):
             "id": updated.id,
             "name": updated.name,
             "rate_limit": updated.rate_limit,
+            "max_concurrency": updated.max_concurrency,
+            "priority": updated.priority,
+            "weight": updated.weight,
+            "tpm_limit": updated.tpm_limit,
+            "daily_budget_usd": updated.daily_budget_usd,
+            "monthly_budget_usd": updated.monthly_budget_usd,
             "is_active": updated.is_active,
             "expires_at": updated.expires_at.isoformat() if updated.expires_at else None
         }
@@ -367,38 +730,392 @@ async def admin_delete_key(key_id: str):
     success = await delete_key(key_id)
     if not success:
         raise HTTPException(status_code=404, detail="Key not found")
+    await state_backend.invalidate_key(key_id)
 
     return {"message": "Key deleted successfully", "key_id": key_id}
 
-# === Passthrough Proxy ===
-@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
-async def proxy(path: str, request: Request):
+# === Models ===
+@app.get("/v1/models")
+async def list_models(request: Request):
+    """Serve the model list from memory, with ETag / If-None-Match support."""
+    if not MODELS_CACHE_ENABLED:
+        return await proxy("v1/models", request)
+
+    cached = await models_cache.get()
+    if cached is None:
+        return await proxy("v1/models", request)
+
+    body, etag = cached
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={models_cache.refresh_interval}"
+    }
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        models_cache.not_modified += 1
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# === Response Tracking ===
+def response_tracker(
+    request: Request,
+    path: str,
+    data: Optional[dict],
+    model: Optional[str],
+    body_size: int,
+    client_key,
+    started: float
+) -> Callable[[Response], Response]:
+    """Count the request's bytes and return `finish`, which records its response metrics and traffic."""
+    model_label = model if isinstance(model, str) and model else "none"
+    BYTES_IN.inc(body_size, model_label)
+
+    # Sanitized request shape for the traffic recorder; `model` is the name the client asked for
+    shape = None
+    if traffic_recorder.should_record():
+        shape = request_shape(request.method, path, data, model, body_size, client_key.id if client_key else None)
+
+    def finish(response: Response) -> Response:
+        response = track_response(response, model_label, started)
+        if shape is not None:
+            response = traffic_recorder.track(response, shape, started)
+        return response
+
+    return finish
+
+# === Embeddings ===
+async def send_embeddings_batch(model: str, options: dict, inputs: list) -> tuple[list, int]:
+    """Send one batched embeddings request upstream. Returns (vectors, prompt tokens)."""
+    vercel_api_key = await vercel_key_manager.get_key()
+    if not vercel_api_key:
+        raise EmbeddingsUpstreamError(503, json.dumps({
+            "error": {
+                "message": "No available Vercel API keys with sufficient credit",
+                "type": "server_error",
+                "param": None,
+                "code": None
+            }
+        }).encode("utf-8"))
+
+    timeouts = resolve_timeouts(model, is_stream=False)
+    try:
+        async with admission.slot(), httpx.AsyncClient(timeout=timeouts.to_httpx()) as client:
+            try:
+                resp = await asyncio.wait_for(
+                    client.post(
+                        f"{VERCEL_GATEWAY_URL}/v1/embeddings",
+                        headers={"Authorization": f"Bearer {vercel_api_key}"},
+                        json={**options, "model": model, "input": inputs}
+                    ),
+                    timeout=timeouts.ttfb
+                )
+            except (asyncio.TimeoutError, httpx.TimeoutException):
+                raise EmbeddingsUpstreamError(504, json.dumps({
+                    "error": {
+                        "message": "Gateway timeout - request took too long",
+                        "type": "timeout_error",
+                        "param": None,
+                        "code": None
+                    }
+                }).encode("utf-8"))
+    except AdmissionRejected as e:
+        raise EmbeddingsUpstreamError(503, rejected_response(e).body)
+
+    if resp.status_code != 200:
+        raise EmbeddingsUpstreamError(
+            resp.status_code, resp.content, resp.headers.get("content-type", "application/json")
+        )
+
+    data = resp.json()
+    items = sorted(data.get("data", []), key=lambda item: item.get("index", 0))
+    if len(items) != len(inputs):
+        raise ValueError(f"Expected {len(inputs)} embeddings from upstream, got {len(items)}")
+
+    usage = data.get("usage") or {}
+    tokens = usage.get("prompt_tokens") or usage.get("total_tokens") or 0
+    return [item.get("embedding") for item in items], tokens
+
+
+embeddings_service = EmbeddingsService(EmbeddingBatcher(send_embeddings_batch))
+
+
+@app.post("/v1/embeddings")
+async def create_embeddings(request: Request):
     """
-    Proxy all requests to Vercel AI Gateway.
-    Automatically selects the best Vercel key based on credit balance.
+    Embeddings with a per-input cache and micro-batching of concurrent requests.
+    Falls through to the plain proxy when batching is disabled or the body is not understood.
     """
-    # Get Vercel API key
-    vercel_api_key = await vercel_key_manager.get_key()
+    if not EMBEDDINGS_BATCHING_ENABLED:
+        return await proxy("v1/embeddings", request)
 
-    if not vercel_api_key:
-        return JSONResponse(
-            status_code=503,
+    started = time.perf_counter()
+    body = await request.body()
+    try:
+        data = json.loads(body)
+        parsed = split_request(data)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        return await proxy("v1/embeddings", request)
+
+    model, options, inputs = parsed
+    client_key = getattr(request.state, "api_key", None)
+    finish = response_tracker(request, "v1/embeddings", data, model, len(body), client_key, started)
+
+    try:
+        quota_ticket = quota_tracker.acquire(client_key, model, body)
+    except QuotaExceeded as e:
+        return finish(quota_exceeded_response(e))
+
+    try:
+        vectors, tokens, hits = await embeddings_service.embed(model, options, inputs)
+    except EmbeddingsUpstreamError as e:
+        if quota_ticket:
+            quota_tracker.settle(quota_ticket, None, failed=True)
+        return finish(Response(content=e.content, status_code=e.status_code, media_type=e.content_type))
+    except Exception as e:
+        if quota_ticket:
+            quota_tracker.settle(quota_ticket, None, failed=True)
+        return finish(JSONResponse(
+            status_code=502,
             content={
                 "error": {
-                    "message": "No available Vercel API keys with sufficient credit",
-                    "type": "server_error",
+                    "message": f"Bad gateway: {str(e)}",
+                    "type": "proxy_error",
                     "param": None,
                     "code": None
                 }
             }
+        ))
+
+    if quota_ticket:
+        quota_tracker.settle(quota_ticket, {"prompt_tokens": tokens})
+    if client_key:
+        await log_usage(
+            key_id=client_key.id,
+            endpoint="/v1/embeddings",
+            tokens_used=tokens,
+            model=model,
+            cached=hits == len(inputs)
         )
 
-    # Clone headers, replace Authorization with Vercel key
-    headers = {
-        k: v for k, v in request.headers.items()
-        if k.lower() not in ("host", "authorization", "content-length")
+    if hits == len(inputs):
+        cache_status = "HIT"
+    elif hits:
+        cache_status = "PARTIAL"
+    else:
+        cache_status = "MISS"
+
+    return finish(JSONResponse(
+        content=build_response(model, vectors, tokens),
+        headers={"X-Cache": cache_status}
+    ))
+
+# === Batches ===
+async def send_batch_request(api_key, endpoint: str, body: dict) -> tuple[int, bytes]:
+    """
+    Send one request of a batch upstream, as its owner: through admission control and the
+    owner's quotas, on a Vercel key picked like any other request. Raises QuotaExceeded.
+    """
+    model = body.get("model")
+    body.pop("stream", None)
+    body.pop("stream_options", None)
+    rewrite_thinking_request(body)
+    payload = json.dumps(body).encode("utf-8")
+
+    quota_ticket = quota_tracker.acquire(api_key, model, payload)
+    vercel_api_key = await vercel_key_manager.get_key()
+    if not vercel_api_key:
+        if quota_ticket:
+            quota_tracker.settle(quota_ticket, None, failed=True)
+        return 503, json.dumps({
+            "error": {
+                "message": "No available Vercel API keys with sufficient credit",
+                "type": "server_error",
+                "param": None,
+                "code": None
+            }
+        }).encode("utf-8")
+
+    timeouts = resolve_timeouts(model, is_stream=False)
+    try:
+        async with admission.slot(api_key), httpx.AsyncClient(timeout=timeouts.to_httpx()) as client:
+            resp = await client.post(
+                f"{VERCEL_GATEWAY_URL}{endpoint}",
+                headers={"Authorization": f"Bearer {vercel_api_key}", "Content-Type": "application/json"},
+                content=payload
+            )
+    except AdmissionRejected as e:
+        if quota_ticket:
+            quota_tracker.settle(quota_ticket, None, failed=True)
+        rejected = rejected_response(e)
+        return rejected.status_code, rejected.body
+    except BaseException:
+        if quota_ticket:
+            quota_tracker.settle(quota_ticket, None, failed=True)
+        raise
+
+    usage = None
+    if resp.status_code < 400:
+        try:
+            usage = resp.json().get("usage")
+        except Exception:
+            pass
+    if quota_ticket:
+        quota_tracker.settle(quota_ticket, usage, failed=resp.status_code >= 400)
+    if api_key:
+        await log_usage(
+            key_id=api_key.id,
+            endpoint=endpoint,
+            tokens_used=usage.get("total_tokens") if isinstance(usage, dict) else None,
+            model=model
+        )
+    return resp.status_code, resp.content
+
+
+batch_store = BatchStore()
+batch_runner = BatchRunner(batch_store, send_batch_request)
+
+
+class CreateBatchRequest(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: Optional[dict] = None
+
+
+@app.post("/v1/files")
+async def upload_file(request: Request):
+    """
+    Upload a batch input file: multipart form with `file` and `purpose=batch` (as the OpenAI
+    SDK sends it), or the raw JSONL body with ?purpose=batch&filename=... .
+    """
+    client_key = request.state.api_key
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            async with request.form() as form:
+                upload = form.get("file")
+                purpose = form.get("purpose")
+                if upload is None or isinstance(upload, str):
+                    raise BatchError(400, "Missing file", "file")
+                if purpose != "batch":
+                    raise BatchError(400, "Only purpose 'batch' is supported", "purpose")
+
+                async def chunks():
+                    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                        yield chunk
+
+                file = await batch_store.save_file(client_key.id, purpose, upload.filename or "upload.jsonl", chunks())
+        else:
+            if request.query_params.get("purpose") != "batch":
+                raise BatchError(400, "Only purpose 'batch' is supported", "purpose")
+            filename = request.query_params.get("filename", "upload.jsonl")
+            file = await batch_store.save_file(client_key.id, "batch", filename, request.stream())
+    except BatchError as e:
+        return error_response(e)
+    return file
+
+
+@app.get("/v1/files/{file_id}")
+async def get_file(file_id: str, request: Request):
+    file = await batch_store.get_file(file_id, request.state.api_key.id)
+    if not file:
+        return error_response(BatchError(404, f"No such file: {file_id}"))
+    return file
+
+
+@app.get("/v1/files/{file_id}/content")
+async def get_file_content(file_id: str, request: Request):
+    """
+    Download a file. Result files of running batches can be downloaded at any time;
+    the download holds the complete lines written so far.
+    """
+    file = await batch_store.get_file(file_id, request.state.api_key.id)
+    if not file:
+        return error_response(BatchError(404, f"No such file: {file_id}"))
+
+    path = batch_store.file_path(file_id)
+    # Results are appended one whole line per write, so the size read here ends on a line
+    size = file["bytes"]
+
+    async def read():
+        with open(path, "rb") as f:
+            left = size
+            while left > 0:
+                chunk = await asyncio.to_thread(f.read, min(UPLOAD_CHUNK_SIZE, left))
+                if not chunk:
+                    break
+                left -= len(chunk)
+                yield chunk
+
+    return StreamingResponse(
+        read(),
+        media_type="application/jsonl",
+        headers={"Content-Length": str(size), "Content-Disposition": f'attachment; filename="{file["filename"]}"'}
+    )
+
+
+@app.post("/v1/batches")
+async def create_batch(req: CreateBatchRequest, request: Request):
+    """Create a batch for an uploaded input file and start it in the background."""
+    client_key = request.state.api_key
+    if req.endpoint not in BATCH_ENDPOINTS:
+        return error_response(BatchError(400, f"endpoint must be one of: {', '.join(BATCH_ENDPOINTS)}", "endpoint"))
+    if req.completion_window != "24h":
+        return error_response(BatchError(400, "completion_window must be 24h", "completion_window"))
+    input_file = await batch_store.get_file(req.input_file_id, client_key.id)
+    if not input_file or input_file["purpose"] != "batch":
+        return error_response(BatchError(404, f"No such input file: {req.input_file_id}", "input_file_id"))
+
+    batch = await batch_store.create_batch(
+        client_key.id, req.input_file_id, req.endpoint, req.completion_window, req.metadata
+    )
+    await batch_runner.adopt()
+    return batch_object(batch)
+
+
+@app.get("/v1/batches")
+async def list_batches(request: Request, limit: int = 20, after: Optional[str] = None):
+    batches, has_more = await batch_store.list_batches(request.state.api_key.id, max(1, min(limit, 100)), after)
+    data = [batch_object(batch) for batch in batches]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": has_more
     }
-    headers["Authorization"] = f"Bearer {vercel_api_key}"
+
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str, request: Request):
+    batch = await batch_store.get_batch(batch_id, request.state.api_key.id)
+    if not batch:
+        return error_response(BatchError(404, f"No such batch: {batch_id}"))
+    return batch_object(batch)
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, request: Request):
+    """Stop sending the batch's remaining requests; requests in flight still finish."""
+    client_key = request.state.api_key
+    batch = await batch_store.get_batch(batch_id, client_key.id)
+    if not batch:
+        return error_response(BatchError(404, f"No such batch: {batch_id}"))
+    if not await batch_store.request_cancel(batch_id, client_key.id):
+        return error_response(BatchError(409, f"Batch is already {batch['status']}"))
+    batch_runner.cancel(batch_id)
+    return batch_object(await batch_store.get_batch(batch_id))
+
+# === Passthrough Proxy ===
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
+async def proxy(path: str, request: Request):
+    """
+    Proxy all requests to Vercel AI Gateway.
+    Automatically selects the best Vercel key based on credit balance.
+    """
+    started = time.perf_counter()
 
     # Build URL with query params
     url = f"{VERCEL_GATEWAY_URL}/{path}"
@@ -412,190 +1129,329 @@ async def proxy(path: str, request: Request):
     is_stream = False
     model = None
     is_thinking_model = False
+    data = None
     if body:
         try:
             data = json.loads(body)
             is_stream = data.get("stream", False)
             model = data.get("model")
 
-            # Handle -thinking models
-            if model and isinstance(model, str) and model.endswith("-thinking"):
+            # Handle -thinking models: strip the suffix and enable reasoning
+            if rewrite_thinking_request(data):
                 is_thinking_model = True
-                # Remove -thinking suffix
-                data["model"] = model[:-9]
-
-                # Add reasoning parameters
-                # Note: In OpenAI SDK, extra_body merges into the root.
-                # So we add 'reasoning' directly to the payload.
-                data["reasoning"] = {
-                    "effort": "medium",
-                    "enabled": True
-                }
-
-                # Re-serialize body
                 body = json.dumps(data).encode("utf-8")
 
         except Exception as e:
-            print(f"Error processing request body: {e}")
+            logger.warning("Error processing request body: %s", e, extra={"path": f"/{path}"})
             pass
 
+    model_label = model if isinstance(model, str) and model else "none"
+    client_key = getattr(request.state, "api_key", None)
+    finish = response_tracker(request, path, data, model, len(body), client_key, started)
+
+    # Serve deterministic completions from the response cache
+    cache_key = None
+    no_store = False
+    if RESPONSE_CACHE_ENABLED and is_cacheable(request.method, path, data, is_stream):
+        cache_key = make_cache_key(path, data, client_key.id if client_key else None)
+        no_cache, no_store = cache_control_flags(request.headers.get("cache-control"))
+        cached = None
+        if not no_cache:
+            with span("cache_lookup"):
+                cached = await response_cache.get(cache_key)
+        if cached:
+            if client_key:
+                with span("log_usage"):
+                    await log_usage(
+                        key_id=client_key.id,
+                        endpoint=f"/{path}",
+                        model=model,
+                        cached=True
+                    )
+            return finish(Response(
+                content=cached.body,
+                status_code=cached.status_code,
+                media_type=cached.content_type,
+                headers={"X-Cache": "HIT"}
+            ))
+
+    strip_usage = False
+    if quota_tracker.applies(client_key) and is_stream and isinstance(data, dict) and path in STREAM_USAGE_PATHS:
+        stream_options = data.get("stream_options")
+        stream_options = stream_options if isinstance(stream_options, dict) else {}
+        if not stream_options.get("include_usage"):
+            # Ask for the usage chunk to settle the quota, and keep it from the client who did not
+            data["stream_options"] = {**stream_options, "include_usage": True}
+            body = json.dumps(data).encode("utf-8")
+            strip_usage = True
+
     # Log usage with model info
-    if hasattr(request.state, "api_key") and request.state.api_key:
-        await log_usage(
-            key_id=request.state.api_key.id,
-            endpoint=f"/{path}",
-            model=model
-        )
+    if client_key:
+        with span("log_usage"):
+            await log_usage(
+                key_id=client_key.id,
+                endpoint=f"/{path}",
+                model=model
+            )
 
-    try:
-        if is_stream:
-            # Streaming response - create client that lives for the duration of the stream
-            async def stream_generator():
+    async def forward() -> Response:
+        """
+        Check the key's quotas, wait for an upstream slot (shared fairly between client keys),
+        then forward the request. Streams hold the slot until they end.
+        """
+        # Token and spend quotas are checked in memory; the prompt estimate is settled with the
+        # reported usage. Replayed and coalesced requests never get here, so they are not charged
+        try:
+            quota_ticket = quota_tracker.acquire(client_key, model, body)
+        except QuotaExceeded as e:
+            return quota_exceeded_response(e)
+        try:
+            ticket = await admission.acquire(client_key)
+        except AdmissionRejected as e:
+            if quota_ticket:
+                quota_tracker.settle(quota_ticket, None, failed=True)
+            return rejected_response(e)
+        try:
+            response = await send_upstream()
+        except BaseException:
+            admission.release(ticket)
+            if quota_ticket:
+                quota_tracker.settle(quota_ticket, None, failed=True)
+            raise
+        response = admission.hold(response, ticket)
+        if quota_ticket:
+            response = quota_tracker.track(response, quota_ticket, strip_usage)
+        return response
+
+    async def send_upstream() -> Response:
+        """Select a Vercel key and forward the request upstream."""
+        # Get Vercel API key
+        selection_started = time.perf_counter()
+        vercel_api_key = await vercel_key_manager.get_key()
+        KEY_SELECTION_DURATION.observe(time.perf_counter() - selection_started)
+
+        if not vercel_api_key:
+            return JSONResponse(
+                status_code=503,
+                content={
+                    "error": {
+                        "message": "No available Vercel API keys with sufficient credit",
+                        "type": "server_error",
+                        "param": None,
+                        "code": None
+                    }
+                }
+            )
+
+        # Clone headers, replace Authorization with Vercel key
+        headers = {
+            k: v for k, v in request.headers.items()
+            if k.lower() not in ("host", "authorization", "content-length")
+        }
+        headers["Authorization"] = f"Bearer {vercel_api_key}"
+
+        timeouts = resolve_timeouts(model, is_stream)
+        tried_keys: set[str] = set()
+
+        while True:
+            tried_keys.add(vercel_api_key)
+            with span("client_setup"):
                 client = httpx.AsyncClient()
-                has_started_thinking = False
-                has_finished_thinking = False
+            trace = UpstreamTrace()
+
+            try:
+                upstream_request = client.build_request(
+                    method=request.method,
+                    url=url,
+                    headers=headers,
+                    content=body,
+                    timeout=timeouts.to_httpx(),
+                    extensions={"trace": trace}
+                )
+                with span("upstream", model=model_label, attempt=len(tried_keys)):
+                    resp, first_chunk, chunks = await send_with_ttfb(
+                        client, upstream_request, timeouts, stream=is_stream
+                    )
+            except TTFBTimeout as e:
+                await client.aclose()
+                # Nothing has been sent to the client yet, so another key can still take over
+                next_key = None
+                if len(tried_keys) <= UPSTREAM_TTFB_RETRIES:
+                    next_key = await vercel_key_manager.get_key(exclude=tried_keys)
+                if not next_key:
+                    return JSONResponse(
+                        status_code=504,
+                        content={
+                            "error": {
+                                "message": f"Gateway timeout - {e}",
+                                "type": "timeout_error",
+                                "param": None,
+                                "code": None
+                            }
+                        }
+                    )
+                logger.warning("⏱️  %s, retrying with another Vercel key", e, extra={"model": model_label})
+                vercel_api_key = next_key
+                headers["Authorization"] = f"Bearer {vercel_api_key}"
+                continue
+            except httpx.TimeoutException:
+                await client.aclose()
+                return JSONResponse(
+                    status_code=504,
+                    content={
+                        "error": {
+                            "message": "Gateway timeout - request took too long",
+                            "type": "timeout_error",
+                            "param": None,
+                            "code": None
+                        }
+                    }
+                )
+            except Exception as e:
+                await client.aclose()
+                return JSONResponse(
+                    status_code=502,
+                    content={
+                        "error": {
+                            "message": f"Bad gateway: {str(e)}",
+                            "type": "proxy_error",
+                            "param": None,
+                            "code": None
+                        }
+                    }
+                )
+
+            break
+
+        # Streams count the first body chunk, other responses the response headers
+        first_byte_at = time.perf_counter() if is_stream or trace.headers_at is None else trace.headers_at
+        UPSTREAM_TTFB.observe(first_byte_at - trace.started, model_label, str(resp.status_code))
+        if trace.connect_duration is not None:
+            UPSTREAM_CONNECT_DURATION.observe(trace.connect_duration, model_label)
+
+        if is_stream:
+            # Streaming response - the upstream response and client live for the duration of the stream
+            async def close_upstream():
+                await resp.aclose()
+                await client.aclose()
 
+            async def stream_generator():
                 try:
-                    async with client.stream(
-                        method=request.method,
-                        url=url,
-                        headers=headers,
-                        content=body,
-                        timeout=300  # 5 minutes for long generations
-                    ) as resp:
-                        if is_thinking_model:
-                            async for line in resp.aiter_lines():
-                                if not line.strip():
-                                    continue
-
-                                if line.startswith("data: "):
-                                    if line.strip() == "data: [DONE]":
-                                        if has_started_thinking and not has_finished_thinking:
-                                            yield f'data: {json.dumps({"choices":[{"index":0,"delta":{"content":"</think>"}}]})}\n\n'.encode('utf-8')
-                                        yield line.encode('utf-8') + b"\n\n"
-                                        continue
-
-                                    try:
-                                        json_str = line[6:]
-                                        data = json.loads(json_str)
-                                        choices = data.get("choices", [])
-                                        if not choices:
-                                            yield line.encode('utf-8') + b"\n\n"
-                                            continue
-
-                                        delta = choices[0].get("delta", {})
-                                        # Check for reasoning_content or reasoning
-                                        reasoning = delta.get("reasoning_content") or delta.get("reasoning")
-                                        content = delta.get("content")
-
-                                        # Logic to inject <think> tags
-                                        if reasoning:
-                                            if not has_started_thinking:
-                                                # Send <think>
-                                                yield f'data: {json.dumps({"choices":[{"index":0,"delta":{"content":"<think>"}}]})}\n\n'.encode('utf-8')
-                                                has_started_thinking = True
-
-                                            # Send reasoning as content, but also keep original reasoning_content if present
-                                            # This ensures compatibility with both clients that expect <think> tags
-                                            # and clients that support reasoning_content field (like LiteLLM)
-                                            new_data = data
-                                            new_data["choices"][0]["delta"]["content"] = reasoning
-                                            yield f'data: {json.dumps(new_data)}\n\n'.encode('utf-8')
-                                            continue
-
-                                        if content:
-                                            if has_started_thinking and not has_finished_thinking:
-                                                # Send </think>
-                                                yield f'data: {json.dumps({"choices":[{"index":0,"delta":{"content":"</think>"}}]})}\n\n'.encode('utf-8')
-                                                has_finished_thinking = True
-
-                                        yield line.encode('utf-8') + b"\n\n"
-
-                                    except Exception as e:
-                                        # If parsing fails, just yield original line
-                                        yield line.encode('utf-8') + b"\n\n"
-                                else:
-                                    yield line.encode('utf-8') + b"\n\n"
-                        else:
-                            # Normal streaming for non-thinking models
-                            async for chunk in resp.aiter_bytes():
-                                yield chunk
+                    if is_thinking_model:
+                        async for chunk in rewrite_thinking_stream(iter_lines(prepend_chunk(first_chunk, chunks))):
+                            yield chunk
+                    else:
+                        # Normal streaming for non-thinking models
+                        async for chunk in prepend_chunk(first_chunk, chunks):
+                            yield chunk
+                except (IdleTimeout, httpx.TimeoutException):
+                    # Idle timeout between chunks - end the stream and free the connection
+                    logger.warning(
+                        "⏱️  Upstream stream idle for more than %gs, closing", timeouts.idle,
+                        extra={"model": model_label}
+                    )
+                except httpx.TransportError as e:
+                    # Upstream dropped the connection mid-stream - end ours without a [DONE]
+                    logger.warning("Upstream stream ended early: %s", e, extra={"model": model_label})
                 finally:
-                    await client.aclose()
+                    await close_upstream()
 
+            # The generator's finally only runs once iteration has started; the background task
+            # also closes the upstream when the client is gone before the body is sent
             return StreamingResponse(
-                stream_generator(),
+                drain.track_stream(coalesce_sse(stream_generator())),
                 media_type="text/event-stream",
                 headers={
                     "Cache-Control": "no-cache",
                     "Connection": "keep-alive",
                     "X-Accel-Buffering": "no"
-                }
+                },
+                background=BackgroundTask(close_upstream)
             )
-        else:
-            # Regular response
-            async with httpx.AsyncClient() as client:
-                resp = await client.request(
-                    method=request.method,
-                    url=url,
-                    headers=headers,
-                    content=body,
-                    timeout=300
-                )
-
-                # Try to extract token usage for logging
-                if hasattr(request.state, "api_key") and request.state.api_key:
-                    try:
-                        resp_data = resp.json()
-                        if "usage" in resp_data:
-                            tokens = resp_data["usage"].get("total_tokens")
-                            if tokens:
-                                await log_usage(
-                                    key_id=request.state.api_key.id,
-                                    endpoint=f"/{path}",
-                                    tokens_used=tokens,
-                                    model=model
-                                )
-                    except:
-                        pass
-
-                return Response(
-                    content=resp.content,
-                    status_code=resp.status_code,
-                    media_type=resp.headers.get("content-type", "application/json")
-                )
 
-    except httpx.TimeoutException:
-        return JSONResponse(
-            status_code=504,
-            content={
-                "error": {
-                    "message": "Gateway timeout - request took too long",
-                    "type": "timeout_error",
-                    "param": None,
-                    "code": None
-                }
-            }
+        # Regular response
+        try:
+            # Try to extract token usage for logging
+            if hasattr(request.state, "api_key") and request.state.api_key:
+                try:
+                    resp_data = resp.json()
+                    if "usage" in resp_data:
+                        tokens = resp_data["usage"].get("total_tokens")
+                        if tokens:
+                            await log_usage(
+                                key_id=request.state.api_key.id,
+                                endpoint=f"/{path}",
+                                tokens_used=tokens,
+                                model=model
+                            )
+                except:
+                    pass
+
+            media_type = resp.headers.get("content-type", "application/json")
+            response_headers = {}
+            if cache_key:
+                response_headers["X-Cache"] = "MISS"
+                if resp.status_code == 200 and not no_store:
+                    await response_cache.set(cache_key, resp.status_code, media_type, resp.content)
+
+            return Response(
+                content=resp.content,
+                status_code=resp.status_code,
+                media_type=media_type,
+                headers=response_headers
+            )
+        finally:
+            await client.aclose()
+
+
+    # Replay or attach to an earlier request with the same Idempotency-Key
+    idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+    if IDEMPOTENCY_ENABLED and idempotency_key and request.method == "POST":
+        scope = client_key.id if client_key else ""
+        response = await idempotency_store.run(
+            f"{scope}:{idempotency_key}",
+            make_fingerprint(request.method, f"/{path}", body),
+            forward
         )
-    except Exception as e:
-        return JSONResponse(
-            status_code=502,
-            content={
-                "error": {
-                    "message": f"Bad gateway: {str(e)}",
-                    "type": "proxy_error",
-                    "param": None,
-                    "code": None
-                }
-            }
+        return finish(response)
+
+    # Share one upstream call between identical concurrent requests
+    if SINGLEFLIGHT_ENABLED and request.method == "POST" and isinstance(data, dict):
+        flight_key = make_flight_key(
+            path, str(request.query_params), data, client_key.id if client_key else None
         )
+        return finish(await singleflight.run(flight_key, forward))
+
+    return finish(await forward())
 
 
 if __name__ == "__main__":
     import uvicorn
+    from importlib.util import find_spec
 
     port = int(os.getenv("PORT", 8000))
     host = os.getenv("HOST", "0.0.0.0")
 
-    print(f"Starting Load Balancer on {host}:{port}")
-    uvicorn.run(app, host=host, port=port)
+    # uvloop and httptools come with uvicorn[standard]; fall back to asyncio and h11 without them
+    loop = "uvloop" if find_spec("uvloop") else "asyncio"
+    http = "httptools" if find_spec("httptools") else "h11"
+
+    # A socket handed over by a supervisor or bound with SO_REUSEPORT lets a new release
+    # start listening before the old one has finished draining
+    sock = listen_socket(host, port)
+    options = {
+        "host": host,
+        "port": port,
+        "fd": sock.fileno() if sock else None,
+        "loop": loop,
+        "http": http,
+        # Backstop for requests that outlive the stream deadline
+        "timeout_graceful_shutdown": int(SHUTDOWN_STREAM_DEADLINE) + 5
+    }
+
+    logger.info(f"Starting Load Balancer on {host}:{port} ({WORKERS} worker(s), {loop}/{http})")
+    if WORKERS > 1:
+        # Each worker is a separate process that imports the app by name
+        uvicorn.run("server:app", workers=WORKERS, **options)
+    else:
+        uvicorn.run(app, **options)
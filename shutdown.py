@@ -0,0 +1,185 @@
+"""
+Graceful shutdown and listening-socket handoff.
+On SIGTERM/SIGINT the process reports "draining" on /health and keeps serving for
+SHUTDOWN_DRAIN_DELAY seconds so load balancers can take it out of rotation. Then it
+stops accepting connections while in-flight requests finish. Streams still open
+SHUTDOWN_STREAM_DEADLINE seconds later are ended with an error event instead of
+being cut off mid-answer.
+"""
+
+import os
+import json
+import time
+import signal
+import socket
+import asyncio
+import threading
+from typing import AsyncIterator, Callable, Optional
+
+from logger import get_logger
+
+# === Configuration ===
+# Seconds /health reports draining before the listener closes (match the load balancer's check interval)
+SHUTDOWN_DRAIN_DELAY = float(os.getenv("SHUTDOWN_DRAIN_DELAY", "0"))
+# Seconds in-flight streams get to finish once the listener has closed
+SHUTDOWN_STREAM_DEADLINE = float(os.getenv("SHUTDOWN_STREAM_DEADLINE", "30"))
+# Bind with SO_REUSEPORT so a new release can listen on the same port while the old one drains
+REUSE_PORT = os.getenv("REUSE_PORT", "false").lower() == "true"
+
+logger = get_logger("shutdown")
+
+# Sent as the last event of a stream cut short by the deadline
+SHUTDOWN_EVENT = b"data: " + json.dumps({
+    "error": {
+        "message": "Server is shutting down, the response was cut short",
+        "type": "server_error",
+        "param": None,
+        "code": None
+    }
+}).encode() + b"\n\n"
+
+_END = object()
+
+
+class DrainController:
+    """Tracks the draining state and the streams still being served."""
+
+    def __init__(self, drain_delay: float = SHUTDOWN_DRAIN_DELAY, stream_deadline: float = SHUTDOWN_STREAM_DEADLINE):
+        self.drain_delay = drain_delay
+        self.stream_deadline = stream_deadline
+        self.draining = False
+        self.drain_started: Optional[float] = None
+        # Set once in-flight streams have run out of time
+        self._deadline: Optional[asyncio.Event] = None
+        self.active_streams = 0
+        self.streams_cut = 0
+
+    def install_signal_handlers(self):
+        """
+        Wrap the server's SIGTERM/SIGINT handlers so the first signal starts draining and the
+        server is only told to stop accepting connections after the drain delay.
+        Must run on the main thread, inside the running event loop (e.g. lifespan startup).
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        loop = asyncio.get_running_loop()
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            previous = signal.getsignal(sig)
+            if not callable(previous):
+                continue
+
+            def handler(signum, frame, previous=previous):
+                if self.draining:
+                    # Second signal: let the server handle it right away (e.g. force quit on Ctrl+C)
+                    previous(signum, frame)
+                    return
+                loop.call_soon_threadsafe(self.begin_drain, lambda: previous(signum, frame))
+
+            signal.signal(sig, handler)
+
+    def begin_drain(self, stop_accepting: Callable[[], None]):
+        """Report draining now, stop accepting after the drain delay, end streams after the deadline."""
+        if self.draining:
+            return
+        loop = asyncio.get_running_loop()
+        self.draining = True
+        self.drain_started = time.time()
+        self._deadline = asyncio.Event()
+        logger.info(
+            f"Draining: closing the listener in {self.drain_delay:g}s, "
+            f"{self.active_streams} stream(s) get {self.stream_deadline:g}s more after that"
+        )
+        loop.call_later(self.drain_delay, stop_accepting)
+        loop.call_later(self.drain_delay + self.stream_deadline, self._deadline.set)
+
+    async def track_stream(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Relay a response stream, ending it with SHUTDOWN_EVENT if the drain deadline passes."""
+        self.active_streams += 1
+        iterator = chunks.__aiter__()
+        try:
+            while True:
+                if self._deadline is None:
+                    try:
+                        chunk = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        return
+                else:
+                    chunk = await self._next_before_deadline(iterator)
+                    if chunk is None:
+                        self.streams_cut += 1
+                        logger.warning("Ending a stream still open at the shutdown deadline")
+                        yield SHUTDOWN_EVENT
+                        return
+                if chunk is _END:
+                    return
+                yield chunk
+        finally:
+            self.active_streams -= 1
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    async def _next_before_deadline(self, iterator: AsyncIterator[bytes]):
+        """The next chunk, _END when the stream is over, or None if the deadline came first."""
+        if self._deadline.is_set():
+            return None
+
+        async def next_chunk():
+            try:
+                return await iterator.__anext__()
+            except StopAsyncIteration:
+                return _END
+
+        chunk_task = asyncio.ensure_future(next_chunk())
+        deadline_task = asyncio.ensure_future(self._deadline.wait())
+        done, _ = await asyncio.wait({chunk_task, deadline_task}, return_when=asyncio.FIRST_COMPLETED)
+        if chunk_task in done:
+            deadline_task.cancel()
+            return chunk_task.result()
+
+        chunk_task.cancel()
+        try:
+            await chunk_task
+        except asyncio.CancelledError:
+            pass
+        return None
+
+    async def wait_for(self, pending: Callable[[], int], timeout: float = 5.0) -> int:
+        """Wait until `pending()` reaches zero (e.g. usage-log writes). Returns what is left."""
+        deadline = time.monotonic() + timeout
+        while pending() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return pending()
+
+    def get_stats(self) -> dict:
+        return {
+            "draining": self.draining,
+            "drain_started": self.drain_started,
+            "active_streams": self.active_streams,
+            "streams_cut": self.streams_cut
+        }
+
+
+def listen_socket(host: str, port: int) -> Optional[socket.socket]:
+    """
+    The listening socket to hand to the server, or None to let it bind on its own:
+    a socket passed in by a supervisor (systemd-style LISTEN_FDS, fd 3), or one bound
+    with SO_REUSEPORT when REUSE_PORT is set.
+    """
+    if os.getenv("LISTEN_FDS") and os.getenv("LISTEN_PID") == str(os.getpid()):
+        logger.info("Using the listening socket passed in by the supervisor (fd 3)")
+        return socket.socket(fileno=3)
+
+    if not REUSE_PORT:
+        return None
+
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+# Global instance
+drain = DrainController()
@@ -0,0 +1,244 @@
+"""
+Single-flight coalescing for the Load Balancer.
+Identical concurrent requests from the same client key share one upstream call;
+streaming duplicates are fanned out from one upstream stream.
+"""
+
+import os
+import json
+import asyncio
+import hashlib
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+# === Configuration ===
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "false").lower() == "true"
+# Late joiners can attach to a stream only while it has produced at most this many bytes
+SINGLEFLIGHT_REPLAY_BYTES = int(os.getenv("SINGLEFLIGHT_REPLAY_BYTES", "1048576"))  # 1 MB
+
+
+def make_flight_key(path: str, query: str, data: Any, client_key_id: Optional[str]) -> str:
+    """Canonical hash of the request and the client key that sent it."""
+    canonical = json.dumps(
+        {"path": path, "query": query, "body": data, "client": client_key_id},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def copy_response(response: Response) -> Response:
+    """Build an independent copy of a buffered response."""
+    return Response(
+        content=response.body,
+        status_code=response.status_code,
+        headers=dict(response.headers)
+    )
+
+
+class StreamBroadcast:
+    """
+    Fans one upstream byte stream out to several subscribers.
+    Chunks are kept for late joiners until SINGLEFLIGHT_REPLAY_BYTES have been produced;
+    after that no new subscribers are accepted and consumed chunks are released.
+    """
+
+    def __init__(self, source: AsyncIterator[bytes], replay_bytes: int = SINGLEFLIGHT_REPLAY_BYTES):
+        self.replay_bytes = replay_bytes
+        self._chunks: list[bytes] = []
+        self._base = 0  # absolute index of self._chunks[0]
+        self._produced = 0
+        self._positions: dict[int, int] = {}
+        self._next_id = 0
+        self._changed = asyncio.Event()
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._pump_task = asyncio.create_task(self._pump(source))
+
+    @property
+    def accepting(self) -> bool:
+        """Whether a new subscriber can still replay the stream from the beginning."""
+        return not self._done and self._base == 0 and self._produced <= self.replay_bytes
+
+    async def _pump(self, source: AsyncIterator[bytes]):
+        try:
+            async for chunk in source:
+                self._chunks.append(chunk)
+                self._produced += len(chunk)
+                if self._produced > self.replay_bytes:
+                    self._release_consumed()
+                self._notify()
+        except asyncio.CancelledError:
+            self._error = ConnectionError("Shared upstream stream was cancelled")
+            raise
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._done = True
+            self._notify()
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def add_done_callback(self, callback: Callable[[], None]):
+        """Call `callback` once the upstream stream has ended."""
+        self._pump_task.add_done_callback(lambda _: callback())
+
+    def _notify(self):
+        self._changed.set()
+        self._changed.clear()
+
+    def _release_consumed(self):
+        if not self._positions:
+            return
+        drop = min(self._positions.values()) - self._base
+        if drop > 0:
+            del self._chunks[:drop]
+            self._base += drop
+
+    def subscribe(self) -> AsyncIterator[bytes]:
+        """Reserve a reader that iterates the stream from the beginning."""
+        return self.read(self.reserve())
+
+    def reserve(self) -> int:
+        """Reserve a place at the start of the stream; read it with read(), give it up with unsubscribe()."""
+        subscriber_id = self._next_id
+        self._next_id += 1
+        self._positions[subscriber_id] = self._base
+        return subscriber_id
+
+    def unsubscribe(self, subscriber_id: int):
+        """Give up a reserved place, whether or not it was ever read. Safe to call twice."""
+        if self._positions.pop(subscriber_id, None) is None:
+            return
+        # Nobody is listening any more - stop reading upstream instead of buffering for no one
+        if not self._positions and not self._done:
+            self._pump_task.cancel()
+
+    async def read(self, subscriber_id: int) -> AsyncIterator[bytes]:
+        try:
+            while True:
+                position = self._positions[subscriber_id]
+                if position < self._base + len(self._chunks):
+                    self._positions[subscriber_id] = position + 1
+                    yield self._chunks[position - self._base]
+                    continue
+                if self._done:
+                    if self._error is not None:
+                        raise self._error
+                    return
+                await self._changed.wait()
+        finally:
+            self.unsubscribe(subscriber_id)
+
+
+class _Flight:
+    def __init__(self):
+        self.task: Optional[asyncio.Future] = None
+        self.broadcast: Optional[StreamBroadcast] = None
+        # The leader's place in the stream, reserved before the upstream can produce anything
+        self.leader_id: Optional[int] = None
+
+
+class SingleFlight:
+    """Registry of in-flight upstream calls keyed by request hash."""
+
+    def __init__(self, replay_bytes: int = SINGLEFLIGHT_REPLAY_BYTES):
+        self.replay_bytes = replay_bytes
+        self._flights: dict[str, _Flight] = {}
+        self.leaders = 0
+        self.collapsed = 0
+        self.collapsed_streams = 0
+
+    async def run(
+        self,
+        key: str,
+        fn: Callable[[], Awaitable[Response]],
+        fallback: Optional[Callable[[], Awaitable[Response]]] = None
+    ) -> Response:
+        """
+        Run fn once for all concurrent callers with the same key.
+        A caller that cannot attach to an in-flight stream gets `fallback()` if given,
+        otherwise makes its own call.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            if flight.broadcast is None or flight.broadcast.accepting:
+                return await self._join(flight, fallback or fn)
+            if fallback is not None:
+                return await fallback()
+
+        self.leaders += 1
+        flight = _Flight()
+        flight.task = asyncio.ensure_future(self._lead(key, flight, fn))
+        self._flights[key] = flight
+        flight.task.add_done_callback(lambda _: self._forget_if_buffered(key, flight))
+
+        # The shared call runs as its own task so a disconnecting leader does not cancel it
+        try:
+            response = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # The leader's client is gone - give up its place in the stream once there is one
+            flight.task.add_done_callback(lambda _: self._release_leader(flight))
+            raise
+        return self._respond(flight, response, flight.leader_id)
+
+    async def _lead(self, key: str, flight: _Flight, fn: Callable[[], Awaitable[Response]]) -> Response:
+        response = await fn()
+        if isinstance(response, StreamingResponse):
+            flight.broadcast = StreamBroadcast(response.body_iterator, self.replay_bytes)
+            flight.leader_id = flight.broadcast.reserve()
+            flight.broadcast.add_done_callback(lambda: self._forget(key, flight))
+        return response
+
+    def _release_leader(self, flight: _Flight):
+        if flight.broadcast is not None and flight.leader_id is not None:
+            flight.broadcast.unsubscribe(flight.leader_id)
+
+    async def _join(self, flight: _Flight, fn: Callable[[], Awaitable[Response]]) -> Response:
+        response = await asyncio.shield(flight.task)
+        if flight.broadcast is not None:
+            if not flight.broadcast.accepting:
+                # The stream moved past the replay window while we waited - go upstream ourselves
+                return await fn()
+            self.collapsed_streams += 1
+        self.collapsed += 1
+        return self._respond(flight, response)
+
+    def _respond(self, flight: _Flight, response: Response, subscriber_id: Optional[int] = None) -> Response:
+        if flight.broadcast is None:
+            return copy_response(response)
+        if subscriber_id is None:
+            subscriber_id = flight.broadcast.reserve()
+        # The background task gives up the place even if the body is never iterated
+        return StreamingResponse(
+            flight.broadcast.read(subscriber_id),
+            status_code=response.status_code,
+            headers=dict(response.headers),
+            media_type=response.media_type,
+            background=BackgroundTask(flight.broadcast.unsubscribe, subscriber_id)
+        )
+
+    def _forget_if_buffered(self, key: str, flight: _Flight):
+        if flight.broadcast is None:
+            self._forget(key, flight)
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": SINGLEFLIGHT_ENABLED,
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "collapsed": self.collapsed,
+            "collapsed_streams": self.collapsed_streams
+        }
+
+
+# Global instance
+singleflight = SingleFlight()
@@ -0,0 +1,117 @@
+"""
+Server-Sent Events helpers for the Load Balancer.
+Coalesces small upstream chunks into fewer writes without splitting SSE events.
+"""
+
+import os
+import asyncio
+from typing import Optional, AsyncIterator
+
+# === Configuration ===
+# Latency budget for merging chunks, in milliseconds (0 = forward every chunk immediately)
+SSE_COALESCE_WINDOW_MS = float(os.getenv("SSE_COALESCE_WINDOW_MS", "0"))
+# Flush as soon as this many bytes of complete events are buffered
+SSE_COALESCE_MAX_BYTES = int(os.getenv("SSE_COALESCE_MAX_BYTES", "8192"))
+
+EVENT_BOUNDARY = b"\n\n"
+
+
+async def coalesce_sse(
+    chunks: AsyncIterator[bytes],
+    window_ms: float = SSE_COALESCE_WINDOW_MS,
+    max_bytes: int = SSE_COALESCE_MAX_BYTES
+) -> AsyncIterator[bytes]:
+    """
+    Merge chunks arriving within `window_ms` of the first buffered chunk into one write.
+
+    Only complete events (ending in a blank line) are flushed; a partial event stays
+    buffered until the rest of it arrives. Everything left is flushed when the stream ends.
+    Reading upstream pauses while `max_bytes` of complete events wait for a slow client.
+    """
+    if window_ms <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    window = window_ms / 1000
+    buffer = bytearray()
+    wakeup: Optional[asyncio.Future] = None
+    timer: Optional[asyncio.TimerHandle] = None
+    # The window ran out; remembered in case the consumer was busy writing when it did
+    due = False
+    # Set while the buffer has room; an oversized partial event never blocks the reader
+    space = asyncio.Event()
+    space.set()
+
+    def full() -> bool:
+        return len(buffer) >= max_bytes and EVENT_BOUNDARY in buffer
+
+    def wake():
+        if wakeup is not None and not wakeup.done():
+            wakeup.set_result(None)
+
+    def on_timer():
+        nonlocal timer, due
+        timer = None
+        due = True
+        wake()
+
+    async def pump():
+        # Reads upstream independently so a window timeout never interrupts a read;
+        # per chunk this only appends to the buffer, timers are armed once per window
+        nonlocal timer
+        try:
+            async for chunk in chunks:
+                buffer.extend(chunk)
+                if len(buffer) >= max_bytes:
+                    wake()
+                    # Backpressure: wait for the client to take what is buffered
+                    while full():
+                        space.clear()
+                        await space.wait()
+                elif timer is None and not due:
+                    timer = loop.call_later(window, on_timer)
+        finally:
+            wake()
+
+    reader = loop.create_task(pump())
+
+    try:
+        while True:
+            wakeup = loop.create_future()
+            # A size- or timer-triggered wake may have fired while the last write was in progress
+            if not reader.done() and not full() and not due:
+                await wakeup
+
+            due = False
+            if timer is not None:
+                timer.cancel()
+                timer = None
+
+            if reader.done():
+                if buffer:
+                    out = bytes(buffer)
+                    buffer.clear()
+                    yield out
+                # Re-raise upstream errors
+                reader.result()
+                break
+
+            # Window elapsed or size limit reached - flush up to the last complete event
+            cut = buffer.rfind(EVENT_BOUNDARY)
+            if cut != -1:
+                cut += len(EVENT_BOUNDARY)
+                out = bytes(buffer[:cut])
+                del buffer[:cut]
+                space.set()
+                yield out
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if not reader.done():
+            reader.cancel()
+            try:
+                await reader
+            except asyncio.CancelledError:
+                pass
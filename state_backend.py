@@ -0,0 +1,241 @@
+"""
+Pluggable state backend for rate limiting and the auth cache.
+The default "memory" backend keeps validated keys in this process and counts the
+rate limit from the node's SQLite usage log. The "redis" backend counts rate limits
+in Redis with an atomic Lua sliding window, so every replica behind a load balancer
+enforces the same limit, and broadcasts auth-cache invalidations over pub/sub.
+"""
+
+import os
+import time
+import uuid
+import asyncio
+from typing import Optional
+
+from database import APIKey, get_request_count_in_window
+from logger import get_logger
+
+# === Configuration ===
+# "memory" (single node, default) or "redis" (shared by all replicas)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Prefix for every Redis key and channel, so several deployments can share one server
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "lb:")
+# Seconds a validated client key is trusted without asking SQLite again; 0 disables the cache
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "10"))
+
+logger = get_logger("state_backend")
+
+# Sliding-window log: drop entries older than the window, count the rest and record this
+# request only if it is admitted. Returns the count before this request.
+# Uses the Redis server clock so replicas with skewed clocks agree on the window.
+RATE_LIMIT_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local window = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local count = redis.call('ZCARD', KEYS[1])
+if count < limit then
+    redis.call('ZADD', KEYS[1], now, ARGV[3])
+end
+redis.call('PEXPIRE', KEYS[1], math.ceil(window * 1000))
+return count
+"""
+
+
+class MemoryStateBackend:
+    """Single-node backend: in-process auth cache, rate limits from the SQLite usage log."""
+
+    name = "memory"
+
+    def __init__(self, auth_cache_ttl: float = AUTH_CACHE_TTL):
+        self.auth_cache_ttl = auth_cache_ttl
+        # key_hash -> (APIKey, cached_until)
+        self._auth_cache: dict[str, tuple[APIKey, float]] = {}
+        self.auth_hits = 0
+        self.auth_misses = 0
+        self.rate_limited = 0
+        self.invalidations = 0
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def get_cached_key(self, key_hash: str) -> Optional[APIKey]:
+        """A recently validated key, unless the cache entry or the key itself has expired."""
+        entry = self._auth_cache.get(key_hash)
+        now = time.time()
+        if entry is None or entry[1] < now:
+            self.auth_misses += 1
+            return None
+
+        api_key = entry[0]
+        if api_key.expires_at and api_key.expires_at.timestamp() < now:
+            del self._auth_cache[key_hash]
+            self.auth_misses += 1
+            return None
+
+        self.auth_hits += 1
+        return api_key
+
+    def cache_key(self, key_hash: str, api_key: APIKey):
+        if self.auth_cache_ttl > 0:
+            self._auth_cache[key_hash] = (api_key, time.time() + self.auth_cache_ttl)
+
+    def _evict(self, key_id: str):
+        for key_hash, (api_key, _) in list(self._auth_cache.items()):
+            if api_key.id == key_id:
+                del self._auth_cache[key_hash]
+
+    async def invalidate_key(self, key_id: str):
+        """Forget a key after it was updated or deleted."""
+        self.invalidations += 1
+        self._evict(key_id)
+
+    async def check_rate_limit(self, key_id: str, limit: int, window_seconds: int = 60) -> tuple[bool, int]:
+        """(allowed, requests already made in the window)."""
+        count = await get_request_count_in_window(key_id, window_seconds=window_seconds)
+        allowed = count < limit
+        if not allowed:
+            self.rate_limited += 1
+        return allowed, count
+
+    def get_stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "auth_cache_entries": len(self._auth_cache),
+            "auth_cache_hits": self.auth_hits,
+            "auth_cache_misses": self.auth_misses,
+            "rate_limited": self.rate_limited,
+            "invalidations": self.invalidations
+        }
+
+
+class RedisStateBackend(MemoryStateBackend):
+    """
+    Multi-replica backend. The auth cache stays in each process, but invalidations are
+    published to every replica; rate-limit windows live in Redis.
+    """
+
+    name = "redis"
+
+    def __init__(
+        self,
+        url: str = REDIS_URL,
+        prefix: str = REDIS_KEY_PREFIX,
+        auth_cache_ttl: float = AUTH_CACHE_TTL,
+        client=None
+    ):
+        super().__init__(auth_cache_ttl)
+        self.url = url
+        self.prefix = prefix
+        self.channel = f"{prefix}auth-invalidate"
+        self._client = client
+        self._script = None
+        self._listener: Optional[asyncio.Task] = None
+        self.errors = 0
+        self.invalidations_received = 0
+
+    def _get_client(self):
+        if self._client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("STATE_BACKEND=redis requires the redis package: pip install redis")
+            self._client = redis.from_url(self.url)
+        return self._client
+
+    async def start(self):
+        """Check the connection and start listening for invalidations from other replicas."""
+        client = self._get_client()
+        await client.ping()
+        self._script = client.register_script(RATE_LIMIT_SCRIPT)
+        ready = asyncio.Event()
+        self._listener = asyncio.create_task(self._listen(ready))
+        await ready.wait()
+        logger.info(f"Using Redis state backend at {self.url}")
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _listen(self, ready: asyncio.Event):
+        while True:
+            pubsub = self._get_client().pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                ready.set()
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    key_id = message["data"]
+                    self.invalidations_received += 1
+                    self._evict(key_id.decode() if isinstance(key_id, bytes) else key_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                ready.set()
+                logger.warning(f"⚠️  Lost Redis invalidation channel, retrying: {e}")
+                # Invalidations may have been missed while disconnected
+                self._auth_cache.clear()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def invalidate_key(self, key_id: str):
+        """Forget a key here and tell every other replica to do the same."""
+        await super().invalidate_key(key_id)
+        try:
+            await self._get_client().publish(self.channel, key_id)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️  Failed to publish auth cache invalidation for {key_id}: {e}")
+
+    async def check_rate_limit(self, key_id: str, limit: int, window_seconds: int = 60) -> tuple[bool, int]:
+        """Atomically count and record the request in the shared window. Fails open if Redis is down."""
+        try:
+            if self._script is None:
+                self._script = self._get_client().register_script(RATE_LIMIT_SCRIPT)
+            count = int(await self._script(
+                keys=[f"{self.prefix}rate:{key_id}"],
+                args=[window_seconds, limit, uuid.uuid4().hex]
+            ))
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️  Redis rate limit check failed, allowing request: {e}")
+            return True, 0
+
+        allowed = count < limit
+        if not allowed:
+            self.rate_limited += 1
+        return allowed, count
+
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        stats["invalidations_received"] = self.invalidations_received
+        stats["errors"] = self.errors
+        return stats
+
+
+def create_state_backend(backend: str = STATE_BACKEND) -> MemoryStateBackend:
+    if backend == "redis":
+        return RedisStateBackend()
+    if backend != "memory":
+        logger.warning(f"⚠️  Unknown STATE_BACKEND '{backend}', using memory")
+    return MemoryStateBackend()
+
+
+# Global instance
+state_backend = create_state_backend()
@@ -0,0 +1,204 @@
+"""
+Unit tests for admission control and fair scheduling of upstream calls.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import asyncio
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi.responses import Response, StreamingResponse
+
+from admission import AdmissionController, AdmissionRejected, rejected_response
+from database import APIKey
+
+
+def make_key(key_id: str, max_concurrency: int = 0, priority: int = 0, weight: int = 1) -> APIKey:
+    return APIKey(
+        id=key_id, key_hash=key_id, name=key_id, created_at=datetime.now(), expires_at=None,
+        rate_limit=0, is_active=True, max_concurrency=max_concurrency, priority=priority, weight=weight
+    )
+
+
+async def run_queued(admission: AdmissionController, keys: list) -> list:
+    """Queue one request per entry of `keys` behind a full controller and return the order they get slots."""
+    held = [await admission.acquire() for _ in range(admission.max_inflight)]
+    order = []
+
+    async def request(key):
+        ticket = await admission.acquire(key)
+        order.append(key.id if key else None)
+        held.append(ticket)
+
+    tasks = [asyncio.create_task(request(key)) for key in keys]
+    await asyncio.sleep(0.01)
+    while len(order) < len(keys):
+        granted = len(order)
+        admission.release(held.pop(0))
+        while len(order) == granted:
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return order
+
+
+class TestAdmissionController:
+    """Test the in-flight cap and the wait queue"""
+
+    @pytest.mark.asyncio
+    async def test_waiters_get_slots_in_order(self):
+        admission = AdmissionController(max_inflight=2, queue_size=10, queue_timeout=1)
+        order = await run_queued(admission, [None, None, None])
+        assert len(order) == 3
+        assert admission.inflight == 2 and admission.queue_depth == 0
+
+    @pytest.mark.asyncio
+    async def test_full_queue_is_shed_immediately(self):
+        admission = AdmissionController(max_inflight=1, queue_size=1, queue_timeout=1)
+        ticket = await admission.acquire()
+        queued = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(AdmissionRejected) as e:
+            await admission.acquire()
+        assert e.value.reason == "queue_full"
+
+        admission.release(ticket)
+        admission.release(await queued)
+        assert admission.get_stats()["rejected"] == 1
+        assert admission.get_stats()["active_keys"] == 0
+
+    @pytest.mark.asyncio
+    async def test_wait_times_out(self):
+        admission = AdmissionController(max_inflight=1, queue_size=5, queue_timeout=0.05)
+        ticket = await admission.acquire()
+
+        with pytest.raises(AdmissionRejected) as e:
+            await admission.acquire()
+        assert e.value.reason == "timeout"
+        assert admission.queue_depth == 0
+
+        # The timed-out waiter does not swallow the released slot
+        admission.release(ticket)
+        assert admission.inflight == 0
+
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        admission = AdmissionController(max_inflight=1, queue_size=5, queue_timeout=5)
+        ticket = await admission.acquire()
+        task = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0.01)
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert admission.queue_depth == 0
+        admission.release(ticket)
+        assert admission.inflight == 0
+
+    @pytest.mark.asyncio
+    async def test_stream_holds_slot_until_last_chunk(self):
+        admission = AdmissionController(max_inflight=1)
+
+        async def body():
+            yield b"data: 1\n\n"
+            yield b"data: 2\n\n"
+
+        ticket = await admission.acquire()
+        response = admission.hold(StreamingResponse(body()), ticket)
+        assert admission.inflight == 1
+        assert [chunk async for chunk in response.body_iterator] == [b"data: 1\n\n", b"data: 2\n\n"]
+        assert admission.inflight == 0
+
+        admission.hold(Response(b"{}"), await admission.acquire())
+        assert admission.inflight == 0
+
+    def test_rejection_responses(self):
+        response = rejected_response(AdmissionRejected("queue_full", retry_after=3))
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "3"
+
+        response = rejected_response(AdmissionRejected("concurrency", limit=2))
+        assert response.status_code == 429
+
+
+class TestFairScheduling:
+    """Test per-key concurrency limits, priorities and weights"""
+
+    @pytest.mark.asyncio
+    async def test_key_concurrency_limit(self):
+        admission = AdmissionController(max_inflight=0, queue_size=10, queue_timeout=0.05)
+        key = make_key("batch", max_concurrency=2)
+        tickets = [await admission.acquire(key), await admission.acquire(key)]
+
+        with pytest.raises(AdmissionRejected) as e:
+            await admission.acquire(key)
+        assert e.value.reason == "concurrency" and e.value.limit == 2
+
+        # Other keys are not affected
+        admission.release(await admission.acquire(make_key("other")))
+
+        admission.release(tickets[0])
+        admission.release(await admission.acquire(key))
+
+    @pytest.mark.asyncio
+    async def test_capped_key_does_not_fill_the_shared_queue(self):
+        admission = AdmissionController(max_inflight=2, queue_size=2, queue_timeout=1, key_queue_size=3)
+        capped = make_key("capped", max_concurrency=1)
+        held = await admission.acquire(capped)
+
+        # Requests held back by the key's own limit wait outside the shared queue
+        flood = [asyncio.create_task(admission.acquire(capped)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert admission.queue_depth == 3 and admission.shared_queue_depth() == 0
+        with pytest.raises(AdmissionRejected) as e:
+            await admission.acquire(capped)
+        assert e.value.reason == "concurrency"
+
+        # Another key still gets the free slot, and may queue behind it
+        other = make_key("other")
+        ticket = await admission.acquire(other)
+        waiting = asyncio.create_task(admission.acquire(other))
+        await asyncio.sleep(0.01)
+        assert admission.shared_queue_depth() == 1
+
+        admission.release(ticket)
+        admission.release(await waiting)
+        for task in flood:
+            admission.release(held)
+            held = await task
+        admission.release(held)
+        assert admission.inflight == 0 and admission.queue_depth == 0
+
+    @pytest.mark.asyncio
+    async def test_busy_key_does_not_starve_others(self):
+        admission = AdmissionController(max_inflight=1, queue_size=100, queue_timeout=1)
+        busy, light = make_key("busy"), make_key("light")
+
+        order = await run_queued(admission, [busy] * 10 + [light] * 2)
+
+        # The light key's requests are interleaved instead of waiting behind all ten
+        assert order.index("light") <= 1
+        assert order[:4].count("light") == 2
+
+    @pytest.mark.asyncio
+    async def test_weights_share_slots(self):
+        admission = AdmissionController(max_inflight=1, queue_size=100, queue_timeout=1)
+        heavy, light = make_key("heavy", weight=3), make_key("light", weight=1)
+
+        order = await run_queued(admission, [heavy] * 12 + [light] * 12)
+
+        assert order[:8].count("heavy") == 6
+        assert order[:8].count("light") == 2
+
+    @pytest.mark.asyncio
+    async def test_higher_priority_goes_first(self):
+        admission = AdmissionController(max_inflight=1, queue_size=100, queue_timeout=1)
+        batch, interactive = make_key("batch", priority=-1), make_key("interactive", priority=1)
+
+        order = await run_queued(admission, [batch] * 3 + [interactive] * 3)
+
+        assert order == ["interactive"] * 3 + ["batch"] * 3
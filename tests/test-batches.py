@@ -0,0 +1,321 @@
+"""
+Unit tests for the batch job API: input validation, fan-out with retries, cancellation
+and resuming after a restart.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import json
+import asyncio
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from batches import BatchRunner, BatchStore, batch_object, scan_results, validate_input
+from database import APIKey
+from quotas import QuotaExceeded
+
+OWNER = APIKey(
+    id="key-1", key_hash="key-1", name="owner", created_at=datetime.now(), expires_at=None,
+    rate_limit=0, is_active=True
+)
+
+
+async def load_owner(key_id: str):
+    return OWNER if key_id == OWNER.id else None
+
+
+def make_runner(store: BatchStore, send, **kwargs) -> BatchRunner:
+    return BatchRunner(store, send, load_key=load_owner, **kwargs)
+
+
+def request_line(custom_id: str, endpoint: str = "/v1/chat/completions", **body) -> bytes:
+    return json.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": endpoint,
+        "body": {"model": "test/model", **body}
+    }).encode() + b"\n"
+
+
+async def chunks_of(data: bytes):
+    yield data
+
+
+async def make_batch(store: BatchStore, lines: list[bytes]) -> dict:
+    file = await store.save_file("key-1", "batch", "input.jsonl", chunks_of(b"".join(lines)))
+    return await store.create_batch("key-1", file["id"], "/v1/chat/completions")
+
+
+async def wait_for_status(store: BatchStore, batch_id: str, statuses: tuple, timeout: float = 5.0) -> dict:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        batch = await store.get_batch(batch_id)
+        if batch["status"] in statuses:
+            return batch
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError(f"batch still {batch['status']}")
+        await asyncio.sleep(0.01)
+
+
+async def wait_until(condition, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condition not reached")
+        await asyncio.sleep(0.01)
+
+
+def read_results(store: BatchStore, file_id: str) -> list[dict]:
+    path = store.file_path(file_id)
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BatchStore(db_path=str(tmp_path / "lb.db"), directory=str(tmp_path / "batches"))
+
+
+class TestValidation:
+    """Test checking input files before a batch starts"""
+
+    def test_valid_file(self, tmp_path):
+        path = tmp_path / "input.jsonl"
+        path.write_bytes(request_line("a") + b"\n" + request_line("b"))
+        assert validate_input(str(path), "/v1/chat/completions") == (2, [])
+
+    def test_line_errors(self, tmp_path):
+        path = tmp_path / "input.jsonl"
+        path.write_bytes(
+            request_line("a") + request_line("a") + b"not json\n" +
+            request_line("c", endpoint="/v1/embeddings")
+        )
+        total, errors = validate_input(str(path), "/v1/chat/completions")
+        assert total == 4
+        assert [(e["code"], e["line"]) for e in errors] == [
+            ("duplicate_custom_id", 2), ("invalid_json", 3), ("mismatched_url", 4)
+        ]
+
+    def test_too_many_requests(self, tmp_path):
+        path = tmp_path / "input.jsonl"
+        path.write_bytes(request_line("a") + request_line("b"))
+        _, errors = validate_input(str(path), "/v1/chat/completions", max_requests=1)
+        assert errors[0]["code"] == "too_many_requests"
+
+    def test_partial_result_line_is_dropped(self, tmp_path):
+        path = tmp_path / "output.jsonl"
+        path.write_bytes(b'{"custom_id": "a"}\n{"custom_id": "b"}\n{"custom_id": "c", "resp')
+        assert scan_results(str(path)) == ({"a", "b"}, 2)
+        assert path.read_bytes().endswith(b'"b"}\n')
+
+
+class TestBatchRunner:
+    """Test running batches in the background"""
+
+    @pytest.mark.asyncio
+    async def test_results_and_retries(self, store):
+        calls = {}
+
+        async def send(api_key, endpoint, body):
+            custom_id = body["messages"]
+            calls[custom_id] = calls.get(custom_id, 0) + 1
+            if custom_id == "flaky" and calls[custom_id] < 3:
+                return 503, b'{"error": {"message": "busy"}}'
+            if custom_id == "bad":
+                return 400, b'{"error": {"message": "bad request"}}'
+            return 200, json.dumps({"id": custom_id, "usage": {"total_tokens": 3}}).encode()
+
+        runner = make_runner(store, send, concurrency=2, retry_backoff=0.001)
+        await runner.start()
+        lines = [request_line(name, messages=name) for name in ("a", "flaky", "bad", "b")]
+        batch = await make_batch(store, lines)
+        await runner.adopt()
+        await runner.wait(batch["id"])
+
+        batch = await store.get_batch(batch["id"])
+        assert batch["status"] == "completed"
+        assert (batch["total"], batch["completed"], batch["failed"]) == (4, 3, 1)
+        assert calls["flaky"] == 3 and calls["bad"] == 1
+        assert runner.get_stats()["retries"] == 2
+
+        output = read_results(store, batch["output_file_id"])
+        assert sorted(r["custom_id"] for r in output) == ["a", "b", "flaky"]
+        assert output[0]["response"]["status_code"] == 200
+        errors = read_results(store, batch["error_file_id"])
+        assert errors[0]["custom_id"] == "bad" and errors[0]["response"]["status_code"] == 400
+
+        obj = batch_object(batch)
+        assert obj["request_counts"] == {"total": 4, "completed": 3, "failed": 1}
+        assert obj["error_file_id"] == batch["error_file_id"]
+        await runner.stop()
+
+    @pytest.mark.asyncio
+    async def test_invalid_input_fails_the_batch(self, store):
+        async def send(api_key, endpoint, body):
+            raise AssertionError("nothing should be sent")
+
+        runner = make_runner(store, send)
+        await runner.start()
+        batch = await make_batch(store, [request_line("a"), b"{}\n"])
+        await runner.adopt()
+        await runner.wait(batch["id"])
+
+        obj = batch_object(await store.get_batch(batch["id"]))
+        assert obj["status"] == "failed"
+        assert obj["errors"]["data"][0]["code"] == "missing_custom_id"
+        assert obj["output_file_id"] is None
+        await runner.stop()
+
+    @pytest.mark.asyncio
+    async def test_spend_quota_fails_requests_without_retries(self, store):
+        async def send(api_key, endpoint, body):
+            raise QuotaExceeded("daily", "Daily spend quota exceeded", 3600)
+
+        runner = make_runner(store, send, retry_backoff=0.001)
+        await runner.start()
+        batch = await make_batch(store, [request_line("a")])
+        await runner.adopt()
+        await runner.wait(batch["id"])
+
+        errors = read_results(store, (await store.get_batch(batch["id"]))["error_file_id"])
+        assert errors[0]["error"]["code"] == "quota_exceeded"
+        # Rejected by the quota before it went upstream
+        assert runner.get_stats()["requests_sent"] == 0
+        await runner.stop()
+
+    @pytest.mark.asyncio
+    async def test_token_rate_wait_is_capped(self, store):
+        calls = 0
+
+        async def send(api_key, endpoint, body):
+            nonlocal calls
+            calls += 1
+            if body["messages"] == "huge":
+                raise QuotaExceeded("tpm_request", "Request too large", 60)
+            raise QuotaExceeded("tpm", "Token rate limit exceeded", 0)
+
+        runner = make_runner(store, send, quota_max_wait=0.3)
+        await runner.start()
+        batch = await make_batch(store, [request_line("a", messages="a"), request_line("huge", messages="huge")])
+        await runner.adopt()
+        await asyncio.wait_for(runner.wait(batch["id"]), timeout=5)
+
+        batch = await store.get_batch(batch["id"])
+        assert (batch["status"], batch["failed"]) == ("completed", 2)
+        errors = read_results(store, batch["error_file_id"])
+        assert {e["custom_id"]: e["error"]["code"] for e in errors} == {"a": "quota_exceeded", "huge": "quota_exceeded"}
+        # A Retry-After of 0 still waits between attempts; the oversized request is not retried
+        assert calls <= 6
+        # Waiting for the token window is not sending
+        assert runner.get_stats()["requests_sent"] == 0
+        await runner.stop()
+
+    @pytest.mark.asyncio
+    async def test_cancel_while_waiting_for_token_rate(self, store):
+        calls = 0
+
+        async def send(api_key, endpoint, body):
+            nonlocal calls
+            calls += 1
+            raise QuotaExceeded("tpm", "Token rate limit exceeded", 60)
+
+        runner = make_runner(store, send)
+        await runner.start()
+        batch = await make_batch(store, [request_line("a")])
+        await runner.adopt()
+        await wait_for_status(store, batch["id"], ("in_progress",))
+        await wait_until(lambda: calls == 1)
+
+        assert await store.request_cancel(batch["id"], "key-1")
+        runner.cancel(batch["id"])
+        await asyncio.wait_for(runner.wait(batch["id"]), timeout=5)
+
+        batch = await store.get_batch(batch["id"])
+        assert batch["status"] == "cancelled"
+        assert read_results(store, batch["error_file_id"]) == []
+        await runner.stop()
+
+    @pytest.mark.asyncio
+    async def test_cancel(self, store):
+        release = asyncio.Event()
+
+        async def send(api_key, endpoint, body):
+            await release.wait()
+            return 200, b"{}"
+
+        runner = make_runner(store, send, concurrency=1)
+        await runner.start()
+        batch = await make_batch(store, [request_line(str(i)) for i in range(10)])
+        await runner.adopt()
+        await wait_for_status(store, batch["id"], ("in_progress",))
+
+        assert await store.request_cancel(batch["id"], "key-1")
+        await asyncio.sleep(1.2)
+        release.set()
+        await runner.wait(batch["id"])
+
+        batch = await store.get_batch(batch["id"])
+        assert batch["status"] == "cancelled"
+        # The request in flight finished, the rest were never sent
+        assert 1 <= batch["completed"] < 10
+        assert not await store.request_cancel(batch["id"], "key-1")
+        await runner.stop()
+
+    @pytest.mark.asyncio
+    async def test_resume_after_restart(self, store):
+        sent = []
+        block = asyncio.Event()
+
+        async def send(api_key, endpoint, body):
+            sent.append(body["messages"])
+            if len(sent) > 3:
+                await block.wait()
+            return 200, b"{}"
+
+        first = make_runner(store, send, concurrency=1)
+        await first.start()
+        batch = await make_batch(store, [request_line(str(i), messages=str(i)) for i in range(6)])
+        await first.adopt()
+        await wait_until(lambda: len(sent) >= 4)
+        # Shut down with the fourth request in flight
+        await first.stop()
+        assert (await store.get_batch(batch["id"]))["runner"] is None
+
+        block.set()
+        second = make_runner(store, send, concurrency=1)
+        await second.start()
+        await second.wait(batch["id"])
+
+        batch = await store.get_batch(batch["id"])
+        assert batch["status"] == "completed" and batch["completed"] == 6
+        # Finished requests were not sent again; the interrupted one was
+        assert sent == ["0", "1", "2", "3", "3", "4", "5"]
+        assert len(read_results(store, batch["output_file_id"])) == 6
+        await second.stop()
+
+    @pytest.mark.asyncio
+    async def test_batch_is_run_by_one_worker(self, store):
+        block = asyncio.Event()
+
+        async def send(api_key, endpoint, body):
+            await block.wait()
+            return 200, b"{}"
+
+        first, second = make_runner(store, send), make_runner(store, send)
+        await first.start()
+        await second.start()
+        batch = await make_batch(store, [request_line("a")])
+        await first.adopt()
+        await second.adopt()
+
+        assert first.get_stats()["running"] == 1
+        assert second.get_stats()["running"] == 0
+        block.set()
+        await first.wait(batch["id"])
+        await first.stop()
+        await second.stop()
@@ -0,0 +1,152 @@
+"""
+Unit tests for the embeddings cache and micro-batcher.
+Runs offline with a fake upstream - no server or Vercel keys needed.
+"""
+import os
+import sys
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from embeddings import (
+    EmbeddingBatcher, EmbeddingsService, EmbeddingsUpstreamError, split_request
+)
+
+
+class FakeUpstream:
+    """Records batches and returns [len(text)] as the vector."""
+
+    def __init__(self, fail_on=None):
+        self.calls = []
+        self.fail_on = fail_on
+
+    async def __call__(self, model, options, inputs):
+        self.calls.append(list(inputs))
+        if self.fail_on is not None and self.fail_on in inputs:
+            raise EmbeddingsUpstreamError(400, b'{"error": {"message": "bad input"}}')
+        return [[float(len(str(item)))] for item in inputs], 10 * len(inputs)
+
+
+class TestSplitRequest:
+    """Test parsing of the embeddings request body"""
+
+    def test_string_and_list_inputs(self):
+        assert split_request({"model": "m", "input": "hi"}) == ("m", {}, ["hi"])
+        assert split_request({"model": "m", "input": ["a", "b"], "dimensions": 8}) == ("m", {"dimensions": 8}, ["a", "b"])
+
+    def test_token_array_is_one_input(self):
+        assert split_request({"model": "m", "input": [1, 2, 3]}) == ("m", {}, [[1, 2, 3]])
+
+    def test_unsupported_bodies(self):
+        assert split_request({"model": "m", "input": []}) is None
+        assert split_request({"input": "hi"}) is None
+        assert split_request(["not", "a", "dict"]) is None
+
+
+class TestEmbeddingBatcher:
+    """Test micro-batching of concurrent callers"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_callers_share_one_call(self):
+        upstream = FakeUpstream()
+        batcher = EmbeddingBatcher(upstream, window_ms=20, max_inputs=100)
+
+        results = await asyncio.gather(
+            batcher.embed("m", {}, ["a"]),
+            batcher.embed("m", {}, ["bb", "ccc"]),
+        )
+
+        assert len(upstream.calls) == 1
+        assert results[0][0] == [[1.0]]
+        assert results[1][0] == [[2.0], [3.0]]
+        assert results[0][1] + results[1][1] == 30
+
+    @pytest.mark.asyncio
+    async def test_duplicate_inputs_are_sent_once(self):
+        upstream = FakeUpstream()
+        batcher = EmbeddingBatcher(upstream, window_ms=20, max_inputs=100)
+
+        await asyncio.gather(batcher.embed("m", {}, ["same"]), batcher.embed("m", {}, ["same"]))
+        assert upstream.calls == [["same"]]
+
+    @pytest.mark.asyncio
+    async def test_different_models_are_not_merged(self):
+        upstream = FakeUpstream()
+        batcher = EmbeddingBatcher(upstream, window_ms=20, max_inputs=100)
+
+        await asyncio.gather(batcher.embed("m1", {}, ["a"]), batcher.embed("m2", {}, ["a"]))
+        assert len(upstream.calls) == 2
+
+    @pytest.mark.asyncio
+    async def test_max_inputs_flushes_immediately(self):
+        upstream = FakeUpstream()
+        batcher = EmbeddingBatcher(upstream, window_ms=10_000, max_inputs=2)
+
+        vectors, _ = await asyncio.wait_for(batcher.embed("m", {}, ["a", "b"]), timeout=1)
+        assert vectors == [[1.0], [1.0]]
+
+    @pytest.mark.asyncio
+    async def test_oversized_request_is_split_and_reassembled(self):
+        upstream = FakeUpstream()
+        batcher = EmbeddingBatcher(upstream, window_ms=10_000, max_inputs=2)
+
+        inputs = ["a", "bb", "ccc", "dddd", "eeeee"]
+        vectors, tokens = await asyncio.wait_for(batcher.embed("m", {}, inputs), timeout=1)
+
+        assert upstream.calls == [["a", "bb"], ["ccc", "dddd"], ["eeeee"]]
+        assert vectors == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+        assert tokens == 50
+
+    @pytest.mark.asyncio
+    async def test_merged_callers_over_max_inputs_are_split(self):
+        upstream = FakeUpstream()
+        batcher = EmbeddingBatcher(upstream, window_ms=20, max_inputs=3)
+
+        first, second = await asyncio.gather(
+            batcher.embed("m", {}, ["a", "bb"]),
+            batcher.embed("m", {}, ["ccc", "dddd"]),
+        )
+
+        assert all(len(call) <= 3 for call in upstream.calls)
+        assert first[0] == [[1.0], [2.0]]
+        assert second[0] == [[3.0], [4.0]]
+
+    @pytest.mark.asyncio
+    async def test_bad_input_only_fails_its_caller(self):
+        upstream = FakeUpstream(fail_on="bad")
+        batcher = EmbeddingBatcher(upstream, window_ms=20, max_inputs=100)
+
+        good, bad = await asyncio.gather(
+            batcher.embed("m", {}, ["good"]),
+            batcher.embed("m", {}, ["bad"]),
+            return_exceptions=True
+        )
+        assert good[0] == [[4.0]]
+        assert isinstance(bad, EmbeddingsUpstreamError)
+
+
+class TestEmbeddingsService:
+    """Test the per-input cache"""
+
+    @pytest.mark.asyncio
+    async def test_cached_inputs_skip_upstream(self):
+        upstream = FakeUpstream()
+        service = EmbeddingsService(EmbeddingBatcher(upstream, window_ms=1, max_inputs=100))
+
+        _, tokens, hits = await service.embed("m", {}, ["a", "b"])
+        assert (tokens, hits) == (20, 0)
+
+        vectors, tokens, hits = await service.embed("m", {}, ["b", "a", "c"])
+        assert vectors == [[1.0], [1.0], [1.0]]
+        assert (tokens, hits) == (10, 2)
+        assert upstream.calls == [["a", "b"], ["c"]]
+
+    @pytest.mark.asyncio
+    async def test_options_are_part_of_the_cache_key(self):
+        upstream = FakeUpstream()
+        service = EmbeddingsService(EmbeddingBatcher(upstream, window_ms=1, max_inputs=100))
+
+        await service.embed("m", {"dimensions": 8}, ["a"])
+        _, _, hits = await service.embed("m", {"dimensions": 16}, ["a"])
+        assert hits == 0
@@ -0,0 +1,111 @@
+"""
+Unit tests for Idempotency-Key replay.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import asyncio
+import pytest
+from fastapi.responses import Response, StreamingResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from idempotency import IdempotencyStore, make_fingerprint
+
+
+async def read_body(response):
+    if isinstance(response, StreamingResponse):
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return response.body
+
+
+class CountingUpstream:
+    """Fake upstream call that counts invocations."""
+
+    def __init__(self, status_code=200, delay=0.0, stream=False):
+        self.calls = 0
+        self.status_code = status_code
+        self.delay = delay
+        self.stream = stream
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.stream:
+            async def gen():
+                yield b"data: 1\n\n"
+                yield b"data: [DONE]\n\n"
+            return StreamingResponse(gen(), status_code=self.status_code, media_type="text/event-stream")
+        return Response(content=b'{"id": "gen-1"}', status_code=self.status_code, media_type="application/json")
+
+
+class TestIdempotencyStore:
+    """Test replay of completed and in-flight requests"""
+
+    @pytest.mark.asyncio
+    async def test_retry_replays_stored_response(self):
+        store = IdempotencyStore()
+        upstream = CountingUpstream()
+        fp = make_fingerprint("POST", "/v1/chat/completions", b"{}")
+
+        first = await store.run("client:abc", fp, upstream)
+        retry = await store.run("client:abc", fp, upstream)
+
+        assert upstream.calls == 1
+        assert retry.body == first.body
+        assert retry.headers["idempotent-replayed"] == "true"
+
+    @pytest.mark.asyncio
+    async def test_retry_attaches_to_in_flight_request(self):
+        store = IdempotencyStore()
+        upstream = CountingUpstream(delay=0.05)
+        fp = make_fingerprint("POST", "/v1/chat/completions", b"{}")
+
+        responses = await asyncio.gather(*[store.run("client:abc", fp, upstream) for _ in range(3)])
+
+        assert upstream.calls == 1
+        assert {r.body for r in responses} == {b'{"id": "gen-1"}'}
+
+    @pytest.mark.asyncio
+    async def test_completed_stream_is_replayed(self):
+        store = IdempotencyStore()
+        upstream = CountingUpstream(stream=True)
+        fp = make_fingerprint("POST", "/v1/chat/completions", b'{"stream": true}')
+
+        first = await store.run("client:abc", fp, upstream)
+        assert await read_body(first) == b"data: 1\n\ndata: [DONE]\n\n"
+
+        retry = await store.run("client:abc", fp, upstream)
+        assert upstream.calls == 1
+        assert await read_body(retry) == b"data: 1\n\ndata: [DONE]\n\n"
+
+    @pytest.mark.asyncio
+    async def test_key_reuse_with_different_body_is_rejected(self):
+        store = IdempotencyStore()
+        upstream = CountingUpstream()
+
+        await store.run("client:abc", make_fingerprint("POST", "/v1/chat/completions", b"{}"), upstream)
+        other = await store.run("client:abc", make_fingerprint("POST", "/v1/chat/completions", b"[]"), upstream)
+
+        assert other.status_code == 422
+        assert upstream.calls == 1
+
+    @pytest.mark.asyncio
+    async def test_server_errors_are_not_stored(self):
+        store = IdempotencyStore()
+        upstream = CountingUpstream(status_code=502)
+        fp = make_fingerprint("POST", "/v1/chat/completions", b"{}")
+
+        await store.run("client:abc", fp, upstream)
+        await store.run("client:abc", fp, upstream)
+        assert upstream.calls == 2
+
+    @pytest.mark.asyncio
+    async def test_expired_entries_are_not_replayed(self):
+        store = IdempotencyStore(ttl=-1)
+        upstream = CountingUpstream()
+        fp = make_fingerprint("POST", "/v1/chat/completions", b"{}")
+
+        await store.run("client:abc", fp, upstream)
+        await store.run("client:abc", fp, upstream)
+        assert upstream.calls == 2
@@ -0,0 +1,101 @@
+"""
+Unit tests for the shared Vercel key state used by multi-worker deployments.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import time
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("USE_POCKETBASE", "false")
+
+from key_state import KeyStateStore
+
+
+def make_manager(store: KeyStateStore, polls: list):
+    """A VercelKeyManager on `store` whose credit polls are counted instead of sent."""
+    import server
+
+    manager = server.VercelKeyManager(state=store)
+    manager._set_keys([{"name": f"k{i}", "api_key": f"vck_{i}"} for i in range(3)])
+
+    async def fake_fetch(key):
+        polls.append(key["api_key"])
+        await asyncio.sleep(0.05)
+        key["balance"] = 10.0 + int(key["api_key"][-1])
+        key["updated_at"] = time.time()
+
+    manager._fetch_credit = fake_fetch
+    return manager
+
+
+class TestKeyStateStore:
+    """Test credit-poll claims"""
+
+    @pytest.mark.asyncio
+    async def test_only_one_worker_wins_a_claim(self, tmp_path):
+        store = KeyStateStore(str(tmp_path / "state.db"))
+        await store.init()
+
+        assert await store.claim("vck_a", max_age=300) is True
+        assert await store.claim("vck_a", max_age=300) is False
+
+    @pytest.mark.asyncio
+    async def test_fresh_balance_is_not_polled_again(self, tmp_path):
+        store = KeyStateStore(str(tmp_path / "state.db"))
+        await store.init()
+        now = time.time()
+
+        assert await store.claim("vck_a", max_age=300, now=now)
+        await store.publish({"api_key": "vck_a", "balance": 4.2, "total_used": 1.0, "updated_at": now})
+
+        assert await store.claim("vck_a", max_age=300, now=now + 10) is False
+        assert await store.claim("vck_a", max_age=300, now=now + 301) is True
+        assert (await store.load())["vck_a"] == (4.2, 1.0, now)
+
+    @pytest.mark.asyncio
+    async def test_stuck_claim_can_be_taken_over(self, tmp_path):
+        store = KeyStateStore(str(tmp_path / "state.db"), claim_timeout=30)
+        await store.init()
+        now = time.time()
+
+        assert await store.claim("vck_a", max_age=300, now=now)
+        assert await store.claim("vck_a", max_age=300, now=now + 5) is False
+        assert await store.claim("vck_a", max_age=300, now=now + 31) is True
+
+        await store.release("vck_a")
+        assert await store.claim("vck_a", max_age=300, now=now + 32) is True
+
+
+class TestSharedKeyManager:
+    """Test several key managers (workers) sharing one store"""
+
+    @pytest.mark.asyncio
+    async def test_workers_poll_each_key_once_and_share_balances(self, tmp_path):
+        store_path = str(tmp_path / "state.db")
+        await KeyStateStore(store_path).init()
+        polls = []
+        workers = [make_manager(KeyStateStore(store_path), polls) for _ in range(3)]
+
+        await asyncio.gather(*[w.refresh_all() for w in workers])
+
+        assert sorted(polls) == ["vck_0", "vck_1", "vck_2"]
+        for worker in workers:
+            assert [k["balance"] for k in worker.keys] == [10.0, 11.0, 12.0]
+            assert await worker.get_key() is not None
+
+    @pytest.mark.asyncio
+    async def test_forced_refresh_polls_again(self, tmp_path):
+        store = KeyStateStore(str(tmp_path / "state.db"))
+        await store.init()
+        polls = []
+        worker = make_manager(store, polls)
+
+        await worker.refresh_all()
+        await worker.refresh_all()
+        assert len(polls) == 3
+
+        await worker.refresh_all(max_age=0)
+        assert len(polls) == 6
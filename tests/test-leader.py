@@ -0,0 +1,126 @@
+"""
+Unit tests for leader election of background tasks between workers.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import time
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("USE_POCKETBASE", "false")
+
+from leader import LeaderLease
+from key_state import KeyStateStore
+
+
+class TestLeaderLease:
+    """Test lease acquisition, renewal and failover"""
+
+    @pytest.mark.asyncio
+    async def test_only_one_worker_is_leader(self, tmp_path):
+        path = str(tmp_path / "state.db")
+        leases = [LeaderLease(path, ttl=15) for _ in range(3)]
+        await leases[0].init()
+
+        won = await asyncio.gather(*[lease.try_acquire() for lease in leases])
+
+        assert sum(won) == 1
+        assert sum(lease.is_leader for lease in leases) == 1
+        # The leader keeps its lease on renewal, the others keep losing
+        assert [await lease.try_acquire() for lease in leases] == list(won)
+
+    @pytest.mark.asyncio
+    async def test_expired_lease_is_taken_over(self, tmp_path):
+        path = str(tmp_path / "state.db")
+        first, second = LeaderLease(path, ttl=15), LeaderLease(path, ttl=15)
+        await first.init()
+        now = time.time()
+
+        assert await first.try_acquire(now=now)
+        assert await second.try_acquire(now=now + 10) is False
+        assert await second.try_acquire(now=now + 16) is True
+        assert second.current_holder == second.holder
+
+        # The old leader notices on its next renewal
+        assert await first.try_acquire(now=now + 17) is False
+        assert first.is_leader is False
+
+    @pytest.mark.asyncio
+    async def test_released_lease_is_free_immediately(self, tmp_path):
+        path = str(tmp_path / "state.db")
+        first, second = LeaderLease(path, ttl=15), LeaderLease(path, ttl=15)
+        await first.init()
+
+        assert await first.try_acquire()
+        await first.release()
+        assert first.is_leader is False
+        assert await second.try_acquire()
+
+
+class TestFollowerRefresh:
+    """Test that followers read the leader's results instead of polling"""
+
+    @pytest.mark.asyncio
+    async def test_follower_adopts_key_list_and_balances(self, tmp_path):
+        import server
+
+        path = str(tmp_path / "state.db")
+        await KeyStateStore(path).init()
+        polls = []
+
+        def make_worker(keys):
+            worker = server.VercelKeyManager(state=KeyStateStore(path))
+            worker._set_keys(keys)
+
+            async def fake_fetch(key):
+                polls.append(key["api_key"])
+                key["balance"] = 7.0
+                key["updated_at"] = time.time()
+
+            worker._fetch_credit = fake_fetch
+            return worker
+
+        leader = make_worker([{"name": "a", "api_key": "vck_a"}, {"name": "b", "api_key": "vck_b"}])
+        follower = make_worker([{"name": "old", "api_key": "vck_old"}])
+
+        await leader.refresh_all(leader=True)
+        await follower.refresh_all(leader=False)
+
+        assert sorted(polls) == ["vck_a", "vck_b"]
+        assert [k["api_key"] for k in follower.keys] == ["vck_a", "vck_b"]
+        assert [k["balance"] for k in follower.keys] == [7.0, 7.0]
+
+    @pytest.mark.asyncio
+    async def test_only_the_leader_loads_keys_at_startup(self, tmp_path, monkeypatch):
+        import server
+
+        path = str(tmp_path / "state.db")
+        await KeyStateStore(path).init()
+        loads = []
+
+        def pocketbase():
+            loads.append(1)
+            return [{"name": "a", "api_key": "vck_a"}]
+
+        monkeypatch.setattr(server, "USE_POCKETBASE", True)
+        monkeypatch.setattr(server, "get_keys_from_pocketbase", pocketbase)
+
+        async def fake_fetch(key):
+            key["balance"] = 7.0
+            key["updated_at"] = time.time()
+
+        workers = [server.VercelKeyManager(state=KeyStateStore(path)) for _ in range(3)]
+        for worker in workers:
+            worker._fetch_credit = fake_fetch
+        assert loads == []
+
+        # Followers start together with the leader and wait for its key list
+        await asyncio.gather(
+            workers[0].refresh_all(leader=True),
+            *[worker.refresh_all(leader=False) for worker in workers[1:]]
+        )
+
+        assert loads == [1]
+        assert all([k["api_key"] for k in worker.keys] == ["vck_a"] for worker in workers)
@@ -0,0 +1,77 @@
+"""
+Unit tests for the queue-based structured logger.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import io
+import json
+import queue
+import logging
+import logging.handlers
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from logger import JSONFormatter, TextFormatter, DroppingQueueHandler
+
+
+def make_record(msg, *args, **extra) -> logging.LogRecord:
+    record = logging.LogRecord("lb.server", logging.INFO, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestFormatters:
+    """Test the JSON and text output formats"""
+
+    def test_json_includes_extra_fields(self):
+        line = JSONFormatter().format(make_record("Selected Vercel key: %s", "main", key="main", balance=4.2))
+        entry = json.loads(line)
+
+        assert entry["level"] == "info"
+        assert entry["logger"] == "lb.server"
+        assert entry["msg"] == "Selected Vercel key: main"
+        assert entry["key"] == "main"
+        assert entry["balance"] == 4.2
+
+    def test_text_appends_extra_fields(self):
+        line = TextFormatter().format(make_record("trace", trace={"status": 200}))
+        assert line.endswith('trace {"trace": {"status": 200}}')
+
+    def test_text_without_extra_fields(self):
+        line = TextFormatter().format(make_record("Database initialized"))
+        assert line.endswith("Database initialized")
+
+
+class TestDroppingQueueHandler:
+    """Test that logging never blocks on a full queue"""
+
+    def test_full_queue_drops_records(self):
+        handler = DroppingQueueHandler(queue.Queue(maxsize=2))
+        for i in range(5):
+            handler.handle(make_record("message %d", i))
+
+        assert handler.queue.qsize() == 2
+        assert handler.dropped == 3
+
+    def test_message_is_resolved_before_queueing(self):
+        handler = DroppingQueueHandler(queue.Queue())
+        handler.handle(make_record("Loaded %d Vercel keys", 3))
+
+        record = handler.queue.get_nowait()
+        assert record.msg == "Loaded 3 Vercel keys"
+        assert record.args is None
+
+    def test_listener_writes_in_background(self):
+        stream = io.StringIO()
+        output = logging.StreamHandler(stream)
+        output.setFormatter(JSONFormatter())
+        handler = DroppingQueueHandler(queue.Queue())
+        listener = logging.handlers.QueueListener(handler.queue, output)
+
+        listener.start()
+        handler.handle(make_record("Response cache enabled"))
+        listener.stop()
+
+        assert json.loads(stream.getvalue())["msg"] == "Response cache enabled"
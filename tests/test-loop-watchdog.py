@@ -0,0 +1,79 @@
+"""
+Unit tests for the event loop watchdog.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import time
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("USE_POCKETBASE", "false")
+
+from loop_watchdog import Watchdog, BlockingCallError
+
+
+def blocking_file_read():
+    """Stands in for sync I/O done on the event loop."""
+    time.sleep(0.2)
+
+
+class TestWatchdog:
+    """Test lag measurement and blocking-call capture"""
+
+    @pytest.mark.asyncio
+    async def test_blocking_call_is_captured(self):
+        async with Watchdog(interval_ms=5, block_threshold_ms=50) as dog:
+            await asyncio.sleep(0.05)
+            blocking_file_read()
+            await asyncio.sleep(0.05)
+
+        stats = dog.get_stats()
+        assert stats["blocked_calls"] == 1
+        assert stats["lag_max_ms"] >= 150
+        block = stats["recent_blocks"][0]
+        assert block["duration_ms"] >= 150
+        assert any("blocking_file_read" in frame for frame in block["stack"])
+
+    @pytest.mark.asyncio
+    async def test_short_callbacks_are_not_reported(self):
+        async with Watchdog(interval_ms=5, block_threshold_ms=100) as dog:
+            for _ in range(10):
+                time.sleep(0.005)
+                await asyncio.sleep(0.01)
+
+        assert dog.get_stats()["blocked_calls"] == 0
+        assert len(dog.lags_ms) > 0
+
+    @pytest.mark.asyncio
+    async def test_strict_mode_fails_on_blocking_call(self):
+        dog = Watchdog(interval_ms=5, block_threshold_ms=50, fail_on_block_ms=100)
+        with pytest.raises(BlockingCallError, match="blocking_file_read"):
+            async with dog:
+                await asyncio.sleep(0.05)
+                blocking_file_read()
+                await asyncio.sleep(0.05)
+
+    @pytest.mark.asyncio
+    async def test_key_reload_does_not_block_the_loop(self, monkeypatch):
+        import server
+
+        def slow_pocketbase():
+            time.sleep(0.2)
+            return [{"name": "main", "api_key": "vck_test"}]
+
+        manager = server.vercel_key_manager
+        monkeypatch.setattr(server, "USE_POCKETBASE", True)
+        monkeypatch.setattr(server, "get_keys_from_pocketbase", slow_pocketbase)
+        monkeypatch.setattr(manager, "keys", [])
+        monkeypatch.setattr(manager, "_keys_last_refresh", 0)
+
+        async def no_credit_fetch(key):
+            pass
+        monkeypatch.setattr(manager, "_fetch_credit", no_credit_fetch)
+
+        async with Watchdog(interval_ms=5, block_threshold_ms=50, fail_on_block_ms=100):
+            await manager.refresh_all()
+
+        assert [k["name"] for k in manager.keys] == ["main"]
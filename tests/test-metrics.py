@@ -0,0 +1,102 @@
+"""
+Unit tests for the Prometheus metrics.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import time
+import pytest
+from fastapi.responses import Response, StreamingResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import metrics
+from metrics import Counter, Histogram, UpstreamTrace, track_response, render_metrics
+
+
+class TestMetricTypes:
+    """Test counters, histograms and the text format"""
+
+    def test_histogram_buckets_are_cumulative(self):
+        hist = Histogram("test_hist_seconds", "Test histogram", ("model",), buckets=(0.1, 1))
+        hist.observe(0.05, "a")
+        hist.observe(0.5, "a")
+        hist.observe(5, "a")
+
+        text = "\n".join(hist.render())
+        assert 'test_hist_seconds_bucket{model="a",le="0.1"} 1' in text
+        assert 'test_hist_seconds_bucket{model="a",le="1"} 2' in text
+        assert 'test_hist_seconds_bucket{model="a",le="+Inf"} 3' in text
+        assert 'test_hist_seconds_count{model="a"} 3' in text
+        assert 'test_hist_seconds_sum{model="a"} 5.55' in text
+
+    def test_label_values_are_escaped(self):
+        counter = Counter("test_escape_total", "Test counter", ("model",))
+        counter.inc(1, 'bad"model\n')
+        assert 'model="bad\\"model\\n"' in "\n".join(counter.render())
+
+    def test_series_are_capped(self, monkeypatch):
+        monkeypatch.setattr(metrics, "METRICS_MAX_SERIES", 2)
+        counter = Counter("test_capped_total", "Test counter", ("model",))
+        for model in ("a", "b", "c", "d"):
+            counter.inc(1, model)
+
+        assert counter.value("a") == 1
+        assert counter.value("other") == 2
+
+    def test_render_includes_registered_metrics(self):
+        text = render_metrics()
+        assert "# TYPE lb_request_duration_seconds histogram" in text
+        assert "# TYPE lb_inflight_streams gauge" in text
+
+
+class TestTrackResponse:
+    """Test request duration and byte accounting"""
+
+    def test_regular_response(self):
+        before = metrics.REQUEST_DURATION.count("test-model", "200")
+        bytes_before = metrics.BYTES_OUT.value("test-model")
+
+        track_response(Response(content=b"hello"), "test-model", time.perf_counter())
+
+        assert metrics.REQUEST_DURATION.count("test-model", "200") == before + 1
+        assert metrics.BYTES_OUT.value("test-model") == bytes_before + 5
+
+    @pytest.mark.asyncio
+    async def test_stream_is_recorded_when_finished(self):
+        async def gen():
+            yield b"data: 1\n\n"
+            assert metrics.INFLIGHT_STREAMS.value() == 1
+            yield b"data: [DONE]\n\n"
+
+        before = metrics.REQUEST_DURATION.count("stream-model", "200")
+        response = track_response(StreamingResponse(gen()), "stream-model", time.perf_counter())
+        assert metrics.REQUEST_DURATION.count("stream-model", "200") == before
+
+        body = b"".join([chunk async for chunk in response.body_iterator])
+
+        assert metrics.INFLIGHT_STREAMS.value() == 0
+        assert metrics.REQUEST_DURATION.count("stream-model", "200") == before + 1
+        assert metrics.BYTES_OUT.value("stream-model") == len(body)
+
+
+class TestUpstreamTrace:
+    """Test timings taken from httpx trace events"""
+
+    @pytest.mark.asyncio
+    async def test_connect_and_headers(self):
+        trace = UpstreamTrace()
+        await trace("connection.connect_tcp.started", {})
+        await trace("connection.connect_tcp.complete", {})
+        await trace("connection.start_tls.started", {})
+        await trace("connection.start_tls.complete", {})
+        await trace("http11.receive_response_headers.complete", {})
+
+        assert trace.connect_duration is not None and trace.connect_duration >= 0
+        assert trace.headers_at is not None and trace.headers_at >= trace.started
+
+    @pytest.mark.asyncio
+    async def test_reused_connection_has_no_connect_time(self):
+        trace = UpstreamTrace()
+        await trace("http11.send_request_headers.started", {})
+        assert trace.connect_duration is None
@@ -0,0 +1,123 @@
+"""
+Unit tests for the bundled mock Vercel AI Gateway.
+Runs offline - the mock is called in-process through httpx's ASGI transport.
+"""
+import os
+import sys
+import json
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from mock_gateway import MockConfig, MockDisconnect, create_app
+
+
+def client_for(config: MockConfig, key: str = "vck_test") -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=create_app(config)),
+        base_url="http://mock",
+        headers={"Authorization": f"Bearer {key}"}
+    )
+
+
+def sse_events(body: str) -> list:
+    return [line[6:] for line in body.splitlines() if line.startswith("data: ")]
+
+
+class TestChatCompletions:
+    """Test streaming and non-streaming completions"""
+
+    @pytest.mark.asyncio
+    async def test_non_streaming_usage(self):
+        async with client_for(MockConfig(completion_tokens=5)) as client:
+            resp = await client.post("/v1/chat/completions", json={"model": "openai/gpt-4o", "messages": []})
+
+        data = resp.json()
+        assert resp.status_code == 200
+        assert data["usage"]["completion_tokens"] == 5
+        assert data["choices"][0]["message"]["content"] == "tok0 tok1 tok2 tok3 tok4"
+
+    @pytest.mark.asyncio
+    async def test_streaming_with_reasoning(self):
+        config = MockConfig(completion_tokens=3, reasoning_tokens=2)
+        async with client_for(config) as client:
+            resp = await client.post("/v1/chat/completions", json={
+                "model": "anthropic/claude-sonnet-4.5", "messages": [], "stream": True,
+                "reasoning": {"enabled": True}, "stream_options": {"include_usage": True}
+            })
+
+        events = sse_events(resp.text)
+        assert events[-1] == "[DONE]"
+        deltas = [json.loads(e)["choices"][0]["delta"] for e in events[:-2]]
+        assert [d.get("reasoning") for d in deltas if "reasoning" in d] == ["think0 ", "think1 "]
+        assert [d.get("content") for d in deltas if d.get("content")] == ["tok0 ", "tok1 ", "tok2 "]
+        assert json.loads(events[-2])["usage"]["completion_tokens"] == 5
+
+    @pytest.mark.asyncio
+    async def test_mid_stream_disconnect(self):
+        error = None
+        async with client_for(MockConfig(completion_tokens=10)) as client:
+            try:
+                await client.post(
+                    "/v1/chat/completions",
+                    json={"model": "openai/gpt-4o", "messages": [], "stream": True},
+                    headers={"X-Mock-Disconnect": "true"}
+                )
+            except Exception as e:
+                error = e
+
+        # In-process the abort surfaces as the exception itself (possibly in a task group)
+        errors = getattr(error, "exceptions", [error])
+        assert any(isinstance(e, MockDisconnect) for e in errors)
+
+
+class TestBalancesAndErrors:
+    """Test per-key balances and error injection"""
+
+    @pytest.mark.asyncio
+    async def test_balance_is_charged_until_402(self):
+        config = MockConfig(balances={"vck_small": 0.01}, cost_per_1k_tokens=1.0, completion_tokens=20)
+        async with client_for(config, key="vck_small") as client:
+            assert (await client.get("/v1/credits")).json()["balance"] == "0.010000"
+
+            first = await client.post("/v1/chat/completions", json={"model": "m", "messages": []})
+            second = await client.post("/v1/chat/completions", json={"model": "m", "messages": []})
+            credits = (await client.get("/v1/credits")).json()
+
+        assert first.status_code == 200
+        assert second.status_code == 402
+        assert float(credits["balance"]) <= 0
+        assert float(credits["total_used"]) > 0
+
+    @pytest.mark.asyncio
+    async def test_forced_error_header(self):
+        async with client_for(MockConfig()) as client:
+            resp = await client.post("/v1/embeddings", json={"model": "m", "input": "hi"}, headers={"X-Mock-Status": "429"})
+        assert resp.status_code == 429
+
+    @pytest.mark.asyncio
+    async def test_error_rate(self):
+        async with client_for(MockConfig(error_rate=1.0, error_codes=(503,))) as client:
+            resp = await client.post("/v1/chat/completions", json={"model": "m", "messages": []})
+        assert resp.status_code == 503
+
+
+class TestEmbeddingsAndModels:
+    """Test embeddings and the model list"""
+
+    @pytest.mark.asyncio
+    async def test_embeddings_are_deterministic(self):
+        async with client_for(MockConfig(embedding_dim=4)) as client:
+            first = (await client.post("/v1/embeddings", json={"model": "m", "input": ["a", "b"]})).json()
+            second = (await client.post("/v1/embeddings", json={"model": "m", "input": "a"})).json()
+
+        assert len(first["data"]) == 2
+        assert len(first["data"][0]["embedding"]) == 4
+        assert first["data"][0]["embedding"] == second["data"][0]["embedding"]
+
+    @pytest.mark.asyncio
+    async def test_models(self):
+        async with client_for(MockConfig(models=["openai/gpt-4o"])) as client:
+            data = (await client.get("/v1/models")).json()
+        assert [m["id"] for m in data["data"]] == ["openai/gpt-4o"]
@@ -0,0 +1,88 @@
+"""
+Unit tests for the cached /v1/models list.
+Runs offline with a fake upstream - no server or Vercel keys needed.
+"""
+import os
+import sys
+import json
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from models_cache import ModelsCache, etag_matches, filter_models
+
+MODELS = {
+    "object": "list",
+    "data": [
+        {"id": "openai/gpt-4o", "object": "model"},
+        {"id": "anthropic/claude-sonnet-4.5", "object": "model"},
+        {"id": "google/gemini-2.5-pro", "object": "model"},
+    ]
+}
+
+
+class FakeUpstream:
+    def __init__(self, status_code=200, body=None):
+        self.calls = 0
+        self.status_code = status_code
+        self.body = body if body is not None else json.dumps(MODELS).encode()
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return self.status_code, self.body
+
+
+class TestModelsCache:
+    """Test fetching, refresh and filtering"""
+
+    @pytest.mark.asyncio
+    async def test_fetches_once_for_concurrent_first_requests(self):
+        upstream = FakeUpstream()
+        cache = ModelsCache(upstream, patterns=[])
+
+        results = await asyncio.gather(*[cache.get() for _ in range(5)])
+
+        assert upstream.calls == 1
+        assert len({etag for _, etag in results}) == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_refresh_keeps_previous_copy(self):
+        upstream = FakeUpstream()
+        cache = ModelsCache(upstream, patterns=[])
+        body, etag = await cache.get()
+
+        upstream.status_code = 500
+        assert not await cache.refresh()
+        assert await cache.get() == (body, etag)
+
+    @pytest.mark.asyncio
+    async def test_etag_changes_with_content(self):
+        upstream = FakeUpstream()
+        cache = ModelsCache(upstream, patterns=[])
+        _, first = await cache.get()
+
+        upstream.body = json.dumps({"object": "list", "data": []}).encode()
+        await cache.refresh()
+        _, second = await cache.get()
+        assert first != second
+
+    def test_filter_models(self):
+        body = filter_models(json.dumps(MODELS).encode(), ["openai/*", "anthropic/claude-*"])
+        ids = [m["id"] for m in json.loads(body)["data"]]
+        assert ids == ["openai/gpt-4o", "anthropic/claude-sonnet-4.5"]
+
+
+class TestEtagMatches:
+    """Test If-None-Match parsing"""
+
+    def test_matching(self):
+        assert etag_matches('"abc"', '"abc"')
+        assert etag_matches('W/"abc"', '"abc"')
+        assert etag_matches('"xyz", "abc"', '"abc"')
+        assert etag_matches("*", '"abc"')
+
+    def test_not_matching(self):
+        assert not etag_matches(None, '"abc"')
+        assert not etag_matches('"xyz"', '"abc"')
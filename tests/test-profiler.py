@@ -0,0 +1,78 @@
+"""
+Unit tests for the on-demand event loop profiler.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import time
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from profiler import SamplingProfiler
+
+
+def blocking_reload():
+    """Stands in for a sync call made on the event loop, like the PocketBase reload."""
+    time.sleep(0.25)
+
+
+async def block_loop_after(delay: float):
+    await asyncio.sleep(delay)
+    blocking_reload()
+
+
+class TestSamplingProfiler:
+    """Test stack sampling, loop lag and slow callback detection"""
+
+    @pytest.mark.asyncio
+    async def test_blocking_call_is_reported(self):
+        profiler = SamplingProfiler(interval_ms=5, slow_callback_ms=50)
+        blocker = asyncio.create_task(block_loop_after(0.05))
+
+        result = await profiler.profile(0.5)
+        await blocker
+
+        assert result.loop_lag()["max_ms"] >= 150
+        assert len(result.slow_callbacks) == 1
+        slow = result.slow_callbacks[0]
+        assert slow["duration_ms"] >= 150
+        assert any("blocking_reload" in frame for frame in slow["stack"])
+        assert "blocking_reload" in result.collapsed()
+
+    @pytest.mark.asyncio
+    async def test_idle_loop_has_no_slow_callbacks(self):
+        profiler = SamplingProfiler(interval_ms=5, slow_callback_ms=50)
+        result = await profiler.profile(0.2)
+
+        assert result.slow_callbacks == []
+        assert result.idle_samples > 0
+        assert result.summary()["busy_ratio"] < 0.5
+
+    @pytest.mark.asyncio
+    async def test_only_one_profile_at_a_time(self):
+        profiler = SamplingProfiler(interval_ms=5)
+        first = asyncio.create_task(profiler.profile(0.1))
+        await asyncio.sleep(0)
+
+        with pytest.raises(RuntimeError):
+            await profiler.profile(0.1)
+        await first
+        assert not profiler.running
+
+    @pytest.mark.asyncio
+    async def test_speedscope_output(self):
+        profiler = SamplingProfiler(interval_ms=5, slow_callback_ms=50)
+        blocker = asyncio.create_task(block_loop_after(0.02))
+        result = await profiler.profile(0.4)
+        await blocker
+
+        doc = result.speedscope()
+        profile = doc["profiles"][0]
+        frame_names = [f["name"] for f in doc["shared"]["frames"]]
+
+        assert profile["type"] == "sampled"
+        assert len(profile["samples"]) == len(profile["weights"])
+        assert all(0 <= i < len(frame_names) for sample in profile["samples"] for i in sample)
+        assert any("blocking_reload" in name for name in frame_names)
@@ -0,0 +1,261 @@
+"""
+Unit tests for token-rate and spend quotas per client key.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import json
+import time
+import functools
+from datetime import datetime
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from fastapi.responses import Response, StreamingResponse
+from starlette.requests import Request
+
+import database
+from database import APIKey
+from quotas import QuotaExceeded, QuotaTracker, quota_exceeded_response, quota_periods
+from idempotency import IdempotencyStore
+from mock_gateway import MockConfig, create_app
+
+# $1 per 1M prompt tokens, $2 per 1M completion tokens
+PRICES = {"test/model": (1.0, 2.0), "test/*": (10.0, 10.0)}
+
+
+def make_key(key_id: str = "key-1", tpm_limit: int = 0, daily: float = 0, monthly: float = 0) -> APIKey:
+    return APIKey(
+        id=key_id, key_hash=key_id, name=key_id, created_at=datetime.now(), expires_at=None,
+        rate_limit=0, is_active=True, tpm_limit=tpm_limit, daily_budget_usd=daily, monthly_budget_usd=monthly
+    )
+
+
+def make_tracker() -> QuotaTracker:
+    return QuotaTracker(prices=PRICES, default_price=(100.0, 100.0))
+
+
+class TestTokenRate:
+    """Test the one-minute token window"""
+
+    def test_keys_without_quotas_are_not_tracked(self):
+        tracker = make_tracker()
+        assert tracker.acquire(make_key(), "test/model", b"x" * 400) is None
+        assert tracker.acquire(None, "test/model", b"x" * 400) is None
+
+    def test_estimate_is_reserved_then_replaced_by_usage(self):
+        tracker = make_tracker()
+        key = make_key(tpm_limit=1000)
+
+        ticket = tracker.acquire(key, "test/model", b"x" * 400)
+        assert ticket.reserved == 100
+        assert tracker.tokens_used(key.id) == 100
+
+        tracker.settle(ticket, {"prompt_tokens": 120, "completion_tokens": 380})
+        assert tracker.tokens_used(key.id) == 500
+
+        # Settling twice does not charge twice
+        tracker.settle(ticket, {"prompt_tokens": 120, "completion_tokens": 380})
+        assert tracker.tokens_used(key.id) == 500
+
+    def test_over_limit_is_rejected_until_the_window_moves(self):
+        tracker = make_tracker()
+        key = make_key(tpm_limit=1000)
+        ticket = tracker.acquire(key, "test/model", b"x" * 400)
+        tracker.settle(ticket, {"prompt_tokens": 100, "completion_tokens": 850})
+
+        with pytest.raises(QuotaExceeded) as e:
+            tracker.acquire(key, "test/model", b"x" * 400)
+        assert e.value.quota == "tpm"
+        assert 1 <= e.value.retry_after <= 61
+
+        tracker.check(key, "test/model", 100, now=time.time() + 61)
+
+    def test_request_larger_than_the_limit_never_fits(self):
+        tracker = make_tracker()
+        key = make_key(tpm_limit=50)
+        with pytest.raises(QuotaExceeded) as e:
+            tracker.acquire(key, "test/model", b"x" * 400)
+        assert e.value.quota == "tpm_request"
+        assert tracker.tokens_used(key.id) == 0
+
+        # Retrying cannot help, so the client is not told to
+        response = quota_exceeded_response(e.value)
+        assert response.status_code == 413
+        assert "retry-after" not in response.headers
+
+    def test_failed_request_frees_the_reservation(self):
+        tracker = make_tracker()
+        key = make_key(tpm_limit=1000)
+        ticket = tracker.acquire(key, "test/model", b"x" * 400)
+        tracker.settle(ticket, None, failed=True)
+        assert tracker.tokens_used(key.id) == 0
+
+
+class TestSpend:
+    """Test daily and monthly budgets"""
+
+    def test_cost_uses_price_list(self):
+        tracker = make_tracker()
+        assert tracker.cost("test/model", 1_000_000, 500_000) == pytest.approx(2.0)
+        assert tracker.cost("test/other", 1_000_000, 0) == pytest.approx(10.0)
+        assert tracker.cost("unknown", 1_000_000, 0) == pytest.approx(100.0)
+
+    def test_daily_budget(self):
+        tracker = make_tracker()
+        key = make_key(daily=0.5)
+
+        ticket = tracker.acquire(key, "test/model", b"x" * 40)
+        tracker.settle(ticket, {"prompt_tokens": 100_000, "completion_tokens": 200_000})
+        assert tracker.spent(key.id)[0] == pytest.approx(0.5)
+
+        with pytest.raises(QuotaExceeded) as e:
+            tracker.acquire(key, "test/model", b"x" * 40)
+        assert e.value.quota == "daily"
+        assert tracker.get_stats()["rejected"] == 1
+
+        response = quota_exceeded_response(e.value)
+        assert response.status_code == 429
+        assert int(response.headers["retry-after"]) <= 86400
+
+    def test_monthly_budget_and_reported_cost(self):
+        tracker = make_tracker()
+        key = make_key(monthly=1.0)
+
+        # A cost reported by the gateway wins over the price list
+        ticket = tracker.acquire(key, "test/model", b"x" * 40)
+        tracker.settle(ticket, {"prompt_tokens": 10, "completion_tokens": 10, "cost": 1.25})
+        assert tracker.spent(key.id) == (pytest.approx(1.25), pytest.approx(1.25))
+
+        with pytest.raises(QuotaExceeded) as e:
+            tracker.acquire(key, "test/model", b"x" * 40)
+        assert e.value.quota == "monthly"
+
+    @pytest.mark.asyncio
+    async def test_spend_is_shared_through_sqlite(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(database, "DATABASE_PATH", str(tmp_path / "lb.db"))
+        await database.init_database()
+        first, second = make_tracker(), make_tracker()
+        key = make_key(daily=10)
+
+        first.settle(first.acquire(key, "test/model", b"x" * 40), {"prompt_tokens": 1_000_000})
+        second.settle(second.acquire(key, "test/model", b"x" * 40), {"prompt_tokens": 2_000_000})
+        await first.sync()
+        await second.sync()
+        await first.sync()
+
+        assert first.spent(key.id)[0] == pytest.approx(3.0)
+        assert second.spent(key.id)[0] == pytest.approx(3.0)
+
+        # A restarted process starts from the stored spend
+        restarted = make_tracker()
+        await restarted.sync()
+        assert restarted.spent(key.id)[0] == pytest.approx(3.0)
+
+    def test_periods_are_utc_days_and_months(self):
+        assert quota_periods(0) == ("1970-01-01", "1970-01")
+
+
+class TestResponseTracking:
+    """Test settling from regular and streamed responses"""
+
+    @pytest.mark.asyncio
+    async def test_regular_response(self):
+        tracker = make_tracker()
+        key = make_key(tpm_limit=10_000)
+        ticket = tracker.acquire(key, "test/model", b"x" * 400)
+
+        body = json.dumps({"usage": {"prompt_tokens": 50, "completion_tokens": 25}}).encode()
+        tracker.track(Response(body), ticket)
+        assert tracker.tokens_used(key.id) == 75
+
+    @pytest.mark.asyncio
+    async def test_stream_usage_chunk_is_settled_and_stripped(self):
+        tracker = make_tracker()
+        key = make_key(tpm_limit=10_000)
+        ticket = tracker.acquire(key, "test/model", b"x" * 400)
+
+        content = b'data: {"choices": [{"delta": {"content": "hi"}}], "usage": null}\n\n'
+        usage = b'data: {"choices": [], "usage": {"prompt_tokens": 30, "completion_tokens": 12}}\n\n'
+
+        async def body():
+            yield content[:20]
+            yield content[20:] + usage[:30]
+            yield usage[30:] + b"data: [DONE]\n\n"
+
+        response = tracker.track(StreamingResponse(body()), ticket, strip_usage=True)
+        chunks = [chunk async for chunk in response.body_iterator]
+
+        assert b"".join(chunks) == content + b"data: [DONE]\n\n"
+        assert tracker.tokens_used(key.id) == 42
+
+    @pytest.mark.asyncio
+    async def test_stream_error_status_frees_the_reservation(self):
+        tracker = make_tracker()
+        key = make_key(tpm_limit=10_000)
+        ticket = tracker.acquire(key, "test/model", b"x" * 400)
+
+        error = b'{"error": {"message": "bad request"}}'
+
+        async def body():
+            yield error
+
+        response = tracker.track(StreamingResponse(body(), status_code=400), ticket)
+        chunks = [chunk async for chunk in response.body_iterator]
+
+        assert b"".join(chunks) == error
+        assert tracker.tokens_used(key.id) == 0
+
+
+class TestProxy:
+    """Test charging quotas only for requests that go upstream"""
+
+    @pytest.mark.asyncio
+    async def test_idempotent_replay_is_not_charged(self, tmp_path, monkeypatch):
+        import server
+
+        monkeypatch.setattr(database, "DATABASE_PATH", str(tmp_path / "lb.db"))
+        await database.init_database()
+        tracker = make_tracker()
+        monkeypatch.setattr(server, "quota_tracker", tracker)
+        monkeypatch.setattr(server, "IDEMPOTENCY_ENABLED", True)
+        monkeypatch.setattr(server, "idempotency_store", IdempotencyStore())
+
+        async def get_key(exclude=None):
+            return "vck_test"
+        monkeypatch.setattr(server.vercel_key_manager, "get_key", get_key)
+        # Upstream calls go to the in-process mock gateway
+        transport = httpx.ASGITransport(app=create_app(MockConfig(completion_tokens=5)))
+        monkeypatch.setattr(httpx, "AsyncClient", functools.partial(httpx.AsyncClient, transport=transport))
+
+        key = make_key(tpm_limit=1000)
+        body = json.dumps({"model": "test/model", "messages": [{"role": "user", "content": "x" * 400}]}).encode()
+
+        async def send():
+            sent = False
+
+            async def receive():
+                nonlocal sent
+                if sent:
+                    return {"type": "http.disconnect"}
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+
+            request = Request({
+                "type": "http", "method": "POST", "path": "/v1/chat/completions", "query_string": b"",
+                "headers": [(b"content-type", b"application/json"), (b"idempotency-key", b"retry-1")],
+                "state": {"api_key": key}
+            }, receive)
+            return await server.proxy("v1/chat/completions", request)
+
+        first = await send()
+        used = tracker.tokens_used(key.id)
+        assert first.status_code == 200 and used > 0
+
+        replay = await send()
+        assert replay.headers["idempotent-replayed"] == "true"
+        assert tracker.tokens_used(key.id) == used
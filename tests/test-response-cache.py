@@ -0,0 +1,99 @@
+"""
+Unit tests for the deterministic response cache.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from response_cache import ResponseCache, is_cacheable, make_cache_key, cache_control_flags
+
+
+@pytest.fixture
+def body():
+    """Fixture for a deterministic chat completion request"""
+    return {
+        "model": "openai/gpt-4o-mini",
+        "messages": [{"role": "user", "content": "Classify: great product"}],
+        "temperature": 0
+    }
+
+
+class TestCacheKey:
+    """Test which requests are cacheable and how they are keyed"""
+
+    def test_only_deterministic_non_stream_requests(self, body):
+        assert is_cacheable("POST", "v1/chat/completions", body, is_stream=False)
+        assert not is_cacheable("POST", "v1/chat/completions", body, is_stream=True)
+        assert not is_cacheable("POST", "v1/chat/completions", {**body, "temperature": 0.7}, is_stream=False)
+        assert not is_cacheable("POST", "v1/chat/completions", {**body, "n": 3}, is_stream=False)
+        assert not is_cacheable("POST", "v1/embeddings", body, is_stream=False)
+        assert not is_cacheable("GET", "v1/chat/completions", body, is_stream=False)
+
+    def test_key_ignores_field_order_and_user(self, body):
+        reordered = dict(reversed(list(body.items())))
+        key = make_cache_key("v1/chat/completions", body, "key-1")
+        assert key == make_cache_key("v1/chat/completions", reordered, "key-1")
+        assert key == make_cache_key("v1/chat/completions", {**body, "user": "someone"}, "key-1")
+
+    def test_key_depends_on_model_and_messages(self, body):
+        key = make_cache_key("v1/chat/completions", body, "key-1")
+        assert key != make_cache_key("v1/chat/completions", {**body, "model": "openai/gpt-4o"}, "key-1")
+        assert key != make_cache_key("v1/chat/completions", {**body, "messages": []}, "key-1")
+
+    def test_key_is_scoped_to_the_client_key(self, body):
+        key = make_cache_key("v1/chat/completions", body, "key-1", shared=False)
+        assert key != make_cache_key("v1/chat/completions", body, "key-2", shared=False)
+        # Opting in to sharing gives every client key the same entry
+        assert make_cache_key("v1/chat/completions", body, "key-1", shared=True) == make_cache_key(
+            "v1/chat/completions", body, "key-2", shared=True
+        )
+
+    def test_cache_control_flags(self):
+        assert cache_control_flags(None) == (False, False)
+        assert cache_control_flags("no-cache") == (True, False)
+        assert cache_control_flags("No-Cache, no-store") == (True, True)
+
+
+class TestResponseCache:
+    """Test the memory and disk tiers"""
+
+    @pytest.mark.asyncio
+    async def test_memory_hit_and_miss(self):
+        cache = ResponseCache(ttl=60, max_entries=10, db_path=None)
+        assert await cache.get("k") is None
+        await cache.set("k", 200, "application/json", b"{}")
+        entry = await cache.get("k")
+        assert entry.body == b"{}"
+        assert cache.hits == 1 and cache.misses == 1
+
+    @pytest.mark.asyncio
+    async def test_lru_eviction(self):
+        cache = ResponseCache(ttl=60, max_entries=2, db_path=None)
+        await cache.set("a", 200, "application/json", b"a")
+        await cache.set("b", 200, "application/json", b"b")
+        await cache.get("a")
+        await cache.set("c", 200, "application/json", b"c")
+        assert await cache.get("b") is None
+        assert (await cache.get("a")).body == b"a"
+
+    @pytest.mark.asyncio
+    async def test_expired_entries_are_dropped(self):
+        cache = ResponseCache(ttl=-1, max_entries=10, db_path=None)
+        await cache.set("k", 200, "application/json", b"{}")
+        assert await cache.get("k") is None
+
+    @pytest.mark.asyncio
+    async def test_disk_tier_survives_new_instance(self, tmp_path):
+        db_path = str(tmp_path / "cache.db")
+        cache = ResponseCache(ttl=60, max_entries=10, db_path=db_path)
+        await cache.init()
+        await cache.set("k", 200, "application/json", b'{"ok": true}')
+
+        restarted = ResponseCache(ttl=60, max_entries=10, db_path=db_path)
+        await restarted.init()
+        entry = await restarted.get("k")
+        assert entry is not None
+        assert entry.body == b'{"ok": true}'
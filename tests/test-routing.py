@@ -0,0 +1,36 @@
+"""
+Unit tests for Vercel key selection.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from routing import select_weighted_random
+
+
+def make_keys(*balances) -> list:
+    return [{"name": f"k{i}", "api_key": f"vck_{i}", "balance": b} for i, b in enumerate(balances)]
+
+
+class TestWeightedRandom:
+    """Test balance-weighted key selection"""
+
+    def test_skips_low_balance_and_excluded_keys(self):
+        keys = make_keys(0.005, 10.0, 5.0)
+        for _ in range(50):
+            chosen = select_weighted_random(keys, exclude={"vck_1"})
+            assert chosen["api_key"] == "vck_2"
+
+    def test_no_available_key(self):
+        assert select_weighted_random(make_keys(0.0, 0.01)) is None
+        assert select_weighted_random(make_keys(5.0), exclude={"vck_0"}) is None
+
+    def test_selection_follows_balance(self):
+        random.seed(7)
+        keys = make_keys(1.0, 9.0)
+        picks = [select_weighted_random(keys)["api_key"] for _ in range(2000)]
+        share = picks.count("vck_1") / len(picks)
+        assert 0.85 < share < 0.95
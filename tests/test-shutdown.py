@@ -0,0 +1,81 @@
+"""
+Unit tests for graceful shutdown and stream draining.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from shutdown import DrainController, SHUTDOWN_EVENT
+
+
+async def slow_stream(chunks: int, interval: float, closed: list):
+    try:
+        for i in range(chunks):
+            await asyncio.sleep(interval)
+            yield f"data: {i}\n\n".encode()
+    finally:
+        closed.append(True)
+
+
+async def collect(stream) -> list:
+    return [chunk async for chunk in stream]
+
+
+class TestDrainController:
+    """Test draining state and the stream deadline"""
+
+    @pytest.mark.asyncio
+    async def test_streams_pass_through_when_not_draining(self):
+        drain = DrainController()
+        closed = []
+        chunks = await collect(drain.track_stream(slow_stream(3, 0, closed)))
+        assert chunks == [b"data: 0\n\n", b"data: 1\n\n", b"data: 2\n\n"]
+        assert closed == [True]
+        assert drain.active_streams == 0
+
+    @pytest.mark.asyncio
+    async def test_stream_finishing_before_deadline_is_untouched(self):
+        drain = DrainController(drain_delay=0, stream_deadline=1)
+        closed = []
+        stream = drain.track_stream(slow_stream(3, 0.01, closed))
+        drain.begin_drain(lambda: None)
+        chunks = await collect(stream)
+        assert len(chunks) == 3 and SHUTDOWN_EVENT not in chunks
+        assert drain.streams_cut == 0
+
+    @pytest.mark.asyncio
+    async def test_stream_is_ended_at_deadline(self):
+        drain = DrainController(drain_delay=0.05, stream_deadline=0.1)
+        stopped = []
+        closed = []
+        stream = drain.track_stream(slow_stream(100, 0.03, closed))
+
+        drain.begin_drain(lambda: stopped.append(True))
+        assert drain.draining and drain.get_stats()["active_streams"] == 0
+        chunks = await collect(stream)
+
+        assert stopped == [True]
+        assert chunks[-1] == SHUTDOWN_EVENT
+        assert 2 <= len(chunks) < 100
+        # The upstream side of the stream is closed too
+        assert closed == [True]
+        assert drain.streams_cut == 1 and drain.active_streams == 0
+
+    @pytest.mark.asyncio
+    async def test_wait_for_pending_work(self):
+        drain = DrainController()
+        pending = [3]
+
+        async def finish():
+            while pending[0]:
+                await asyncio.sleep(0.01)
+                pending[0] -= 1
+
+        task = asyncio.create_task(finish())
+        assert await drain.wait_for(lambda: pending[0], timeout=1) == 0
+        await task
+        assert await drain.wait_for(lambda: 1, timeout=0.05) == 1
@@ -0,0 +1,180 @@
+"""
+Unit tests for single-flight coalescing of identical requests.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import asyncio
+import pytest
+from fastapi.responses import Response, StreamingResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from singleflight import SingleFlight, StreamBroadcast, make_flight_key
+
+
+async def read_body(response):
+    if isinstance(response, StreamingResponse):
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return response.body
+
+
+class TestFlightKey:
+    """Test request hashing"""
+
+    def test_same_body_same_key(self):
+        a = make_flight_key("v1/chat/completions", "", {"model": "m", "stream": True}, "client-1")
+        b = make_flight_key("v1/chat/completions", "", {"stream": True, "model": "m"}, "client-1")
+        assert a == b
+
+    def test_client_key_is_part_of_the_key(self):
+        a = make_flight_key("v1/chat/completions", "", {"model": "m"}, "client-1")
+        b = make_flight_key("v1/chat/completions", "", {"model": "m"}, "client-2")
+        assert a != b
+
+
+class TestSingleFlight:
+    """Test sharing of upstream calls"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_duplicates_share_one_call(self):
+        flights = SingleFlight()
+        calls = 0
+
+        async def upstream():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return Response(content=b'{"ok": true}', media_type="application/json")
+
+        responses = await asyncio.gather(*[flights.run("k", upstream) for _ in range(5)])
+
+        assert calls == 1
+        assert flights.collapsed == 4
+        assert all(r.body == b'{"ok": true}' for r in responses)
+
+    @pytest.mark.asyncio
+    async def test_sequential_requests_are_not_collapsed(self):
+        flights = SingleFlight()
+        calls = 0
+
+        async def upstream():
+            nonlocal calls
+            calls += 1
+            return Response(content=b"{}")
+
+        await flights.run("k", upstream)
+        await flights.run("k", upstream)
+        assert calls == 2
+
+    @pytest.mark.asyncio
+    async def test_streaming_duplicates_fan_out(self):
+        flights = SingleFlight()
+        calls = 0
+
+        async def upstream():
+            nonlocal calls
+            calls += 1
+
+            async def gen():
+                for i in range(3):
+                    await asyncio.sleep(0.01)
+                    yield f"data: {i}\n\n".encode()
+
+            await asyncio.sleep(0.02)
+            return StreamingResponse(gen(), media_type="text/event-stream")
+
+        responses = await asyncio.gather(*[flights.run("k", upstream) for _ in range(3)])
+        bodies = await asyncio.gather(*[read_body(r) for r in responses])
+
+        assert calls == 1
+        assert flights.collapsed_streams == 2
+        assert bodies == [b"data: 0\n\ndata: 1\n\ndata: 2\n\n"] * 3
+
+
+    @pytest.mark.asyncio
+    async def test_stream_stops_when_the_leader_disconnects_first(self):
+        flights = SingleFlight(replay_bytes=10)
+        produced = 0
+        started = asyncio.Event()
+
+        async def upstream():
+            async def gen():
+                nonlocal produced
+                for _ in range(1000):
+                    produced += 1
+                    yield b"x" * 10
+                    await asyncio.sleep(0.001)
+
+            await started.wait()
+            return StreamingResponse(gen(), media_type="text/event-stream")
+
+        leader = asyncio.ensure_future(flights.run("k", upstream))
+        await asyncio.sleep(0)
+        # The client goes away while the upstream call is still starting
+        leader.cancel()
+        started.set()
+        await asyncio.sleep(0.05)
+
+        assert produced < 50
+        assert flights.get_stats()["in_flight"] == 0
+
+    @pytest.mark.asyncio
+    async def test_unread_response_gives_up_its_place(self):
+        flights = SingleFlight(replay_bytes=10)
+        produced = 0
+
+        async def upstream():
+            async def gen():
+                nonlocal produced
+                for _ in range(1000):
+                    produced += 1
+                    yield b"x" * 10
+                    await asyncio.sleep(0.001)
+
+            return StreamingResponse(gen(), media_type="text/event-stream")
+
+        response = await flights.run("k", upstream)
+        # The body is never iterated; Starlette still runs the background task
+        await response.background()
+        await asyncio.sleep(0.05)
+
+        assert produced < 50
+
+
+class TestStreamBroadcast:
+    """Test the bounded replay buffer"""
+
+    @pytest.mark.asyncio
+    async def test_late_subscriber_replays_from_start(self):
+        release = asyncio.Event()
+
+        async def source():
+            yield b"a"
+            await release.wait()
+            yield b"b"
+
+        broadcast = StreamBroadcast(source(), replay_bytes=1024)
+        first = broadcast.subscribe()
+        assert await first.__anext__() == b"a"
+
+        assert broadcast.accepting
+        second = broadcast.subscribe()
+        release.set()
+
+        assert [c async for c in first] == [b"b"]
+        assert [c async for c in second] == [b"a", b"b"]
+
+    @pytest.mark.asyncio
+    async def test_stops_accepting_after_replay_limit(self):
+        async def source():
+            for _ in range(4):
+                yield b"x" * 10
+                await asyncio.sleep(0)
+
+        broadcast = StreamBroadcast(source(), replay_bytes=15)
+        reader = broadcast.subscribe()
+        chunks = [c async for c in reader]
+
+        assert chunks == [b"x" * 10] * 4
+        assert not broadcast.accepting
@@ -0,0 +1,111 @@
+"""
+Unit tests for SSE write coalescing.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sse import coalesce_sse
+
+
+async def timed_source(items):
+    """Yield (delay_seconds, chunk) pairs."""
+    for delay, chunk in items:
+        await asyncio.sleep(delay)
+        yield chunk
+
+
+async def collect(gen):
+    return [chunk async for chunk in gen]
+
+
+class TestCoalesceSSE:
+    """Test chunk merging and event boundaries"""
+
+    @pytest.mark.asyncio
+    async def test_disabled_passes_chunks_through(self):
+        chunks = [(0, b"data: a\n\n"), (0, b"data: b\n\n")]
+        out = await collect(coalesce_sse(timed_source(chunks), window_ms=0))
+        assert out == [b"data: a\n\n", b"data: b\n\n"]
+
+    @pytest.mark.asyncio
+    async def test_chunks_within_window_are_merged(self):
+        chunks = [(0, b"data: a\n\n"), (0, b"data: b\n\n"), (0, b"data: c\n\n")]
+        out = await collect(coalesce_sse(timed_source(chunks), window_ms=50))
+        assert out == [b"data: a\n\ndata: b\n\ndata: c\n\n"]
+
+    @pytest.mark.asyncio
+    async def test_chunks_outside_window_are_separate(self):
+        chunks = [(0, b"data: a\n\n"), (0.1, b"data: b\n\n")]
+        out = await collect(coalesce_sse(timed_source(chunks), window_ms=10))
+        assert out == [b"data: a\n\n", b"data: b\n\n"]
+
+    @pytest.mark.asyncio
+    async def test_partial_event_is_not_flushed(self):
+        chunks = [(0, b"data: a\n\ndata: {\"par"), (0.1, b"tial\": 1}\n\n")]
+        out = await collect(coalesce_sse(timed_source(chunks), window_ms=10))
+        assert out == [b"data: a\n\n", b'data: {"partial": 1}\n\n']
+
+    @pytest.mark.asyncio
+    async def test_size_limit_flushes_before_window(self):
+        chunks = [(0, b"data: aaaa\n\n"), (0, b"data: bbbb\n\n"), (0.2, b"data: c\n\n")]
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        gen = coalesce_sse(timed_source(chunks), window_ms=1000, max_bytes=16)
+        first = await gen.__anext__()
+        assert loop.time() - start < 0.5
+        assert first == b"data: aaaa\n\ndata: bbbb\n\n"
+        assert await collect(gen) == [b"data: c\n\n"]
+
+    @pytest.mark.asyncio
+    async def test_upstream_error_is_raised_after_flush(self):
+        async def failing():
+            yield b"data: a\n\n"
+            raise RuntimeError("upstream broke")
+
+        gen = coalesce_sse(failing(), window_ms=10)
+        assert await gen.__anext__() == b"data: a\n\n"
+        with pytest.raises(RuntimeError):
+            await gen.__anext__()
+
+    @pytest.mark.asyncio
+    async def test_slow_client_pauses_upstream_reads(self):
+        produced = 0
+
+        async def fast_source():
+            nonlocal produced
+            for _ in range(1000):
+                await asyncio.sleep(0)
+                produced += 1
+                yield b"data: xxxxxx\n\n"
+
+        gen = coalesce_sse(fast_source(), window_ms=10, max_bytes=64)
+        first = await gen.__anext__()
+        # The client stops reading; the upstream must not be drained into memory
+        await asyncio.sleep(0.1)
+        assert produced * 14 <= len(first) + 2 * 64
+        rest = await collect(gen)
+        assert len(first) + sum(len(c) for c in rest) == 1000 * 14
+
+    @pytest.mark.asyncio
+    async def test_window_expiring_during_a_slow_write_still_flushes(self):
+        async def steady_source():
+            for i in range(100):
+                await asyncio.sleep(0.002)
+                yield b"data: %d\n\n" % i
+
+        loop = asyncio.get_running_loop()
+        gen = coalesce_sse(steady_source(), window_ms=5, max_bytes=1 << 20)
+        await gen.__anext__()
+        # A slow client write: the window runs out while the consumer is away
+        await asyncio.sleep(0.05)
+        await gen.__anext__()
+        started = loop.time()
+        second = await gen.__anext__()
+        assert loop.time() - started < 0.05
+        assert len(second) < 200
+        await gen.aclose()
@@ -0,0 +1,132 @@
+"""
+Unit tests for the rate limit / auth cache state backends.
+Runs offline - the Redis backend is tested against fakeredis (skipped if not installed).
+"""
+import os
+import sys
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import database
+from database import APIKey
+from state_backend import MemoryStateBackend, RedisStateBackend
+
+
+def make_key(key_id: str = "key-1", expires_at=None) -> APIKey:
+    return APIKey(
+        id=key_id, key_hash=f"hash-{key_id}", name=key_id, created_at=datetime.now(),
+        expires_at=expires_at, rate_limit=3, is_active=True
+    )
+
+
+async def wait_for(condition, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condition not reached")
+        await asyncio.sleep(0.01)
+
+
+class TestAuthCache:
+    """Test the per-process auth cache"""
+
+    @pytest.mark.asyncio
+    async def test_cached_key_until_invalidated(self):
+        backend = MemoryStateBackend(auth_cache_ttl=60)
+        assert backend.get_cached_key("hash-key-1") is None
+
+        backend.cache_key("hash-key-1", make_key())
+        assert backend.get_cached_key("hash-key-1").id == "key-1"
+
+        await backend.invalidate_key("key-1")
+        assert backend.get_cached_key("hash-key-1") is None
+        assert backend.get_stats()["auth_cache_hits"] == 1
+
+    def test_expired_key_is_not_served_from_cache(self):
+        backend = MemoryStateBackend(auth_cache_ttl=60)
+        backend.cache_key("hash-key-1", make_key(expires_at=datetime.now() - timedelta(seconds=1)))
+        assert backend.get_cached_key("hash-key-1") is None
+
+    def test_zero_ttl_disables_cache(self):
+        backend = MemoryStateBackend(auth_cache_ttl=0)
+        backend.cache_key("hash-key-1", make_key())
+        assert backend.get_cached_key("hash-key-1") is None
+
+
+class TestMemoryRateLimit:
+    """Test the default backend counting the SQLite usage log"""
+
+    @pytest.mark.asyncio
+    async def test_limit_from_usage_log(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(database, "DATABASE_PATH", str(tmp_path / "lb.db"))
+        await database.init_database()
+        backend = MemoryStateBackend()
+
+        for _ in range(2):
+            await database.log_usage("key-1", "v1/chat/completions")
+        assert await backend.check_rate_limit("key-1", 3) == (True, 2)
+
+        await database.log_usage("key-1", "v1/chat/completions")
+        assert await backend.check_rate_limit("key-1", 3) == (False, 3)
+
+
+@pytest.fixture
+def replicas():
+    """Two Redis backends sharing one fake server, like two proxy replicas."""
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    return [
+        RedisStateBackend(auth_cache_ttl=60, client=fakeredis.FakeAsyncRedis(server=server))
+        for _ in range(2)
+    ]
+
+
+class TestRedisBackend:
+    """Test rate limits and invalidations shared between replicas"""
+
+    @pytest.mark.asyncio
+    async def test_sliding_window_is_shared(self, replicas):
+        first, second = replicas
+
+        results = [await first.check_rate_limit("key-1", 3, window_seconds=1) for _ in range(2)]
+        results.append(await second.check_rate_limit("key-1", 3, window_seconds=1))
+        assert results == [(True, 0), (True, 1), (True, 2)]
+
+        # Rejected requests are not recorded, so they do not extend the block
+        assert await first.check_rate_limit("key-1", 3, window_seconds=1) == (False, 3)
+        assert await second.check_rate_limit("key-1", 3, window_seconds=1) == (False, 3)
+        assert await first.check_rate_limit("key-2", 3, window_seconds=1) == (True, 0)
+
+        await asyncio.sleep(1.1)
+        assert await second.check_rate_limit("key-1", 3, window_seconds=1) == (True, 0)
+
+    @pytest.mark.asyncio
+    async def test_concurrent_checks_never_exceed_limit(self, replicas):
+        results = await asyncio.gather(*[
+            replica.check_rate_limit("key-1", 5, window_seconds=60)
+            for replica in replicas for _ in range(10)
+        ])
+        assert sum(allowed for allowed, _ in results) == 5
+
+    @pytest.mark.asyncio
+    async def test_invalidation_reaches_other_replicas(self, replicas):
+        first, second = replicas
+        await first.start()
+        await second.start()
+        try:
+            first.cache_key("hash-key-1", make_key())
+            first.cache_key("hash-key-2", make_key("key-2"))
+
+            await second.invalidate_key("key-1")
+
+            await wait_for(lambda: first.invalidations_received == 1)
+            assert first.get_cached_key("hash-key-1") is None
+            assert first.get_cached_key("hash-key-2") is not None
+        finally:
+            await first.stop()
+            await second.stop()
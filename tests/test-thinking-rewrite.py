@@ -0,0 +1,83 @@
+"""
+Unit tests for the -thinking request rewrite and <think> tag stream transform.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import json
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from thinking import ThinkTagRewriter, rewrite_thinking_request, rewrite_thinking_stream
+
+
+def sse(delta: dict) -> str:
+    return "data: " + json.dumps({"choices": [{"index": 0, "delta": delta}]})
+
+
+def contents(output: bytes) -> list:
+    """Content deltas of every event in `output`."""
+    events = [e[6:] for e in output.decode("utf-8").split("\n\n") if e.startswith("data: {")]
+    return [json.loads(e)["choices"][0]["delta"].get("content") for e in events]
+
+
+async def lines_of(items):
+    for item in items:
+        yield item
+
+
+class TestRequestRewrite:
+    """Test the -thinking model alias"""
+
+    def test_thinking_model_is_rewritten(self):
+        data = {"model": "anthropic/claude-sonnet-4.5-thinking", "messages": []}
+        assert rewrite_thinking_request(data) is True
+        assert data["model"] == "anthropic/claude-sonnet-4.5"
+        assert data["reasoning"] == {"effort": "medium", "enabled": True}
+
+    def test_other_models_are_untouched(self):
+        data = {"model": "openai/gpt-4o", "messages": []}
+        assert rewrite_thinking_request(data) is False
+        assert data == {"model": "openai/gpt-4o", "messages": []}
+        assert rewrite_thinking_request({"model": None}) is False
+
+
+class TestThinkTagRewriter:
+    """Test wrapping reasoning deltas in <think> tags"""
+
+    def test_reasoning_then_content(self):
+        rewriter = ThinkTagRewriter()
+        output = b"".join(rewriter.feed(line) for line in [
+            sse({"role": "assistant", "content": ""}),
+            "",
+            sse({"reasoning": "step one "}),
+            sse({"reasoning_content": "step two"}),
+            sse({"content": "answer"}),
+            "data: [DONE]",
+        ])
+
+        assert contents(output) == ["", "<think>", "step one ", "step two", "</think>", "answer"]
+        assert output.endswith(b"data: [DONE]\n\n")
+
+    def test_unclosed_block_is_closed_at_done(self):
+        rewriter = ThinkTagRewriter()
+        output = rewriter.feed(sse({"reasoning": "hmm"})) + rewriter.feed("data: [DONE]")
+        assert contents(output) == ["<think>", "hmm", "</think>"]
+
+    def test_reasoning_fields_are_kept(self):
+        out = ThinkTagRewriter().feed(sse({"reasoning": "hmm"}))
+        last = json.loads(out.decode("utf-8").split("\n\n")[-2][6:])
+        assert last["choices"][0]["delta"] == {"reasoning": "hmm", "content": "hmm"}
+
+    def test_passthrough(self):
+        rewriter = ThinkTagRewriter()
+        assert rewriter.feed(": keep-alive") == b": keep-alive\n\n"
+        assert rewriter.feed("data: not json") == b"data: not json\n\n"
+        assert rewriter.feed('data: {"choices": []}') == b'data: {"choices": []}\n\n'
+        assert rewriter.feed("   ") == b""
+
+    @pytest.mark.asyncio
+    async def test_stream(self):
+        chunks = [c async for c in rewrite_thinking_stream(lines_of([sse({"reasoning": "a"}), "", sse({"content": "b"})]))]
+        assert contents(b"".join(chunks)) == ["<think>", "a", "</think>", "b"]
@@ -0,0 +1,171 @@
+"""
+Unit tests for per-request tracing.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import json
+import asyncio
+import logging
+import threading
+import contextvars
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import tracing
+from tracing import span, start_trace, finish_trace, finish_after_body, current_trace
+
+
+def capture_trace_log(monkeypatch) -> list:
+    """Collect records written by the tracing logger."""
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    test_logger = logging.getLogger("test.tracing")
+    test_logger.setLevel(logging.INFO)
+    monkeypatch.setattr(test_logger, "handlers", [handler])
+    monkeypatch.setattr(tracing, "logger", test_logger)
+    return records
+
+
+def run_in_new_context(fn):
+    """Run fn in a fresh context so traces don't leak between tests."""
+    return contextvars.Context().run(fn)
+
+
+class TestSpans:
+    """Test span recording and nesting"""
+
+    def test_span_outside_trace_is_noop(self):
+        def body():
+            with span("get_key") as s:
+                assert s is None
+            return current_trace()
+
+        assert run_in_new_context(body) is None
+
+    def test_nested_spans_have_parents(self):
+        def body():
+            trace = start_trace("POST", "/v1/chat/completions")
+            with span("auth") as auth:
+                with span("validate_key") as validate:
+                    pass
+            with span("get_key") as get_key:
+                pass
+            return trace, auth, validate, get_key
+
+        trace, auth, validate, get_key = run_in_new_context(body)
+        assert auth.parent_id == trace.root.span_id
+        assert validate.parent_id == auth.span_id
+        assert get_key.parent_id == trace.root.span_id
+        assert all(s.end_ns is not None for s in trace.spans)
+
+    @pytest.mark.asyncio
+    async def test_spans_from_child_tasks_attach_to_trace(self):
+        async def body():
+            trace = start_trace("POST", "/v1/embeddings")
+
+            async def endpoint():
+                with span("upstream"):
+                    await asyncio.sleep(0)
+
+            await asyncio.create_task(endpoint())
+            return trace
+
+        trace = await asyncio.create_task(body(), context=contextvars.Context())
+        assert [s.name for s in trace.spans] == ["upstream"]
+
+    def test_server_timing_sums_spans_by_name(self):
+        def body():
+            trace = start_trace("POST", "/v1/chat/completions")
+            for _ in range(2):
+                with span("log_usage"):
+                    pass
+            return trace
+
+        header = run_in_new_context(body).server_timing()
+        assert header.count("log_usage;dur=") == 1
+        assert "total;dur=" in header
+
+
+class TestTraceExport:
+    """Test the sampled JSON log and the OTLP file exporter"""
+
+    def test_sampled_trace_is_logged_and_exported(self, tmp_path, monkeypatch):
+        records = capture_trace_log(monkeypatch)
+        otlp_file = tmp_path / "traces.jsonl"
+        monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 1.0)
+        monkeypatch.setattr(tracing, "TRACE_OTLP_FILE", str(otlp_file))
+
+        def body():
+            trace = start_trace("POST", "/v1/chat/completions")
+            with span("upstream", model="openai/gpt-4o"):
+                pass
+            finish_trace(trace, 200)
+            return trace
+
+        trace = run_in_new_context(body)
+        tracing.otlp_exporter.stop()
+
+        log = records[0].trace
+        assert log["trace_id"] == trace.trace_id
+        assert log["status"] == 200
+        assert log["spans"][0]["name"] == "upstream"
+
+        exported = json.loads(otlp_file.read_text().strip())
+        spans = exported["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        assert [s["name"] for s in spans] == ["request", "upstream"]
+        assert spans[1]["parentSpanId"] == spans[0]["spanId"]
+        assert int(spans[0]["endTimeUnixNano"]) >= int(spans[0]["startTimeUnixNano"])
+
+    @pytest.mark.asyncio
+    async def test_export_file_is_written_off_the_event_loop(self, tmp_path, monkeypatch):
+        capture_trace_log(monkeypatch)
+        otlp_file = tmp_path / "traces.jsonl"
+        monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 1.0)
+        monkeypatch.setattr(tracing, "TRACE_OTLP_FILE", str(otlp_file))
+
+        opened_on = []
+
+        def recording_open(*args, **kwargs):
+            opened_on.append(threading.get_ident())
+            return open(*args, **kwargs)
+
+        monkeypatch.setattr(tracing, "open", recording_open, raising=False)
+
+        async def body():
+            for _ in range(3):
+                finish_trace(start_trace("POST", "/v1/chat/completions"), 200)
+
+        await asyncio.create_task(body(), context=contextvars.Context())
+        tracing.otlp_exporter.stop()
+
+        assert opened_on
+        assert threading.get_ident() not in opened_on
+        assert len(otlp_file.read_text().splitlines()) == 3
+
+    def test_unsampled_trace_is_not_logged(self, monkeypatch):
+        records = capture_trace_log(monkeypatch)
+        monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 0.0)
+        monkeypatch.setattr(tracing, "TRACE_SLOW_MS", 0)
+
+        def body():
+            finish_trace(start_trace("GET", "/v1/models"), 200)
+
+        run_in_new_context(body)
+        assert records == []
+
+    @pytest.mark.asyncio
+    async def test_streamed_body_finishes_trace(self, monkeypatch):
+        monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 0.0)
+        trace = run_in_new_context(lambda: start_trace("POST", "/v1/chat/completions"))
+
+        async def gen():
+            yield b"data: 1\n\n"
+
+        body = finish_after_body(trace, gen(), 200)
+        assert not trace.finished
+        assert [chunk async for chunk in body] == [b"data: 1\n\n"]
+        assert trace.finished
+        assert trace.root.attributes["http.status_code"] == 200
@@ -0,0 +1,97 @@
+"""
+Unit tests for the traffic recorder.
+Runs offline - no server or Vercel keys needed.
+"""
+import os
+import sys
+import json
+import time
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi.responses import Response, StreamingResponse
+
+from traffic_recorder import TrafficRecorder, request_shape
+
+
+def read_records(path) -> list:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+async def token_stream():
+    for i in range(3):
+        yield f"data: {i}\n\n".encode("utf-8")
+
+
+class TestRequestShape:
+    """Test that recorded shapes keep sizes and flags but no content"""
+
+    def test_shape_is_sanitized(self):
+        data = {
+            "model": "anthropic/claude-sonnet-4.5",
+            "messages": [{"role": "user", "content": "secret prompt"}],
+            "stream": True,
+            "max_tokens": 100
+        }
+        shape = request_shape("POST", "v1/chat/completions", data, "anthropic/claude-sonnet-4.5-thinking", 120, "key-id-1")
+
+        assert shape["path"] == "/v1/chat/completions"
+        assert shape["model"] == "anthropic/claude-sonnet-4.5-thinking"
+        assert shape["stream"] is True
+        assert shape["think"] is True
+        assert shape["in"] == 120
+        assert shape["msgs"] == 1
+        assert shape["max_tokens"] == 100
+        assert len(shape["key"]) == 8
+        assert "secret prompt" not in json.dumps(shape)
+        assert "key-id-1" not in json.dumps(shape)
+
+    def test_shape_without_json_body(self):
+        shape = request_shape("GET", "v1/models", None, None, 0, None)
+        assert shape["model"] is None
+        assert shape["stream"] is False
+        assert shape["key"] is None
+
+
+class TestTrafficRecorder:
+    """Test response tracking and the background writer"""
+
+    @pytest.mark.asyncio
+    async def test_records_plain_and_streaming_responses(self, tmp_path):
+        path = tmp_path / "traffic.jsonl"
+        recorder = TrafficRecorder(path=str(path), sample_rate=1.0)
+        recorder.start()
+        assert recorder.should_record()
+
+        shape = request_shape("POST", "v1/chat/completions", {"model": "m"}, "m", 10, "k")
+        recorder.track(Response(content=b"hello", status_code=429), shape, time.perf_counter())
+
+        response = recorder.track(StreamingResponse(token_stream()), {**shape, "stream": True}, time.perf_counter())
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        recorder.stop()
+
+        plain, streamed = read_records(path)
+        assert plain["status"] == 429
+        assert plain["out"] == 5
+        assert streamed["status"] == 200
+        assert streamed["out"] == len(body)
+        assert streamed["ttfb_ms"] <= streamed["ms"]
+        assert recorder.get_stats()["recorded"] == 2
+
+    def test_disabled_and_sampled_out(self, tmp_path):
+        assert not TrafficRecorder(path="").should_record()
+
+        recorder = TrafficRecorder(path=str(tmp_path / "traffic.jsonl"), sample_rate=0.0)
+        recorder.start()
+        assert not recorder.should_record()
+        recorder.stop()
+
+    def test_full_queue_drops_records(self, tmp_path):
+        recorder = TrafficRecorder(path=str(tmp_path / "traffic.jsonl"), queue_size=1)
+        shape = request_shape("POST", "v1/embeddings", {}, None, 0, None)
+        # Not started, so nothing drains the queue
+        recorder.track(Response(content=b"a"), shape, time.perf_counter())
+        recorder.track(Response(content=b"b"), shape, time.perf_counter())
+        assert recorder.dropped == 1
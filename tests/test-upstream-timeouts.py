@@ -0,0 +1,224 @@
+"""
+Unit tests for phase-specific upstream timeouts.
+Runs offline against httpx.MockTransport and a local socket - no server or Vercel keys needed.
+"""
+import os
+import sys
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from upstream import (
+    UpstreamTimeouts, TTFBTimeout, IdleTimeout, resolve_timeouts, send_with_ttfb,
+    iter_lines, iter_with_idle_timeout, prepend_chunk
+)
+
+
+class SlowStream(httpx.AsyncByteStream):
+    """Async byte stream that waits before each chunk."""
+
+    def __init__(self, chunks, delays):
+        self.chunks = chunks
+        self.delays = delays
+
+    async def __aiter__(self):
+        for chunk, delay in zip(self.chunks, self.delays):
+            await asyncio.sleep(delay)
+            yield chunk
+
+
+def make_client(chunks, delays, header_delay=0.0):
+    async def handler(request):
+        await asyncio.sleep(header_delay)
+        return httpx.Response(200, stream=SlowStream(chunks, delays))
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+@asynccontextmanager
+async def slow_server(header_delay, chunks, delays):
+    """
+    Plain HTTP/1.1 server on a local socket that waits before the headers and before each
+    chunk. MockTransport does not enforce httpx timeouts, this does. Yields the URL.
+    """
+    handlers = set()
+
+    async def handle(reader, writer):
+        handlers.add(asyncio.current_task())
+        await reader.readuntil(b"\r\n\r\n")
+        try:
+            await asyncio.sleep(header_delay)
+            writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+            for chunk, delay in zip(chunks, delays):
+                await asyncio.sleep(delay)
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{port}/v1/chat/completions"
+    finally:
+        server.close()
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await server.wait_closed()
+
+
+class TestResolveTimeouts:
+    """Test per-model override resolution"""
+
+    def test_defaults_differ_for_streaming(self):
+        stream = resolve_timeouts("openai/gpt-4o", is_stream=True, overrides={})
+        non_stream = resolve_timeouts("openai/gpt-4o", is_stream=False, overrides={})
+        assert non_stream.ttfb >= stream.ttfb
+
+    def test_exact_override_wins_over_prefix(self):
+        overrides = {
+            "openai/*": {"ttfb": 30},
+            "openai/o3": {"ttfb": 180, "idle": 90},
+        }
+        t = resolve_timeouts("openai/o3", is_stream=True, overrides=overrides)
+        assert t.ttfb == 180
+        assert t.idle == 90
+
+        t = resolve_timeouts("openai/gpt-4o", is_stream=True, overrides=overrides)
+        assert t.ttfb == 30
+
+    def test_non_stream_override_key(self):
+        overrides = {"anthropic/*": {"non_stream_ttfb": 600}}
+        t = resolve_timeouts("anthropic/claude-sonnet-4.5", is_stream=False, overrides=overrides)
+        assert t.ttfb == 600
+
+
+class TestSendWithTTFB:
+    """Test the time-to-first-byte deadline"""
+
+    @pytest.mark.asyncio
+    async def test_first_chunk_within_deadline(self):
+        client = make_client([b"data: a\n\n", b"data: b\n\n"], [0.0, 0.0])
+        timeouts = UpstreamTimeouts(connect=1, ttfb=1, idle=1)
+        async with client:
+            request = client.build_request("POST", "https://gateway.test/v1/chat/completions")
+            resp, first, rest = await send_with_ttfb(client, request, timeouts, stream=True)
+            body = b"".join([chunk async for chunk in prepend_chunk(first, rest)])
+            await resp.aclose()
+        assert body == b"data: a\n\ndata: b\n\n"
+
+    @pytest.mark.asyncio
+    async def test_slow_first_chunk_raises(self):
+        client = make_client([b"data: a\n\n"], [0.5])
+        timeouts = UpstreamTimeouts(connect=1, ttfb=0.05, idle=1)
+        async with client:
+            request = client.build_request("POST", "https://gateway.test/v1/chat/completions")
+            with pytest.raises(TTFBTimeout):
+                await send_with_ttfb(client, request, timeouts, stream=True)
+
+    @pytest.mark.asyncio
+    async def test_slow_headers_raise_for_non_stream(self):
+        client = make_client([b"{}"], [0.0], header_delay=0.5)
+        timeouts = UpstreamTimeouts(connect=1, ttfb=0.05, idle=1)
+        async with client:
+            request = client.build_request("POST", "https://gateway.test/v1/chat/completions")
+            with pytest.raises(TTFBTimeout):
+                await send_with_ttfb(client, request, timeouts, stream=False)
+
+
+class TestIdleTimeout:
+    """Test the per-chunk idle deadline"""
+
+    @pytest.mark.asyncio
+    async def test_slow_consumer_does_not_count_as_idle(self):
+        async def chunks():
+            for i in range(3):
+                await asyncio.sleep(0)
+                yield bytes([i])
+
+        received = []
+        async for chunk in iter_with_idle_timeout(chunks(), idle=0.1):
+            received.append(chunk)
+            await asyncio.sleep(0.2)
+        assert received == [b"\x00", b"\x01", b"\x02"]
+
+    @pytest.mark.asyncio
+    async def test_no_task_per_chunk(self):
+        tasks = []
+
+        async def chunks():
+            for _ in range(50):
+                await asyncio.sleep(0)
+                tasks.append(asyncio.current_task())
+                yield b"x"
+
+        async for _ in iter_with_idle_timeout(chunks(), idle=1):
+            pass
+        assert set(tasks) == {asyncio.current_task()}
+
+    @pytest.mark.asyncio
+    async def test_stall_raises(self):
+        async def chunks():
+            yield b"a"
+            await asyncio.sleep(5)
+            yield b"b"
+
+        with pytest.raises(IdleTimeout):
+            async for _ in iter_with_idle_timeout(chunks(), idle=0.1):
+                pass
+
+
+class TestIterLines:
+    """Test splitting a byte stream into lines"""
+
+    @pytest.mark.asyncio
+    async def test_lines_split_across_chunks(self):
+        async def chunks():
+            for c in [b"data: {\"a\"", b": 1}\r\n\ndata: [DO", b"NE]\n", "é".encode()[:1], "é".encode()[1:]]:
+                yield c
+
+        lines = [line async for line in iter_lines(chunks())]
+        assert lines == ['data: {"a": 1}', "", "data: [DONE]", "é"]
+
+
+class TestRealSocket:
+    """Test the timeouts against a real slow upstream"""
+
+    @pytest.mark.asyncio
+    async def test_ttfb_longer_than_idle_is_honored(self):
+        # Headers take longer than the idle timeout but arrive within the TTFB window
+        timeouts = UpstreamTimeouts(connect=1, ttfb=3, idle=0.2)
+        async with slow_server(0.6, [b"{}"], [0.0]) as url, httpx.AsyncClient() as client:
+            request = client.build_request("POST", url, timeout=timeouts.to_httpx())
+            resp, _, _ = await send_with_ttfb(client, request, timeouts, stream=False)
+        assert resp.status_code == 200 and resp.content == b"{}"
+
+    @pytest.mark.asyncio
+    async def test_ttfb_breach_raises_ttfb_timeout(self):
+        timeouts = UpstreamTimeouts(connect=1, ttfb=0.3, idle=0.1)
+        async with slow_server(2, [b"{}"], [0.0]) as url, httpx.AsyncClient() as client:
+            request = client.build_request("POST", url, timeout=timeouts.to_httpx())
+            with pytest.raises(TTFBTimeout):
+                await send_with_ttfb(client, request, timeouts, stream=True)
+
+    @pytest.mark.asyncio
+    async def test_stalled_stream_raises_idle_timeout(self):
+        timeouts = UpstreamTimeouts(connect=1, ttfb=3, idle=0.3)
+        async with slow_server(0.0, [b"data: a\n\n", b"data: b\n\n"], [0.0, 2]) as url, httpx.AsyncClient() as client:
+            request = client.build_request("POST", url, timeout=timeouts.to_httpx())
+            resp, first, rest = await send_with_ttfb(client, request, timeouts, stream=True)
+            assert first == b"data: a\n\n"
+            started = asyncio.get_running_loop().time()
+            with pytest.raises(IdleTimeout):
+                async for _ in rest:
+                    pass
+            assert asyncio.get_running_loop().time() - started < 1.5
+            await resp.aclose()
@@ -0,0 +1,95 @@
+"""
+Helpers for "-thinking" model aliases.
+Requests for `<model>-thinking` are sent upstream as `<model>` with reasoning enabled,
+and streamed reasoning deltas are surfaced to the client as content wrapped in <think> tags.
+"""
+
+import json
+from typing import Optional, AsyncIterator
+
+THINKING_SUFFIX = "-thinking"
+# Note: In OpenAI SDK, extra_body merges into the root, so 'reasoning' goes directly in the payload
+REASONING_PARAMS = {"effort": "medium", "enabled": True}
+
+THINK_OPEN = f'data: {json.dumps({"choices":[{"index":0,"delta":{"content":"<think>"}}]})}\n\n'.encode("utf-8")
+THINK_CLOSE = f'data: {json.dumps({"choices":[{"index":0,"delta":{"content":"</think>"}}]})}\n\n'.encode("utf-8")
+
+
+def rewrite_thinking_request(data: dict) -> bool:
+    """
+    Strip the -thinking suffix from data["model"] and enable reasoning, in place.
+    Returns True if the request was for a thinking model.
+    """
+    model = data.get("model")
+    if not (model and isinstance(model, str) and model.endswith(THINKING_SUFFIX)):
+        return False
+
+    data["model"] = model[:-len(THINKING_SUFFIX)]
+    data["reasoning"] = dict(REASONING_PARAMS)
+    return True
+
+
+class ThinkTagRewriter:
+    """Rewrites one upstream SSE line at a time, tracking whether a <think> block is open."""
+
+    def __init__(self):
+        self.started = False
+        self.finished = False
+
+    def _close(self) -> bytes:
+        if self.started and not self.finished:
+            self.finished = True
+            return THINK_CLOSE
+        return b""
+
+    def feed(self, line: str) -> bytes:
+        """Bytes to send downstream for `line` (without its line terminator); b"" for none."""
+        if not line.strip():
+            return b""
+
+        raw = line.encode("utf-8") + b"\n\n"
+        if not line.startswith("data: "):
+            return raw
+
+        if line.strip() == "data: [DONE]":
+            return self._close() + raw
+
+        try:
+            data = json.loads(line[6:])
+            choices = data.get("choices", [])
+            if not choices:
+                return raw
+
+            delta = choices[0].get("delta", {})
+            # Check for reasoning_content or reasoning
+            reasoning = delta.get("reasoning_content") or delta.get("reasoning")
+            content = delta.get("content")
+        except Exception:
+            # If parsing fails, pass the original line through
+            return raw
+
+        if reasoning:
+            prefix = b""
+            if not self.started:
+                prefix = THINK_OPEN
+                self.started = True
+
+            # Send reasoning as content, but also keep the original reasoning fields.
+            # This serves clients that expect <think> tags as well as clients that
+            # read reasoning_content (like LiteLLM)
+            delta["content"] = reasoning
+            return prefix + f"data: {json.dumps(data)}\n\n".encode("utf-8")
+
+        if content:
+            return self._close() + raw
+
+        return raw
+
+
+async def rewrite_thinking_stream(lines: AsyncIterator[str], rewriter: Optional[ThinkTagRewriter] = None) -> AsyncIterator[bytes]:
+    """Apply ThinkTagRewriter to a stream of SSE lines."""
+    rewriter = rewriter or ThinkTagRewriter()
+    async for line in lines:
+        out = rewriter.feed(line)
+        if out:
+            yield out
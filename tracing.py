@@ -0,0 +1,269 @@
+"""
+Per-request tracing for the Load Balancer.
+Spans are recorded with contextvars across the auth middleware, key manager and
+proxy, returned in a Server-Timing header and written to a sampled JSON log.
+Traces can also be appended to a file in the OTLP/JSON format for offline analysis.
+"""
+
+import os
+import json
+import time
+import queue
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Iterator, Optional
+
+from logger import get_logger
+
+# === Configuration ===
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+# Fraction of requests written to the JSON trace log (0 = none, 1 = all)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+# Requests slower than this are always logged (0 = disabled)
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+# Append logged traces to this file as OTLP/JSON lines (empty = disabled)
+TRACE_OTLP_FILE = os.getenv("TRACE_OTLP_FILE", "")
+# Traces waiting for the OTLP writer thread; further traces are dropped
+TRACE_OTLP_QUEUE_SIZE = int(os.getenv("TRACE_OTLP_QUEUE_SIZE", "10000"))
+
+SERVICE_NAME = "vercel-api-key-lb"
+
+logger = get_logger("tracing")
+
+_STOP = object()
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    end_ns: Optional[int] = None
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        return (end - self.start_ns) / 1e6
+
+
+class Trace:
+    """Spans recorded for one request."""
+
+    def __init__(self, method: str, path: str, sampled: bool):
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.wall_start_ns = time.time_ns()
+        self.root = Span(
+            name="request",
+            span_id=os.urandom(8).hex(),
+            parent_id=None,
+            start_ns=time.perf_counter_ns(),
+            attributes={"http.method": method, "http.path": path}
+        )
+        self.spans: list[Span] = []
+        self.finished = False
+
+    def _unix_ns(self, perf_ns: int) -> int:
+        return self.wall_start_ns + (perf_ns - self.root.start_ns)
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: finished spans summed by name, plus the time so far."""
+        totals: dict[str, float] = {}
+        for s in self.spans:
+            if s.end_ns is not None:
+                totals[s.name] = totals.get(s.name, 0.0) + s.duration_ms
+        entries = [f"{name};dur={dur:.2f}" for name, dur in totals.items()]
+        entries.append(f"total;dur={self.root.duration_ms:.2f}")
+        return ", ".join(entries)
+
+    def to_log(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "method": self.root.attributes.get("http.method"),
+            "path": self.root.attributes.get("http.path"),
+            "status": self.root.attributes.get("http.status_code"),
+            "duration_ms": round(self.root.duration_ms, 3),
+            "spans": [
+                {
+                    "name": s.name,
+                    "start_ms": round((s.start_ns - self.root.start_ns) / 1e6, 3),
+                    "duration_ms": round(s.duration_ms, 3),
+                    **({"attributes": s.attributes} if s.attributes else {})
+                }
+                for s in self.spans
+            ]
+        }
+
+    def to_otlp(self) -> dict:
+        """ExportTraceServiceRequest in the OTLP/JSON encoding."""
+        status_code = self.root.attributes.get("http.status_code") or 0
+
+        def encode(s: Span, kind: int) -> dict:
+            encoded = {
+                "traceId": self.trace_id,
+                "spanId": s.span_id,
+                "name": s.name,
+                "kind": kind,
+                "startTimeUnixNano": str(self._unix_ns(s.start_ns)),
+                "endTimeUnixNano": str(self._unix_ns(s.end_ns or s.start_ns)),
+                "attributes": [_otlp_attribute(k, v) for k, v in s.attributes.items()]
+            }
+            if s.parent_id:
+                encoded["parentSpanId"] = s.parent_id
+            return encoded
+
+        root = encode(self.root, 2)  # SPAN_KIND_SERVER
+        root["status"] = {"code": 2 if status_code >= 500 else 1}  # ERROR / OK
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+                "scopeSpans": [{
+                    "scope": {"name": "tracing"},
+                    "spans": [root] + [encode(s, 1) for s in self.spans]  # SPAN_KIND_INTERNAL
+                }]
+            }]
+        }
+
+
+def _otlp_attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        encoded = {"boolValue": value}
+    elif isinstance(value, int):
+        encoded = {"intValue": str(value)}
+    elif isinstance(value, float):
+        encoded = {"doubleValue": value}
+    else:
+        encoded = {"stringValue": str(value)}
+    return {"key": key, "value": encoded}
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+_current_span_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("span_id", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def start_trace(method: str, path: str) -> Optional[Trace]:
+    """Start a trace for the current request; spans opened in this context attach to it."""
+    if not TRACING_ENABLED:
+        return None
+    trace = Trace(method, path, sampled=random.random() < TRACE_SAMPLE_RATE)
+    _current_trace.set(trace)
+    _current_span_id.set(trace.root.span_id)
+    return trace
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """Record a span in the current trace (no-op outside a traced request)."""
+    trace = _current_trace.get()
+    if trace is None or trace.finished:
+        yield None
+        return
+
+    s = Span(
+        name=name,
+        span_id=os.urandom(8).hex(),
+        parent_id=_current_span_id.get(),
+        start_ns=time.perf_counter_ns(),
+        attributes=attributes
+    )
+    trace.spans.append(s)
+    token = _current_span_id.set(s.span_id)
+    try:
+        yield s
+    finally:
+        s.end_ns = time.perf_counter_ns()
+        _current_span_id.reset(token)
+
+
+def finish_trace(trace: Trace, status_code: int):
+    """Close the root span and write the trace if it is sampled or slow."""
+    if trace.finished:
+        return
+    trace.finished = True
+    trace.root.end_ns = time.perf_counter_ns()
+    trace.root.attributes["http.status_code"] = status_code
+
+    slow = TRACE_SLOW_MS > 0 and trace.root.duration_ms >= TRACE_SLOW_MS
+    if not (trace.sampled or slow):
+        return
+
+    logger.info("trace", extra={"trace": trace.to_log()})
+    if TRACE_OTLP_FILE:
+        otlp_exporter.export(TRACE_OTLP_FILE, trace.to_otlp())
+
+
+async def finish_after_body(trace: Trace, body: AsyncIterator, status_code: int) -> AsyncIterator:
+    """Pass a response body through and finish the trace once it has been sent."""
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        finish_trace(trace, status_code)
+
+
+class OTLPExporter:
+    """Queues OTLP/JSON traces and appends them to their file from a background thread."""
+
+    def __init__(self, queue_size: int = TRACE_OTLP_QUEUE_SIZE):
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, path: str, otlp: dict):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="otlp-exporter", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait((path, otlp))
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Write out queued traces and stop the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            # Write everything that is already queued with one open per file
+            batch = []
+            while item is not _STOP:
+                batch.append(item)
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._write(batch)
+            if item is _STOP:
+                return
+
+    def _write(self, batch: list):
+        lines: dict = {}
+        for path, otlp in batch:
+            lines.setdefault(path, []).append(json.dumps(otlp, separators=(",", ":")) + "\n")
+        for path, path_lines in lines.items():
+            try:
+                with open(path, "a", encoding="utf-8") as f:
+                    f.writelines(path_lines)
+                self.exported += len(path_lines)
+            except OSError as e:
+                self.dropped += len(path_lines)
+                logger.warning(f"⚠️  Failed to write traces to {path}: {e}")
+
+
+# Global instance
+otlp_exporter = OTLPExporter()
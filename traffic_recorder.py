@@ -0,0 +1,166 @@
+"""
+Traffic recorder for the Load Balancer.
+Appends the sanitized shape of proxied requests (sizes, flags and timing - no prompts,
+no keys) to a JSONL trace file that benchmarks/replay.py can replay against the mock gateway.
+"""
+
+import os
+import json
+import time
+import queue
+import random
+import hashlib
+import threading
+from typing import Optional, AsyncIterator
+
+from fastapi.responses import Response, StreamingResponse
+
+from logger import get_logger
+from thinking import THINKING_SUFFIX
+
+# === Configuration ===
+# Append request shapes to this JSONL file (empty = disabled)
+TRAFFIC_RECORD_FILE = os.getenv("TRAFFIC_RECORD_FILE", "")
+TRAFFIC_RECORD_SAMPLE_RATE = float(os.getenv("TRAFFIC_RECORD_SAMPLE_RATE", "1.0"))
+# Records waiting for the writer thread; further records are dropped
+TRAFFIC_RECORD_QUEUE_SIZE = int(os.getenv("TRAFFIC_RECORD_QUEUE_SIZE", "10000"))
+
+logger = get_logger("traffic_recorder")
+
+_STOP = object()
+
+
+def request_shape(
+    method: str,
+    path: str,
+    data: Optional[dict],
+    model: Optional[str],
+    body_size: int,
+    client_key_id: Optional[str]
+) -> dict:
+    """The replayable, content-free description of a request."""
+    data = data if isinstance(data, dict) else {}
+    model = model if isinstance(model, str) else None
+    messages = data.get("messages")
+    shape = {
+        "ts": round(time.time(), 3),
+        "method": method,
+        "path": f"/{path}",
+        "model": model,
+        "stream": bool(data.get("stream")),
+        "think": bool(model and model.endswith(THINKING_SUFFIX)),
+        "in": body_size,
+        # Stable per client key, but not reversible to the key or its id
+        "key": hashlib.sha256(client_key_id.encode()).hexdigest()[:8] if client_key_id else None,
+    }
+    if isinstance(messages, list):
+        shape["msgs"] = len(messages)
+    if isinstance(data.get("max_tokens"), int):
+        shape["max_tokens"] = data["max_tokens"]
+    return shape
+
+
+class TrafficRecorder:
+    """Queues completed request records and writes them from a background thread."""
+
+    def __init__(
+        self,
+        path: str = TRAFFIC_RECORD_FILE,
+        sample_rate: float = TRAFFIC_RECORD_SAMPLE_RATE,
+        queue_size: int = TRAFFIC_RECORD_QUEUE_SIZE
+    ):
+        self.path = path
+        self.sample_rate = sample_rate
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self.recorded = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="traffic-recorder", daemon=True)
+        self._thread.start()
+        logger.info(f"Recording traffic to {self.path}")
+
+    def stop(self):
+        """Write out queued records and stop the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def should_record(self) -> bool:
+        return self._thread is not None and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def track(self, response: Response, shape: dict, started: float) -> Response:
+        """Record `shape` with the response's status, size and timing once the body has been sent."""
+        if isinstance(response, StreamingResponse):
+            response.body_iterator = self._track_stream(response.body_iterator, shape, response.status_code, started)
+            return response
+
+        elapsed = round((time.perf_counter() - started) * 1000, 1)
+        self._put({**shape, "status": response.status_code, "out": len(response.body), "ttfb_ms": elapsed, "ms": elapsed})
+        return response
+
+    async def _track_stream(self, chunks: AsyncIterator[bytes], shape: dict, status: int, started: float) -> AsyncIterator[bytes]:
+        sent = 0
+        ttfb = None
+        try:
+            async for chunk in chunks:
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                sent += len(chunk)
+                yield chunk
+        finally:
+            elapsed = time.perf_counter() - started
+            self._put({
+                **shape,
+                "status": status,
+                "out": sent,
+                "ttfb_ms": round((ttfb if ttfb is not None else elapsed) * 1000, 1),
+                "ms": round(elapsed * 1000, 1)
+            })
+
+    def _put(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                record = self._queue.get()
+                # Write everything that is already queued, then flush once
+                while record is not _STOP:
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                    self.recorded += 1
+                    try:
+                        record = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                f.flush()
+                if record is _STOP:
+                    return
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "path": self.path or None,
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "queued": self._queue.qsize()
+        }
+
+
+# Global instance
+traffic_recorder = TrafficRecorder()
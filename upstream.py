@@ -0,0 +1,191 @@
+"""
+Upstream request helpers for the Load Balancer.
+Phase-specific timeouts (connect, time-to-first-byte, idle) for calls to the Vercel AI Gateway.
+"""
+
+import os
+import json
+import codecs
+import asyncio
+from dataclasses import dataclass
+from typing import Optional, AsyncIterator
+
+import httpx
+
+from logger import get_logger
+
+# === Configuration ===
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+# Streaming: response headers + first body chunk must arrive within this window
+UPSTREAM_TTFB_TIMEOUT = float(os.getenv("UPSTREAM_TTFB_TIMEOUT", "60"))
+# Non-streaming: the whole generation happens before the first byte, so allow more
+UPSTREAM_NON_STREAM_TTFB_TIMEOUT = float(os.getenv("UPSTREAM_NON_STREAM_TTFB_TIMEOUT", "300"))
+# Maximum gap between two chunks of an upstream response
+UPSTREAM_IDLE_TIMEOUT = float(os.getenv("UPSTREAM_IDLE_TIMEOUT", "60"))
+# How many other Vercel keys to try after a TTFB breach (0 = no retry)
+UPSTREAM_TTFB_RETRIES = int(os.getenv("UPSTREAM_TTFB_RETRIES", "1"))
+# Per-model overrides, e.g. {"openai/o3": {"ttfb": 180}, "anthropic/*": {"idle": 120}}
+UPSTREAM_TIMEOUT_OVERRIDES = os.getenv("UPSTREAM_TIMEOUT_OVERRIDES", "")
+
+logger = get_logger("upstream")
+
+
+@dataclass(frozen=True)
+class UpstreamTimeouts:
+    connect: float
+    ttfb: float
+    idle: float
+
+    def to_httpx(self) -> httpx.Timeout:
+        """
+        Per-operation httpx timeout. httpx's read timeout also covers the wait for the
+        response headers, so it must allow the whole TTFB window; the idle timeout between
+        body chunks is enforced separately by iter_with_idle_timeout.
+        """
+        return httpx.Timeout(
+            connect=self.connect,
+            read=max(self.ttfb, self.idle),
+            write=self.idle,
+            pool=self.connect
+        )
+
+
+class TTFBTimeout(Exception):
+    """The upstream did not send its first byte within the TTFB timeout."""
+
+
+class IdleTimeout(Exception):
+    """The upstream stream went quiet for longer than the idle timeout."""
+
+
+def load_timeout_overrides(raw: str) -> dict[str, dict]:
+    """Parse the per-model timeout overrides JSON. Invalid input is ignored."""
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        logger.warning("⚠️  UPSTREAM_TIMEOUT_OVERRIDES is not valid JSON, ignoring")
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {k: v for k, v in data.items() if isinstance(v, dict)}
+
+
+_overrides = load_timeout_overrides(UPSTREAM_TIMEOUT_OVERRIDES)
+
+
+def _find_override(model: Optional[str], overrides: dict[str, dict]) -> dict:
+    """Find the override for a model: exact match first, then the longest matching "prefix*"."""
+    if not model:
+        return {}
+    if model in overrides:
+        return overrides[model]
+
+    best = ""
+    for pattern in overrides:
+        if pattern.endswith("*") and model.startswith(pattern[:-1]) and len(pattern) > len(best):
+            best = pattern
+    return overrides[best] if best else {}
+
+
+def resolve_timeouts(
+    model: Optional[str],
+    is_stream: bool,
+    overrides: Optional[dict[str, dict]] = None
+) -> UpstreamTimeouts:
+    """Resolve the timeouts for a request to the given model."""
+    override = _find_override(model, _overrides if overrides is None else overrides)
+
+    if is_stream:
+        ttfb = override.get("ttfb", UPSTREAM_TTFB_TIMEOUT)
+    else:
+        ttfb = override.get("non_stream_ttfb", UPSTREAM_NON_STREAM_TTFB_TIMEOUT)
+
+    return UpstreamTimeouts(
+        connect=float(override.get("connect", UPSTREAM_CONNECT_TIMEOUT)),
+        ttfb=float(ttfb),
+        idle=float(override.get("idle", UPSTREAM_IDLE_TIMEOUT))
+    )
+
+
+async def send_with_ttfb(
+    client: httpx.AsyncClient,
+    request: httpx.Request,
+    timeouts: UpstreamTimeouts,
+    stream: bool
+) -> tuple[httpx.Response, bytes, Optional[AsyncIterator[bytes]]]:
+    """
+    Send a request and wait for the first byte within the TTFB timeout.
+
+    For streaming requests returns (response, first_chunk, remaining_chunks) with the
+    response still open; the remaining chunks raise IdleTimeout if the stream stalls.
+    For non-streaming requests the body is read fully and returned as (response, b"", None).
+    Raises TTFBTimeout if the deadline passes; the response is closed in that case.
+    """
+    resp: Optional[httpx.Response] = None
+
+    async def _first_byte():
+        nonlocal resp
+        resp = await client.send(request, stream=stream)
+        if not stream:
+            return resp, b"", None
+
+        chunks = resp.aiter_bytes()
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = b""
+        return resp, first, iter_with_idle_timeout(chunks, timeouts.idle)
+
+    try:
+        return await asyncio.wait_for(_first_byte(), timeout=timeouts.ttfb)
+    except asyncio.TimeoutError:
+        if resp is not None:
+            await resp.aclose()
+        raise TTFBTimeout(f"No response from upstream within {timeouts.ttfb:g}s") from None
+
+
+async def iter_with_idle_timeout(chunks: AsyncIterator[bytes], idle: float) -> AsyncIterator[bytes]:
+    """Yield chunks, raising IdleTimeout when the next one takes longer than `idle` seconds."""
+    # One timeout for the whole stream, re-armed per chunk, rather than a task and
+    # a timer per chunk. It is disarmed while the consumer holds a chunk.
+    loop = asyncio.get_running_loop()
+    try:
+        async with asyncio.timeout(None) as deadline:
+            while True:
+                deadline.reschedule(loop.time() + idle)
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    return
+                deadline.reschedule(None)
+                yield chunk
+    except TimeoutError:
+        raise IdleTimeout(f"No data from upstream for {idle:g}s") from None
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream into text lines (without line terminators)."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buffer = ""
+
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def prepend_chunk(first: bytes, chunks: Optional[AsyncIterator[bytes]]) -> AsyncIterator[bytes]:
+    """Yield an already-read first chunk followed by the rest of the stream."""
+    if first:
+        yield first
+    if chunks is not None:
+        async for chunk in chunks:
+            yield chunk